@@ -72,6 +72,5 @@ CELL_IMAGE_SIZES = [
     1024,
 ]
 
-# Define the cache directory
+# Define the cache directory (created on first download, not at import time)
 CACHE_DIR = Path(os.getenv("CELLVIT_CACHE", str(Path.home() / ".cache" / "cellvit")))
-CACHE_DIR.mkdir(parents=True, exist_ok=True)
@@ -8,6 +8,7 @@
 # University Medicine Essen
 
 from dataclasses import dataclass
+from typing import Optional
 
 import torch
 
@@ -22,9 +23,15 @@ class CellGraphDataWSI:
             be it detected cells or extracted patches. That's why we store the 2D position here, globally for the WSI.
             Shape (num_nodes, 2)
         metadata (dict, optional): Metadata about the object is stored here. Defaults to None
+        nuclei_types (torch.Tensor): Cell type of each node. Shape (num_nodes)
+        edge_index (torch.Tensor, optional): Spatial edges between the nodes (source, target), see
+            cellvit.inference.graph_edges. Shape (2, num_edges). Defaults to None
+        edge_attr (torch.Tensor, optional): Euclidean length of each edge. Shape (num_edges, 1). Defaults to None
     """
 
     x: torch.Tensor
     positions: torch.Tensor
     metadata: dict
     nuclei_types: torch.Tensor
+    edge_index: Optional[torch.Tensor] = None
+    edge_attr: Optional[torch.Tensor] = None
@@ -5,12 +5,352 @@
 # Institute for Artifical Intelligence in Medicine,
 # University Medicine Essen
 
-from cellvit.inference.cli import InferenceWSIParser, get_user_input_with_timeout
-from cellvit.inference.inference import CellViTInference
-from cellvit.utils.ressource_manager import SystemConfiguration
+# torch, ray and the inference pipeline are imported after the arguments have been parsed
+# and validated, such that the help message and configuration errors are shown fast
+
+from cellvit.inference.cli import InferenceWSIParser
+from cellvit.utils.sharding import select_shard, shard_ledger_name
+from cellvit.utils.work_queue import WorkQueue
+from functools import partial
 from pathlib import Path
-import ujson as json
-import numpy as np
+from typing import TYPE_CHECKING, Callable, List, Tuple, Union
+import math
+import time
+import uuid
+
+if TYPE_CHECKING:
+    from cellvit.inference.inference import CellViTInference
+
+
+def process_dataset_wsi(
+    celldetector: "CellViTInference",
+    wsi_path: Path,
+    wsi_mpp: float = None,
+    wsi_magnification: float = None,
+    skip_failed: bool = False,
+    on_complete: Callable[[], None] = None,
+    on_error: Callable[[str], None] = None,
+) -> Union[str, None]:
+    """Process one WSI of a dataset, skipping it if the run ledger marks it as finished
+
+    Errors are logged (and recorded in the run ledger) without aborting the dataset.
+
+    Args:
+        celldetector (CellViTInference): Inference pipeline
+        wsi_path (Path): Path to the WSI
+        wsi_mpp (float, optional): Microns per pixel override. Defaults to None.
+        wsi_magnification (float, optional): Magnification override. Defaults to None.
+        skip_failed (bool, optional): Skip WSI whose last attempt failed instead of retrying them. Defaults to False.
+        on_complete (Callable[[], None], optional): Called after all outputs are written. Defaults to None.
+        on_error (Callable[[str], None], optional): Called with the error message if processing failed. Defaults to None.
+
+    Returns:
+        Union[str, None]: Status in the run ledger if the WSI has been skipped ("finished" or "failed"), else None
+    """
+    try:
+        status = celldetector.run_status(wsi_path, wsi_mpp, wsi_magnification)
+    except Exception as e:
+        celldetector.logger.error(f"Processing {Path(wsi_path).name} failed: {e!r}")
+        if on_error is not None:
+            on_error(repr(e))
+        return None
+    if status == "finished" or (status == "failed" and skip_failed):
+        celldetector.logger.info(
+            f"Skipping {Path(wsi_path).name}, {status} with the same configuration"
+        )
+        return status
+    try:
+        celldetector.process_wsi(
+            wsi_path=wsi_path,
+            wsi_mpp=wsi_mpp,
+            wsi_magnification=wsi_magnification,
+            on_complete=on_complete,
+            on_error=on_error,
+        )
+    except Exception as e:
+        celldetector.logger.error(f"Processing {Path(wsi_path).name} failed: {e!r}")
+
+
+def process_dataset_group(
+    celldetector: "CellViTInference",
+    wsi_jobs: List[dict],
+    skip_failed: bool = False,
+) -> List[Union[str, None]]:
+    """Process multiple WSI of a dataset together (patches packed into full batches), skipping WSI marked as finished
+
+    Errors are logged (and recorded in the run ledger) without aborting the dataset.
+
+    Args:
+        celldetector (CellViTInference): Inference pipeline
+        wsi_jobs (List[dict]): WSI to process, see CellViTInference.process_wsi_group
+        skip_failed (bool, optional): Skip WSI whose last attempt failed instead of retrying them. Defaults to False.
+
+    Returns:
+        List[Union[str, None]]: Status in the run ledger of each WSI if it has been skipped ("finished" or "failed"), else None
+    """
+    statuses = []
+    group = []
+    for job in wsi_jobs:
+        try:
+            status = celldetector.run_status(
+                job["wsi_path"], job.get("wsi_mpp"), job.get("wsi_magnification")
+            )
+        except Exception as e:
+            celldetector.logger.error(
+                f"Processing {Path(job['wsi_path']).name} failed: {e!r}"
+            )
+            if job.get("on_error") is not None:
+                job["on_error"](repr(e))
+            statuses.append(None)
+            continue
+        if status == "finished" or (status == "failed" and skip_failed):
+            celldetector.logger.info(
+                f"Skipping {Path(job['wsi_path']).name}, {status} with the same configuration"
+            )
+            statuses.append(status)
+        else:
+            group.append(job)
+            statuses.append(None)
+    if len(group) == 0:
+        return statuses
+    try:
+        celldetector.process_wsi_group(group)
+    except Exception as e:
+        celldetector.logger.error(
+            f"Processing {', '.join(Path(job['wsi_path']).name for job in group)} failed: {e!r}"
+        )
+    return statuses
+
+
+def process_work_queue(
+    celldetector: "CellViTInference",
+    wsi_jobs: List[Tuple[Path, Union[float, None], Union[float, None]]],
+    lease_timeout: float = 600,
+    skip_failed: bool = False,
+    pack_slides: int = 1,
+    queue_path: Path = None,
+) -> None:
+    """Process WSI pulled from the work queue in the output directory, until the queue is empty
+
+    The WSI of the dataset are added to the queue (WSI already queued by other processes are ignored).
+    Each pulled WSI is leased until its outputs are written, failed WSI are released for a retry.
+
+    Args:
+        celldetector (CellViTInference): Inference pipeline
+        wsi_jobs (List[Tuple[Path, Union[float, None], Union[float, None]]]): WSI path, mpp and magnification override of the dataset
+        lease_timeout (float, optional): Seconds after which the lease of a WSI expires if the process is dead. Defaults to 600.
+        skip_failed (bool, optional): Skip WSI whose last attempt failed instead of retrying them. Defaults to False.
+        pack_slides (int, optional): Number of WSI leased and processed together (patches packed into full batches). Defaults to 1.
+        queue_path (Path, optional): Path to the queue. Defaults to None (outdir/work_queue.sqlite).
+    """
+    queue_path = (
+        celldetector.outdir / "work_queue.sqlite" if queue_path is None else queue_path
+    )
+    queue = WorkQueue(queue_path, lease_timeout=lease_timeout)
+    num_added = queue.add(wsi_jobs, logger=celldetector.logger)
+    celldetector.logger.info(
+        f"Work queue: added {num_added} WSI ({len(wsi_jobs) - num_added} already queued or unreadable)"
+    )
+    queue.start_heartbeat()
+    try:
+        while (job := queue.lease()) is not None:
+            jobs = [job]
+            while len(jobs) < pack_slides and (job := queue.lease()) is not None:
+                jobs.append(job)
+            progress = queue.progress()
+            celldetector.logger.info(
+                f"Progress: {progress['finished']} finished, {progress['leased']} in progress, "
+                f"{progress['pending']} pending, {progress['failed']} failed"
+            )
+            if pack_slides == 1:
+                wsi_path, wsi_mpp, wsi_magnification = jobs[0]
+                statuses = [
+                    process_dataset_wsi(
+                        celldetector,
+                        wsi_path=wsi_path,
+                        wsi_mpp=wsi_mpp,
+                        wsi_magnification=wsi_magnification,
+                        skip_failed=skip_failed,
+                        on_complete=partial(queue.complete, wsi_path),
+                        on_error=partial(queue.release, wsi_path),
+                    )
+                ]
+            else:
+                statuses = process_dataset_group(
+                    celldetector,
+                    [
+                        {
+                            "wsi_path": wsi_path,
+                            "wsi_mpp": wsi_mpp,
+                            "wsi_magnification": wsi_magnification,
+                            "on_complete": partial(queue.complete, wsi_path),
+                            "on_error": partial(queue.release, wsi_path),
+                        }
+                        for wsi_path, wsi_mpp, wsi_magnification in jobs
+                    ],
+                    skip_failed=skip_failed,
+                )
+            for (wsi_path, _, _), skipped in zip(jobs, statuses):
+                if skipped == "finished":
+                    queue.complete(wsi_path)
+                elif skipped == "failed":
+                    queue.release(wsi_path, "Failed before (skip_failed)", retry=False)
+        # leases are held until the outputs are written
+        celldetector.flush_outputs()
+    finally:
+        queue.close()
+
+
+def split_cleaning_workers(cleaning_workers: int, num_processes: int) -> int:
+    """Cleaning workers of one of multiple inference processes sharing the host
+
+    The cleaning workers are divided evenly, each process keeps at least one if cleaning workers are enabled.
+
+    Args:
+        cleaning_workers (int): Number of cleaning workers of the host (0 cleans in the inference process)
+        num_processes (int): Number of processes
+
+    Returns:
+        int: Number of cleaning workers of one process
+    """
+    if cleaning_workers == 0:
+        return 0
+    return max(1, cleaning_workers // num_processes)
+
+
+def _parallel_slides_worker(
+    inference_kwargs: dict,
+    shared_model: dict,
+    ray_address: str,
+    queue_path: Path,
+    wsi_jobs: List[Tuple[Path, Union[float, None], Union[float, None]]],
+    lease_timeout: float,
+    skip_failed: bool,
+    pack_slides: int,
+) -> None:
+    """Worker process of process_parallel_slides: pull WSI from the queue until it is empty
+
+    Args:
+        inference_kwargs (dict): Arguments of CellViTInference, with the system configuration of the worker
+        shared_model (dict): Model with weights in shared memory (see CellViTInference.share_model)
+        ray_address (str): Address of the Ray cluster of the main process
+        queue_path (Path): Path to the work queue
+        wsi_jobs (List[Tuple[Path, Union[float, None], Union[float, None]]]): WSI path, mpp and magnification override of the dataset
+        lease_timeout (float): Seconds after which the lease of a WSI expires if the process is dead
+        skip_failed (bool): Skip WSI whose last attempt failed instead of retrying them
+        pack_slides (int): Number of WSI processed together (patches packed into full batches)
+    """
+    import torch
+
+    from cellvit.inference.inference import CellViTInference
+
+    torch.set_num_threads(inference_kwargs["system_configuration"]["cpu_count"])
+    celldetector = CellViTInference(
+        **inference_kwargs, shared_model=shared_model, ray_address=ray_address
+    )
+    try:
+        process_work_queue(
+            celldetector,
+            wsi_jobs,
+            lease_timeout=lease_timeout,
+            skip_failed=skip_failed,
+            pack_slides=pack_slides,
+            queue_path=queue_path,
+        )
+    finally:
+        celldetector.close()
+
+
+def process_parallel_slides(
+    celldetector: "CellViTInference",
+    inference_kwargs: dict,
+    wsi_jobs: List[Tuple[Path, Union[float, None], Union[float, None]]],
+    parallel_slides: int,
+    lease_timeout: float = 600,
+    skip_failed: bool = False,
+    pack_slides: int = 1,
+    work_queue: bool = False,
+) -> None:
+    """Process the WSI of a dataset with multiple worker processes on this host, sharing the model weights
+
+    The weights of the loaded model are moved to shared memory and handed over to the workers without copying them.
+    The workers connect to the Ray cluster of this process and split its CPU cores, Ray workers and cleaning workers.
+    They pull the WSI from a work queue (largest first): the shared queue in the output directory if work_queue
+    is set (multiple hosts), else a private queue removed afterwards.
+
+    Args:
+        celldetector (CellViTInference): Inference pipeline of this process, providing the model and the Ray cluster
+        inference_kwargs (dict): Arguments of CellViTInference
+        wsi_jobs (List[Tuple[Path, Union[float, None], Union[float, None]]]): WSI path, mpp and magnification override of the dataset
+        parallel_slides (int): Number of worker processes
+        lease_timeout (float, optional): Seconds after which the lease of a WSI expires if the process is dead. Defaults to 600.
+        skip_failed (bool, optional): Skip WSI whose last attempt failed instead of retrying them. Defaults to False.
+        pack_slides (int, optional): Number of WSI processed together by each worker. Defaults to 1.
+        work_queue (bool, optional): Use the shared work queue in the output directory. Defaults to False.
+
+    Raises:
+        RuntimeError: If a worker process exited with an error (WSI of the dataset might not have been processed)
+    """
+    import ray
+    import torch
+
+    if work_queue:
+        queue_path = celldetector.outdir / "work_queue.sqlite"
+    else:
+        queue_path = (
+            celldetector.outdir / f"parallel_queue_{uuid.uuid4().hex[:8]}.sqlite"
+        )
+    queue = WorkQueue(queue_path, lease_timeout=lease_timeout)
+    queue.add(wsi_jobs, logger=celldetector.logger)
+    queue.close()
+
+    worker_kwargs = {
+        **inference_kwargs,
+        "system_configuration": celldetector.system_configuration.split_between_processes(
+            parallel_slides
+        ),
+        "cleaning_workers": split_cleaning_workers(
+            inference_kwargs.get("cleaning_workers", 0), parallel_slides
+        ),
+    }
+    shared_model = celldetector.share_model()
+    ray_address = ray.get_runtime_context().gcs_address
+    celldetector.logger.info(
+        f"Starting {parallel_slides} worker processes with "
+        f"{worker_kwargs['system_configuration']['cpu_count']} CPUs and "
+        f"{worker_kwargs['system_configuration']['ray_worker']} Ray workers each"
+    )
+    context = torch.multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(
+            target=_parallel_slides_worker,
+            args=(
+                worker_kwargs,
+                shared_model,
+                ray_address,
+                queue_path,
+                wsi_jobs,
+                lease_timeout,
+                skip_failed,
+                pack_slides,
+            ),
+            name=f"cellvit-worker-{worker_index}",
+        )
+        for worker_index in range(parallel_slides)
+    ]
+    try:
+        [worker.start() for worker in workers]
+        [worker.join() for worker in workers]
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        if not work_queue:
+            queue_path.unlink(missing_ok=True)
+    failed_workers = [worker.name for worker in workers if worker.exitcode != 0]
+    if len(failed_workers) > 0:
+        celldetector.logger.error(f"Worker processes failed: {failed_workers}")
+        raise RuntimeError(f"Worker processes failed: {failed_workers}")
 
 
 def main():
@@ -19,6 +359,9 @@ def main():
     args = configuration_parser.parse_arguments()
     command = args["command"]
 
+    from cellvit.inference.inference import CellViTInference
+    from cellvit.utils.ressource_manager import SystemConfiguration
+
     # set up ressource manager
     system_configuration = SystemConfiguration(gpu=args["gpu"])
     if args["cpu_count"] is not None:
@@ -31,19 +374,56 @@ def main():
         system_configuration.overwrite_memory(args["memory"])
     system_configuration.log_system_configuration()
 
+    # each shard of a job array has its own run ledger (see cellvit-merge-runs)
+    ledger_path = None
+    if command.lower() == "process_dataset" and args["num_shards"] is not None:
+        ledger_path = Path(args["outdir"]) / shard_ledger_name(
+            args["shard_index"], args["num_shards"]
+        )
+
     # set up inference pipeline
-    celldetector = CellViTInference(
+    inference_kwargs = dict(
         model_name=args["model"],
         outdir=args["outdir"],
         system_configuration=system_configuration,
         nuclei_taxonomy=args["nuclei_taxonomy"],
         batch_size=args["batch_size"],
+        weight_cache=args["weight_cache"],
+        weight_dtype=args["weight_dtype"],
+        compile_model=args["compile_model"],
+        artifact_cache_size=args["artifact_cache_size"],
         geojson=args["geojson"],
         graph=args["graph"],
         compression=args["compression"],
+        compression_codec=args["compression_codec"],
+        compression_level=args["compression_level"],
+        compression_threads=args["compression_threads"],
         enforce_amp=args["enforce_amp"],
+        cell_cleaner=args["cell_cleaner"],
+        cell_cleaner_strategy=args["cell_cleaner_strategy"],
+        cell_cleaner_radius=args["cell_cleaner_radius"],
+        cleaning_workers=args["cleaning_workers"],
+        file_format=args["file_format"],
+        background_writer=args["background_writer"],
+        spatial_index=args["spatial_index"],
+        tile_size=args["tile_size"],
+        graph_format=args["graph_format"],
+        graph_dtype=args["graph_dtype"],
+        graph_edges=args["graph_edges"],
+        graph_edge_k=args["graph_edge_k"],
+        graph_edge_radius=args["graph_edge_radius"],
+        detection_only=args["detection_only"],
+        detection_engine=args["detection_engine"],
+        detection_validation_interval=args["detection_validation_interval"],
+        instance_map=args["instance_map"],
+        instance_map_levels=args["instance_map_levels"],
+        contour_encoding=args["contour_encoding"],
+        contour_precision=args["contour_precision"],
+        contour_tolerance=args["contour_tolerance"],
+        ledger_path=ledger_path,
         debug=args["debug"],
     )
+    celldetector = CellViTInference(**inference_kwargs)
 
     if command.lower() == "process_wsi":
         celldetector.logger.info("Processing single WSI file")
@@ -55,6 +435,8 @@ def main():
 
     elif command.lower() == "process_dataset":
         celldetector.logger.info("Processing whole dataset")
+        start_time = time.time()
+        wsi_jobs = []
         if args["wsi_filelist"] is not None:
             celldetector.logger.info(f"Loading files from filelist")
             args["wsi_filelist"]["path"] = args["wsi_filelist"]["path"].apply(
@@ -83,39 +465,14 @@ def main():
             args["wsi_filelist"] = (
                 args["wsi_filelist"].loc[wsi_index_keep].reset_index(drop=True)
             )
-            # check if files are already processed
-            if (celldetector.outdir / "processed_files.json").exists():
-                processed_files = []
-                with open(celldetector.outdir / "processed_files.json", "r") as f:
-                    processed_files = json.load(f)
-                if len(processed_files) != 0:
-                    celldetector.logger.info(
-                        f"Found processed files: {len(processed_files)}"
-                    )
-                    remove_files = get_user_input_with_timeout(
-                        f"Should the {len(processed_files)} found files be removed from the processing stack?"
-                    )
-                    if remove_files:
-                        print("\n")
-                        args.wsi_filelist = args["wsi_filelist"][
-                            ~args["wsi_filelist"]["filename"].isin(processed_files)
-                        ]
-
-                        celldetector.logger.info(
-                            f"New processing amount: {len(args['wsi_filelist'])}"
-                        )
-
             for wsi_index in range(len(args["wsi_filelist"])):
-                celldetector.logger.info(
-                    f"Progress: {wsi_index+1}/{len(args['wsi_filelist'])}"
-                )
                 wsi_path = args["wsi_filelist"].iloc[wsi_index]["path"]
                 column_names = list(args["wsi_filelist"].columns)
 
                 if "wsi_mpp" in column_names:
                     wsi_mpp = args["wsi_filelist"].iloc[wsi_index]["wsi_mpp"]
                     if wsi_mpp is not None:
-                        if np.isnan(wsi_mpp):
+                        if math.isnan(wsi_mpp):
                             wsi_mpp = None
                         if args["wsi_mpp"]:
                             wsi_mpp = args["wsi_mpp"]
@@ -131,7 +488,7 @@ def main():
                         "wsi_magnification"
                     ]
                     if wsi_magnification is not None:
-                        if np.isnan(wsi_magnification):
+                        if math.isnan(wsi_magnification):
                             wsi_magnification = None
                             if args["wsi_magnification"]:
                                 wsi_magnification = args["wsi_magnification"]
@@ -143,11 +500,7 @@ def main():
                 else:
                     wsi_magnification = None
 
-                celldetector.process_wsi(
-                    wsi_path=wsi_path,
-                    wsi_mpp=wsi_mpp,
-                    wsi_magnification=wsi_magnification,
-                )
+                wsi_jobs.append((Path(wsi_path), wsi_mpp, wsi_magnification))
 
         elif args["wsi_folder"] is not None:
             celldetector.logger.info(
@@ -183,38 +536,77 @@ def main():
                 ]
             celldetector.logger.info(f"Found {len(wsi_filelist)} files inside folder")
 
-            # check if files are already processed
-            if (celldetector.outdir / "processed_files.json").exists():
-                processed_files = []
-                with open(celldetector.outdir / "processed_files.json", "r") as f:
-                    processed_files = json.load(f)
-                if len(processed_files) != 0:
-                    celldetector.logger.info(
-                        f"Found processed files: {len(processed_files)}"
-                    )
-                    remove_files = get_user_input_with_timeout(
-                        f"Should the {len(processed_files)} found files be removed from the processing stack?"
-                    )
-                    if remove_files:
-                        print("\n")
-                        wsi_filelist = [
-                            f for f in wsi_filelist if f.name not in processed_files
-                        ]
-                        celldetector.logger.info(
-                            f"New processing amount: {len(wsi_filelist)}"
-                        )
-
-            for wsi_index, wsi in enumerate(wsi_filelist):
-                celldetector.logger.info(f"Progress: {wsi_index+1}/{len(wsi_filelist)}")
-                wsi_path = Path(wsi)
-
-                celldetector.process_wsi(
-                    wsi_path=wsi_path,
-                    wsi_mpp=args["wsi_mpp"],
-                    wsi_magnification=args["wsi_magnification"],
-                )
+            for wsi in wsi_filelist:
+                wsi_jobs.append((Path(wsi), args["wsi_mpp"], args["wsi_magnification"]))
         else:
             raise ValueError("Provide either filelist or wsi_folder.")
+
+        if args["num_shards"] is not None:
+            wsi_jobs = select_shard(wsi_jobs, args["shard_index"], args["num_shards"])
+            celldetector.logger.info(
+                f"Processing shard {args['shard_index']+1}/{args['num_shards']} with {len(wsi_jobs)} WSI"
+            )
+
+        if args["parallel_slides"] > 1:
+            process_parallel_slides(
+                celldetector,
+                inference_kwargs,
+                wsi_jobs,
+                parallel_slides=args["parallel_slides"],
+                lease_timeout=args["lease_timeout"],
+                skip_failed=args["skip_failed"],
+                pack_slides=args["pack_slides"],
+                work_queue=args["work_queue"],
+            )
+        elif args["work_queue"]:
+            celldetector.logger.info("Pulling WSI from the work queue")
+            process_work_queue(
+                celldetector,
+                wsi_jobs,
+                lease_timeout=args["lease_timeout"],
+                skip_failed=args["skip_failed"],
+                pack_slides=args["pack_slides"],
+            )
+        elif args["pack_slides"] > 1:
+            for group_start in range(0, len(wsi_jobs), args["pack_slides"]):
+                group = wsi_jobs[group_start : group_start + args["pack_slides"]]
+                celldetector.logger.info(
+                    f"Progress: {group_start+1}-{group_start+len(group)}/{len(wsi_jobs)}"
+                )
+                process_dataset_group(
+                    celldetector,
+                    [
+                        {
+                            "wsi_path": wsi_path,
+                            "wsi_mpp": wsi_mpp,
+                            "wsi_magnification": wsi_magnification,
+                        }
+                        for wsi_path, wsi_mpp, wsi_magnification in group
+                    ],
+                    skip_failed=args["skip_failed"],
+                )
+        else:
+            for wsi_index, (wsi_path, wsi_mpp, wsi_magnification) in enumerate(
+                wsi_jobs
+            ):
+                celldetector.logger.info(f"Progress: {wsi_index+1}/{len(wsi_jobs)}")
+                process_dataset_wsi(
+                    celldetector,
+                    wsi_path=wsi_path,
+                    wsi_mpp=wsi_mpp,
+                    wsi_magnification=wsi_magnification,
+                    skip_failed=args["skip_failed"],
+                )
+    celldetector.flush_outputs()
+    if command.lower() == "process_dataset":
+        report = celldetector.ledger.summary(since=start_time)
+        celldetector.logger.info(
+            f"Processed {report['num_finished']} WSI ({report['num_failed']} failed) with "
+            f"{report['slides_per_hour']:.2f} WSI/h and {report['cells_per_second']:.1f} cells/s"
+        )
+        for slide, error in celldetector.ledger.failures(since=start_time):
+            celldetector.logger.warning(f"Failed: {slide} ({error})")
+    celldetector.close()
     celldetector.logger.info("Finished processing")
 
 
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# Packing patches of multiple WSI into full batches
+#
+# Small slides (e.g., needle biopsies) have fewer patches than a batch. If each slide is
+# processed on its own, the last batch of every slide is underfilled and the model runs far
+# below its throughput. The packer concatenates the patch streams of several slides: a batch
+# is filled with the remaining patches of one slide and continued with the next one. Each
+# patch is tagged with the index of its slide, such that the results can be handed over to
+# the stitcher (sink) of the respective slide.
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union
+
+import numpy as np
+import torch
+
+
+@dataclass
+class PackedBatch:
+    """Batch with patches of one or multiple slides
+
+    Args:
+        patches (Union[torch.Tensor, list]): Patches, shape (num_patches, 3, H, W). Empty list if all patches of the batch have been discarded.
+        metadata (List[dict]): Metadata of each patch
+        slide_indices (List[int]): Index of the slide of each patch
+        discarded (Dict[int, List[Tuple[int, int]]]): Patches (row, col) of each slide that have been skipped by the dataloader
+        finished (List[int]): Slides without remaining patches
+    """
+
+    patches: Union[torch.Tensor, list]
+    metadata: List[dict]
+    slide_indices: List[int]
+    discarded: Dict[int, List[Tuple[int, int]]] = field(default_factory=dict)
+    finished: List[int] = field(default_factory=list)
+
+    def slide_slices(self) -> List[Tuple[int, slice]]:
+        """Contiguous patch range of each slide in the batch
+
+        Returns:
+            List[Tuple[int, slice]]: Slide index and patch range
+        """
+        slices = []
+        start = 0
+        for idx in range(1, len(self.slide_indices) + 1):
+            if (
+                idx == len(self.slide_indices)
+                or self.slide_indices[idx] != self.slide_indices[start]
+            ):
+                slices.append((self.slide_indices[start], slice(start, idx)))
+                start = idx
+        return slices
+
+
+@dataclass
+class SlideInferenceState:
+    """State of a WSI during the (packed) inference
+
+    Args:
+        wsi_path (Path): Path to the WSI
+        run_id (int): Run id of the attempt in the run ledger
+        fail (Callable[[str], None]): Records a failure (run ledger and callback of the caller)
+        on_complete (Callable[[], None]): Callback of the caller after all outputs are written
+        start_time (float): Start of the processing (unix timestamp)
+        wsi_outdir (Path, optional): Output directory of the WSI. Defaults to None.
+        dataset (Any, optional): Patch dataset (LivePatchWSIDataset). Defaults to None.
+        dataloader (Any, optional): Patch dataloader (LivePatchWSIDataloader). Defaults to None.
+        wsi (Any, optional): WSI metadata (WSIMetadata). Defaults to None.
+        patch_coordinates (List[Tuple[int, int]], optional): Patches (row, col) of the dataset. Defaults to empty list.
+        stitcher (Any, optional): Stitcher of the WSI (IncrementalCellStitcher). Defaults to None.
+        instance_map_writer (Any, optional): Writer of the instance map (InstanceMapWriter). Defaults to None.
+        cell_dict_wsi (List[dict], optional): Collected cells. Defaults to empty list.
+        cell_dict_detection (List[dict], optional): Collected cell detections. Defaults to empty list.
+        graph_data (dict, optional): Collected graph data. Defaults to empty dict.
+        validation_ids (list, optional): Pending comparisons of peak and watershed detection. Defaults to empty list.
+        validation_stats (List[dict], optional): Finished comparisons. Defaults to empty list.
+        pending_calls (int, optional): Number of pending postprocessing calls. Defaults to 0.
+        stitching_tasks (list, optional): Stitching tasks (futures) submitted to the stitching thread. Defaults to empty list.
+        exhausted (bool, optional): If all patches have been passed to the model. Defaults to False.
+        submitted (bool, optional): If the outputs have been submitted to the writer. Defaults to False.
+    """
+
+    wsi_path: Path
+    run_id: int
+    fail: Callable[[str], None]
+    on_complete: Callable[[], None]
+    start_time: float
+    wsi_outdir: Path = None
+    dataset: Any = None
+    dataloader: Any = None
+    wsi: Any = None
+    patch_coordinates: List[Tuple[int, int]] = field(default_factory=list)
+    stitcher: Any = None
+    instance_map_writer: Any = None
+    cell_dict_wsi: List[dict] = field(default_factory=list)
+    cell_dict_detection: List[dict] = field(default_factory=list)
+    graph_data: dict = field(default_factory=dict)
+    validation_ids: list = field(default_factory=list)
+    validation_stats: List[dict] = field(default_factory=list)
+    pending_calls: int = 0
+    stitching_tasks: list = field(default_factory=list)
+    exhausted: bool = False
+    submitted: bool = False
+
+
+class SlideBatchPacker:
+    def __init__(
+        self,
+        dataloaders: List[Any],
+        patch_coordinates: List[List[Tuple[int, int]]],
+        batch_size: int,
+    ) -> None:
+        """Iterate over full batches with the patches of multiple slides
+
+        The slides are processed one after another, a batch is continued with the next slide
+        if the current slide has no remaining patches.
+
+        Args:
+            dataloaders (List[Any]): Dataloader of each slide (LivePatchWSIDataloader). The batch size of the
+                dataloaders is adjusted to request just the missing number of patches.
+            patch_coordinates (List[List[Tuple[int, int]]]): Patches (row, col) of each slide, indexed by the dataset index
+            batch_size (int): Batch size
+
+        Attributes:
+            dataloaders (List[Any]): Dataloader of each slide
+            patch_coordinates (List[List[Tuple[int, int]]]): Patches of each slide
+            batch_size (int): Batch size
+        """
+        assert len(dataloaders) == len(
+            patch_coordinates
+        ), "Each dataloader needs patch coordinates"
+        assert batch_size > 0, "Batch size must be greater than 0"
+        self.dataloaders = dataloaders
+        self.patch_coordinates = patch_coordinates
+        self.batch_size = batch_size
+
+    def __len__(self) -> int:
+        """Estimated number of batches (patches discarded by the dataloaders reduce it)"""
+        num_patches = sum(len(dataloader.dataset) for dataloader in self.dataloaders)
+        return int(np.ceil(num_patches / self.batch_size))
+
+    def __iter__(self) -> Iterator[PackedBatch]:
+        iterators = [iter(dataloader) for dataloader in self.dataloaders]
+        slide_idx = 0
+        while slide_idx < len(iterators):
+            patches, metadata, slide_indices = [], [], []
+            discarded, finished = {}, []
+            while len(metadata) < self.batch_size and slide_idx < len(iterators):
+                dataloader = self.dataloaders[slide_idx]
+                missing = self.batch_size - len(metadata)
+                dataloader.batch_size = missing
+                consumed_before = dataloader.i
+                try:
+                    slide_patches, slide_metadata, _ = next(iterators[slide_idx])
+                except StopIteration:
+                    slide_patches, slide_metadata = [], []
+
+                # patches skipped by the dataloader will never be postprocessed
+                yielded = {(meta["row"], meta["col"]) for meta in slide_metadata}
+                skipped = [
+                    self.patch_coordinates[slide_idx][idx]
+                    for idx in dataloader.element_list[consumed_before : dataloader.i]
+                    if self.patch_coordinates[slide_idx][idx] not in yielded
+                ]
+                if len(skipped) > 0:
+                    discarded.setdefault(slide_idx, []).extend(skipped)
+                if len(slide_metadata) > 0:
+                    patches.append(slide_patches)
+                    metadata.extend(slide_metadata)
+                    slide_indices.extend([slide_idx] * len(slide_metadata))
+                if len(slide_metadata) < missing or dataloader.i >= len(
+                    dataloader.element_list
+                ):
+                    finished.append(slide_idx)
+                    slide_idx += 1
+            if len(patches) == 0:
+                patches = []
+            elif len(patches) == 1:
+                patches = patches[0]
+            else:
+                patches = torch.cat(patches)
+            yield PackedBatch(
+                patches=patches,
+                metadata=metadata,
+                slide_indices=slide_indices,
+                discarded=discarded,
+                finished=finished,
+            )
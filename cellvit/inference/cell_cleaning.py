@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Entry point for removing cells detected multiple times in overlapping patches
+#
+# Module-level function (picklable) selecting the polygon or centroid cell cleaner, such that
+# independent groups of cells can be cleaned in worker processes. Just lightweight modules are
+# imported, workers do not load torch or Ray.
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import logging
+from typing import List, Literal
+
+from cellvit.inference.centroid_cell_cleaner import CentroidCellCleaner
+from cellvit.utils.logger import NullLogger
+
+
+def clean_cells(
+    cell_list: List[dict],
+    cell_cleaner: Literal["polygon", "centroid"] = "polygon",
+    radius: float = 6.0,
+    merge_strategy: Literal["area", "probability"] = "area",
+    logger: logging.Logger = None,
+) -> List[int]:
+    """Remove cells detected multiple times in overlapping patches
+
+    Args:
+        cell_list (List[dict]): List with cell-dictionaries, see OverlapCellCleaner and CentroidCellCleaner
+        cell_cleaner (Literal["polygon", "centroid"], optional): Polygon-based OverlapCellCleaner or
+            KD-tree based CentroidCellCleaner. Defaults to "polygon".
+        radius (float, optional): Maximum centroid distance of duplicates (just centroid). Defaults to 6.0.
+        merge_strategy (Literal["area", "probability"], optional): Cell kept of duplicates (just centroid). Defaults to "area".
+        logger (logging.Logger, optional): Logger. Defaults to None (no logging).
+
+    Raises:
+        NotImplementedError: Unknown cell cleaner
+
+    Returns:
+        List[int]: Sorted list with the indices of all cells that should be kept
+    """
+    logger = NullLogger() if logger is None else logger
+    if cell_cleaner == "centroid":
+        cleaner = CentroidCellCleaner(
+            cell_list, logger, radius=radius, merge_strategy=merge_strategy
+        )
+        return cleaner.clean_detected_cells()
+    elif cell_cleaner == "polygon":
+        from cellvit.inference.overlap_cell_cleaner import OverlapCellCleaner
+
+        cleaner = OverlapCellCleaner(cell_list, logger)
+        cleaned_cells = cleaner.clean_detected_cells()
+        return list(cleaned_cells.index.values)
+    else:
+        raise NotImplementedError(
+            f"Unknown cell cleaner {cell_cleaner}. Please select one of ['polygon', 'centroid']"
+        )
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+# Clean Duplicated Cells from a list of cells by using their centroids
+#
+# Lightweight alternative to the OverlapCellCleaner for detection-only workflows.
+# Duplicates (same nucleus detected in two overlapping patches) are found with a
+# KD-tree radius query over the centroids of all margin cells.
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import logging
+from typing import List, Literal, Tuple
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+
+class CentroidCellCleaner:
+    def __init__(
+        self,
+        cell_list: List[dict],
+        logger: logging.Logger,
+        radius: float = 6.0,
+        merge_strategy: Literal["area", "probability"] = "area",
+    ) -> None:
+        """Post-Processing a list of cells from one WSI for removing duplicated detections
+
+        In contrast to the OverlapCellCleaner, no polygons are created. All margin cells
+        are indexed in a KD-tree by their centroid and cells from different patches whose
+        centroids are closer than the given radius are merged into one cluster. Of each cluster,
+        just one cell is kept.
+
+        The selection of the margin and edge cells is identical to the OverlapCellCleaner.
+
+        Args:
+            cell_list (List[dict]): List with cell-dictionaries. Required keys:
+                * bbox
+                * centroid
+                * type_prob
+                * patch_coordinates
+                * cell_status
+                Optional keys (only needed for cells touching the patch border):
+                * edge_position
+                * edge_information
+            logger (logging.Logger): Logger
+            radius (float, optional): Maximum centroid distance (in global pixel coordinates) of two
+                cells to be considered as duplicates. Defaults to 6.0.
+            merge_strategy (Literal["area", "probability"], optional): Strategy to select the cell
+                of a cluster that is kept. Either the cell with the largest bounding box area ("area")
+                or with the highest type probability ("probability"). Defaults to "area".
+        """
+        self._test_cell_list(cell_list)
+        assert radius > 0, "Radius must be greater than 0"
+        assert merge_strategy in [
+            "area",
+            "probability",
+        ], "Merge strategy must be either 'area' or 'probability'"
+
+        self.logger = logger
+        self.logger.info("Initializing Centroid-Cell-Postprocessor")
+        self.radius = radius
+        self.merge_strategy = merge_strategy
+        self.num_cells = len(cell_list)
+
+        # flat numpy representation, contours are not needed here
+        self.centroids = np.array([c["centroid"] for c in cell_list], dtype=np.float64)
+        self.bboxes = np.array([c["bbox"] for c in cell_list], dtype=np.float64)
+        self.type_prob = np.array([c["type_prob"] for c in cell_list], dtype=np.float64)
+        self.patch_coordinates = np.array(
+            [c["patch_coordinates"] for c in cell_list], dtype=np.int64
+        )
+        self.cell_status = np.array(
+            [c["cell_status"] for c in cell_list], dtype=np.int64
+        )
+        self.edge_patch = self._get_first_edge_patch(cell_list)
+
+    def _test_cell_list(self, cell_list: List[dict]):
+        """Test if the provided cell_list has the required keys
+
+        Args:
+            cell_list (List[dict]): List with cell-dictionaries. Required keys:
+                * bbox
+                * centroid
+                * type_prob
+                * patch_coordinates
+                * cell_status
+        """
+        required_keys = [
+            "bbox",
+            "centroid",
+            "type_prob",
+            "patch_coordinates",
+            "cell_status",
+        ]
+        for key in required_keys:
+            assert (
+                key in cell_list[0]
+            ), f"Key {key} not found in the first dictionary of cell_list"
+
+    def _get_first_edge_patch(self, cell_list: List[dict]) -> np.ndarray:
+        """Extract the first neighbouring patch for all cells touching the patch border
+
+        Args:
+            cell_list (List[dict]): List with cell-dictionaries
+
+        Returns:
+            np.ndarray: Array with shape (N, 2) with row and col of the neighbouring patch.
+                Cells not touching the border are marked with (-2, -2), cells touching the border
+                without any neighbouring patch are marked with (-3, -3).
+        """
+        edge_patch = np.full((len(cell_list), 2), -2, dtype=np.int64)
+        for idx, cell in enumerate(cell_list):
+            if not cell.get("edge_position", False):
+                continue
+            edge_patches = cell["edge_information"]["edge_patches"]
+            if edge_patches is None:
+                edge_patch[idx] = -3
+            else:
+                edge_patch[idx] = edge_patches[0]
+        return edge_patch
+
+    def clean_detected_cells(self) -> List[int]:
+        """Main Post-Processing coordinator, entry point
+
+        Returns:
+            List[int]: Sorted list with the indices of all cells that should be kept
+        """
+        mid_idx = np.flatnonzero(self.cell_status == 0)
+        self.logger.info("Finding edge-cells for merging")
+        candidate_idx = self._get_candidate_cells()
+        self.logger.info("Removal of cells detected multiple times")
+        kept_idx = self._remove_duplicates(candidate_idx)
+
+        keep_idx = np.sort(np.concatenate([mid_idx, kept_idx]))
+        return keep_idx.tolist()
+
+    def _get_candidate_cells(self) -> np.ndarray:
+        """Select all margin cells (cells inside the margin, not touching the border)
+        and border/edge cells (touching border) with no overlapping equivalent (e.g, if patch has no neighbour)
+
+        Returns:
+            np.ndarray: Indices of all candidate cells
+        """
+        margin_mask = self.cell_status != 0
+        edge_mask = self.edge_patch[:, 0] != -2
+
+        existing_patches = np.unique(self.patch_coordinates[margin_mask], axis=0)
+        has_neighbour = self._contains_rows(existing_patches, self.edge_patch)
+
+        keep_edge = margin_mask & edge_mask & (self.edge_patch[:, 0] != -3)
+        keep_edge = keep_edge & ~has_neighbour
+        keep_margin = margin_mask & ~edge_mask
+
+        return np.flatnonzero(keep_margin | keep_edge)
+
+    def _remove_duplicates(self, candidate_idx: np.ndarray) -> np.ndarray:
+        """Cluster the candidate cells by their centroid distance and keep one cell per cluster
+
+        Args:
+            candidate_idx (np.ndarray): Indices of all candidate cells
+
+        Returns:
+            np.ndarray: Indices of the kept candidate cells
+        """
+        if len(candidate_idx) == 0:
+            return candidate_idx
+
+        labels, num_clusters, duplicates = self.cluster_cells(candidate_idx)
+        self.logger.info(f"Found duplicated detections of # cells: {duplicates}")
+
+        score = self._get_merge_score(candidate_idx)
+        # sort by cluster, then by descending score, ties are resolved by the smaller index
+        order = np.lexsort((candidate_idx, -score, labels))
+        first_of_cluster = np.ones(len(order), dtype=bool)
+        first_of_cluster[1:] = labels[order][1:] != labels[order][:-1]
+
+        return candidate_idx[order[first_of_cluster]]
+
+    def cluster_cells(self, candidate_idx: np.ndarray) -> Tuple[np.ndarray, int, int]:
+        """Assign all candidate cells to clusters of duplicated detections
+
+        Two cells are connected if their centroids are closer than the radius and if they
+        originate from different patches. Clusters are the connected components of this graph.
+
+        Args:
+            candidate_idx (np.ndarray): Indices of all candidate cells
+
+        Returns:
+            Tuple[np.ndarray, int, int]:
+                * np.ndarray: Cluster label for each candidate cell
+                * int: Number of clusters
+                * int: Number of cells that are removed as duplicates
+        """
+        num_candidates = len(candidate_idx)
+        tree = cKDTree(self.centroids[candidate_idx])
+        pairs = tree.query_pairs(r=self.radius, output_type="ndarray")
+
+        patches = self.patch_coordinates[candidate_idx]
+        different_patch = np.any(patches[pairs[:, 0]] != patches[pairs[:, 1]], axis=1)
+        pairs = pairs[different_patch]
+
+        adjacency = coo_matrix(
+            (np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+            shape=(num_candidates, num_candidates),
+        )
+        num_clusters, labels = connected_components(adjacency, directed=False)
+
+        return labels, num_clusters, num_candidates - num_clusters
+
+    def _get_merge_score(self, candidate_idx: np.ndarray) -> np.ndarray:
+        """Score used to select the cell of a cluster that is kept (highest score is kept)
+
+        Args:
+            candidate_idx (np.ndarray): Indices of all candidate cells
+
+        Returns:
+            np.ndarray: Score for each candidate cell
+        """
+        if self.merge_strategy == "probability":
+            return self.type_prob[candidate_idx]
+        bboxes = self.bboxes[candidate_idx]
+        extent = bboxes[:, 1, :] - bboxes[:, 0, :]
+        return extent[:, 0] * extent[:, 1]
+
+    @staticmethod
+    def _contains_rows(reference: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Check for each row of query if it is contained in reference
+
+        Args:
+            reference (np.ndarray): Reference rows. Shape: (M, 2)
+            query (np.ndarray): Query rows. Shape: (N, 2)
+
+        Returns:
+            np.ndarray: Boolean mask with shape (N,)
+        """
+        if len(reference) == 0:
+            return np.zeros(len(query), dtype=bool)
+        # encode (row, col) as one integer key, negative markers are shifted to be positive
+        shift = 4
+        width = int(max(reference[:, 1].max(), query[:, 1].max())) + 2 * shift
+        reference_keys = (reference[:, 0] + shift) * width + reference[:, 1] + shift
+        query_keys = (query[:, 0] + shift) * width + query[:, 1] + shift
+        return np.isin(query_keys, reference_keys)
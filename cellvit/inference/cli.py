@@ -5,14 +5,20 @@
 # Institute for Artifical Intelligence in Medicine,
 # University Medicine Essen
 
+# No heavy dependencies (torch, ray, pandas) at import time: the configuration is parsed
+# and validated before they are loaded (see cellvit.detect_cells.main)
+
 import argparse
+import logging
 from pathlib import Path
-import torch
-import pandas as pd
+from typing import TYPE_CHECKING
 import json
 import yaml
-import pandas as pd
-import threading
+from cellvit.utils.check_module import check_module
+from cellvit.utils.ressource_manager import get_job_array_shard
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 def parse_wsi_properties(wsi_properties_str):
@@ -35,10 +41,38 @@ class InferenceConfiguration:
             gpu (int): Cuda-GPU ID for inference. Default: 0
             enforce_amp (bool): Whether to use mixed precision for inference (enforced). Otherwise network default training settings are used. Default: False
             batch_size (int): Inference batch-size. Default: 8
+            weight_cache (bool): Convert the checkpoint once into memory-mapped inference-only weights (faster startup, lower peak memory). Default: True
+            weight_dtype (str): Dtype of the cached weights. Allowed values: 'float32', 'float16' or 'bfloat16'. Default: 'float32'
+            compile_model (bool): Compile the model with torch.compile, compiled artifacts are cached. Default: False
+            artifact_cache_size (float): Maximum size of the compiled artifact cache in MB. Default: 10240
+            cell_cleaner (str): Method to remove cells detected multiple times in overlapping patches. Allowed values: 'polygon' or 'centroid'. Default: 'polygon'
+            cell_cleaner_strategy (str): Cell kept of duplicated detections (just centroid cleaner). Allowed values: 'area' or 'probability'. Default: 'area'
+            cell_cleaner_radius (float): Maximum centroid distance in pixels of duplicated detections (just centroid cleaner). Default: 6.0
+            cleaning_workers (int): Number of worker processes cleaning overlapping cells in parallel, 0 cleans in the inference process. Default: 0
             outdir (Path): Output directory to store results
             geojson (bool): Set this flag to export results as additional geojson files for loading them into Software like QuPath
             graph (bool): Set this flag to export results as pytorch graph including embeddings (.pt) file
             compression (bool): Set this flag to export results as snappy compressed file
+            compression_codec (str): Codec for streaming compression. Allowed values: 'snappy' or 'zstd'. Default: 'snappy'
+            compression_level (int): Compression level (just zstd). Default: 3
+            compression_threads (int): Number of compression worker threads (just zstd), 0 disables multithreading. Default: 0
+            file_format (str): File format for cells and detections. Allowed values: 'json', 'arrow' or 'parquet'. Default: 'json'
+            background_writer (bool): Set this flag to write the outputs in background threads while the next WSI is processed. Default: False
+            spatial_index (bool): Set this flag to store cells in Hilbert order together with a spatial index (.sidx) for region queries. Default: False
+            tile_size (int): If provided, cells are additionally stored in spatial tiles of this size (in pixels) for viewers. Default: None
+            graph_format (str): Storage format of the graph. Allowed values: 'pt' (cells.pt) or 'mmap' (memory-mappable cells_graph directory). Default: 'pt'
+            graph_dtype (str): Dtype of the stored cell tokens. Allowed values: 'float32' or 'float16'. Default: 'float32'
+            graph_edges (str): If provided, spatial edges are built and stored in the graph. Allowed values: 'knn', 'radius' or 'delaunay'. Default: None
+            graph_edge_k (int): Number of neighbors (knn) or maximum number of neighbors (radius). Default: 8
+            graph_edge_radius (float): Maximum edge length in pixels, required for radius, optional for delaunay. Default: None
+            detection_only (bool): Set this flag to extract just detections (bbox, centroid, type) without contours. Implies centroid cell cleaning. Default: False
+            detection_engine (str): Method for separating the nuclei. Allowed values: 'watershed' or 'peaks' (implies detection_only). Default: 'watershed'
+            detection_validation_interval (int): Compare every n-th batch of the peak detection with the watershed detection, 0 disables the validation. Default: 0
+            instance_map (bool): Set this flag to export the stitched instance label map as chunked zarr store. Default: False
+            instance_map_levels (int): Number of resolution levels of the instance map. Default: 4
+            contour_encoding (bool): Set this flag to store contours compactly encoded (quantized, delta and varint coded). Default: False
+            contour_precision (float): Quantization step of encoded contours in pixels. Default: 1.0
+            contour_tolerance (float): Tolerance in pixels for simplifying the contours (Douglas-Peucker), 0 disables the simplification. Default: 0.0
             command (str): Main run command for either performing inference on single WSI-file or on whole dataset
             wsi_path (Path): Path to WSI file
             wsi_folder (Path): Path to the folder where all WSI are stored
@@ -46,6 +80,13 @@ class InferenceConfiguration:
             wsi_extension (str): The extension types used for the WSI files, see configs.python.config (WSI_EXT)
             wsi_mpp (float): The microns per pixel (mpp) of the WSI
             wsi_magnification (float): The magnification of the WSI
+            skip_failed (bool): Skip WSI whose last attempt with the same configuration failed (run ledger) instead of retrying them. Default: False
+            work_queue (bool): Pull the WSI from a work queue in the output directory shared by multiple processes/nodes (largest first). Default: False
+            lease_timeout (int): Seconds after which a WSI leased by a dead process is handed out again (work queue). Default: 600
+            pack_slides (int): Number of WSI processed together, their patches are packed into full batches (for many small WSI, e.g., biopsies). Default: 1
+            parallel_slides (int): Number of worker processes on this host processing different WSI, sharing the model weights. Default: 1
+            shard_index (int): Index of the shard of the dataset to process (job array). Default: SLURM_ARRAY_TASK_ID or JOB_COMPLETION_INDEX if set, else no sharding
+            num_shards (int): Number of shards the dataset is partitioned into (balanced by file size). Default: SLURM_ARRAY_TASK_COUNT if set
             cpu_count (int): Number of CPU cores to use/available. Recommend to first test automatic derivation, and just change if problems occur. Default: System configuration is used
             ray_worker (int): Number of Ray workers to use
             ray_remote_cpus (int): Number of CPUs to use for Ray workers
@@ -57,17 +98,52 @@ class InferenceConfiguration:
         self.gpu: int = 0
         self.enforce_amp: bool = False
         self.batch_size: int = 8
+        self.weight_cache: bool = True
+        self.weight_dtype: str = "float32"
+        self.compile_model: bool = False
+        self.artifact_cache_size: float = 10240
+        self.cell_cleaner: str = "polygon"
+        self.cell_cleaner_strategy: str = "area"
+        self.cell_cleaner_radius: float = 6.0
+        self.cleaning_workers: int = 0
         self.outdir: Path
         self.geojson: bool = False
         self.graph: bool = False
         self.compression: bool = False
+        self.compression_codec: str = "snappy"
+        self.compression_level: int = 3
+        self.compression_threads: int = 0
+        self.file_format: str = "json"
+        self.background_writer: bool = False
+        self.spatial_index: bool = False
+        self.tile_size: int = None
+        self.graph_format: str = "pt"
+        self.graph_dtype: str = "float32"
+        self.graph_edges: str = None
+        self.graph_edge_k: int = 8
+        self.graph_edge_radius: float = None
+        self.detection_only: bool = False
+        self.detection_engine: str = "watershed"
+        self.detection_validation_interval: int = 0
+        self.instance_map: bool = False
+        self.instance_map_levels: int = 4
+        self.contour_encoding: bool = False
+        self.contour_precision: float = 1.0
+        self.contour_tolerance: float = 0.0
         self.command: str
         self.wsi_path: Path = None
         self.wsi_folder: Path = None
-        self.wsi_filelist: pd.DataFrame = None
+        self.wsi_filelist: "pd.DataFrame" = None
         self.wsi_extension: str = "svs"
         self.wsi_mpp: float = None
         self.wsi_magnification: float = None
+        self.skip_failed: bool = False
+        self.work_queue: bool = False
+        self.lease_timeout: int = 600
+        self.pack_slides: int = 1
+        self.parallel_slides: int = 1
+        self.shard_index: int = None
+        self.num_shards: int = None
         self.cpu_count: int = None
         self.ray_worker: int = None
         self.ray_remote_cpus: int = None
@@ -84,12 +160,26 @@ class InferenceConfiguration:
         self.__set_gpu(config)
         self.__set_amp(config)
         self.__set_batch_size(config)
+        self.__set_weight_cache(config)
+        self.__set_compilation(config)
+        self.__set_cell_cleaner(config)
 
         # set output information
         self.__set_outdir(config)
         self.__set_geojson(config)
         self.__set_graph(config)
         self.__set_compression(config)
+        self.__set_compression_settings(config)
+        self.__set_file_format(config)
+        self.__set_background_writer(config)
+        self.__set_spatial_index(config)
+        self.__set_tile_size(config)
+        self.__set_graph_storage(config)
+        self.__set_graph_edges(config)
+        self.__set_detection_only(config)
+        self.__set_detection_engine(config)
+        self.__set_instance_map(config)
+        self.__set_contour_encoding(config)
 
         # set command
         self.__set_command(config)
@@ -174,7 +264,8 @@ class InferenceConfiguration:
 
         Raises:
             AssertionError: If GPU is not of type integer
-            AssertionError: If GPU is not between 0 and number of available GPUs
+            AssertionError: If GPU is negative. Whether the GPU exists is checked by the SystemConfiguration,
+                such that the configuration can be validated without initializing CUDA.
         """
         inference_config = config.get("inference")
         if inference_config is None:
@@ -183,9 +274,7 @@ class InferenceConfiguration:
         gpu = inference_config.get("gpu")
         if gpu is not None:
             assert isinstance(gpu, int), "GPU must be of type integer"
-            assert (
-                0 <= gpu < torch.cuda.device_count()
-            ), f"GPU must be between 0 and {torch.cuda.device_count()-1}"
+            assert gpu >= 0, "GPU must be between 0 and the number of GPUs - 1"
             self.gpu = gpu
 
     def __set_amp(self, config: dict) -> None:
@@ -226,6 +315,116 @@ class InferenceConfiguration:
             assert 1 < batch_size <= 48, "Batch size must be between 2 and 48"
             self.batch_size = batch_size
 
+    def __set_weight_cache(self, config: dict) -> None:
+        """Sets the usage and dtype of the inference-only weight cache
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If weight cache is not of type boolean
+            AssertionError: If weight dtype is not 'float32', 'float16' or 'bfloat16'
+        """
+        inference_config = config.get("inference")
+        if inference_config is None:
+            return
+
+        weight_cache = inference_config.get("weight_cache")
+        if weight_cache is not None:
+            assert isinstance(
+                weight_cache, bool
+            ), "Weight cache must be of type boolean"
+            self.weight_cache = weight_cache
+        weight_dtype = inference_config.get("weight_dtype")
+        if weight_dtype is not None:
+            assert isinstance(weight_dtype, str) and weight_dtype.lower() in [
+                "float32",
+                "float16",
+                "bfloat16",
+            ], "Weight dtype must be 'float32', 'float16' or 'bfloat16'"
+            self.weight_dtype = weight_dtype.lower()
+
+    def __set_compilation(self, config: dict) -> None:
+        """Sets the model compilation and the size of the compiled artifact cache
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If compile model is not of type boolean
+            AssertionError: If artifact cache size is not a positive number
+        """
+        inference_config = config.get("inference")
+        if inference_config is None:
+            return
+
+        compile_model = inference_config.get("compile_model")
+        if compile_model is not None:
+            assert isinstance(
+                compile_model, bool
+            ), "Compile model must be of type boolean"
+            self.compile_model = compile_model
+        artifact_cache_size = inference_config.get("artifact_cache_size")
+        if artifact_cache_size is not None:
+            assert (
+                isinstance(artifact_cache_size, (int, float))
+                and not isinstance(artifact_cache_size, bool)
+                and artifact_cache_size > 0
+            ), "Artifact cache size must be a positive number (MB)"
+            self.artifact_cache_size = float(artifact_cache_size)
+
+    def __set_cell_cleaner(self, config: dict) -> None:
+        """Sets the method to remove cells detected multiple times in overlapping patches
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If cell cleaner is not of type string
+            AssertionError: If cell cleaner is not 'polygon' or 'centroid'
+            AssertionError: If cell cleaner strategy is not 'area' or 'probability'
+            AssertionError: If cell cleaner radius is not a positive number
+            AssertionError: If cleaning workers is not a non-negative integer
+        """
+        inference_config = config.get("inference")
+        if inference_config is None:
+            return
+
+        cell_cleaner = inference_config.get("cell_cleaner")
+        if cell_cleaner is not None:
+            assert isinstance(cell_cleaner, str), "Cell cleaner must be of type string"
+            assert cell_cleaner.lower() in [
+                "polygon",
+                "centroid",
+            ], "Cell cleaner must be either 'polygon' or 'centroid'"
+            self.cell_cleaner = cell_cleaner.lower()
+        cell_cleaner_strategy = inference_config.get("cell_cleaner_strategy")
+        if cell_cleaner_strategy is not None:
+            assert isinstance(
+                cell_cleaner_strategy, str
+            ), "Cell cleaner strategy must be of type string"
+            assert cell_cleaner_strategy.lower() in [
+                "area",
+                "probability",
+            ], "Cell cleaner strategy must be either 'area' or 'probability'"
+            self.cell_cleaner_strategy = cell_cleaner_strategy.lower()
+        cell_cleaner_radius = inference_config.get("cell_cleaner_radius")
+        if cell_cleaner_radius is not None:
+            assert (
+                isinstance(cell_cleaner_radius, (int, float))
+                and not isinstance(cell_cleaner_radius, bool)
+                and cell_cleaner_radius > 0
+            ), "Cell cleaner radius must be a positive number"
+            self.cell_cleaner_radius = float(cell_cleaner_radius)
+        cleaning_workers = inference_config.get("cleaning_workers")
+        if cleaning_workers is not None:
+            assert (
+                isinstance(cleaning_workers, int)
+                and not isinstance(cleaning_workers, bool)
+                and cleaning_workers >= 0
+            ), "Cleaning workers must be a non-negative integer"
+            self.cleaning_workers = cleaning_workers
+
     def __set_outdir(self, config: dict) -> None:
         """Sets the output directory to store results
 
@@ -295,6 +494,329 @@ class InferenceConfiguration:
             ), "Compression must be of type boolean"
             self.compression = output_format["compression"]
 
+    def __set_compression_settings(self, config: dict) -> None:
+        """Sets codec, level and worker threads for the streaming compression
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If compression codec is not 'snappy' or 'zstd'
+            AssertionError: If compression codec is 'zstd' and zstandard is not installed
+            AssertionError: If compression level is not an integer between 1 and 22
+            AssertionError: If compression threads is not a non-negative integer
+        """
+        output_format = config.get("output_format")
+        compression_codec = output_format.get("compression_codec")
+        if compression_codec is not None:
+            assert isinstance(
+                compression_codec, str
+            ), "Compression codec must be of type string"
+            assert compression_codec.lower() in [
+                "snappy",
+                "zstd",
+            ], "Compression codec must be one of 'snappy' or 'zstd'"
+            self.compression_codec = compression_codec.lower()
+            if self.compression_codec == "zstd":
+                assert check_module(
+                    "zstandard"
+                ), "Compression codec 'zstd' requires zstandard. Install it with: pip install cellvit[zstd]"
+
+        compression_level = output_format.get("compression_level")
+        if compression_level is not None:
+            assert isinstance(
+                compression_level, int
+            ), "Compression level must be of type integer"
+            assert (
+                1 <= compression_level <= 22
+            ), "Compression level must be between 1 and 22"
+            self.compression_level = compression_level
+
+        compression_threads = output_format.get("compression_threads")
+        if compression_threads is not None:
+            assert isinstance(
+                compression_threads, int
+            ), "Compression threads must be of type integer"
+            assert compression_threads >= 0, "Compression threads must be at least 0"
+            self.compression_threads = compression_threads
+
+    def __set_file_format(self, config: dict) -> None:
+        """Sets the file format to store cells and detections
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If file format is not of type string
+            AssertionError: If file format is not 'json', 'arrow' or 'parquet'
+            AssertionError: If file format is 'arrow' or 'parquet' and pyarrow is not installed
+        """
+        output_format = config.get("output_format")
+        file_format = output_format.get("file_format")
+        if file_format is not None:
+            assert isinstance(file_format, str), "File format must be of type string"
+            assert file_format.lower() in [
+                "json",
+                "arrow",
+                "parquet",
+            ], "File format must be one of 'json', 'arrow' or 'parquet'"
+            self.file_format = file_format.lower()
+            if self.file_format in ["arrow", "parquet"]:
+                assert check_module(
+                    "pyarrow"
+                ), f"File format '{self.file_format}' requires pyarrow. Install it with: pip install cellvit[columnar]"
+
+    def __set_background_writer(self, config: dict) -> None:
+        """Sets the flag to write the outputs in background threads
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If background writer is not of type boolean
+        """
+        output_format = config.get("output_format")
+        background_writer = output_format.get("background_writer")
+        if background_writer is not None:
+            assert isinstance(
+                background_writer, bool
+            ), "Background writer must be of type boolean"
+            self.background_writer = background_writer
+
+    def __set_spatial_index(self, config: dict) -> None:
+        """Sets the flag to store a spatial index next to the cell files
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If spatial index is not of type boolean
+        """
+        output_format = config.get("output_format")
+        spatial_index = output_format.get("spatial_index")
+        if spatial_index is not None:
+            assert isinstance(
+                spatial_index, bool
+            ), "Spatial index must be of type boolean"
+            self.spatial_index = spatial_index
+
+    def __set_tile_size(self, config: dict) -> None:
+        """Sets the tile size for the tiled output
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If tile size is not of type integer
+            AssertionError: If tile size is smaller than 256
+        """
+        output_format = config.get("output_format")
+        tile_size = output_format.get("tile_size")
+        if tile_size is not None:
+            assert isinstance(tile_size, int), "Tile size must be of type integer"
+            assert tile_size >= 256, "Tile size must be at least 256"
+            self.tile_size = tile_size
+
+    def __set_graph_storage(self, config: dict) -> None:
+        """Sets the storage format and token dtype of the graph
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If graph format is not a string
+            AssertionError: If graph format is not one of 'pt' or 'mmap'
+            AssertionError: If graph dtype is not a string
+            AssertionError: If graph dtype is not one of 'float32' or 'float16'
+        """
+        output_format = config.get("output_format")
+        graph_format = output_format.get("graph_format")
+        if graph_format is not None:
+            assert isinstance(graph_format, str), "Graph format must be of type string"
+            assert graph_format.lower() in [
+                "pt",
+                "mmap",
+            ], "Graph format must be one of 'pt' or 'mmap'"
+            self.graph_format = graph_format.lower()
+        graph_dtype = output_format.get("graph_dtype")
+        if graph_dtype is not None:
+            assert isinstance(graph_dtype, str), "Graph dtype must be of type string"
+            assert graph_dtype.lower() in [
+                "float32",
+                "float16",
+            ], "Graph dtype must be one of 'float32' or 'float16'"
+            self.graph_dtype = graph_dtype.lower()
+
+    def __set_graph_edges(self, config: dict) -> None:
+        """Sets the method and parameters for building spatial edges of the graph
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If graph edges is not a string
+            AssertionError: If graph edges is not one of 'knn', 'radius' or 'delaunay'
+            AssertionError: If graph edge k is not a positive integer
+            AssertionError: If graph edge radius is not a positive number
+            AssertionError: If no radius is provided for radius graphs
+        """
+        output_format = config.get("output_format")
+        graph_edges = output_format.get("graph_edges")
+        if graph_edges is not None:
+            assert isinstance(graph_edges, str), "Graph edges must be of type string"
+            assert graph_edges.lower() in [
+                "knn",
+                "radius",
+                "delaunay",
+            ], "Graph edges must be one of 'knn', 'radius' or 'delaunay'"
+            self.graph_edges = graph_edges.lower()
+        graph_edge_k = output_format.get("graph_edge_k")
+        if graph_edge_k is not None:
+            assert (
+                isinstance(graph_edge_k, int) and graph_edge_k > 0
+            ), "Graph edge k must be a positive integer"
+            self.graph_edge_k = graph_edge_k
+        graph_edge_radius = output_format.get("graph_edge_radius")
+        if graph_edge_radius is not None:
+            assert (
+                isinstance(graph_edge_radius, (int, float)) and graph_edge_radius > 0
+            ), "Graph edge radius must be a positive number"
+            self.graph_edge_radius = float(graph_edge_radius)
+        if self.graph_edges == "radius":
+            assert (
+                self.graph_edge_radius is not None
+            ), "Graph edge radius must be provided for radius graphs"
+
+    def __set_detection_only(self, config: dict) -> None:
+        """Sets the flag to extract just detections without contours
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If detection only is not of type boolean
+        """
+        output_format = config.get("output_format")
+        detection_only = output_format.get("detection_only")
+        if detection_only is not None:
+            assert isinstance(
+                detection_only, bool
+            ), "Detection only must be of type boolean"
+            self.detection_only = detection_only
+            if detection_only:
+                self.cell_cleaner = "centroid"
+
+    def __set_detection_engine(self, config: dict) -> None:
+        """Sets the detection engine and the interval for validating peak detection against watershed
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If detection engine is not of type string
+            AssertionError: If detection engine is not 'watershed' or 'peaks'
+            AssertionError: If detection validation interval is not of type integer
+            AssertionError: If detection validation interval is negative
+        """
+        inference_config = config.get("inference")
+        if inference_config is None:
+            return
+
+        detection_engine = inference_config.get("detection_engine")
+        if detection_engine is not None:
+            assert isinstance(
+                detection_engine, str
+            ), "Detection engine must be of type string"
+            assert detection_engine.lower() in [
+                "watershed",
+                "peaks",
+            ], "Detection engine must be either 'watershed' or 'peaks'"
+            self.detection_engine = detection_engine.lower()
+            if self.detection_engine == "peaks":
+                # peak detection does not provide contours
+                self.detection_only = True
+                self.cell_cleaner = "centroid"
+
+        detection_validation_interval = inference_config.get(
+            "detection_validation_interval"
+        )
+        if detection_validation_interval is not None:
+            assert isinstance(
+                detection_validation_interval, int
+            ), "Detection validation interval must be of type integer"
+            assert (
+                detection_validation_interval >= 0
+            ), "Detection validation interval must be greater or equal to 0"
+            self.detection_validation_interval = detection_validation_interval
+
+    def __set_instance_map(self, config: dict) -> None:
+        """Sets the export of the instance label map and its number of resolution levels
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If instance map is not of type boolean
+            AssertionError: If instance map levels is not of type integer
+            AssertionError: If instance map levels is smaller than 1
+            AssertionError: If instance map is used with the peak detection engine
+        """
+        output_format = config.get("output_format")
+        instance_map = output_format.get("instance_map")
+        if instance_map is not None:
+            assert isinstance(
+                instance_map, bool
+            ), "Instance map must be of type boolean"
+            self.instance_map = instance_map
+
+        instance_map_levels = output_format.get("instance_map_levels")
+        if instance_map_levels is not None:
+            assert isinstance(
+                instance_map_levels, int
+            ), "Instance map levels must be of type integer"
+            assert instance_map_levels >= 1, "Instance map levels must be at least 1"
+            self.instance_map_levels = instance_map_levels
+        assert not (
+            self.instance_map and self.detection_engine == "peaks"
+        ), "Instance map export is not available for the peak detection engine"
+
+    def __set_contour_encoding(self, config: dict) -> None:
+        """Sets the compact contour encoding, its precision and the contour simplification
+
+        Args:
+            config (dict): Configuration dictionary
+
+        Raises:
+            AssertionError: If contour encoding is not of type boolean
+            AssertionError: If contour precision is not a number greater than 0
+            AssertionError: If contour tolerance is not a number greater or equal to 0
+        """
+        output_format = config.get("output_format")
+        contour_encoding = output_format.get("contour_encoding")
+        if contour_encoding is not None:
+            assert isinstance(
+                contour_encoding, bool
+            ), "Contour encoding must be of type boolean"
+            self.contour_encoding = contour_encoding
+
+        contour_precision = output_format.get("contour_precision")
+        if contour_precision is not None:
+            assert isinstance(
+                contour_precision, (int, float)
+            ), "Contour precision must be a number"
+            assert contour_precision > 0, "Contour precision must be greater than 0"
+            self.contour_precision = float(contour_precision)
+
+        contour_tolerance = output_format.get("contour_tolerance")
+        if contour_tolerance is not None:
+            assert isinstance(
+                contour_tolerance, (int, float)
+            ), "Contour tolerance must be a number"
+            assert (
+                contour_tolerance >= 0
+            ), "Contour tolerance must be greater or equal to 0"
+            self.contour_tolerance = float(contour_tolerance)
+
     def __set_cpu_count(self, config: dict) -> None:
         """Sets the number of CPU cores to use/available
 
@@ -406,6 +928,10 @@ class InferenceConfiguration:
             AssertionError: If WSI filelist is not a file
             AssertionError: If WSI filelist is not a .csv file
             AssertionError: If WSI filelist does not contain a 'path' column
+            AssertionError: If skip failed is not of type boolean
+            AssertionError: If work queue is not of type boolean
+            AssertionError: If lease timeout is not a positive integer
+            AssertionError: If shard index or number of shards are invalid or combined with the work queue
         """
         assert (
             "process_wsi" in config or "process_dataset" in config
@@ -496,6 +1022,8 @@ class InferenceConfiguration:
                     ".csv"
                 ], "WSI filelist must be a .csv file"
                 self.wsi_filelist = Path(process_dataset["wsi_filelist"])
+                import pandas as pd
+
                 self.wsi_filelist = pd.read_csv(self.wsi_filelist, delimiter=",")
                 filelist_header = self.wsi_filelist.columns.tolist()
                 assert (
@@ -511,6 +1039,83 @@ class InferenceConfiguration:
             if wsi_magnification is not None:
                 assert wsi_magnification > 0, "WSI magnification must be greater than 0"
                 self.wsi_magnification = wsi_magnification
+            skip_failed = process_dataset.get("skip_failed")
+            if skip_failed is not None:
+                assert isinstance(
+                    skip_failed, bool
+                ), "Skip failed must be of type boolean"
+                self.skip_failed = skip_failed
+            work_queue = process_dataset.get("work_queue")
+            if work_queue is not None:
+                assert isinstance(
+                    work_queue, bool
+                ), "Work queue must be of type boolean"
+                self.work_queue = work_queue
+            lease_timeout = process_dataset.get("lease_timeout")
+            if lease_timeout is not None:
+                assert isinstance(
+                    lease_timeout, int
+                ), "Lease timeout must be of type integer"
+                assert lease_timeout > 0, "Lease timeout must be greater than 0"
+                self.lease_timeout = lease_timeout
+            pack_slides = process_dataset.get("pack_slides")
+            if pack_slides is not None:
+                assert isinstance(
+                    pack_slides, int
+                ), "Pack slides must be of type integer"
+                assert pack_slides > 0, "Pack slides must be greater than 0"
+                self.pack_slides = pack_slides
+            parallel_slides = process_dataset.get("parallel_slides")
+            if parallel_slides is not None:
+                assert isinstance(
+                    parallel_slides, int
+                ), "Parallel slides must be of type integer"
+                assert parallel_slides > 0, "Parallel slides must be greater than 0"
+                self.parallel_slides = parallel_slides
+            self.__set_shard(process_dataset)
+
+    def __set_shard(self, process_dataset: dict) -> None:
+        """Set the shard of the dataset to process, defaults to the job array of SLURM or Kubernetes
+
+        Args:
+            process_dataset (dict): Process dataset configuration
+
+        Raises:
+            AssertionError: If shard index or number of shards are not integers
+            AssertionError: If the number of shards is not greater than 0
+            AssertionError: If the shard index is not in [0, num_shards)
+            AssertionError: If just one of shard index and number of shards is given explicitly
+            AssertionError: If sharding is combined with the work queue
+        """
+        shard_index = process_dataset.get("shard_index")
+        num_shards = process_dataset.get("num_shards")
+        if self.work_queue:
+            assert (
+                shard_index is None and num_shards is None
+            ), "Sharding and work queue are mutually exclusive"
+            return
+        array_index, array_count = get_job_array_shard()
+        num_shards = array_count if num_shards is None else num_shards
+        if shard_index is None and array_index is not None:
+            if num_shards is None:
+                # e.g. Kubernetes indexed jobs, which do not expose the number of completions
+                logging.getLogger(__name__).warning(
+                    "Job array index found but number of shards is unknown, "
+                    "sharding is disabled (set --num_shards to enable it)"
+                )
+                return
+            shard_index = array_index
+        if shard_index is None and num_shards is None:
+            return
+        assert (
+            shard_index is not None and num_shards is not None
+        ), "Shard index and number of shards must be provided together"
+        assert isinstance(shard_index, int), "Shard index must be of type integer"
+        assert isinstance(num_shards, int), "Number of shards must be of type integer"
+        assert num_shards > 0, "Number of shards must be greater than 0"
+        assert 0 <= shard_index < num_shards, "Shard index must be in [0, num_shards)"
+        self.shard_index = shard_index
+        self.num_shards = num_shards
 
 
 class InferenceWSIParser:
@@ -569,6 +1174,73 @@ class InferenceWSIParser:
             default=8,
             help="Number of images processed per batch",
         )
+        inference_group.add_argument(
+            "--disable_weight_cache",
+            action="store_true",
+            help="Load the training checkpoint instead of the memory-mapped inference weights (converted once)",
+        )
+        inference_group.add_argument(
+            "--weight_dtype",
+            type=str,
+            default="float32",
+            choices=["float32", "float16", "bfloat16"],
+            help="Dtype of the cached inference weights, half precision halves the size of the cache file",
+        )
+        inference_group.add_argument(
+            "--compile_model",
+            action="store_true",
+            help="Compile the model with torch.compile, the compiled artifacts are cached such that just the first start compiles",
+        )
+        inference_group.add_argument(
+            "--artifact_cache_size",
+            type=float,
+            default=10240,
+            help="Maximum size of the compiled artifact cache in MB, least recently used artifacts are evicted",
+        )
+        inference_group.add_argument(
+            "--cell_cleaner",
+            type=str,
+            default="polygon",
+            choices=["polygon", "centroid"],
+            help="Method to remove cells detected multiple times in overlapping patches. "
+            "'centroid' is faster and recommended if only cell detections are needed",
+        )
+        inference_group.add_argument(
+            "--cell_cleaner_strategy",
+            type=str,
+            default="area",
+            choices=["area", "probability"],
+            help="Cell kept of duplicated detections, the one with the largest bounding box area or the highest "
+            "type probability (just centroid cell cleaner)",
+        )
+        inference_group.add_argument(
+            "--cell_cleaner_radius",
+            type=float,
+            default=6.0,
+            help="Maximum centroid distance in pixels of duplicated detections (just centroid cell cleaner)",
+        )
+        inference_group.add_argument(
+            "--cleaning_workers",
+            type=int,
+            default=0,
+            help="Number of worker processes cleaning independent groups of overlapping cells in parallel, "
+            "0 cleans in the inference process",
+        )
+        inference_group.add_argument(
+            "--detection_engine",
+            type=str,
+            default="watershed",
+            choices=["watershed", "peaks"],
+            help="Method for separating the nuclei. 'peaks' detects nucleus centers without watershed "
+            "and implies detection_only",
+        )
+        inference_group.add_argument(
+            "--detection_validation_interval",
+            type=int,
+            default=0,
+            help="Compare every n-th batch of the peak detection with the watershed detection "
+            "(report stored as detection_validation.json), 0 disables the validation",
+        )
 
         # Output Settings
         output_group = parser.add_argument_group("Output Settings")
@@ -592,6 +1264,117 @@ class InferenceWSIParser:
             action="store_true",
             help="Whether to use Snappy compression for output files",
         )
+        output_group.add_argument(
+            "--compression_codec",
+            type=str,
+            default="snappy",
+            choices=["snappy", "zstd"],
+            help="Codec for streaming compression. 'zstd' requires zstandard",
+        )
+        output_group.add_argument(
+            "--compression_level",
+            type=int,
+            default=3,
+            help="Compression level (just zstd)",
+        )
+        output_group.add_argument(
+            "--compression_threads",
+            type=int,
+            default=0,
+            help="Number of compression worker threads (just zstd), 0 disables multithreading",
+        )
+        output_group.add_argument(
+            "--file_format",
+            type=str,
+            default="json",
+            choices=["json", "arrow", "parquet"],
+            help="File format for cells and detections. "
+            "'arrow' (memory-mappable) and 'parquet' require pyarrow",
+        )
+        output_group.add_argument(
+            "--background_writer",
+            action="store_true",
+            help="Whether to write outputs in background threads while the next WSI is processed",
+        )
+        output_group.add_argument(
+            "--spatial_index",
+            action="store_true",
+            help="Whether to store cells in Hilbert order with a spatial index (.sidx) for region queries",
+        )
+        output_group.add_argument(
+            "--tile_size",
+            type=int,
+            default=None,
+            help="If provided, cells are additionally stored in spatial tiles of this size (in pixels) for viewers",
+        )
+        output_group.add_argument(
+            "--graph_format",
+            type=str,
+            default="pt",
+            choices=["pt", "mmap"],
+            help="Storage format of the graph. 'mmap' writes the tokens to disk while the inference is running "
+            "and stores a memory-mappable directory (cells_graph)",
+        )
+        output_group.add_argument(
+            "--graph_dtype",
+            type=str,
+            default="float32",
+            choices=["float32", "float16"],
+            help="Dtype of the stored cell tokens",
+        )
+        output_group.add_argument(
+            "--graph_edges",
+            type=str,
+            default=None,
+            choices=["knn", "radius", "delaunay"],
+            help="If provided, spatial edges between the cells are built and stored in the graph (edge_index, edge_attr)",
+        )
+        output_group.add_argument(
+            "--graph_edge_k",
+            type=int,
+            default=8,
+            help="Number of neighbors (knn) or maximum number of neighbors (radius)",
+        )
+        output_group.add_argument(
+            "--graph_edge_radius",
+            type=float,
+            default=None,
+            help="Maximum edge length in pixels, required for radius, optional for delaunay",
+        )
+        output_group.add_argument(
+            "--detection_only",
+            action="store_true",
+            help="Whether to extract just detections (bbox, centroid, type) without contours. "
+            "Implies centroid cell cleaning, just cell_detection files are stored",
+        )
+        output_group.add_argument(
+            "--instance_map",
+            action="store_true",
+            help="Whether to export the stitched instance label map as chunked zarr store (instance_map.zarr)",
+        )
+        output_group.add_argument(
+            "--instance_map_levels",
+            type=int,
+            default=4,
+            help="Number of resolution levels of the instance map (downsampled by factor 2 per level)",
+        )
+        output_group.add_argument(
+            "--contour_encoding",
+            action="store_true",
+            help="Whether to store contours compactly encoded (quantized, delta and varint coded, base64 in json)",
+        )
+        output_group.add_argument(
+            "--contour_precision",
+            type=float,
+            default=1.0,
+            help="Quantization step of encoded contours in pixels",
+        )
+        output_group.add_argument(
+            "--contour_tolerance",
+            type=float,
+            default=0.0,
+            help="Tolerance in pixels for simplifying the contours (Douglas-Peucker), 0 disables the simplification",
+        )
 
         # Processing Mode
         mode_group = parser.add_argument_group("Processing Mode (Choose One)")
@@ -647,6 +1430,44 @@ class InferenceWSIParser:
         dataset_parser.add_argument(
             "--wsi_magnification", type=int, help="Magnification level of the slides"
         )
+        dataset_parser.add_argument(
+            "--skip_failed",
+            action="store_true",
+            help="Skip WSI whose last attempt with the same configuration failed instead of retrying them",
+        )
+        dataset_parser.add_argument(
+            "--work_queue",
+            action="store_true",
+            help="Pull WSI from a work queue in the output directory, shared by all processes started with this flag (multiple processes/nodes)",
+        )
+        dataset_parser.add_argument(
+            "--lease_timeout",
+            type=int,
+            default=600,
+            help="Seconds after which a WSI leased by a dead process is handed out again",
+        )
+        dataset_parser.add_argument(
+            "--pack_slides",
+            type=int,
+            default=1,
+            help="Number of WSI processed together, their patches are packed into full batches (for many small WSI)",
+        )
+        dataset_parser.add_argument(
+            "--parallel_slides",
+            type=int,
+            default=1,
+            help="Number of worker processes processing different WSI in parallel, the model weights are shared",
+        )
+        dataset_parser.add_argument(
+            "--shard_index",
+            type=int,
+            help="Index of the shard of the dataset to process (default: SLURM_ARRAY_TASK_ID or JOB_COMPLETION_INDEX)",
+        )
+        dataset_parser.add_argument(
+            "--num_shards",
+            type=int,
+            help="Number of shards the dataset is partitioned into, balanced by file size (default: SLURM_ARRAY_TASK_COUNT)",
+        )
 
         # System Settings
         system_group = parser.add_argument_group("System Settings")
@@ -683,6 +1504,26 @@ class InferenceWSIParser:
         opt_yaml_style["inference"]["gpu"] = opt["gpu"]
         opt_yaml_style["inference"]["enforce_amp"] = opt["enforce_amp"]
         opt_yaml_style["inference"]["batch_size"] = opt["batch_size"]
+        opt_yaml_style["inference"]["weight_cache"] = not opt.get(
+            "disable_weight_cache", False
+        )
+        opt_yaml_style["inference"]["weight_dtype"] = opt.get("weight_dtype")
+        opt_yaml_style["inference"]["compile_model"] = opt.get("compile_model", False)
+        opt_yaml_style["inference"]["artifact_cache_size"] = opt.get(
+            "artifact_cache_size"
+        )
+        opt_yaml_style["inference"]["cell_cleaner"] = opt.get("cell_cleaner")
+        opt_yaml_style["inference"]["cell_cleaner_strategy"] = opt.get(
+            "cell_cleaner_strategy"
+        )
+        opt_yaml_style["inference"]["cell_cleaner_radius"] = opt.get(
+            "cell_cleaner_radius"
+        )
+        opt_yaml_style["inference"]["cleaning_workers"] = opt.get("cleaning_workers")
+        opt_yaml_style["inference"]["detection_engine"] = opt.get("detection_engine")
+        opt_yaml_style["inference"]["detection_validation_interval"] = opt.get(
+            "detection_validation_interval"
+        )
 
         # output format
         opt_yaml_style["output_format"] = {}
@@ -690,6 +1531,42 @@ class InferenceWSIParser:
         opt_yaml_style["output_format"]["geojson"] = opt["geojson"]
         opt_yaml_style["output_format"]["graph"] = opt["graph"]
         opt_yaml_style["output_format"]["compression"] = opt["compression"]
+        opt_yaml_style["output_format"]["compression_codec"] = opt.get(
+            "compression_codec"
+        )
+        opt_yaml_style["output_format"]["compression_level"] = opt.get(
+            "compression_level"
+        )
+        opt_yaml_style["output_format"]["compression_threads"] = opt.get(
+            "compression_threads"
+        )
+        opt_yaml_style["output_format"]["file_format"] = opt.get("file_format")
+        opt_yaml_style["output_format"]["background_writer"] = opt.get(
+            "background_writer"
+        )
+        opt_yaml_style["output_format"]["spatial_index"] = opt.get("spatial_index")
+        opt_yaml_style["output_format"]["tile_size"] = opt.get("tile_size")
+        opt_yaml_style["output_format"]["graph_format"] = opt.get("graph_format")
+        opt_yaml_style["output_format"]["graph_dtype"] = opt.get("graph_dtype")
+        opt_yaml_style["output_format"]["graph_edges"] = opt.get("graph_edges")
+        opt_yaml_style["output_format"]["graph_edge_k"] = opt.get("graph_edge_k")
+        opt_yaml_style["output_format"]["graph_edge_radius"] = opt.get(
+            "graph_edge_radius"
+        )
+        opt_yaml_style["output_format"]["detection_only"] = opt.get("detection_only")
+        opt_yaml_style["output_format"]["instance_map"] = opt.get("instance_map")
+        opt_yaml_style["output_format"]["instance_map_levels"] = opt.get(
+            "instance_map_levels"
+        )
+        opt_yaml_style["output_format"]["contour_encoding"] = opt.get(
+            "contour_encoding"
+        )
+        opt_yaml_style["output_format"]["contour_precision"] = opt.get(
+            "contour_precision"
+        )
+        opt_yaml_style["output_format"]["contour_tolerance"] = opt.get(
+            "contour_tolerance"
+        )
 
         # system setting
         opt_yaml_style["system"] = {}
@@ -715,6 +1592,17 @@ class InferenceWSIParser:
             opt_yaml_style["process_dataset"]["wsi_magnification"] = opt[
                 "wsi_magnification"
             ]
+            opt_yaml_style["process_dataset"]["skip_failed"] = opt.get("skip_failed")
+            opt_yaml_style["process_dataset"]["work_queue"] = opt.get("work_queue")
+            opt_yaml_style["process_dataset"]["lease_timeout"] = opt.get(
+                "lease_timeout"
+            )
+            opt_yaml_style["process_dataset"]["pack_slides"] = opt.get("pack_slides")
+            opt_yaml_style["process_dataset"]["parallel_slides"] = opt.get(
+                "parallel_slides"
+            )
+            opt_yaml_style["process_dataset"]["shard_index"] = opt.get("shard_index")
+            opt_yaml_style["process_dataset"]["num_shards"] = opt.get("num_shards")
         else:
             raise NotImplementedError(
                 "Problem occured - use either process_wsi or process_dataset"
@@ -733,39 +1621,3 @@ class InferenceWSIParser:
 
         inf_conf = InferenceConfiguration(config)
         return inf_conf
-
-
-def get_user_input_with_timeout(
-    prompt: str, timeout: int = 5, default: bool = True
-) -> bool:
-    """Prompt user input, return after timeout
-
-    Args:
-        prompt (str): Prompt to ask
-        timeout (int, optional): Timeout. Defaults to 5.
-        default (bool, optional): Default return value. Defaults to 1 ("yes").
-
-    Returns:
-        bool: Yes (1) or No (0)
-    """
-    print(
-        f"{prompt} (yes/no) [default: {['no','yes'][default]} in {timeout} seconds]: ",
-        end="",
-        flush=True,
-    )
-
-    result = [default]
-
-    def user_input():
-        response = input().strip().lower()
-        if response in ["yes", "y"]:
-            result[0] = True
-        elif response in ["no", "n"]:
-            result[0] = False
-
-    thread = threading.Thread(target=user_input)
-    thread.daemon = True
-    thread.start()
-    thread.join(timeout)
-
-    return result[0]
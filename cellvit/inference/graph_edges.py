@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# Spatial edge construction for cell graphs
+#
+# Edges between the cells of a WSI are built once after cleaning, such that downstream
+# graph models do not need to rebuild them. Supported are k-nearest neighbors and radius
+# graphs (KD-tree, queried chunk-wise) and Delaunay triangulations. Edges are returned
+# in the PyTorch Geometric layout: edge_index with shape (2, num_edges), first row source
+# node, second row target node, and edge_attr with the euclidean edge length (num_edges, 1).
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+from typing import Literal, Tuple
+
+import numpy as np
+import torch
+from scipy.spatial import Delaunay, QhullError, cKDTree
+
+
+def build_edges(
+    positions: torch.Tensor,
+    method: Literal["knn", "radius", "delaunay"],
+    k: int = 8,
+    radius: float = None,
+    chunk_size: int = 100000,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Build spatial edges between cells
+
+    Args:
+        positions (torch.Tensor): Cell positions (num_nodes, 2)
+        method (Literal["knn", "radius", "delaunay"]): Edge construction method:
+            * knn: Each cell is connected to its k nearest neighbors
+            * radius: Each cell is connected to all cells within the radius (at most k nearest neighbors)
+            * delaunay: Edges of the Delaunay triangulation (edges longer than radius are removed)
+        k (int, optional): Number of neighbors (knn) or maximum number of neighbors (radius). Defaults to 8.
+        radius (float, optional): Maximum edge length in pixels. Required for radius, optional for delaunay. Defaults to None.
+        chunk_size (int, optional): Number of cells queried at once (knn, radius). Defaults to 100000.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]:
+            * edge_index (torch.Tensor): Edges (2, num_edges), dtype int64
+            * edge_attr (torch.Tensor): Euclidean edge length (num_edges, 1), dtype float32
+    """
+    assert method in [
+        "knn",
+        "radius",
+        "delaunay",
+    ], "Edge method must be one of 'knn', 'radius' or 'delaunay'"
+    assert method != "radius" or radius is not None, "Radius graph requires a radius"
+    points = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+
+    if method == "delaunay":
+        source, target = delaunay_edges(points)
+        if radius is not None:
+            length = np.linalg.norm(points[source] - points[target], axis=1)
+            source, target = source[length <= radius], target[length <= radius]
+    else:
+        source, target = neighbor_edges(
+            points,
+            k=k,
+            radius=radius if method == "radius" else None,
+            chunk_size=chunk_size,
+        )
+    edge_index = torch.from_numpy(np.stack([source, target]).astype(np.int64))
+    edge_attr = torch.from_numpy(
+        np.linalg.norm(points[source] - points[target], axis=1)
+        .astype(np.float32)
+        .reshape(-1, 1)
+    )
+    return edge_index, edge_attr
+
+
+def neighbor_edges(
+    points: np.ndarray,
+    k: int,
+    radius: float = None,
+    chunk_size: int = 100000,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Edges from each cell (target) to its k nearest neighbors (source), optionally limited to a radius
+
+    The KD-tree is queried chunk-wise, such that the temporary distance matrices stay small
+    for slides with millions of cells.
+
+    Args:
+        points (np.ndarray): Cell positions (num_nodes, 2)
+        k (int): Number of neighbors
+        radius (float, optional): Maximum distance of neighbors. Defaults to None.
+        chunk_size (int, optional): Number of cells queried at once. Defaults to 100000.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Source and target node of each edge
+    """
+    assert k > 0, "Number of neighbors must be greater than 0"
+    num_nodes = len(points)
+    if num_nodes < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    k = min(k, num_nodes - 1)
+    upper_bound = np.inf if radius is None else radius
+    tree = cKDTree(points)
+
+    sources, targets = [], []
+    for start in range(0, num_nodes, chunk_size):
+        distances, neighbors = tree.query(
+            points[start : start + chunk_size],
+            k=k + 1,
+            distance_upper_bound=upper_bound,
+            workers=-1,
+        )
+        node_ids = np.arange(start, start + len(neighbors))[:, None]
+        # remove the cell itself and missing neighbors (outside of the radius)
+        valid = np.isfinite(distances) & (neighbors != node_ids)
+        # duplicated positions: keep at most k neighbors per cell
+        valid &= np.cumsum(valid, axis=1) <= k
+        sources.append(neighbors[valid])
+        targets.append(np.broadcast_to(node_ids, neighbors.shape)[valid])
+    return np.concatenate(sources), np.concatenate(targets)
+
+
+def delaunay_edges(points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Edges of the Delaunay triangulation, in both directions
+
+    Args:
+        points (np.ndarray): Cell positions (num_nodes, 2)
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Source and target node of each edge
+    """
+    if len(points) < 3:
+        return neighbor_edges(points, k=1)
+    try:
+        triangulation = Delaunay(points)
+    except QhullError:
+        # all cells on a line, no triangulation possible: connect neighbors on the line
+        return neighbor_edges(points, k=2)
+    indptr, neighbors = triangulation.vertex_neighbor_vertices
+    targets = np.repeat(np.arange(len(points)), np.diff(indptr))
+    return neighbors.astype(np.int64), targets
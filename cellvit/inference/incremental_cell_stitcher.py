@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+# Incremental removal of duplicated cells while the inference is still running
+#
+# Cells detected in the overlap of two patches can only be compared with cells of
+# the neighbouring patches. The margin cells are therefore grouped into connected
+# components of cells that may be duplicates of each other. A component is cleaned
+# once, as soon as no missing patch can add a cell to it, without waiting for the whole WSI.
+# Components are independent of each other, large cleaning steps are therefore split into
+# tasks of whole components, which are cleaned in parallel by an executor (e.g., a process pool).
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+from concurrent.futures import Executor
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+import torch
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+Patch = Tuple[int, int]
+
+NEIGHBOUR_OFFSETS = [(dr, dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1)]
+
+
+class IncrementalCellStitcher:
+    def __init__(
+        self,
+        patch_coordinates: Iterable[Patch],
+        cell_cleaner: Callable[[List[dict]], List[int]],
+        sink: Callable[
+            [List[dict], List[dict], List[torch.Tensor], List[torch.Tensor]], None
+        ],
+        link_distance: float = 6.0,
+        executor: Executor = None,
+        min_cells_per_task: int = 2000,
+    ) -> None:
+        """Resolve cells detected multiple times in overlapping patches while the inference is running
+
+        Post-processed batches are handed over with `add_batch` in arbitrary order. Cells in the mid
+        of a patch can never be duplicated and are therefore passed directly to the sink.
+        The margin cells are grouped into components of cells from different patches with intersecting
+        bounding boxes. Each component is cleaned exactly once with the cell_cleaner, as soon as all
+        neighbours of all patches contributing to the component are available (or discarded by the dataloader).
+        Thus, every duplicate group is decided by one call over all of its cells, ordered by patch,
+        which is identical to cleaning all cells of the WSI at once.
+
+        Args:
+            patch_coordinates (Iterable[Patch]): (row, col) coordinates of all patches that are processed.
+                Patches that are not listed here are treated as non-existing.
+            cell_cleaner (Callable[[List[dict]], List[int]]): Function returning the indices of the cells to keep,
+                e.g., CellViTInference._post_process_edge_cells
+            sink (Callable[[List[dict], List[dict], List[torch.Tensor], List[torch.Tensor]], None]): Receives the finalized cells
+                as (cell_dicts, cell_detections, cell_tokens, cell_positions)
+            link_distance (float, optional): Cells are linked if their bounding boxes, enlarged by half of this distance,
+                intersect. Must cover the maximum distance of duplicates with disjoint bounding boxes
+                (radius of the CentroidCellCleaner). Defaults to 6.0.
+            executor (Executor, optional): Executor cleaning independent components in parallel, e.g., a ProcessPoolExecutor.
+                The cell_cleaner must be picklable for process pools (e.g., cellvit.inference.cell_cleaning.clean_cells).
+                Defaults to None (cleaning in the calling thread).
+            min_cells_per_task (int, optional): Minimum number of cells of a parallel cleaning task, smaller cleaning steps
+                are not split. Defaults to 2000.
+        """
+        assert link_distance >= 0, "Link distance must be non-negative"
+        assert (
+            min_cells_per_task > 0
+        ), "Minimum number of cells per task must be greater than 0"
+        self.cell_cleaner = cell_cleaner
+        self.sink = sink
+        self.link_distance = link_distance
+        self.executor = executor
+        self.min_cells_per_task = min_cells_per_task
+
+        self.expected: Set[Patch] = {(int(r), int(c)) for r, c in patch_coordinates}
+        self.available: Set[Patch] = set()  # processed or discarded
+        self.complete: Set[Patch] = set()  # available with all neighbours available
+        self.resolved: Set[Patch] = set()  # available without pending margin cells
+        # margin cells that are not decided yet, by patch and id (arrival order)
+        self.margin_cells: Dict[Patch, Dict[int, tuple]] = {}
+        # patches with margin cells, border cells overlapping these patches are dropped
+        self.patches_with_margin_cells: Set[Patch] = set()
+
+        # state of the pending margin cells, updated with each batch
+        self._next_cell_id: int = 0
+        self._cell_patch: Dict[int, Patch] = {}
+        self._cell_bounds: Dict[int, np.ndarray] = {}
+        # cells of neighbouring patches with intersecting enlarged bounding boxes
+        self._links: Dict[int, List[int]] = {}
+        # border cells waiting for margin cells of the neighbouring patch they overlap
+        self._border_cells: Dict[Patch, List[int]] = {}
+
+        self.num_cells_emitted: int = 0
+        self.num_cells_received: int = 0
+
+    def neighbours(self, patch: Patch) -> List[Patch]:
+        """Return the existing patches of the 3x3 neighbourhood (always including the patch itself)
+
+        Args:
+            patch (Patch): (row, col)
+
+        Returns:
+            List[Patch]: Existing patches, sorted by row and col
+        """
+        row, col = patch
+        return sorted(
+            (row + dr, col + dc)
+            for dr, dc in NEIGHBOUR_OFFSETS
+            if (row + dr, col + dc) in self.expected or (dr, dc) == (0, 0)
+        )
+
+    def mark_discarded(self, patches: Iterable[Patch]) -> None:
+        """Mark patches as discarded (e.g., removed by the dataloader), no cells are expected for them
+
+        Args:
+            patches (Iterable[Patch]): (row, col) coordinates of discarded patches
+        """
+        patches = [(int(r), int(c)) for r, c in patches]
+        self.available.update(patches)
+        self._resolve_ready(patches, seeds=set())
+
+    def add_batch(
+        self,
+        patches: List[Patch],
+        batch_results: Tuple[
+            List[dict], List[dict], List[torch.Tensor], List[torch.Tensor]
+        ],
+    ) -> None:
+        """Add the post-processing results of one batch
+
+        Args:
+            patches (List[Patch]): (row, col) coordinates of all patches in this batch (including patches without cells)
+            batch_results (Tuple[List[dict], List[dict], List[torch.Tensor], List[torch.Tensor]]): Output of the
+                BatchPoolingActor: (cell_dicts, cell_detections, cell_tokens, cell_positions)
+        """
+        patches = [(int(r), int(c)) for r, c in patches]
+        cell_dicts, cell_detections, cell_tokens, cell_positions = batch_results
+        self.num_cells_received += len(cell_dicts)
+
+        mid_cells, new_margin_cells = [], {}
+        for cell in zip(cell_dicts, cell_detections, cell_tokens, cell_positions):
+            if cell[0]["cell_status"] == 0:
+                mid_cells.append(cell)
+            else:
+                patch = tuple(cell[0]["patch_coordinates"])
+                new_margin_cells.setdefault(patch, []).append(cell)
+        self._emit(mid_cells)
+
+        seeds = self._add_margin_cells(new_margin_cells)
+        self.available.update(patches)
+        self._resolve_ready(patches, seeds=seeds)
+
+    def finalize(self) -> None:
+        """Resolve all remaining cells, even if neighbours are missing. Call after the last batch."""
+        self._decide(list(self._cell_patch))
+        self.margin_cells = {}
+
+    def _add_margin_cells(self, new_margin_cells: Dict[Patch, List[tuple]]) -> Set[int]:
+        """Store the new margin cells and link them with the pending cells of the neighbouring patches
+
+        Border cells covered by a neighbouring patch with margin cells are dropped (also pending border cells
+        of other patches, once the patch they overlap receives margin cells). The rule is identical to the cell
+        cleaners, but is applied with the margin cells of all patches of the WSI, not just the patches of one component.
+        Just the new cells and the cells of their neighbouring patches are touched.
+
+        Args:
+            new_margin_cells (Dict[Patch, List[tuple]]): Margin cells of the batch by patch
+
+        Returns:
+            Set[int]: Pending cells that were linked to dropped cells, their components might have become complete
+        """
+        newly_marked = set(new_margin_cells) - self.patches_with_margin_cells
+        self.patches_with_margin_cells.update(new_margin_cells)
+        seeds = set()
+        for patch in sorted(newly_marked):
+            for cell_id in self._border_cells.pop(patch, []):
+                if cell_id in self._cell_patch:
+                    seeds.update(self._links[cell_id])
+                    self._remove_cell(cell_id)
+
+        for patch in sorted(new_margin_cells):
+            cell_ids = []
+            for cell in new_margin_cells[patch]:
+                edge_patch = None
+                if cell[0].get("edge_position", False):
+                    edge_patches = cell[0]["edge_information"]["edge_patches"]
+                    if edge_patches is None:
+                        continue
+                    edge_patch = tuple(edge_patches[0])
+                    if edge_patch in self.patches_with_margin_cells:
+                        continue
+                cell_id = self._next_cell_id
+                self._next_cell_id += 1
+                if edge_patch is not None:
+                    self._border_cells.setdefault(edge_patch, []).append(cell_id)
+                self.margin_cells.setdefault(patch, {})[cell_id] = cell
+                self._cell_patch[cell_id] = patch
+                self._links[cell_id] = []
+                cell_ids.append(cell_id)
+            if len(cell_ids) == 0:
+                continue
+
+            bboxes = np.array(
+                [self.margin_cells[patch][idx][0]["bbox"] for idx in cell_ids],
+                dtype=np.float64,
+            )
+            bounds = np.concatenate(
+                [np.flip(bboxes[:, 0], axis=1), np.flip(bboxes[:, 1], axis=1)],
+                axis=1,
+            )  # minx, miny, maxx, maxy
+            bounds[:, :2] -= self.link_distance / 2
+            bounds[:, 2:] += self.link_distance / 2
+            self._cell_bounds.update(zip(cell_ids, bounds))
+
+            # cells can just intersect cells of the neighbouring patches
+            neighbour_ids = [
+                idx
+                for neighbour in self.neighbours(patch)
+                if neighbour != patch
+                for idx in self.margin_cells.get(neighbour, {})
+            ]
+            if len(neighbour_ids) == 0:
+                continue
+            rows, cols = get_overlap_pairs(
+                bounds, np.stack([self._cell_bounds[idx] for idx in neighbour_ids])
+            )
+            for row, col in zip(rows.tolist(), cols.tolist()):
+                self._links[cell_ids[row]].append(neighbour_ids[col])
+                self._links[neighbour_ids[col]].append(cell_ids[row])
+        return seeds
+
+    def _resolve_ready(self, patches: List[Patch], seeds: Set[int]) -> None:
+        """Resolve all components that became complete by adding the given patches
+
+        A component can only become complete if at least one of its patches became complete
+        or if a dropped border cell connected it to an incomplete patch.
+
+        Args:
+            patches (List[Patch]): Newly available patches
+            seeds (Set[int]): Further pending cells whose components might have become complete
+        """
+        candidates = set()
+        for patch in patches:
+            candidates.update(self.neighbours(patch))
+        newly_complete = [
+            patch
+            for patch in sorted(candidates - self.complete)
+            if patch in self.available
+            and all(n in self.available for n in self.neighbours(patch))
+        ]
+        self.complete.update(newly_complete)
+        for patch in newly_complete:
+            seeds.update(self.margin_cells.get(patch, {}))
+        self._resolve_components(seeds)
+        self.resolved.update(p for p in patches if p not in self.margin_cells)
+
+    def _resolve_components(self, seeds: Set[int]) -> None:
+        """Clean all complete components containing one of the seed cells and emit the kept cells
+
+        Components are traversed along the links of the pending cells, the traversal stops as soon as a cell
+        of an incomplete patch is reached. Thus, the cost depends on the size of the touched components, not on
+        the number of pending cells.
+
+        Args:
+            seeds (Set[int]): Pending cells whose components might have become complete
+        """
+        decided, visited = [], set()
+        for seed in sorted(seeds):
+            if seed in visited or seed not in self._cell_patch:
+                continue
+            component, complete = self._traverse_component(seed, visited)
+            visited.update(component)
+            if complete:
+                decided.extend(component)
+        self._decide(decided)
+
+    def _traverse_component(
+        self, seed: int, visited: Set[int]
+    ) -> Tuple[Set[int], bool]:
+        """Collect the component of a pending cell, stopping at cells of incomplete patches
+
+        Args:
+            seed (int): Id of a pending cell
+            visited (Set[int]): Cells of components traversed before in this step
+
+        Returns:
+            Tuple[Set[int], bool]: Traversed cells and if the component is complete (all cells traversed)
+        """
+        component, stack = {seed}, [seed]
+        while len(stack) > 0:
+            cell_id = stack.pop()
+            if self._cell_patch[cell_id] not in self.complete:
+                return component, False
+            for linked_id in self._links[cell_id]:
+                if linked_id in component or linked_id not in self._cell_patch:
+                    continue
+                if linked_id in visited:
+                    # part of a component that has been found incomplete before
+                    return component, False
+                component.add(linked_id)
+                stack.append(linked_id)
+        return component, True
+
+    def _decide(self, cell_ids: List[int]) -> None:
+        """Clean the given pending cells in one step, emit the kept cells and remove all of them
+
+        Each component is decided exactly once by a single call of the cell_cleaner over the union of
+        the cells of all patches involved. Cells are passed ordered by patch and by arrival inside a patch,
+        such that the result does not depend on the order of the batches. Components are independent
+        of each other, thus all complete components are cleaned in one call.
+
+        Args:
+            cell_ids (List[int]): Ids of the pending cells of complete components
+        """
+        if len(cell_ids) == 0:
+            return
+        cell_ids = sorted(cell_ids, key=lambda idx: (self._cell_patch[idx], idx))
+        cells = [self.margin_cells[self._cell_patch[idx]][idx] for idx in cell_ids]
+        bounds = np.stack([self._cell_bounds[idx] for idx in cell_ids])
+        keep_idx = self._clean([cell[0] for cell in cells], bounds)
+        self._emit([cells[idx] for idx in keep_idx])
+        for cell_id in cell_ids:
+            self._remove_cell(cell_id)
+
+    def _clean(self, cell_dicts: List[dict], bounds: np.ndarray) -> List[int]:
+        """Clean the decided cells, split into parallel tasks of whole components if an executor is set
+
+        Tasks consist of components linked regardless of the patch, as the OverlapCellCleaner also merges
+        overlapping cells of the same patch. Each task keeps the order of the cells, such that the result
+        is identical to a single call over all cells.
+
+        Args:
+            cell_dicts (List[dict]): Cells to clean
+            bounds (np.ndarray): Enlarged bounding box of each cell as (minx, miny, maxx, maxy). Shape: (N, 4)
+
+        Returns:
+            List[int]: Sorted indices of the kept cells
+        """
+        if self.executor is None or len(cell_dicts) < 2 * self.min_cells_per_task:
+            return sorted(self.cell_cleaner(cell_dicts))
+
+        labels = get_overlap_components(bounds)
+        order = np.argsort(labels, kind="stable")
+        sorted_labels = labels[order]
+        starts = np.flatnonzero(
+            np.concatenate([[True], sorted_labels[1:] != sorted_labels[:-1]])
+        )
+        # split at the first component start after every min_cells_per_task cells
+        targets = np.arange(
+            self.min_cells_per_task, len(cell_dicts), self.min_cells_per_task
+        )
+        positions = np.searchsorted(starts, targets)
+        cuts = np.unique(starts[positions[positions < len(starts)]])
+        tasks = [np.sort(task) for task in np.split(order, cuts)]
+
+        futures = [
+            self.executor.submit(self.cell_cleaner, [cell_dicts[idx] for idx in task])
+            for task in tasks
+        ]
+        keep_idx = []
+        for task, future in zip(tasks, futures):
+            keep_idx.extend(task[future.result()].tolist())
+        return sorted(keep_idx)
+
+    def _remove_cell(self, cell_id: int) -> None:
+        """Remove a decided or dropped cell, its patch is resolved if no margin cells are pending anymore
+
+        Args:
+            cell_id (int): Id of the pending cell
+        """
+        patch = self._cell_patch.pop(cell_id)
+        del self._cell_bounds[cell_id]
+        del self._links[cell_id]
+        del self.margin_cells[patch][cell_id]
+        if len(self.margin_cells[patch]) == 0:
+            del self.margin_cells[patch]
+            if patch in self.available:
+                self.resolved.add(patch)
+
+    def _emit(self, cells: List[tuple]) -> None:
+        """Hand over finalized cells to the sink
+
+        Args:
+            cells (List[tuple]): List with (cell_dict, cell_detection, cell_token, cell_position)
+        """
+        if len(cells) == 0:
+            return
+        self.num_cells_emitted += len(cells)
+        cell_dicts, cell_detections, cell_tokens, cell_positions = zip(*cells)
+        self.sink(
+            list(cell_dicts),
+            list(cell_detections),
+            list(cell_tokens),
+            list(cell_positions),
+        )
+
+
+def get_overlap_pairs(
+    bounds: np.ndarray, other_bounds: np.ndarray = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Index pairs of intersecting bounding boxes
+
+    Candidates are queried with a kd-tree on the box centers (Chebyshev distance up to the largest box extent),
+    such that only nearby boxes are compared, regardless of their arrangement.
+
+    Args:
+        bounds (np.ndarray): Bounding boxes as (minx, miny, maxx, maxy). Shape: (N, 4)
+        other_bounds (np.ndarray, optional): Second set of bounding boxes. Shape: (M, 4).
+            Defaults to None (pairs i < j inside bounds).
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Indices of intersecting pairs (into bounds and into other_bounds or bounds)
+    """
+    second = bounds if other_bounds is None else other_bounds
+    if len(bounds) == 0 or len(second) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # boxes intersect only if their centers are closer than the largest box extent in x and y
+    extent = max(
+        (bounds[:, 2:] - bounds[:, :2]).max(), (second[:, 2:] - second[:, :2]).max()
+    )
+    extent = extent * (1 + 1e-9) + 1e-9
+    tree = cKDTree((bounds[:, :2] + bounds[:, 2:]) / 2)
+    if other_bounds is None:
+        pairs = tree.query_pairs(extent, p=np.inf, output_type="ndarray")
+        rows, cols = pairs[:, 0], pairs[:, 1]
+    else:
+        pairs = tree.sparse_distance_matrix(
+            cKDTree((second[:, :2] + second[:, 2:]) / 2),
+            extent,
+            p=np.inf,
+            output_type="ndarray",
+        )
+        rows, cols = pairs["i"], pairs["j"]
+    rows, cols = rows.astype(np.int64), cols.astype(np.int64)
+    hits = (
+        (bounds[rows, 0] <= second[cols, 2])
+        & (second[cols, 0] <= bounds[rows, 2])
+        & (bounds[rows, 1] <= second[cols, 3])
+        & (second[cols, 1] <= bounds[rows, 3])
+    )
+    return rows[hits], cols[hits]
+
+
+def get_overlap_components(bounds: np.ndarray, groups: np.ndarray = None) -> np.ndarray:
+    """Label the connected components of cells with intersecting bounding boxes
+
+    Args:
+        bounds (np.ndarray): Bounding box of each cell as (minx, miny, maxx, maxy). Shape: (N, 4)
+        groups (np.ndarray, optional): Group of each cell (e.g., the patch). Cells of the same group
+            are never linked. Shape: (N,). Defaults to None.
+
+    Returns:
+        np.ndarray: Component label for each cell
+    """
+    num_cells = len(bounds)
+    if num_cells == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    rows, cols = get_overlap_pairs(bounds)
+    if groups is not None:
+        groups = np.asarray(groups)
+        hits = groups[rows] != groups[cols]
+        rows, cols = rows[hits], cols[hits]
+
+    adjacency = coo_matrix(
+        (np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(num_cells, num_cells)
+    )
+    _, labels = connected_components(adjacency, directed=False)
+
+    return labels.astype(np.int64)
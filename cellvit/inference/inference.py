@@ -14,47 +14,69 @@
 
 import sys
 
-import itertools
 import logging
-import uuid
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from functools import partial
 from pathlib import Path
-from typing import Callable, List, Literal, Tuple, Union
+from typing import IO, Callable, List, Literal, Tuple, Union
 from importlib.resources import files
 
 import numpy as np
-import pandas as pd
 import ray
-import snappy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import tqdm
 import ujson
-from pathopatch.patch_extraction.dataset import (
-    LivePatchWSIConfig,
-    LivePatchWSIDataloader,
-    LivePatchWSIDataset,
-)
 from torchvision import transforms as T
 
-from cellvit.config.config import COLOR_DICT_CELLS, TYPE_NUCLEI_DICT_PANNUKE
-from cellvit.config.templates import get_template_point, get_template_segmentation
+from cellvit.config.config import TYPE_NUCLEI_DICT_PANNUKE
 from cellvit.data.dataclass.cell_graph import CellGraphDataWSI
 from cellvit.data.dataclass.wsi import WSIMetadata
-from cellvit.data.dataclass.wsi_meta import load_wsi_meta
-from cellvit.inference.overlap_cell_cleaner import OverlapCellCleaner
+from cellvit.inference.batch_packing import SlideBatchPacker, SlideInferenceState
+from cellvit.inference.cell_cleaning import clean_cells
+from cellvit.inference.graph_edges import build_edges
+from cellvit.inference.incremental_cell_stitcher import IncrementalCellStitcher
+from cellvit.inference.peak_detection import summarize_comparison
 from cellvit.models.cell_segmentation.cellvit import CellViT
 from cellvit.models.cell_segmentation.cellvit_256 import CellViT256
 from cellvit.models.cell_segmentation.cellvit_sam import CellViTSAM
 from cellvit.models.classifier.linear_classifier import LinearClassifier
+from cellvit.output.cell_json import write_cell_json
+from cellvit.output.compression import COMPRESSION_SUFFIXES, open_compressed
+from cellvit.output.background_writer import BackgroundWriter
+from cellvit.output.geojson import write_geojson
+from cellvit.output.graph_store import TokenStore, write_graph_store
+from cellvit.output.contour_codec import contour_encoding_metadata, simplify_contours
+from cellvit.output.instance_map import InstanceMapWriter
+from cellvit.output.spatial_index import hilbert_order, write_spatial_index
+from cellvit.output.tiles import write_tiles
+from cellvit.utils.artifact_cache import ArtifactCache
 from cellvit.utils.cache_models import (
     cache_cellvit_256,
     cache_cellvit_sam_h,
     cache_classifier,
 )
+from cellvit.utils.coordinate_transform import AffineTransform
 from cellvit.utils.logger import Logger
 from cellvit.utils.ressource_manager import SystemConfiguration, retrieve_actor_usage
+from cellvit.utils.run_ledger import (
+    RunLedger,
+    combined_status,
+    config_hash,
+    slide_fingerprint,
+)
 from cellvit.utils.tools import unflatten_dict
+from cellvit.utils.weight_cache import (
+    WEIGHT_DTYPES,
+    load_inference_weights,
+    weight_cache_supported,
+)
+
+# pandas, shapely and pathopatch (WSI loading) are imported by the processing steps that need them
 
 PYTHON_PATH = sys.executable
 CHECK_RAY_PATH = str(files("cellvit.utils").joinpath("check_ray.py"))
@@ -83,7 +105,38 @@ class CellViTInference:
         geojson: bool = False,
         graph: bool = False,
         compression: bool = False,
+        compression_codec: Literal["snappy", "zstd"] = "snappy",
+        compression_level: int = 3,
+        compression_threads: int = 0,
         enforce_amp: bool = False,
+        cell_cleaner: Literal["polygon", "centroid"] = "polygon",
+        cell_cleaner_strategy: Literal["area", "probability"] = "area",
+        cell_cleaner_radius: float = 6.0,
+        cleaning_workers: int = 0,
+        file_format: Literal["json", "arrow", "parquet"] = "json",
+        background_writer: bool = False,
+        spatial_index: bool = False,
+        tile_size: int = None,
+        graph_format: Literal["pt", "mmap"] = "pt",
+        graph_dtype: Literal["float32", "float16"] = "float32",
+        graph_edges: Literal["knn", "radius", "delaunay"] = None,
+        graph_edge_k: int = 8,
+        graph_edge_radius: float = None,
+        detection_only: bool = False,
+        detection_engine: Literal["watershed", "peaks"] = "watershed",
+        detection_validation_interval: int = 0,
+        instance_map: bool = False,
+        instance_map_levels: int = 4,
+        contour_encoding: bool = False,
+        contour_precision: float = 1.0,
+        contour_tolerance: float = 0.0,
+        ledger_path: Union[Path, str] = None,
+        shared_model: dict = None,
+        ray_address: str = None,
+        weight_cache: bool = True,
+        weight_dtype: Literal["float32", "float16", "bfloat16"] = "float32",
+        compile_model: bool = False,
+        artifact_cache_size: float = 10240,
         debug: bool = False,
     ) -> None:
         """CellViT Inference Class
@@ -100,9 +153,67 @@ class CellViTInference:
             overlap (int, optional): Overlap between patches. Defaults to 64.
             geojson (bool, optional): If a geojson export should be performed. Defaults to False.
             graph (bool, optional): If a graph export should be performed. Defaults to False.
-            compression (bool, optional): If a snappy compression should be performed. Defaults to False.
+            compression (bool, optional): If the outputs should be compressed (see compression_codec). Defaults to False.
+            compression_codec (Literal["snappy", "zstd"], optional): Codec for streaming compression. "snappy" uses the snappy framing format,
+                "zstd" requires zstandard. Defaults to "snappy".
+            compression_level (int, optional): Compression level (just zstd). Defaults to 3.
+            compression_threads (int, optional): Number of compression worker threads (just zstd), 0 disables multithreading. Defaults to 0.
             enforce_amp (bool, optional): Using PyTorch autocasting with dtype float16 to speed up inference. Also good for trained amp networks.
                 Can be used to enforce amp inference even for networks trained without amp. Otherwise, the network setting is used. Defaults to False.
+            cell_cleaner (Literal["polygon", "centroid"], optional): Method to remove cells detected multiple times in overlapping patches.
+                "polygon" uses the contour overlap (shapely), "centroid" uses a KD-tree on the cell centroids (faster, recommended if only detections are needed).
+                Defaults to "polygon".
+            cell_cleaner_strategy (Literal["area", "probability"], optional): Cell kept of duplicated detections, the one with the
+                largest bounding box area or the highest type probability (just centroid cell cleaner). Defaults to "area".
+            cell_cleaner_radius (float, optional): Maximum centroid distance in pixels of duplicated detections (just centroid cell cleaner).
+                Defaults to 6.0.
+            cleaning_workers (int, optional): Number of worker processes cleaning independent groups of overlapping cells in parallel.
+                Defaults to 0 (cleaning in the inference process).
+            file_format (Literal["json", "arrow", "parquet"], optional): File format for storing cells and detections.
+                "arrow" (Arrow IPC, memory-mappable) and "parquet" require pyarrow. Defaults to "json".
+            background_writer (bool, optional): If outputs should be written in background threads while the next WSI is processed.
+                Call flush_outputs to wait for all outputs. Defaults to False.
+            spatial_index (bool, optional): If cells should be stored in Hilbert order together with a spatial index (.sidx)
+                for region queries (see cellvit.output.spatial_index). Not available for compressed json. Defaults to False.
+            tile_size (int, optional): If provided, cells are additionally stored in spatial tiles of this size (in pixels)
+                with coarser levels and a manifest for viewers (see cellvit.output.tiles). Defaults to None.
+            graph_format (Literal["pt", "mmap"], optional): Storage format of the graph. "pt" stores a CellGraphDataWSI (cells.pt),
+                "mmap" appends the tokens to a preallocated file on disk while the inference is running and stores a memory-mappable
+                directory (cells_graph, see cellvit.output.graph_store). Defaults to "pt".
+            graph_dtype (Literal["float32", "float16"], optional): Dtype of the stored cell tokens. Defaults to "float32".
+            graph_edges (Literal["knn", "radius", "delaunay"], optional): If provided, spatial edges between the cells are built
+                and stored as edge_index/edge_attr in the graph (see cellvit.inference.graph_edges). Defaults to None.
+            graph_edge_k (int, optional): Number of neighbors (knn) or maximum number of neighbors (radius). Defaults to 8.
+            graph_edge_radius (float, optional): Maximum edge length in pixels, required for radius, optional for delaunay. Defaults to None.
+            detection_only (bool, optional): If just bbox, centroid and type of the cells should be extracted, without contours.
+                Cells are cleaned with the centroid cleaner and just the detections (cell_detection) are stored. Defaults to False.
+            detection_engine (Literal["watershed", "peaks"], optional): Method for separating the nuclei. "peaks" detects the nucleus
+                centers without watershed (see cellvit.inference.peak_detection) and implies detection_only. Defaults to "watershed".
+            detection_validation_interval (int, optional): For the peak engine, every n-th batch is additionally processed with the
+                watershed and both detections are compared (stored as detection_validation.json). 0 disables the validation. Defaults to 0.
+            instance_map (bool, optional): If the stitched instance label map should be exported as chunked zarr store
+                (see cellvit.output.instance_map). Not available for the peak detection engine. Defaults to False.
+            instance_map_levels (int, optional): Number of resolution levels of the instance map. Defaults to 4.
+            contour_encoding (bool, optional): If contours should be stored compactly encoded (see cellvit.output.contour_codec),
+                as base64 strings in json and as binary column in arrow/parquet files and tiles. Defaults to False.
+            contour_precision (float, optional): Quantization step of encoded contours in pixels. Defaults to 1.0.
+            contour_tolerance (float, optional): Tolerance in pixels for simplifying the contours (Douglas-Peucker),
+                0 disables the simplification. Defaults to 0.0.
+            ledger_path (Union[Path, str], optional): Path to the run ledger, e.g., one ledger per shard of a job array.
+                Defaults to None (outdir/run_ledger.sqlite).
+            shared_model (dict, optional): Model loaded by another process with weights in shared memory (see share_model),
+                used instead of loading the checkpoint. Defaults to None.
+            ray_address (str, optional): Address of a running Ray cluster to connect to (e.g., of the process sharing the model).
+                Defaults to None (a new Ray cluster is started).
+            weight_cache (bool, optional): If the checkpoint should be converted once into inference-only weights, which are memory-mapped
+                and assigned to a model created on the meta device (see cellvit.utils.weight_cache). Lowers the startup time and peak memory.
+                Requires PyTorch >= 2.1, ignored for older versions. Defaults to True.
+            weight_dtype (Literal["float32", "float16", "bfloat16"], optional): Dtype of the cached weights. Half precision halves the
+                size of the cache file, the weights are cast back to float32 for inference. Defaults to "float32".
+            compile_model (bool, optional): If the model should be compiled with torch.compile. The compiled artifacts are cached
+                (see cellvit.utils.artifact_cache), such that just the first start compiles. Defaults to False.
+            artifact_cache_size (float, optional): Maximum size of the artifact cache in MB, least recently used artifacts are evicted.
+                Defaults to 10240.
             debug (bool, optional): If debug level. Defaults to False.
 
         Attributes:
@@ -115,12 +226,45 @@ class CellViTInference:
             overlap (int): Overlap between patches
             geojson (bool): If a geojson export should be performed
             graph (bool): If a graph export should be performed
-            compression (bool): If a snappy compression should be performed
+            compression (bool): If the outputs should be compressed
+            compression_codec (Literal["snappy", "zstd"]): Codec for streaming compression
+            compression_level (int): Compression level (just zstd)
+            compression_threads (int): Number of compression worker threads (just zstd)
+            cell_cleaner (Literal["polygon", "centroid"]): Method to remove cells detected multiple times in overlapping patches
+            cell_cleaner_strategy (Literal["area", "probability"]): Cell kept of duplicated detections (just centroid cell cleaner)
+            cell_cleaner_radius (float): Maximum centroid distance of duplicated detections (just centroid cell cleaner)
+            cleaning_workers (int): Number of worker processes cleaning overlapping cells in parallel
+            file_format (Literal["json", "arrow", "parquet"]): File format for storing cells and detections
+            background_writer (bool): If outputs should be written in background threads
+            spatial_index (bool): If cells should be stored in Hilbert order together with a spatial index
+            tile_size (int): Tile size for the tiled output, None if disabled
+            graph_format (Literal["pt", "mmap"]): Storage format of the graph
+            graph_dtype (Literal["float32", "float16"]): Dtype of the stored cell tokens
+            graph_edges (Literal["knn", "radius", "delaunay"]): Method for building spatial edges, None if disabled
+            graph_edge_k (int): Number of neighbors (knn) or maximum number of neighbors (radius)
+            graph_edge_radius (float): Maximum edge length in pixels
+            detection_only (bool): If just detections without contours should be extracted
+            detection_engine (Literal["watershed", "peaks"]): Method for separating the nuclei
+            detection_validation_interval (int): Interval of batches compared with the watershed detection, 0 if disabled
+            instance_map (bool): If the stitched instance label map should be exported
+            instance_map_levels (int): Number of resolution levels of the instance map
+            contour_encoding (bool): If contours should be stored compactly encoded
+            contour_precision (float): Quantization step of encoded contours in pixels
+            contour_tolerance (float): Tolerance for simplifying the contours in pixels, 0 if disabled
+            ledger_path (Path): Path to the run ledger
+            shared_model (dict): Model loaded by another process, None if the checkpoint is loaded
+            ray_address (str): Address of the Ray cluster to connect to, None if a new cluster is started
+            weight_cache (bool): If the inference-only weight cache is used
+            weight_dtype (str): Dtype of the cached weights
+            compile_model (bool): If the model is compiled with torch.compile
+            artifact_cache_size (float): Maximum size of the artifact cache in MB
             debug (bool): If debug level
             logger (Logger): Logger
             model (CellViT): Model
             model_arch (str): Model architecture
+            model_path (Path): Path to the checkpoint
             run_conf (dict): Run configuration
+            startup_timings (dict): Durations of the startup steps in seconds (model, classifier, ray, compilation, total)
             inference_transforms (Callable): Inference transformations
             mixed_precision (bool): Using PyTorch autocasting with dtype float16 to speed up inference. Also good for trained amp networks.
             num_workers_torch (int): Number of workers for PyTorch
@@ -128,12 +272,24 @@ class CellViTInference:
             classifier (nn.Module): Classifier
             binary (bool): If binary detection
             device (torch.device): Device
+            writer (BackgroundWriter): Writer for the output files
+            ledger (RunLedger): Ledger of all processing attempts (ledger_path)
+            ledger_paths (List[Path]): Run ledgers consulted for the status of a WSI (own ledger and all ledgers next to it)
+            config_hash (str): Hash of the configuration influencing the outputs
 
         Methods:
             _instantiate_logger() -> None:
                 Instantiate logger
+            _setup_writer() -> None:
+                Setup the writer for the output files
+            _setup_ledger() -> None:
+                Open the run ledger and hash the output configuration
+            _resolve_ledger_paths() -> None:
+                Collect the run ledgers consulted for the status of a WSI, once per run
             _load_model() -> None:
-                Load model and checkpoint and load the state_dict
+                Load model and checkpoint and load the state_dict (or use the shared model)
+            share_model() -> dict:
+                Move the model weights to shared memory and return the model for other processes
             _get_model(model_type: Literal["CellViT256", "CellViTSAM"]) -> CellViT:
                 Return the trained model for inference (CellViT-Backbone)
             _check_devices() -> None:
@@ -144,22 +300,84 @@ class CellViTInference:
                 Load the inference transformations from the run_configuration
             _setup_amp(enforce_amp: bool=False) -> None:
                 Setup automated mixed precision (amp) for inference
+            _setup_compilation() -> None:
+                Compile the model, using cached compiled artifacts if available
+            _save_compiled_artifacts() -> None:
+                Store the compiled artifacts in the artifact cache
             _setup_worker() -> None:
-                Setup the worker for inference
+                Setup the worker for inference (Ray)
+            _setup_dataloader_workers() -> None:
+                Set the number of workers for loading patches
+            _timed_step(name: str, step: Callable[[], None]) -> None:
+                Run a setup step and record its duration in startup_timings
+            _report_startup() -> None:
+                Log the durations of the startup steps
             _import_postprocessing() -> None:
                 Import the postprocessing module
-            process_wsi(wsi_path: Union[Path, str], wsi_mpp: float = None, wsi_magnification: float = None, apply_prefilter: bool = True, filter_patches: bool = False, **kwargs) -> None:
-                Process a whole slide image with CellViT
+            process_wsi(wsi_path: Union[Path, str], wsi_mpp: float = None, wsi_magnification: float = None, apply_prefilter: bool = True, filter_patches: bool = False, on_complete: Callable[[], None] = None, on_error: Callable[[str], None] = None, **kwargs) -> None:
+                Process a whole slide image with CellViT and record the attempt in the run ledger
+            run_status(wsi_path: Union[Path, str], wsi_mpp: float = None, wsi_magnification: float = None) -> Union[str, None]:
+                Status of a WSI in the run ledger for the current configuration
+            _ledger_key(wsi_path: Path, wsi_mpp: float = None, wsi_magnification: float = None) -> Tuple[str, str, str]:
+                Slide path, content fingerprint and configuration hash identifying a WSI in the run ledger
+            process_wsi_group(wsi_jobs: List[dict], apply_prefilter: bool = True, filter_patches: bool = False, **kwargs) -> None:
+                Process multiple whole slide images together, the patches of all WSI are packed into full batches
+            _start_slide(wsi_path: Path, wsi_mpp: float = None, wsi_magnification: float = None, on_complete: Callable[[], None] = None, on_error: Callable[[str], None] = None) -> SlideInferenceState:
+                Record the start of a WSI in the run ledger and create its inference state
+            _prepare_slide(slide: SlideInferenceState, wsi_mpp: float = None, wsi_magnification: float = None, apply_prefilter: bool = True, filter_patches: bool = False, **kwargs) -> None:
+                Load the tissue region and the patches of a WSI and set up its stitcher and output collectors
+            _collect_cells(slide: SlideInferenceState, batch_complete_dict: List[dict], batch_detection: List[dict], batch_cell_tokens: List[torch.Tensor], batch_cell_positions: List[torch.Tensor]) -> None:
+                Sink of the stitcher: collect the cleaned cells of a WSI
+            _run_inference(slides: List[SlideInferenceState]) -> None:
+                Run the model on the (packed) patches of the prepared WSI, postprocess and stitch the results
+            _select_predictions(predictions: dict, patch_range: slice, batch_size: int) -> dict:
+                Select the predictions of a range of patches in the batch
+            _finalize_slides(slides: List[SlideInferenceState]) -> None:
+                Submit the outputs of all WSI whose patches have been processed and stitched completely
+            _finalize_slide(slide: SlideInferenceState) -> None:
+                Transform the collected cells of a WSI into slide coordinates and submit its outputs to the writer
             apply_softmax_reorder(predictions: dict) -> dict:
                 Reorder and apply softmax on predictions
-            _post_process_edge_cells(cell_list: List[dict]) -> List[int]:
+            _post_process_edge_cells(cell_list: List[dict], logger: logging.Logger = None) -> List[int]:
                 Use the CellPostProcessor to remove multiple cells and merge due to overlap
-            def _reallign_grid(cell_dict_wsi: List[dict], cell_dict_detection: List[dict], graph_data: dict, rescaling_factor: float) -> Tuple[List[dict], List[dict], dict]:
+            _stitch_batch_results(call_ids: List[ray.ObjectRef], call_patches: dict, stitching: ThreadPoolExecutor, wait: bool = False) -> List[ray.ObjectRef]:
+                Retrieve finished postprocessing calls and hand them over to the stitching thread
+            _stitch_slide_batches(slide: SlideInferenceState, batches: List[Tuple[list, tuple]]) -> None:
+                Stitch postprocessed batches of a WSI (runs in the stitching thread)
+            def _reallign_grid(rescaling_factor: float) -> AffineTransform:
                 Reallign grid if interpolation was used (including target_mpp_tolerance)
-            def _convert_json_geojson(cell_dict: List[dict], complete: bool) -> List[dict]:
-                Convert JSON to GeoJSON
-            def _remove_padding(cell_dict_wsi: List[dict], cell_dict_detection: List[dict], graph_data: dict, wsi_dimension: Tuple[int, int]) -> Tuple[List[dict], List[dict], dict]:
+            def _store_cells_columnar(cell_dict: dict, path: Path, detection: bool, spatial_index: bool = False) -> None:
+                Store cells in a columnar file format (Arrow IPC or Parquet)
+            def _open_output(path: Path) -> IO[str]:
+                Open a text file for writing, streaming compressed if compression is used
+            def _store_cells_json(cell_dict: dict, path: Path, spatial_index: bool = False) -> None:
+                Stream cells as json to disk
+            def _store_tiles(cell_dict: dict, outdir: Path, polygons: bool = True) -> None:
+                Store cells in spatial tiles with a manifest
+            def _store_graph(graph_data: dict, path: Path) -> None:
+                Store the cell graph with embeddings
+            def _store_graph_mmap(graph_data: dict, outdir: Path) -> None:
+                Finalize the on-disk token store and store the graph as memory-mappable directory
+            def _build_graph_edges(positions: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+                Build spatial edges between the cells
+            def _store_geojson(cell_list: List[dict], path: Path, polygons: bool) -> None:
+                Stream cells as geojson to disk
+            def _remove_padding(wsi_dimension: Tuple[int, int]) -> AffineTransform:
                 Remove padding from the WSI
+            def _apply_coordinate_transform(coordinate_transform: AffineTransform, cell_dict_wsi: List[dict], cell_dict_detection: List[dict], graph_data: dict) -> Tuple[List[dict], List[dict], dict]:
+                Apply a coordinate transformation on all cells and the graph positions
+            def _simplify_contours(cell_list: List[dict]) -> None:
+                Simplify the contours of all cells with the Douglas-Peucker algorithm
+            def _sort_cells_spatially(cell_dict_wsi: List[dict], cell_dict_detection: List[dict], graph_data: dict, order: np.ndarray = None) -> Tuple[List[dict], List[dict], dict]:
+                Sort cells, detections and graph nodes by the Hilbert index of the cell centroids
+            def _finish_wsi(wsi_path: Path, cell_list: List[dict], run_id: int, timings: dict, submit_time: float, on_complete: Callable[[], None] = None) -> None:
+                Log the cell statistics and mark the WSI as finished in the run ledger after all outputs are written
+            _store_detection_validation(validation_stats: List[dict], path: Path) -> None:
+                Summarize the comparison of the peak detection with the watershed detection and store it
+            flush_outputs() -> None:
+                Wait until the outputs of all processed WSI are written
+            close() -> None:
+                Shut down the worker processes cleaning overlapping cells
         """
         # hand over parameters
         self.model_name: str = model_name.upper()
@@ -172,12 +390,58 @@ class CellViTInference:
         self.geojson: bool = geojson
         self.graph: bool = graph
         self.compression: bool = compression
+        self.compression_codec: str = compression_codec.lower()
+        self.compression_level: int = compression_level
+        self.compression_threads: int = compression_threads
+        self.cell_cleaner: str = cell_cleaner.lower()
+        self.cell_cleaner_strategy: str = cell_cleaner_strategy.lower()
+        self.cell_cleaner_radius: float = cell_cleaner_radius
+        self.cleaning_workers: int = cleaning_workers
+        self.file_format: str = file_format.lower()
+        self.background_writer: bool = background_writer
+        self.spatial_index: bool = spatial_index
+        self.tile_size: int = tile_size
+        self.graph_format: str = graph_format.lower()
+        self.graph_dtype: str = graph_dtype.lower()
+        self.graph_edges: str = graph_edges
+        self.graph_edge_k: int = graph_edge_k
+        self.graph_edge_radius: float = graph_edge_radius
+        self.detection_engine: str = detection_engine.lower()
+        self.detection_validation_interval: int = detection_validation_interval
+        # peak detection does not provide contours
+        self.detection_only: bool = detection_only or self.detection_engine == "peaks"
+        if self.detection_only:
+            # polygon-based cleaning requires contours
+            self.cell_cleaner = "centroid"
+        self.instance_map: bool = instance_map
+        self.instance_map_levels: int = instance_map_levels
+        if self.instance_map and self.detection_engine == "peaks":
+            raise ValueError(
+                "Instance map export is not available for the peak detection engine"
+            )
+        self.contour_encoding: bool = contour_encoding
+        self.contour_precision: float = contour_precision
+        self.contour_tolerance: float = contour_tolerance
+        self.ledger_path: Path = (
+            self.outdir / "run_ledger.sqlite"
+            if ledger_path is None
+            else Path(ledger_path)
+        )
+        self.shared_model: dict = shared_model
+        self.ray_address: str = ray_address
+        self.weight_cache: bool = weight_cache and weight_cache_supported()
+        self.weight_dtype: str = (
+            weight_dtype.lower() if self.weight_cache else "float32"
+        )
+        self.compile_model: bool = compile_model
+        self.artifact_cache_size: float = artifact_cache_size
         self.debug: bool = debug
 
         # derived parameters
         self.logger: Logger
         self.model: CellViT
         self.model_arch: str
+        self.model_path: Path
         self.run_conf: dict
         self.inference_transforms: Callable
         self.mixed_precision: bool
@@ -186,15 +450,71 @@ class CellViTInference:
         self.classifier: nn.Module = None
         self.binary: bool = False
         self.device: torch.device = f"cuda:{self.system_configuration['gpu_index']}"
+        self.writer: BackgroundWriter
+        self.ledger: RunLedger
+        self.ledger_paths: List[Path]
+        self.config_hash: str
+        self.artifact_cache: ArtifactCache = None
+        self.artifact_key: str = None
+        self.startup_timings: dict = {}
+        # worker processes are spawned on the first large cleaning step and shared by all WSI
+        self.cleaning_pool: ProcessPoolExecutor = (
+            ProcessPoolExecutor(
+                max_workers=cleaning_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            if cleaning_workers > 0
+            else None
+        )
 
-        # setup
+        # setup, Ray and the classifier are started while the model weights are loaded
+        startup_start = time.time()
         self._instantiate_logger()
-        self._load_model()
-        self._check_devices()
-        self._load_classifier()
-        self._load_inference_transforms()
-        self._setup_amp(enforce_amp=enforce_amp)
-        self._setup_worker()
+        if weight_cache and not self.weight_cache:
+            self.logger.warning(
+                "The weight cache requires PyTorch >= 2.1, loading the checkpoint without it"
+            )
+        self._setup_writer()
+        self._setup_ledger()
+        with ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="cellvit-startup"
+        ) as executor:
+            ray_startup = executor.submit(self._timed_step, "ray", self._setup_worker)
+            classifier_loading = executor.submit(
+                self._timed_step, "classifier", self._load_classifier
+            )
+            self._timed_step("model", self._load_model)
+            self._check_devices()
+            self._load_inference_transforms()
+            self._setup_amp(enforce_amp=enforce_amp)
+            classifier_loading.result()
+            ray_startup.result()
+        self._setup_dataloader_workers()
+        self._timed_step("compilation", self._setup_compilation)
+        self.startup_timings["total"] = time.time() - startup_start
+        self._report_startup()
+
+    def _timed_step(self, name: str, step: Callable[[], None]) -> None:
+        """Run a setup step and record its duration in startup_timings
+
+        Args:
+            name (str): Name of the step
+            step (Callable[[], None]): Setup step
+        """
+        start = time.time()
+        step()
+        self.startup_timings[name] = time.time() - start
+
+    def _report_startup(self) -> None:
+        """Log the durations of the startup steps"""
+        steps = ", ".join(
+            f"{step}: {duration:.2f} s"
+            for step, duration in self.startup_timings.items()
+            if step != "total"
+        )
+        self.logger.info(
+            f"Startup finished in {self.startup_timings['total']:.2f} s ({steps})"
+        )
 
     def _instantiate_logger(self) -> None:
         """Instantiate logger
@@ -219,8 +539,84 @@ class CellViTInference:
                     "This debug session will not run with ray-dashboard for debugging."
                 )
 
+    def _setup_writer(self) -> None:
+        """Setup the writer for the output files, synchronous if background_writer is disabled"""
+        self.writer = BackgroundWriter(
+            max_workers=4 if self.background_writer else 0,
+            max_pending_slides=1,
+            logger=self.logger,
+        )
+
+    def _setup_ledger(self) -> None:
+        """Open the run ledger and hash the output configuration
+
+        All parameters changing the outputs are hashed, such that a WSI is processed again if one of them changes.
+        Options without effect (e.g., the codec if compression is disabled) are hashed as None.
+        """
+        self.outdir.mkdir(exist_ok=True, parents=True)
+        self.ledger = RunLedger(self.ledger_path)
+        self._resolve_ledger_paths()
+        output_configuration = {
+            "model_name": self.model_name,
+            "nuclei_taxonomy": self.nuclei_taxonomy,
+            "patch_size": self.patch_size,
+            "overlap": self.overlap,
+            "geojson": self.geojson,
+            "graph": self.graph,
+            "compression": self.compression,
+            "compression_codec": self.compression_codec if self.compression else None,
+            "cell_cleaner": self.cell_cleaner,
+            "file_format": self.file_format,
+            "spatial_index": self.spatial_index,
+            "tile_size": self.tile_size,
+            "graph_format": self.graph_format,
+            "graph_dtype": self.graph_dtype,
+            "graph_edges": self.graph_edges,
+            "graph_edge_k": self.graph_edge_k,
+            "graph_edge_radius": self.graph_edge_radius,
+            "detection_only": self.detection_only,
+            "detection_engine": self.detection_engine,
+            "instance_map": self.instance_map,
+            "instance_map_levels": self.instance_map_levels,
+            "contour_encoding": self.contour_encoding,
+            "contour_precision": self._encoded_contour_precision,
+            "contour_tolerance": (
+                self.contour_tolerance if self.contour_encoding else None
+            ),
+        }
+        if self.cell_cleaner == "centroid" and (
+            self.cell_cleaner_strategy != "area" or self.cell_cleaner_radius != 6.0
+        ):
+            # default settings are not hashed, hashes of previous runs stay valid
+            output_configuration["cell_cleaner_strategy"] = self.cell_cleaner_strategy
+            output_configuration["cell_cleaner_radius"] = self.cell_cleaner_radius
+        if self.weight_dtype != "float32":
+            # full precision weights do not change the outputs, hashes of previous runs stay valid
+            output_configuration["weight_dtype"] = self.weight_dtype
+        self.config_hash = config_hash(output_configuration)
+        self.logger.debug(f"Configuration hash: {self.config_hash}")
+
+    def _resolve_ledger_paths(self) -> None:
+        """Collect the run ledgers consulted for the status of a WSI, once per run
+
+        Besides the own ledger, all run_ledger*.sqlite files in its directory are consulted (e.g., ledgers
+        of other shards, of an unsharded run or the merged ledger).
+        """
+        self.ledger_paths = sorted(
+            set(self.ledger_path.parent.glob("run_ledger*.sqlite")) | {self.ledger_path}
+        )
+
     def _load_model(self) -> None:
-        """Load model and checkpoint and load the state_dict"""
+        """Load model and checkpoint and load the state_dict (or use the shared model)"""
+        if self.shared_model is not None:
+            self.logger.info(f"Using shared model: {self.model_name}")
+            self.run_conf = self.shared_model["run_conf"]
+            self.model = self.shared_model["model"]
+            self.model_arch = self.shared_model["model_arch"]
+            self.model_path = self.shared_model["model_path"]
+            self.model.eval()
+            self.model.to(self.device)
+            return
         self.logger.info(f"Loading model: {self.model_name}")
         if self.model_name == "SAM":
             model_path = cache_cellvit_sam_h(logger=self.logger)
@@ -228,20 +624,67 @@ class CellViTInference:
             model_path = cache_cellvit_256(logger=self.logger)
         else:
             raise ValueError("Unknown model name. Please select one of ['SAM', 'HIPT']")
+        self.model_path = Path(model_path)
 
-        model_checkpoint = torch.load(model_path, map_location="cpu")
+        model_checkpoint = None
+        if self.weight_cache:
+            try:
+                model_checkpoint = load_inference_weights(
+                    model_path, weight_dtype=self.weight_dtype, logger=self.logger
+                )
+            except OSError as e:
+                # e.g., read-only checkpoint directory, the converted weights cannot be written
+                self.logger.warning(
+                    f"Weight cache not available ({e!r}), loading the checkpoint without it"
+                )
+        if model_checkpoint is not None:
+            # memory-mapped weights are assigned to a model without initialized parameters
+            self.run_conf = unflatten_dict(model_checkpoint["config"], ".")
+            with torch.device("meta"):
+                self.model = self._get_model(model_type=model_checkpoint["arch"])
+            self.logger.info(
+                self.model.load_state_dict(
+                    model_checkpoint["model_state_dict"], assign=True
+                )
+            )
+        else:
+            model_checkpoint = torch.load(model_path, map_location="cpu")
 
-        # unpack checkpoint
-        self.run_conf = unflatten_dict(model_checkpoint["config"], ".")
-        self.model = self._get_model(model_type=model_checkpoint["arch"])
-        self.logger.info(
-            self.model.load_state_dict(model_checkpoint["model_state_dict"])
-        )
+            # unpack checkpoint
+            self.run_conf = unflatten_dict(model_checkpoint["config"], ".")
+            self.model = self._get_model(model_type=model_checkpoint["arch"])
+            self.logger.info(
+                self.model.load_state_dict(model_checkpoint["model_state_dict"])
+            )
+            if self.weight_cache and self.weight_dtype != "float32":
+                # same rounding as the cached weights, such that the outputs match the configuration hash
+                self.model.to(WEIGHT_DTYPES[self.weight_dtype])
         self.model.eval()
+        # weights are moved in their stored dtype and cast to float32 on the device,
+        # such that the memory-mapped weights are not copied in CPU memory
         self.model.to(self.device)
+        self.model.float()
         self.run_conf["model"]["token_patch_size"] = self.model.patch_size
         self.model_arch = model_checkpoint["arch"]
 
+    def share_model(self) -> dict:
+        """Move the model weights to shared memory and return the model for other processes
+
+        Processes started with torch.multiprocessing receive the model without copying the weights
+        (CUDA tensors are shared via CUDA IPC). Pass the result as shared_model to CellViTInference.
+        The model must not be modified (read-only) and this process must be alive while it is used.
+
+        Returns:
+            dict: Model, run configuration, architecture and checkpoint path (keys: model, run_conf, model_arch, model_path)
+        """
+        self.model.share_memory()
+        return {
+            "model": self.model,
+            "run_conf": self.run_conf,
+            "model_arch": self.model_arch,
+            "model_path": self.model_path,
+        }
+
     def _get_model(
         self, model_type: Literal["CellViT256", "CellViTSAM"]
     ) -> Union[CellViT256, CellViTSAM]:
@@ -413,8 +856,72 @@ class CellViTInference:
                 "mixed_precision", False
             )
 
+    def _setup_compilation(self) -> None:
+        """Compile the model, using cached compiled artifacts if available
+
+        The artifacts are identified by the checkpoint, architecture, device type, precision, batch size and PyTorch version.
+        Compilation itself is lazy (first batch), the artifacts are stored after the first inference run.
+        PyTorch versions without torch.compiler.save_cache_artifacts (< 2.7) compile without the cache.
+        """
+        if not self.compile_model:
+            return
+        if not (
+            hasattr(torch.compiler, "load_cache_artifacts")
+            and hasattr(torch.compiler, "save_cache_artifacts")
+        ):
+            self.logger.warning(
+                f"Caching compiled models requires PyTorch >= 2.7 (installed: {torch.__version__}), "
+                "compiling the model on every start"
+            )
+            self.artifact_cache = None
+            self.artifact_key = None
+            self.model.compile()
+            return
+        self.artifact_cache = ArtifactCache(
+            max_size_mb=self.artifact_cache_size, logger=self.logger
+        )
+        self.artifact_key = self.artifact_cache.key(
+            checkpoint=slide_fingerprint(self.model_path),
+            model_arch=self.model_arch,
+            device=torch.device(self.device).type,
+            precision="amp" if self.mixed_precision else "float32",
+            batch_size=self.batch_size,
+            torch=torch.__version__,
+        )
+        artifacts = self.artifact_cache.get(self.artifact_key)
+        if artifacts is not None:
+            self.logger.info(f"Loading compiled model from cache ({self.artifact_key})")
+            torch.compiler.load_cache_artifacts(artifacts)
+        else:
+            self.logger.info(
+                "Compiling model, this takes some minutes on the first batch (just once)"
+            )
+        self.model.compile()
+
+    def _save_compiled_artifacts(self) -> None:
+        """Store the compiled artifacts in the artifact cache (just once, after the first inference run)"""
+        if self.artifact_cache is None or self.artifact_key is None:
+            return
+        try:
+            artifacts = torch.compiler.save_cache_artifacts()
+            if artifacts is not None:
+                self.artifact_cache.put(
+                    self.artifact_key,
+                    artifacts[0],
+                    metadata={
+                        "model_arch": self.model_arch,
+                        "batch_size": self.batch_size,
+                    },
+                )
+                self.logger.info(
+                    f"Stored compiled model in cache ({self.artifact_key})"
+                )
+        except Exception as e:
+            self.logger.warning(f"Storing the compiled model failed: {e!r}")
+        self.artifact_key = None
+
     def _setup_worker(self) -> None:
-        """Setup the worker for inference"""
+        """Setup the worker for inference (Ray), runs concurrently to the model loading"""
         runtime_env = {"env_vars": {"PYTHONPATH": PYTHON_PATH}}
         # Set the global logging settings
 
@@ -437,15 +944,26 @@ class CellViTInference:
                     formatter = handler.formatter
                     break
 
-        # init ray
-        ray.init(
-            num_cpus=self.system_configuration["cpu_count"] - 2,
-            runtime_env=runtime_env,
-            object_store_memory=0.3 * self.system_configuration["memory"] * 1024 * 1024,
-            include_dashboard=include_dashboard,
-            logging_level=logging_level,
-            log_to_driver=True,
-        )
+        # init ray, resources are set by the running cluster when connecting
+        if self.ray_address is not None:
+            ray.init(
+                address=self.ray_address,
+                runtime_env=runtime_env,
+                logging_level=logging_level,
+                log_to_driver=True,
+            )
+        else:
+            ray.init(
+                num_cpus=self.system_configuration["cpu_count"] - 2,
+                runtime_env=runtime_env,
+                object_store_memory=0.3
+                * self.system_configuration["memory"]
+                * 1024
+                * 1024,
+                include_dashboard=include_dashboard,
+                logging_level=logging_level,
+                log_to_driver=True,
+            )
         # overwrite rays logger style
         if formatter is not None:
             ray_loggers = [
@@ -461,7 +979,8 @@ class CellViTInference:
                     if isinstance(handler, logging.StreamHandler):
                         handler.setFormatter(formatter)
 
-        # workers for loading data
+    def _setup_dataloader_workers(self) -> None:
+        """Set the number of workers for loading patches (after the batch size has been limited)"""
         num_workers = int(3 / 4 * self.system_configuration["cpu_count"])
         if num_workers is None:
             num_workers = 8
@@ -486,9 +1005,14 @@ class CellViTInference:
             )
         return DetectionCellPostProcessor, create_batch_pooling_actor
 
-    def _post_process_edge_cells(self, cell_list: List[dict]) -> List[int]:
+    def _post_process_edge_cells(
+        self, cell_list: List[dict], logger: logging.Logger = None
+    ) -> List[int]:
         """Use the CellPostProcessor to remove multiple cells and merge due to overlap
 
+        Depending on self.cell_cleaner, either the polygon-based OverlapCellCleaner
+        or the KD-tree based CentroidCellCleaner (with cell_cleaner_radius and cell_cleaner_strategy) is used.
+
         Args:
             cell_list (List[dict]): List with cell-dictionaries. Required keys:
                 * bbox
@@ -499,154 +1023,424 @@ class CellViTInference:
                 * patch_coordinates
                 * cell_status
                 * offset_global
+            logger (logging.Logger, optional): Logger for the cell cleaner. Defaults to None (self.logger).
 
         Returns:
             List[int]: List with integers of cells that should be kept
         """
-        cell_cleaner = OverlapCellCleaner(cell_list, self.logger)
-        cleaned_cells = cell_cleaner.clean_detected_cells()
-
-        return list(cleaned_cells.index.values)
+        return clean_cells(
+            cell_list,
+            cell_cleaner=self.cell_cleaner,
+            radius=self.cell_cleaner_radius,
+            merge_strategy=self.cell_cleaner_strategy,
+            logger=self.logger if logger is None else logger,
+        )
 
-    def _reallign_grid(
+    def _stitch_batch_results(
         self,
-        cell_dict_wsi: list[dict],
-        cell_dict_detection: list[dict],
-        graph_data,
-        rescaling_factor: float,
-    ) -> Tuple[list[dict], list[dict]]:
+        call_ids: List[ray.ObjectRef],
+        call_patches: dict,
+        stitching: ThreadPoolExecutor,
+        wait: bool = False,
+    ) -> List[ray.ObjectRef]:
+        """Retrieve finished postprocessing calls and hand them over to the stitching thread
+
+        The cleaning of the cells runs in the stitching thread, such that it overlaps with the next forward passes.
+
+        Args:
+            call_ids (List[ray.ObjectRef]): Pending postprocessing calls
+            call_patches (dict): WSI (SlideInferenceState) and patches (row, col) of each postprocessing call. Retrieved calls are removed.
+            stitching (ThreadPoolExecutor): Stitching thread (single worker, tasks are executed in order)
+            wait (bool, optional): Wait for all pending calls. Defaults to False (just retrieve finished calls).
+
+        Returns:
+            List[ray.ObjectRef]: Calls that are still pending
+        """
+        if len(call_ids) == 0:
+            return call_ids
+        if wait:
+            ready_ids, pending_ids = call_ids, []
+        else:
+            ready_ids, pending_ids = ray.wait(
+                call_ids, num_returns=len(call_ids), timeout=0
+            )
+        if len(ready_ids) > 0:
+            slide_batches = []  # retrieved batches of each WSI
+            for call_id, batch_results in zip(ready_ids, ray.get(ready_ids)):
+                slide, patches = call_patches.pop(call_id)
+                slide.pending_calls -= 1
+                for updated, batches in slide_batches:
+                    if updated is slide:
+                        batches.append((patches, batch_results))
+                        break
+                else:
+                    slide_batches.append((slide, [(patches, batch_results)]))
+            ray.internal.free(ready_ids)
+            for slide, batches in slide_batches:
+                slide.stitching_tasks.append(
+                    stitching.submit(self._stitch_slide_batches, slide, batches)
+                )
+        return pending_ids
+
+    def _stitch_slide_batches(
+        self, slide: SlideInferenceState, batches: List[Tuple[list, tuple]]
+    ) -> None:
+        """Stitch postprocessed batches of a WSI (runs in the stitching thread)
+
+        Args:
+            slide (SlideInferenceState): State of the WSI
+            batches (List[Tuple[list, tuple]]): Patches (row, col) and results of each postprocessing call
+        """
+        for patches, batch_results in batches:
+            if slide.instance_map_writer is not None:
+                slide.instance_map_writer.add_patches(patches, batch_results[4])
+                batch_results = batch_results[:4]
+            slide.stitcher.add_batch(patches, batch_results)
+        if slide.instance_map_writer is not None:
+            slide.instance_map_writer.write_ready(slide.stitcher.resolved)
+
+    def _store_detection_validation(
+        self, validation_stats: List[dict], path: Path
+    ) -> None:
+        """Summarize the comparison of the peak detection with the watershed detection and store it
+
+        Args:
+            validation_stats (List[dict]): Matching counts of the validated batches
+            path (Path): Path to the validation report (json)
+        """
+        report = summarize_comparison(validation_stats)
+        report["validated_batches"] = len(validation_stats)
+        self.logger.info(
+            f"Peak detection vs. watershed ({len(validation_stats)} batches): "
+            f"Precision {report['precision']:.4f}, Recall {report['recall']:.4f}, "
+            f"F1 {report['f1']:.4f}, mean centroid distance {report['mean_distance']:.2f} px, "
+            f"type agreement {report['type_agreement']:.4f}"
+        )
+        with open(path, "w") as outfile:
+            ujson.dump(report, outfile, indent=2)
+
+    def _reallign_grid(self, rescaling_factor: float) -> AffineTransform:
         """Reallign grid if interpolation was used (including target_mpp_tolerance)
 
         Args:
-            cell_dict_wsi (list[dict]):  Input cell dict
-            cell_dict_detection (list[dict]): Input cell dict (detection)
-            graph_data (_type_): Graph
             rescaling_factor (float): Rescaling Factor
 
         Returns:
-            Tuple[list[dict],list[dict]]:
-                * Realligned cell dict (contours)
-                * Realligned cell dict (detection)
-        """
-        for cell in cell_dict_detection:
-            cell["bbox"][0][0] = cell["bbox"][0][0] * rescaling_factor
-            cell["bbox"][0][1] = cell["bbox"][0][1] * rescaling_factor
-            cell["bbox"][1][0] = cell["bbox"][1][0] * rescaling_factor
-            cell["bbox"][1][1] = cell["bbox"][1][1] * rescaling_factor
-            cell["centroid"][0] = cell["centroid"][0] * rescaling_factor
-            cell["centroid"][1] = cell["centroid"][1] * rescaling_factor
-        for cell in cell_dict_wsi:
-            cell["bbox"][0][0] = cell["bbox"][0][0] * rescaling_factor
-            cell["bbox"][0][1] = cell["bbox"][0][1] * rescaling_factor
-            cell["bbox"][1][0] = cell["bbox"][1][0] * rescaling_factor
-            cell["bbox"][1][1] = cell["bbox"][1][1] * rescaling_factor
-            cell["centroid"][0] = cell["centroid"][0] * rescaling_factor
-            cell["centroid"][1] = cell["centroid"][1] * rescaling_factor
-            cell["contour"] = [
-                [round(c[0] * rescaling_factor), round(c[1] * rescaling_factor)]
-                for c in cell["contour"]
-            ]
-        positions_cleaned = []
-        for cell in graph_data["positions"]:
-            positions_cleaned.append(cell * rescaling_factor)
-        graph_data["positions"] = positions_cleaned
+            AffineTransform: Transformation of the cell coordinates
+        """
+        return AffineTransform(scale=rescaling_factor)
 
-        return cell_dict_wsi, cell_dict_detection, graph_data
+    @property
+    def _encoded_contour_precision(self) -> Union[float, None]:
+        """Quantization step passed to the writers, None if contours are stored plain"""
+        return self.contour_precision if self.contour_encoding else None
+
+    def _store_cells_columnar(
+        self, cell_dict: dict, path: Path, detection: bool, spatial_index: bool = False
+    ) -> None:
+        """Store cells in a columnar file format (Arrow IPC or Parquet)
 
-    def _convert_json_geojson(
-        self, cell_list: list[dict], polygons: bool = False
-    ) -> List[dict]:
-        """Convert a list of cells to a geojson object
+        Args:
+            cell_dict (dict): Dictionary with keys wsi_metadata, type_map and cells
+            path (Path): Output path without suffix
+            detection (bool): If just the detection columns should be stored
+            spatial_index (bool, optional): If a spatial index (.sidx) should be stored next to the file. Defaults to False.
+        """
+        from cellvit.output.columnar import write_cells
+
+        outfile = write_cells(
+            path=path,
+            cell_list=cell_dict["cells"],
+            wsi_metadata=cell_dict["wsi_metadata"],
+            type_map=cell_dict["type_map"],
+            detection=detection,
+            file_format=self.file_format,
+            compression=self.compression_codec if self.compression else None,
+            contour_precision=self._encoded_contour_precision,
+        )
+        self.logger.info(f"Stored cells as {self.file_format}: {outfile}")
+        if spatial_index:
+            write_spatial_index(
+                outfile.with_suffix(".sidx"), cell_dict["cells"], source=outfile
+            )
 
-        Either a segmentation object (polygon) or detection points are converted
+    def _open_output(self, path: Path) -> IO[str]:
+        """Open a text file for writing, streaming compressed if compression is used
 
         Args:
-            cell_list (list[dict]): Cell list with dict entry for each cell.
+            path (Path): Output path without compression suffix (e.g., cells.json)
+
+        Returns:
+            IO[str]: Text file object, the codec suffix is appended if compression is used
+        """
+        if not self.compression:
+            return open(str(path), "w")
+        return open_compressed(
+            str(path) + COMPRESSION_SUFFIXES[self.compression_codec],
+            "wt",
+            codec=self.compression_codec,
+            level=self.compression_level,
+            threads=self.compression_threads,
+        )
+
+    def _store_cells_json(
+        self, cell_dict: dict, path: Path, spatial_index: bool = False
+    ) -> None:
+        """Stream cells as json to disk
+
+        Args:
+            cell_dict (dict): Dictionary with keys wsi_metadata, type_map and cells
+            path (Path): Output path (.json), the codec suffix is appended if compression is used
+            spatial_index (bool, optional): If a spatial index (.sidx) with the byte ranges of all cells
+                should be stored next to the file. Just for uncompressed files. Defaults to False.
+        """
+        cell_spans = [] if spatial_index else None
+        with self._open_output(path) as outfile:
+            write_cell_json(
+                outfile.write,
+                cell_dict,
+                cell_spans=cell_spans,
+                contour_precision=self._encoded_contour_precision,
+            )
+        if spatial_index:
+            encoded = (
+                self._encoded_contour_precision is not None
+                and len(cell_dict["cells"]) > 0
+                and "contour" in cell_dict["cells"][0]
+            )
+            write_spatial_index(
+                path.with_suffix(".sidx"),
+                cell_dict["cells"],
+                source=path,
+                spans=cell_spans,
+                contour_encoding=(
+                    contour_encoding_metadata(self.contour_precision)
+                    if encoded
+                    else None
+                ),
+            )
+
+    def _store_tiles(
+        self, cell_dict: dict, outdir: Path, polygons: bool = True
+    ) -> None:
+        """Store cells in spatial tiles with a manifest
+
+        Args:
+            cell_dict (dict): Dictionary with keys wsi_metadata, type_map and cells
+            outdir (Path): Output directory of the tiles
+            polygons (bool, optional): If level 0 should contain polygons (requires contours). Defaults to True.
+        """
+        manifest = write_tiles(
+            outdir,
+            cell_dict["cells"],
+            label_map=self.label_map,
+            tile_size=self.tile_size,
+            file_format="geojson" if self.file_format == "json" else self.file_format,
+            wsi_metadata=cell_dict["wsi_metadata"],
+            compression=self.compression_codec if self.compression else None,
+            compression_level=self.compression_level,
+            polygons=polygons,
+            contour_precision=self._encoded_contour_precision,
+        )
+        self.logger.info(f"Stored tiled output: {manifest}")
+
+    def _store_graph(self, graph_data: dict, path: Path) -> None:
+        """Store the cell graph with embeddings
+
+        Args:
+            graph_data (dict): Graph data with keys cell_tokens, positions, metadata and nuclei_types
+            path (Path): Output path (.pt)
+        """
+        self.logger.info(
+            f"Create cell graph with embeddings and save it under: {str(path)}"
+        )
+        positions = torch.stack(graph_data["positions"])
+        edge_index, edge_attr = self._build_graph_edges(positions)
+        graph = CellGraphDataWSI(
+            x=torch.stack(graph_data["cell_tokens"]).to(
+                getattr(torch, self.graph_dtype)
+            ),
+            positions=positions,
+            metadata=graph_data["metadata"],
+            nuclei_types=torch.tensor(graph_data["nuclei_types"]),
+            edge_index=edge_index,
+            edge_attr=edge_attr,
+        )
+        torch.save(graph, str(path))
+
+    def _store_graph_mmap(self, graph_data: dict, outdir: Path) -> None:
+        """Finalize the on-disk token store and store the graph as memory-mappable directory
+
+        Args:
+            graph_data (dict): Graph data with keys cell_tokens (TokenStore), positions, metadata, nuclei_types
+                and optionally token_order (if cells have been reordered after collecting the tokens)
+            outdir (Path): Output directory of the graph
+        """
+        self.logger.info(
+            f"Create cell graph with embeddings and save it under: {str(outdir)}"
+        )
+        positions = (
+            torch.stack(graph_data["positions"])
+            if len(graph_data["positions"]) > 0
+            else torch.zeros((0, 2))
+        )
+        edge_index, edge_attr = self._build_graph_edges(positions)
+        write_graph_store(
+            outdir,
+            token_store=graph_data["cell_tokens"],
+            positions=positions,
+            nuclei_types=torch.tensor(graph_data["nuclei_types"], dtype=torch.int64),
+            metadata=graph_data["metadata"],
+            order=graph_data.get("token_order"),
+            edge_index=edge_index,
+            edge_attr=edge_attr,
+        )
+
+    def _build_graph_edges(
+        self, positions: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Build spatial edges between the cells
+
+        Args:
+            positions (torch.Tensor): Cell positions (num_cells, 2)
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: edge_index (2, num_edges) and edge_attr (num_edges, 1),
+                both None if no edges should be built
+        """
+        if self.graph_edges is None:
+            return None, None
+        edge_index, edge_attr = build_edges(
+            positions,
+            method=self.graph_edges,
+            k=self.graph_edge_k,
+            radius=self.graph_edge_radius,
+        )
+        self.logger.info(
+            f"Built {edge_index.shape[1]} edges ({self.graph_edges}) between {len(positions)} cells"
+        )
+        return edge_index, edge_attr
+
+    def _store_geojson(self, cell_list: List[dict], path: Path, polygons: bool) -> None:
+        """Stream cells as geojson to disk, the feature list is never held in memory
+
+        Args:
+            cell_list (List[dict]): Cell list with dict entry for each cell.
                 Required keys for detection:
                     * type
                     * centroid
                 Required keys for segmentation:
                     * type
                     * contour
-            polygons (bool, optional): If polygon segmentations (True) or detection points (False). Defaults to False.
+            path (Path): Output path (.geojson), the codec suffix is appended if compression is used
+            polygons (bool): If polygon segmentations (True) or detection points (False)
+        """
+        self.logger.info(
+            f"Converting {'segmentation' if polygons else 'detection'} to geojson"
+        )
+        with self._open_output(path) as outfile:
+            write_geojson(outfile.write, cell_list, self.label_map, polygons=polygons)
+
+    def _remove_padding(self, wsi_dimension: Tuple[int, int]) -> AffineTransform:
+        """Remove padding from the WSI
+
+        Args:
+            wsi_dimension (Tuple[int, int]): Width and height of the WSI
 
         Returns:
-            List[dict]: Geojson like list
-        """
-        if polygons:
-            cell_segmentation_df = pd.DataFrame(cell_list)
-            detected_types = sorted(cell_segmentation_df.type.unique())
-            geojson_placeholder = []
-            for cell_type in detected_types:
-                cells = cell_segmentation_df[cell_segmentation_df["type"] == cell_type]
-                contours = cells["contour"].to_list()
-                final_c = []
-                for c in contours:
-                    c.append(c[0])
-                    final_c.append([c])
-
-                cell_geojson_object = get_template_segmentation()
-                cell_geojson_object["id"] = str(uuid.uuid4())
-                cell_geojson_object["geometry"]["coordinates"] = final_c
-                cell_geojson_object["properties"]["classification"][
-                    "name"
-                ] = self.label_map[cell_type]
-                cell_geojson_object["properties"]["classification"][
-                    "color"
-                ] = COLOR_DICT_CELLS[cell_type]
-                geojson_placeholder.append(cell_geojson_object)
-        else:
-            cell_detection_df = pd.DataFrame(cell_list)
-            detected_types = sorted(cell_detection_df.type.unique())
-            geojson_placeholder = []
-            for cell_type in detected_types:
-                cells = cell_detection_df[cell_detection_df["type"] == cell_type]
-                centroids = cells["centroid"].to_list()
-                cell_geojson_object = get_template_point()
-                cell_geojson_object["id"] = str(uuid.uuid4())
-                cell_geojson_object["geometry"]["coordinates"] = centroids
-                cell_geojson_object["properties"]["classification"][
-                    "name"
-                ] = self.label_map[cell_type]
-                cell_geojson_object["properties"]["classification"][
-                    "color"
-                ] = COLOR_DICT_CELLS[cell_type]
-                geojson_placeholder.append(cell_geojson_object)
-        return geojson_placeholder
-
-    def _remove_padding(
-        self, cell_dict_wsi, cell_dict_detection, graph_data, wsi_dimension
-    ):
+            AffineTransform: Transformation of the cell coordinates
+        """
         width, height = wsi_dimension
         correction_width = 1024 - width - 32
         correction_height = 1024 - height - 32
-        correction_tensor = torch.tensor([correction_width, correction_height])
-
-        for cell in cell_dict_detection:
-            cell["bbox"][0][0] = cell["bbox"][0][0] - correction_height
-            cell["bbox"][0][1] = cell["bbox"][0][1] - correction_width
-            cell["bbox"][1][0] = cell["bbox"][1][0] - correction_height
-            cell["bbox"][1][1] = cell["bbox"][1][1] - correction_width
-            cell["centroid"][0] = cell["centroid"][0] - correction_width
-            cell["centroid"][1] = cell["centroid"][1] - correction_height
-        for cell in cell_dict_wsi:
-            cell["bbox"][0][0] = cell["bbox"][0][0] - correction_height
-            cell["bbox"][0][1] = cell["bbox"][0][1] - correction_width
-            cell["bbox"][1][0] = cell["bbox"][1][0] - correction_height
-            cell["bbox"][1][1] = cell["bbox"][1][1] - correction_width
-            cell["centroid"][0] = cell["centroid"][0] - correction_width
-            cell["centroid"][1] = cell["centroid"][1] - correction_height
-            cell["contour"] = [
-                [round(c[0] - correction_width), round(c[1] - correction_height)]
-                for c in cell["contour"]
-            ]
-        positions_cleaned = []
-        for cell in graph_data["positions"]:
-            positions_cleaned.append(cell - correction_tensor)
-        graph_data["positions"] = positions_cleaned
+
+        return AffineTransform(translation=(-correction_width, -correction_height))
+
+    def _apply_coordinate_transform(
+        self,
+        coordinate_transform: AffineTransform,
+        cell_dict_wsi: List[dict],
+        cell_dict_detection: List[dict],
+        graph_data: dict,
+    ) -> Tuple[List[dict], List[dict], dict]:
+        """Apply a coordinate transformation on all cells and the graph positions
+
+        Args:
+            coordinate_transform (AffineTransform): Transformation
+            cell_dict_wsi (List[dict]): Input cell dict
+            cell_dict_detection (List[dict]): Input cell dict (detection)
+            graph_data (dict): Graph
+
+        Returns:
+            Tuple[List[dict], List[dict], dict]:
+                * Transformed cell dict (contours)
+                * Transformed cell dict (detection)
+                * Graph with transformed positions
+        """
+        if coordinate_transform.is_identity:
+            return cell_dict_wsi, cell_dict_detection, graph_data
+        cell_dict_wsi = coordinate_transform.apply_cells(cell_dict_wsi)
+        cell_dict_detection = coordinate_transform.apply_cells(
+            cell_dict_detection, contour=False
+        )
+        if len(graph_data["positions"]) > 0:
+            graph_data["positions"] = list(
+                coordinate_transform.apply_tensor(torch.stack(graph_data["positions"]))
+            )
 
         return cell_dict_wsi, cell_dict_detection, graph_data
 
+    def _simplify_contours(self, cell_list: List[dict]) -> None:
+        """Simplify the contours of all cells with the Douglas-Peucker algorithm (inplace)
+
+        Args:
+            cell_list (List[dict]): Cells with contours
+        """
+        contours = simplify_contours(
+            [c["contour"] for c in cell_list], tolerance=self.contour_tolerance
+        )
+        num_points = sum(len(c["contour"]) for c in cell_list)
+        for cell, contour in zip(cell_list, contours):
+            cell["contour"] = contour.tolist()
+        self.logger.debug(
+            f"Simplified contours: {num_points} -> {sum(len(c) for c in contours)} points"
+        )
+
+    def _sort_cells_spatially(
+        self,
+        cell_dict_wsi: List[dict],
+        cell_dict_detection: List[dict],
+        graph_data: dict,
+        order: np.ndarray = None,
+    ) -> Tuple[List[dict], List[dict], dict]:
+        """Sort cells, detections and graph nodes by the Hilbert index of the cell centroids
+
+        Args:
+            cell_dict_wsi (List[dict]): Cells
+            cell_dict_detection (List[dict]): Detections (same order as cells)
+            graph_data (dict): Graph (same order as cells)
+            order (np.ndarray, optional): Precomputed Hilbert order, computed if not provided. Defaults to None.
+
+        Returns:
+            Tuple[List[dict], List[dict], dict]: Reordered cells, detections and graph
+        """
+        if order is None:
+            order = hilbert_order(cell_dict_detection)
+        order = np.asarray(order).tolist()
+        if not self.detection_only:
+            cell_dict_wsi = [cell_dict_wsi[idx] for idx in order]
+        cell_dict_detection = [cell_dict_detection[idx] for idx in order]
+        if isinstance(graph_data["cell_tokens"], TokenStore):
+            # tokens are already on disk, they are reordered when the store is finalized
+            graph_data["token_order"] = np.asarray(order, dtype=np.int64)
+        else:
+            graph_data["cell_tokens"] = [
+                graph_data["cell_tokens"][idx] for idx in order
+            ]
+        for key in ["positions", "nuclei_types"]:
+            graph_data[key] = [graph_data[key][idx] for idx in order]
+        return cell_dict_wsi, cell_dict_detection, graph_data
+
     def process_wsi(
         self,
         wsi_path: Union[Path, str],
@@ -654,26 +1448,238 @@ class CellViTInference:
         wsi_magnification: float = None,
         apply_prefilter: bool = True,
         filter_patches: bool = False,
+        on_complete: Callable[[], None] = None,
+        on_error: Callable[[str], None] = None,
         **kwargs,
     ) -> None:
         """Process a whole slide image with CellViT.
 
+        The attempt is recorded in the run ledger (started, finished after all outputs are written, or failed).
+
         Args:
             wsi_path (Union[Path, str]): Path to the whole slide image.
-            wsi_properties (dict, optional): Optional WSI properties,
-                Allowed keys are 'slide_mpp' and 'magnification'. Defaults to {}.
-            resolution (float, optional): Target resolution. Defaults to 0.25.
+            wsi_mpp (float, optional): Microns per pixel of the WSI, overrides the metadata. Defaults to None.
+            wsi_magnification (float, optional): Magnification of the WSI, overrides the metadata. Defaults to None.
             apply_prefilter (bool, optional): Prefilter. Defaults to True.
             filter_patches (bool, optional): Filter patches after processing. Defaults to False.
+            on_complete (Callable[[], None], optional): Called after all outputs are written. Defaults to None.
+            on_error (Callable[[str], None], optional): Called with the error message if processing or writing failed. Defaults to None.
         """
-        wsi_path = Path(wsi_path)
+        slide = self._start_slide(
+            Path(wsi_path), wsi_mpp, wsi_magnification, on_complete, on_error
+        )
+        try:
+            self._prepare_slide(
+                slide,
+                wsi_mpp=wsi_mpp,
+                wsi_magnification=wsi_magnification,
+                apply_prefilter=apply_prefilter,
+                filter_patches=filter_patches,
+                **kwargs,
+            )
+            self._run_inference([slide])
+        except Exception as e:
+            if not slide.submitted:
+                slide.fail(repr(e))
+            raise
+
+    def process_wsi_group(
+        self,
+        wsi_jobs: List[dict],
+        apply_prefilter: bool = True,
+        filter_patches: bool = False,
+        **kwargs,
+    ) -> None:
+        """Process multiple whole slide images together, the patches of all WSI are packed into full batches.
+
+        Suited for many small WSI (e.g., biopsies), which would otherwise run mostly underfilled batches.
+        The postprocessing actors are shared by all WSI. Each WSI has its own outputs and is recorded in the run ledger.
+        A WSI failing during the preparation (e.g., corrupt file) is skipped, an error during the inference
+        fails all WSI of the group whose outputs have not been submitted yet.
+
+        Args:
+            wsi_jobs (List[dict]): WSI to process. Keys:
+                * wsi_path: Path to the whole slide image
+                * wsi_mpp (optional): Microns per pixel of the WSI, overrides the metadata
+                * wsi_magnification (optional): Magnification of the WSI, overrides the metadata
+                * on_complete (optional): Called after all outputs of the WSI are written
+                * on_error (optional): Called with the error message if processing or writing the WSI failed
+            apply_prefilter (bool, optional): Prefilter. Defaults to True.
+            filter_patches (bool, optional): Filter patches after processing. Defaults to False.
+
+        Raises:
+            Exception: Error during the inference, after recording it for all affected WSI
+        """
+        slides = []
+        for job in wsi_jobs:
+            wsi_path = Path(job["wsi_path"])
+            try:
+                slide = self._start_slide(
+                    wsi_path,
+                    job.get("wsi_mpp"),
+                    job.get("wsi_magnification"),
+                    job.get("on_complete"),
+                    job.get("on_error"),
+                )
+            except Exception as e:
+                self.logger.error(f"Processing {wsi_path.name} failed: {e!r}")
+                if job.get("on_error") is not None:
+                    job["on_error"](repr(e))
+                continue
+            try:
+                self._prepare_slide(
+                    slide,
+                    wsi_mpp=job.get("wsi_mpp"),
+                    wsi_magnification=job.get("wsi_magnification"),
+                    apply_prefilter=apply_prefilter,
+                    filter_patches=filter_patches,
+                    **kwargs,
+                )
+            except Exception as e:
+                self.logger.error(f"Processing {wsi_path.name} failed: {e!r}")
+                slide.fail(repr(e))
+                continue
+            slides.append(slide)
+        if len(slides) == 0:
+            return
+        self.logger.info(f"Packing the patches of {len(slides)} WSI into batches")
+        try:
+            self._run_inference(slides)
+        except Exception as e:
+            for slide in slides:
+                if not slide.submitted:
+                    slide.fail(repr(e))
+            raise
+
+    def run_status(
+        self,
+        wsi_path: Union[Path, str],
+        wsi_mpp: float = None,
+        wsi_magnification: float = None,
+    ) -> Union[str, None]:
+        """Status of a WSI for the current configuration in all run ledgers next to the run ledger
+
+        Besides the own ledger, all run_ledger*.sqlite files in its directory found at the start of the run
+        are consulted (e.g., ledgers of other shards, of an unsharded run or the merged ledger), such that
+        finished WSI are skipped also if the number of shards changes between runs.
+
+        Args:
+            wsi_path (Union[Path, str]): Path to the whole slide image
+            wsi_mpp (float, optional): Microns per pixel override. Defaults to None.
+            wsi_magnification (float, optional): Magnification override. Defaults to None.
+
+        Returns:
+            Union[str, None]: "finished", "failed", "started" (running or crashed) or None if never processed
+        """
+        return combined_status(
+            self.ledger_paths,
+            *self._ledger_key(Path(wsi_path), wsi_mpp, wsi_magnification),
+        )
+
+    def _ledger_key(
+        self, wsi_path: Path, wsi_mpp: float = None, wsi_magnification: float = None
+    ) -> Tuple[str, str, str]:
+        """Slide path, content fingerprint and configuration hash identifying a WSI in the run ledger
+
+        Overrides of the WSI metadata are part of the configuration hash. Missing or unreadable
+        slides get a placeholder fingerprint, such that their failed attempt is still recorded.
+
+        Args:
+            wsi_path (Path): Path to the whole slide image
+            wsi_mpp (float, optional): Microns per pixel override. Defaults to None.
+            wsi_magnification (float, optional): Magnification override. Defaults to None.
+
+        Returns:
+            Tuple[str, str, str]: Slide path, fingerprint and configuration hash
+        """
+        try:
+            fingerprint = slide_fingerprint(wsi_path)
+        except OSError:
+            fingerprint = "unreadable"
+        slide_configuration = {
+            "config_hash": self.config_hash,
+            "wsi_mpp": float(wsi_mpp) if wsi_mpp is not None else None,
+            "wsi_magnification": (
+                float(wsi_magnification) if wsi_magnification is not None else None
+            ),
+        }
+        return (
+            str(wsi_path.resolve()),
+            fingerprint,
+            config_hash(slide_configuration),
+        )
+
+    def _start_slide(
+        self,
+        wsi_path: Path,
+        wsi_mpp: float = None,
+        wsi_magnification: float = None,
+        on_complete: Callable[[], None] = None,
+        on_error: Callable[[str], None] = None,
+    ) -> SlideInferenceState:
+        """Record the start of a WSI in the run ledger and create its inference state
+
+        Args:
+            wsi_path (Path): Path to the whole slide image
+            wsi_mpp (float, optional): Microns per pixel override. Defaults to None.
+            wsi_magnification (float, optional): Magnification override. Defaults to None.
+            on_complete (Callable[[], None], optional): Called after all outputs are written. Defaults to None.
+            on_error (Callable[[str], None], optional): Called with the error message if processing or writing failed. Defaults to None.
+
+        Returns:
+            SlideInferenceState: State of the WSI
+        """
+        run_id = self.ledger.start(
+            *self._ledger_key(wsi_path, wsi_mpp, wsi_magnification)
+        )
+
+        def fail(error: str) -> None:
+            self.ledger.fail(run_id, error)
+            if on_error is not None:
+                on_error(error)
+
+        return SlideInferenceState(
+            wsi_path=wsi_path,
+            run_id=run_id,
+            fail=fail,
+            on_complete=on_complete,
+            start_time=time.time(),
+        )
+
+    def _prepare_slide(
+        self,
+        slide: SlideInferenceState,
+        wsi_mpp: float = None,
+        wsi_magnification: float = None,
+        apply_prefilter: bool = True,
+        filter_patches: bool = False,
+        **kwargs,
+    ) -> None:
+        """Load the tissue region and the patches of a WSI and set up its stitcher and output collectors
+
+        Args:
+            slide (SlideInferenceState): State of the WSI, filled in place
+            wsi_mpp (float, optional): Microns per pixel of the WSI, overrides the metadata. Defaults to None.
+            wsi_magnification (float, optional): Magnification of the WSI, overrides the metadata. Defaults to None.
+            apply_prefilter (bool, optional): Prefilter. Defaults to True.
+            filter_patches (bool, optional): Filter patches after processing. Defaults to False.
+        """
+        from pathopatch.patch_extraction.dataset import (
+            LivePatchWSIConfig,
+            LivePatchWSIDataloader,
+            LivePatchWSIDataset,
+        )
+
+        from cellvit.data.dataclass.wsi_meta import load_wsi_meta
+
+        wsi_path = slide.wsi_path
         self.logger.info(f"Processing WSI: {wsi_path.name}")
         self.logger.info(f"Preparing WSI - Loading tissue region and prepare patches")
 
         # create output directory
         self.outdir.mkdir(exist_ok=True, parents=True)
-        wsi_outdir = self.outdir / wsi_path.stem
-        wsi_outdir.mkdir(exist_ok=True, parents=True)
+        slide.wsi_outdir = self.outdir / wsi_path.stem
+        slide.wsi_outdir.mkdir(exist_ok=True, parents=True)
 
         # load metadata
         slide_meta, target_mpp = load_wsi_meta(
@@ -683,7 +1689,7 @@ class CellViTInference:
             logger=self.logger,
         )
 
-        # setup wsi dataloader and postprocessor
+        # setup wsi dataloader
         dataset_config = LivePatchWSIConfig(
             wsi_path=str(wsi_path),
             wsi_properties=slide_meta,
@@ -695,27 +1701,116 @@ class CellViTInference:
             target_mpp_tolerance=0.035,
             **kwargs,
         )
-        wsi_inference_dataset = LivePatchWSIDataset(
+        slide.dataset = LivePatchWSIDataset(
             slide_processor_config=dataset_config,
             logger=self.logger,
             transforms=self.inference_transforms,
         )
         if self.debug:
-            (wsi_outdir / "masks").mkdir(exist_ok=True, parents=True)
-            for img_name, img in wsi_inference_dataset.mask_images.items():
-                img.save(wsi_outdir / "masks" / f"{img_name}.jpeg", quality=50)
-        wsi_inference_dataset.mask_images = None  # clean to free up memory
+            (slide.wsi_outdir / "masks").mkdir(exist_ok=True, parents=True)
+            for img_name, img in slide.dataset.mask_images.items():
+                img.save(slide.wsi_outdir / "masks" / f"{img_name}.jpeg", quality=50)
+        slide.dataset.mask_images = None  # clean to free up memory
 
-        wsi_inference_dataloader = LivePatchWSIDataloader(
-            dataset=wsi_inference_dataset, batch_size=self.batch_size, shuffle=False
+        slide.dataloader = LivePatchWSIDataloader(
+            dataset=slide.dataset, batch_size=self.batch_size, shuffle=False
         )
-        wsi = WSIMetadata(
+        slide.wsi = WSIMetadata(
             name=wsi_path.name,
             slide_path=wsi_path,
-            metadata=wsi_inference_dataset.wsi_metadata,
+            metadata=slide.dataset.wsi_metadata,
+        )
+
+        # unpack inference results
+        slide.graph_data = {
+            "cell_tokens": [],
+            "positions": [],
+            "metadata": {
+                "wsi_metadata": slide.wsi.metadata,
+                "nuclei_types": self.label_map,
+            },
+            "nuclei_types": [],
+        }
+        if self.graph_edges is not None:
+            slide.graph_data["metadata"]["edges"] = {
+                "method": self.graph_edges,
+                "k": self.graph_edge_k,
+                "radius": self.graph_edge_radius,
+            }
+        if self.graph and self.graph_format == "mmap":
+            slide.graph_data["cell_tokens"] = TokenStore(
+                slide.wsi_outdir / "cells_graph" / "tokens.npy", dtype=self.graph_dtype
+            )
+
+        # cleaning overlapping cells is performed patch-wise while the inference is running
+        slide.patch_coordinates = [
+            (row, col) for row, col, _ in slide.dataset.interesting_coords
+        ]
+        slide.stitcher = IncrementalCellStitcher(
+            patch_coordinates=slide.patch_coordinates,
+            cell_cleaner=partial(
+                clean_cells,
+                cell_cleaner=self.cell_cleaner,
+                radius=self.cell_cleaner_radius,
+                merge_strategy=self.cell_cleaner_strategy,
+            ),
+            sink=partial(self._collect_cells, slide),
+            link_distance=self.cell_cleaner_radius,
+            executor=self.cleaning_pool,
         )
+        if self.instance_map:
+            slide.instance_map_writer = InstanceMapWriter(
+                slide.wsi_outdir / "instance_map.zarr",
+                patch_coordinates=slide.patch_coordinates,
+                patch_size=slide.wsi.metadata["patch_size"],
+                overlap=slide.wsi.metadata["patch_overlap"],
+                num_levels=self.instance_map_levels,
+            )
+
+    def _collect_cells(
+        self,
+        slide: SlideInferenceState,
+        batch_complete_dict: List[dict],
+        batch_detection: List[dict],
+        batch_cell_tokens: List[torch.Tensor],
+        batch_cell_positions: List[torch.Tensor],
+    ) -> None:
+        """Sink of the stitcher: collect the cleaned cells of a WSI
+
+        Args:
+            slide (SlideInferenceState): State of the WSI
+            batch_complete_dict (List[dict]): Cells
+            batch_detection (List[dict]): Cell detections
+            batch_cell_tokens (List[torch.Tensor]): Cell tokens
+            batch_cell_positions (List[torch.Tensor]): Cell positions
+        """
+        if slide.instance_map_writer is not None:
+            # labels of the instance map are the cell indices (+1)
+            slide.instance_map_writer.register_cells(
+                batch_complete_dict, first_label=len(slide.cell_dict_detection) + 1
+            )
+        if not self.detection_only:
+            slide.cell_dict_wsi.extend(batch_complete_dict)
+        slide.cell_dict_detection.extend(batch_detection)
+        graph_data = slide.graph_data
+        if isinstance(graph_data["cell_tokens"], TokenStore):
+            graph_data["cell_tokens"].append(batch_cell_tokens)
+        elif self.graph:
+            graph_data["cell_tokens"].extend(batch_cell_tokens)
+        graph_data["positions"].extend(batch_cell_positions)
+        graph_data["nuclei_types"].extend([v["type"] for v in batch_detection])
+
+    def _run_inference(self, slides: List[SlideInferenceState]) -> None:
+        """Run the model on the (packed) patches of the prepared WSI, postprocess and stitch the results
+
+        The outputs of a WSI are submitted to the writer as soon as all of its patches have been processed.
+        Stitching (cleaning of the cells in the overlap of the patches) runs in a separate thread, such
+        that it overlaps with the next forward passes.
 
-        # global postprocessor
+        Args:
+            slides (List[SlideInferenceState]): Prepared WSI
+        """
+        # global postprocessor, the WSI is passed with each call such that the actors are shared by all slides
         (
             DetectionCellPostProcessor,
             create_batch_pooling_actor,
@@ -725,36 +1820,56 @@ class CellViTInference:
         )
 
         postprocessor = DetectionCellPostProcessor(
-            wsi=wsi,
+            wsi=slides[0].wsi,
             nr_types=self.run_conf["data"]["num_nuclei_classes"],
             classifier=self.classifier,
             binary=self.binary,
+            detection_only=self.detection_only,
+            detection_engine=self.detection_engine,
         )
 
         # create ray actors for batch-wise postprocessing
         batch_pooling_actors = [
-            BatchPoolingActor.remote(postprocessor, self.run_conf)
+            BatchPoolingActor.remote(postprocessor, self.run_conf, self.instance_map)
             for i in range(self.system_configuration["ray_worker"])
         ]
 
         call_ids = []
-        batch_results_list = []
+        call_patches = {}  # slide and patches (row, col) of each postprocessing call
+        validate_detection = (
+            self.detection_engine == "peaks" and self.detection_validation_interval > 0
+        )
+        batch_packer = SlideBatchPacker(
+            dataloaders=[slide.dataloader for slide in slides],
+            patch_coordinates=[slide.patch_coordinates for slide in slides],
+            batch_size=self.batch_size,
+        )
+
+        # single worker: stitching tasks of a WSI are executed in order of submission
+        stitching = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="cellvit-stitching"
+        )
 
         self.logger.info("Extracting cells using CellViT...")
-        with torch.no_grad():
-            pbar = tqdm.tqdm(
-                wsi_inference_dataloader, total=len(wsi_inference_dataloader)
-            )
+        with torch.no_grad(), stitching:
+            pbar = tqdm.tqdm(batch_packer, total=len(batch_packer))
             pbar.set_postfix(status="Running CellViT...")
-            for batch_num, batch in enumerate(wsi_inference_dataloader):
+            for batch_num, batch in enumerate(batch_packer):
+                # patches skipped by the dataloader will never be postprocessed
+                for slide_idx, discarded in batch.discarded.items():
+                    slide = slides[slide_idx]
+                    slide.stitching_tasks.append(
+                        stitching.submit(slide.stitcher.mark_discarded, discarded)
+                    )
+                for slide_idx in batch.finished:
+                    slides[slide_idx].exhausted = True
+
                 # check if batch is empty, then continue
-                if isinstance(batch[0], list):
-                    if len(batch[0]) == 0:
-                        pbar.update(1)
-                        pbar.total = len(wsi_inference_dataloader)
-                        continue
-                patches = batch[0].to(self.device)
-                metadata = batch[1]
+                if len(batch.metadata) == 0:
+                    pbar.update(1)
+                    self._finalize_slides(slides)
+                    continue
+                patches = batch.patches.to(self.device)
                 memory_percentage = (
                     self.system_configuration.get_current_memory_percentage()
                 )
@@ -770,27 +1885,58 @@ class CellViTInference:
                 # inference with model
                 if self.mixed_precision:
                     with torch.autocast(device_type="cuda", dtype=torch.float16):
-                        predictions = self.model.forward(patches, retrieve_tokens=True)
+                        predictions = self.model(patches, retrieve_tokens=True)
                 else:
-                    predictions = self.model.forward(patches, retrieve_tokens=True)
+                    predictions = self.model(patches, retrieve_tokens=True)
 
                 predictions = self.apply_softmax_reorder(predictions)
 
-                # postprocessing
-
-                call_id = batch_actor.convert_batch_to_graph_nodes.remote(
-                    predictions, metadata
-                )
-                call_ids.append(call_id)
-
-                # after 50 batches, retrieve results to lower pressure on memory
+                # postprocessing, one call per slide of the batch
+                for slide_idx, patch_range in batch.slide_slices():
+                    slide = slides[slide_idx]
+                    slide_predictions = self._select_predictions(
+                        predictions, patch_range, len(batch.metadata)
+                    )
+                    metadata = batch.metadata[patch_range]
+                    call_id = batch_actor.convert_batch_to_graph_nodes.remote(
+                        slide_predictions, metadata, slide.wsi
+                    )
+                    call_ids.append(call_id)
+                    call_patches[call_id] = (
+                        slide,
+                        [(meta["row"], meta["col"]) for meta in metadata],
+                    )
+                    slide.pending_calls += 1
+                    if (
+                        validate_detection
+                        and batch_num % self.detection_validation_interval == 0
+                    ):
+                        slide.validation_ids.append(
+                            batch_actor.compare_detection_engines.remote(
+                                slide_predictions
+                            )
+                        )
+
+                # stitch finished batches, after 50 pending batches wait to lower pressure on memory
                 pbar.update(1)
                 if len(call_ids) >= 50:
                     pbar.set_postfix(status="Buffering postprocessing... (50 batches)")
-                    batch_results = ray.get(call_ids)
-                    batch_results_list.append(batch_results)
-                    ray.internal.free(call_ids)
-                    call_ids = []  # Clear the processed IDs
+                    call_ids = self._stitch_batch_results(
+                        call_ids, call_patches, stitching, wait=True
+                    )
+                else:
+                    call_ids = self._stitch_batch_results(
+                        call_ids, call_patches, stitching, wait=False
+                    )
+                pending_stitching = [
+                    task
+                    for slide in slides
+                    for task in slide.stitching_tasks
+                    if not task.done()
+                ]
+                if len(pending_stitching) >= 50:
+                    pbar.set_postfix(status="Buffering stitching... (50 batches)")
+                    wait_futures(pending_stitching)
 
                 percentage_actor_alloc = (
                     sum(retrieve_actor_usage()) / self.system_configuration.memory * 100
@@ -799,73 +1945,118 @@ class CellViTInference:
                     percentage_actor_alloc >= 50 or percentage_actor_alloc <= 0.1
                 ) and memory_percentage >= 70:
                     pbar.set_postfix(status="Re-register worker")
-                    batch_results = ray.get(call_ids)
-                    batch_results_list.append(batch_results)
-                    ray.internal.free(call_ids)
-                    call_ids = []
+                    call_ids = self._stitch_batch_results(
+                        call_ids, call_patches, stitching, wait=True
+                    )
+                    for slide in slides:
+                        slide.validation_stats.extend(ray.get(slide.validation_ids))
+                        slide.validation_ids = []
                     [ray.kill(batch_actor) for batch_actor in batch_pooling_actors]
                     batch_pooling_actors = [
-                        BatchPoolingActor.remote(postprocessor, self.run_conf)
+                        BatchPoolingActor.remote(
+                            postprocessor, self.run_conf, self.instance_map
+                        )
                         for i in range(self.system_configuration["ray_worker"])
                     ]
 
-                pbar.total = len(wsi_inference_dataloader)
+                # outputs of slides without remaining patches are submitted while the next slides are processed
+                self._finalize_slides(slides)
 
             self.logger.info("Waiting for final batches to be processed...")
-            if len(call_ids) > 0:
-                batch_results = ray.get(call_ids)
-                batch_results_list.append(batch_results)
+            self._stitch_batch_results(call_ids, call_patches, stitching, wait=True)
+            for slide in slides:
+                slide.exhausted = True
+            self._finalize_slides(slides)
         del pbar
         [ray.kill(batch_actor) for batch_actor in batch_pooling_actors]
+        self._save_compiled_artifacts()
 
-        # flattend results
-        inference_results = list(itertools.chain.from_iterable(batch_results_list))
+    def _select_predictions(
+        self, predictions: dict, patch_range: slice, batch_size: int
+    ) -> dict:
+        """Select the predictions of a range of patches in the batch
 
-        # unpack inference results
-        cell_dict_wsi = []  # for storing all cell information
-        cell_dict_detection = []  # for storing only the centroids
+        Args:
+            predictions (dict): Network predictions of the batch
+            patch_range (slice): Patches to select
+            batch_size (int): Number of patches in the batch
 
-        graph_data = {
-            "cell_tokens": [],
-            "positions": [],
-            "metadata": {
-                "wsi_metadata": wsi.metadata,
-                "nuclei_types": self.label_map,
-            },
-            "nuclei_types": [],
+        Returns:
+            dict: Predictions of the selected patches
+        """
+        if patch_range == slice(0, batch_size):
+            return predictions
+        return {
+            key: (
+                value[patch_range]
+                if isinstance(value, torch.Tensor) and value.shape[0] == batch_size
+                else value
+            )
+            for key, value in predictions.items()
         }
 
-        self.logger.info("Unpack Batches")
-        for batch_results in inference_results:
-            (
-                batch_complete_dict,
-                batch_detection,
-                batch_cell_tokens,
-                batch_cell_positions,
-            ) = batch_results
-            cell_dict_wsi = cell_dict_wsi + batch_complete_dict
-            cell_dict_detection = cell_dict_detection + batch_detection
-            graph_data["cell_tokens"] = graph_data["cell_tokens"] + batch_cell_tokens
-            graph_data["positions"] = graph_data["positions"] + batch_cell_positions
-            graph_data["nuclei_types"] = graph_data["nuclei_types"] + [
-                v["type"] for v in batch_detection
-            ]
+    def _finalize_slides(self, slides: List[SlideInferenceState]) -> None:
+        """Submit the outputs of all WSI whose patches have been processed and stitched completely
+
+        Waits for the pending stitching tasks of these WSI, errors of the stitching thread are raised here.
+
+        Args:
+            slides (List[SlideInferenceState]): WSI of the current inference
+        """
+        for slide in slides:
+            if slide.submitted or not slide.exhausted or slide.pending_calls > 0:
+                continue
+            for task in slide.stitching_tasks:
+                task.result()
+            slide.stitching_tasks = []
+            slide.stitcher.finalize()
+            slide.validation_stats.extend(ray.get(slide.validation_ids))
+            slide.validation_ids = []
+            self._finalize_slide(slide)
+            slide.submitted = True
+            # release the slide handle and the patch dataset
+            slide.dataset, slide.dataloader = None, None
+
+    def _finalize_slide(self, slide: SlideInferenceState) -> None:
+        """Transform the collected cells of a WSI into slide coordinates and submit its outputs to the writer
 
-        # cleaning overlapping cells
-        if len(cell_dict_wsi) == 0:
-            self.logger.warning("No cells have been extracted")
+        Args:
+            slide (SlideInferenceState): State of the WSI
+        """
+        wsi_path, wsi_outdir, wsi = slide.wsi_path, slide.wsi_outdir, slide.wsi
+        wsi_inference_dataset = slide.dataset
+        instance_map_writer = slide.instance_map_writer
+        cell_dict_wsi = slide.cell_dict_wsi
+        cell_dict_detection = slide.cell_dict_detection
+        graph_data = slide.graph_data
+        if len(slide.validation_stats) > 0:
+            self._store_detection_validation(
+                slide.validation_stats, wsi_outdir / "detection_validation.json"
+            )
+
+        if slide.stitcher.num_cells_received == 0:
+            self.logger.warning(f"No cells have been extracted ({wsi_path.name})")
+            if isinstance(graph_data.get("cell_tokens"), TokenStore):
+                graph_data["cell_tokens"].discard()
+            if instance_map_writer is not None:
+                instance_map_writer.finalize(
+                    AffineTransform(scale=wsi.metadata["downsampling"])
+                )
+            self.ledger.finish(
+                slide.run_id,
+                num_cells=0,
+                timings={"inference": time.time() - slide.start_time},
+            )
+            if slide.on_complete is not None:
+                slide.on_complete()
             return
-        keep_idx = self._post_process_edge_cells(cell_list=cell_dict_wsi)
-        cell_dict_wsi = [cell_dict_wsi[idx_c] for idx_c in keep_idx]
-        cell_dict_detection = [cell_dict_detection[idx_c] for idx_c in keep_idx]
-        graph_data["cell_tokens"] = [
-            graph_data["cell_tokens"][idx_c] for idx_c in keep_idx
-        ]
-        graph_data["positions"] = [graph_data["positions"][idx_c] for idx_c in keep_idx]
-        graph_data["nuclei_types"] = [
-            graph_data["nuclei_types"][idx_c] for idx_c in keep_idx
-        ]
-        self.logger.info(f"Detected cells after cleaning: {len(keep_idx)}")
+        self.logger.info(
+            f"Detected cells before cleaning: {slide.stitcher.num_cells_received}"
+        )
+        self.logger.info(f"Detected cells after cleaning: {len(cell_dict_detection)}")
+
+        # all coordinate corrections are collected and applied at once
+        coordinate_transform = AffineTransform()
 
         # reallign grid if interpolation was used (including target_mpp_tolerance)
         if (
@@ -873,11 +2064,10 @@ class CellViTInference:
             <= wsi.metadata["target_patch_mpp"]
             <= wsi.metadata["base_mpp"] + 0.035
         ):
-            cell_dict_wsi, cell_dict_detection, graph_data = self._reallign_grid(
-                cell_dict_wsi=cell_dict_wsi,
-                cell_dict_detection=cell_dict_detection,
-                graph_data=graph_data,
-                rescaling_factor=wsi_inference_dataset.rescaling_factor,
+            coordinate_transform = coordinate_transform.then(
+                self._reallign_grid(
+                    rescaling_factor=wsi_inference_dataset.rescaling_factor
+                )
             )
 
         # reallign cells if either row or columns is one (dimension in one direction smaller)
@@ -889,108 +2079,187 @@ class CellViTInference:
             self.logger.warning(
                 "WSI is smaller than 1024x1024px, we need to remove padding"
             )
-            cell_dict_wsi, cell_dict_detection, graph_data = self._remove_padding(
+            coordinate_transform = coordinate_transform.then(
+                self._remove_padding(
+                    wsi_dimension=wsi_inference_dataset.tile_extractor.level_dimensions[
+                        wsi_inference_dataset.curr_wsi_level
+                    ],
+                )
+            )
+        (
+            cell_dict_wsi,
+            cell_dict_detection,
+            graph_data,
+        ) = self._apply_coordinate_transform(
+            coordinate_transform=coordinate_transform,
+            cell_dict_wsi=cell_dict_wsi,
+            cell_dict_detection=cell_dict_detection,
+            graph_data=graph_data,
+        )
+        if self.contour_tolerance > 0 and not self.detection_only:
+            self._simplify_contours(cell_dict_wsi)
+
+        cell_order = None
+        if self.spatial_index:
+            if self.file_format == "json" and self.compression:
+                self.logger.warning(
+                    "Spatial index is not available for compressed json files, cells are just sorted"
+                )
+            cell_order = hilbert_order(cell_dict_detection)
+            cell_dict_wsi, cell_dict_detection, graph_data = self._sort_cells_spatially(
                 cell_dict_wsi=cell_dict_wsi,
                 cell_dict_detection=cell_dict_detection,
                 graph_data=graph_data,
-                wsi_dimension=wsi_inference_dataset.tile_extractor.level_dimensions[
-                    wsi_inference_dataset.curr_wsi_level
-                ],
+                order=cell_order,
             )
 
         # saving/storing
-        output_wsi_name = wsi_path.name.split(".")[0]
         cell_dict_wsi = {
             "wsi_metadata": wsi.metadata,
             "type_map": self.label_map,
             "cells": cell_dict_wsi,
         }
-        if self.compression:
-            with open(str(wsi_outdir / f"cells.json.snappy"), "wb") as outfile:
-                compressed_data = snappy.compress(ujson.dumps(cell_dict_wsi, outfile))
-                outfile.write(compressed_data)
-        else:
-            with open(str(wsi_outdir / "cells.json"), "w") as outfile:
-                ujson.dump(cell_dict_wsi, outfile)
-
-        if self.geojson:
-            self.logger.info("Converting segmentation to geojson")
-            geojson_list = self._convert_json_geojson(cell_dict_wsi["cells"], True)
-            if self.compression:
-                with open(str(wsi_outdir / "cells.geojson.snappy"), "wb") as outfile:
-                    compressed_data = snappy.compress(
-                        ujson.dumps(geojson_list, outfile)
-                    )
-                    outfile.write(compressed_data)
-            else:
-                with open(str(str(wsi_outdir / "cells.geojson")), "w") as outfile:
-                    ujson.dump(geojson_list, outfile)
-
         cell_dict_detection = {
             "wsi_metadata": wsi.metadata,
             "type_map": self.label_map,
             "cells": cell_dict_detection,
         }
-        if self.compression:
-            with open(str(wsi_outdir / "cell_detection.json.snappy"), "wb") as outfile:
-                compressed_data = snappy.compress(
-                    ujson.dumps(cell_dict_detection, outfile)
+        # without contours (detection_only), just detections are stored and indexed
+        cells_index = self.spatial_index and not self.detection_only
+        detection_index = self.spatial_index and self.detection_only
+        artifacts = {}
+        if self.file_format != "json":
+            if not self.detection_only:
+                artifacts["cells"] = partial(
+                    self._store_cells_columnar,
+                    cell_dict_wsi,
+                    wsi_outdir / "cells",
+                    False,
+                    cells_index,
                 )
-                outfile.write(compressed_data)
+            artifacts["cell_detection"] = partial(
+                self._store_cells_columnar,
+                cell_dict_detection,
+                wsi_outdir / "cell_detection",
+                True,
+                detection_index,
+            )
         else:
-            with open(str(wsi_outdir / "cell_detection.json"), "w") as outfile:
-                ujson.dump(cell_dict_detection, outfile)
+            if not self.detection_only:
+                artifacts["cells.json"] = partial(
+                    self._store_cells_json,
+                    cell_dict_wsi,
+                    wsi_outdir / "cells.json",
+                    cells_index and not self.compression,
+                )
+            artifacts["cell_detection.json"] = partial(
+                self._store_cells_json,
+                cell_dict_detection,
+                wsi_outdir / "cell_detection.json",
+                detection_index and not self.compression,
+            )
         if self.geojson:
-            self.logger.info("Converting detection to geojson")
-            geojson_list = self._convert_json_geojson(
-                cell_dict_detection["cells"], False
-            )
-            if self.compression:
-                with open(
-                    str(wsi_outdir / "cell_detection.geojson.snappy"),
-                    "wb",
-                ) as outfile:
-                    compressed_data = snappy.compress(
-                        ujson.dumps(geojson_list, outfile)
-                    )
-                    outfile.write(compressed_data)
-            else:
-                with open(
-                    str(str(wsi_outdir / "cell_detection.geojson")),
-                    "w",
-                ) as outfile:
-                    ujson.dump(geojson_list, outfile)
-
-        # store graph
-        if self.graph:
-            self.logger.info(
-                f"Create cell graph with embeddings and save it under: {str(wsi_outdir/ 'cells.pt')}"
+            if not self.detection_only:
+                artifacts["cells.geojson"] = partial(
+                    self._store_geojson,
+                    cell_dict_wsi["cells"],
+                    wsi_outdir / "cells.geojson",
+                    True,
+                )
+            artifacts["cell_detection.geojson"] = partial(
+                self._store_geojson,
+                cell_dict_detection["cells"],
+                wsi_outdir / "cell_detection.geojson",
+                False,
             )
-            graph = CellGraphDataWSI(
-                x=torch.stack(graph_data["cell_tokens"]),
-                positions=torch.stack(graph_data["positions"]),
-                metadata=graph_data["metadata"],
-                nuclei_types=torch.tensor(graph_data["nuclei_types"]),
+        if self.tile_size is not None and self.detection_only:
+            artifacts["tiles"] = partial(
+                self._store_tiles, cell_dict_detection, wsi_outdir / "tiles", False
             )
-            torch.save(graph, str(wsi_outdir / "cells.pt"))
+        elif self.tile_size is not None:
+            artifacts["tiles"] = partial(
+                self._store_tiles, cell_dict_wsi, wsi_outdir / "tiles"
+            )
+        if self.graph and self.graph_format == "mmap":
+            artifacts["cells_graph"] = partial(
+                self._store_graph_mmap, graph_data, wsi_outdir / "cells_graph"
+            )
+        elif self.graph:
+            artifacts["cells.pt"] = partial(
+                self._store_graph, graph_data, wsi_outdir / "cells.pt"
+            )
+        if instance_map_writer is not None:
+            # label map pixels are given in the (downsampled) inference resolution
+            artifacts["instance_map.zarr"] = partial(
+                instance_map_writer.finalize,
+                AffineTransform(scale=wsi.metadata["downsampling"]).then(
+                    coordinate_transform
+                ),
+                cell_order,
+            )
+        timings = {"inference": time.time() - slide.start_time}
+        self.writer.submit_slide(
+            wsi_path.name,
+            artifacts,
+            on_complete=partial(
+                self._finish_wsi,
+                wsi_path,
+                cell_dict_detection["cells"],
+                slide.run_id,
+                timings,
+                time.time(),
+                slide.on_complete,
+            ),
+            on_error=slide.fail,
+        )
 
-        # final output message
-        cell_stats_df = pd.DataFrame(cell_dict_wsi["cells"])
+    def _finish_wsi(
+        self,
+        wsi_path: Path,
+        cell_list: List[dict],
+        run_id: int,
+        timings: dict,
+        submit_time: float,
+        on_complete: Callable[[], None] = None,
+    ) -> None:
+        """Log the cell statistics and mark the WSI as finished in the run ledger after all outputs are written
+
+        Args:
+            wsi_path (Path): Path to the WSI
+            cell_list (List[dict]): Detected cells
+            run_id (int): Run id of the attempt in the run ledger
+            timings (dict): Durations of the processing steps, the time for writing the outputs is added
+            submit_time (float): Time the outputs have been submitted to the writer
+            on_complete (Callable[[], None], optional): Callback of the caller of process_wsi. Defaults to None.
+        """
+        import pandas as pd
+
+        output_wsi_name = wsi_path.name.split(".")[0]
+        cell_stats_df = pd.DataFrame(cell_list)
         cell_stats = dict(cell_stats_df.value_counts("type"))
         verbose_stats = {self.label_map[k]: v for k, v in cell_stats.items()}
         self.logger.info(f"Finished with cell detection for WSI {output_wsi_name}")
         self.logger.info("Stats:")
         self.logger.info(f"{verbose_stats}")
 
-        # store a json with processed files -> append if already exists
-        processed_files = []
-        if (self.outdir / "processed_files.json").exists():
-            with open(self.outdir / "processed_files.json", "r") as infile:
-                processed_files = ujson.load(infile)
-        processed_files.append(wsi_path.name)
-        processed_files = list(set(processed_files))
-        with open(self.outdir / "processed_files.json", "w") as outfile:
-            ujson.dump(processed_files, outfile)
+        timings = {**timings, "writing": time.time() - submit_time}
+        self.ledger.finish(run_id, num_cells=len(cell_list), timings=timings)
+        if on_complete is not None:
+            on_complete()
+
+    def flush_outputs(self) -> None:
+        """Wait until the outputs of all processed WSI are written
+
+        Raises:
+            RuntimeError: If writing any output failed
+        """
+        self.writer.flush()
+
+    def close(self) -> None:
+        """Shut down the worker processes cleaning overlapping cells (no WSI can be processed afterwards)"""
+        if self.cleaning_pool is not None:
+            self.cleaning_pool.shutdown(wait=True)
+            self.cleaning_pool = None
 
     def apply_softmax_reorder(self, predictions: dict) -> dict:
         """Reorder and apply softmax on predictions
@@ -166,9 +166,9 @@ class OverlapCellCleaner:
 
             for query_poly in poly_list:
                 if query_poly.uid not in iterated_cells:
-                    intersected_polygons = tree.query(
-                        query_poly
-                    )  # this also contains a self-intersection
+                    intersected_polygons = sorted(
+                        tree.query(query_poly), key=lambda p: p.uid
+                    )  # this also contains a self-intersection, sorted for deterministic ties
                     if (
                         len(intersected_polygons) > 1
                     ):  # we have more at least one intersection with another cell
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+# Peak-based cell detection without watershed
+#
+# Lightweight alternative to the watershed instance separation for detection-only
+# workflows (e.g., cell counting). Nucleus centers are derived directly from the network
+# output: inside a nucleus, the horizontal and vertical map have a zero crossing with
+# positive gradient at the center. The center energy
+#   E = P(nucleus) * (1 - |h|) * (1 - |v|)
+# is maximal there, peaks are found with a max-pooling non-maximum suppression for the
+# whole batch at once. Bounding boxes are derived from the nucleus extent along the row
+# and column through the center, the type by a majority vote in a small window.
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+from typing import List, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy.spatial import cKDTree
+
+
+def detect_peaks(
+    predictions: dict,
+    min_distance: int = 4,
+    threshold: float = 0.4,
+    max_radius: int = 32,
+    vote_size: int = 5,
+) -> Tuple[torch.Tensor, List[dict]]:
+    """Detect nucleus centers of a batch from the binary, hv and type maps
+
+    The returned cell dictionaries have the same schema as the detection-only output
+    of the DetectionCellPostProcessor (keys bbox, centroid, type_prob, type).
+
+    Args:
+        predictions (dict): Network predictions (after softmax). Keys (required):
+            * nuclei_binary_map: Binary Nucleus Predictions. Shape: (B, H, W, 2)
+            * nuclei_type_map: Type prediction of nuclei. Shape: (B, H, W, num_nuclei_classes)
+            * hv_map: Horizontal-Vertical nuclei mapping. Shape: (B, H, W, 2)
+        min_distance (int, optional): Minimum distance between two nucleus centers in pixels. Defaults to 4.
+        threshold (float, optional): Minimum center energy of a peak. Defaults to 0.4.
+        max_radius (int, optional): Maximum nucleus radius in pixels for the bounding box estimation. Defaults to 32.
+        vote_size (int, optional): Window size for the type vote. Defaults to 5.
+
+    Returns:
+        Tuple[torch.Tensor, List[dict]]:
+            * torch.Tensor: Marker map, each nucleus center has an own integer. Shape: (B, H, W)
+            * List of dictionaries. Each List entry is one image, with a dict for each detected nucleus.
+    """
+    foreground = predictions["nuclei_binary_map"][..., 1].float()
+    hv_map = predictions["hv_map"].float().clamp(-1, 1)
+    h_map, v_map = hv_map[..., 0], hv_map[..., 1]
+    types = torch.argmax(predictions["nuclei_type_map"], dim=-1)
+    num_types = predictions["nuclei_type_map"].shape[-1]
+    b, h, w = foreground.shape
+
+    # center energy, smoothed against noisy hv predictions
+    energy = foreground * (1 - h_map.abs()) * (1 - v_map.abs())
+    energy = F.avg_pool2d(energy[:, None], 3, stride=1, padding=1)[:, 0]
+
+    # zero crossing with positive gradient (center of a nucleus, not a boundary)
+    h_grad = F.pad(h_map[..., 2:] - h_map[..., :-2], (1, 1)) / 2
+    v_grad = F.pad(v_map[:, 2:, :] - v_map[:, :-2, :], (0, 0, 1, 1)) / 2
+
+    # non-maximum suppression
+    window = 2 * min_distance + 1
+    local_max = F.max_pool2d(energy[:, None], window, stride=1, padding=min_distance)
+    peaks = (
+        (energy == local_max[:, 0])
+        & (energy >= threshold)
+        & (foreground >= 0.5)
+        & (h_grad > 0)
+        & (v_grad > 0)
+    )
+    # plateaus: keep the last pixel of equal peaks within the window
+    pixel_idx = torch.arange(h * w, device=energy.device, dtype=torch.float64)
+    peak_idx = torch.where(peaks, pixel_idx.reshape(1, h, w), -1.0)
+    local_max = F.max_pool2d(peak_idx[:, None], window, stride=1, padding=min_distance)
+    peaks = peaks & (peak_idx == local_max[:, 0])
+    batch_idx, rows, cols = torch.nonzero(peaks, as_tuple=True)
+    markers = torch.zeros((b, h, w), dtype=torch.int32)
+    cell_dicts = [{} for _ in range(b)]
+    if len(rows) == 0:
+        return markers, cell_dicts
+
+    # subpixel center: zero crossing of the (linear) hv maps, at most one pixel shift
+    shift_x = (-h_map[batch_idx, rows, cols] / h_grad[batch_idx, rows, cols]).clamp(
+        -1, 1
+    )
+    shift_y = (-v_map[batch_idx, rows, cols] / v_grad[batch_idx, rows, cols]).clamp(
+        -1, 1
+    )
+    centroids = torch.stack([cols + shift_x, rows + shift_y], dim=1).double()
+
+    bboxes = _estimate_bboxes(
+        foreground, h_map, v_map, batch_idx, rows, cols, max_radius
+    )
+    cell_types, type_probs = _vote_types(
+        foreground, types, num_types, batch_idx, rows, cols, vote_size
+    )
+
+    batch_idx, rows, cols = batch_idx.cpu(), rows.cpu(), cols.cpu()
+    centroids, bboxes = centroids.cpu().numpy(), bboxes.cpu().numpy()
+    cell_types, type_probs = cell_types.cpu().tolist(), type_probs.cpu().tolist()
+    for image_idx in range(b):
+        members = torch.nonzero(batch_idx == image_idx)[:, 0]
+        inst_ids = torch.arange(1, len(members) + 1, dtype=torch.int32)
+        markers[image_idx, rows[members], cols[members]] = inst_ids
+        for inst_id, cell_idx in zip(inst_ids.tolist(), members.tolist()):
+            cell_dicts[image_idx][inst_id] = {
+                "bbox": bboxes[cell_idx],
+                "centroid": centroids[cell_idx],
+                "type_prob": type_probs[cell_idx],
+                "type": cell_types[cell_idx],
+            }
+    return markers, cell_dicts
+
+
+def _estimate_bboxes(
+    foreground: torch.Tensor,
+    h_map: torch.Tensor,
+    v_map: torch.Tensor,
+    batch_idx: torch.Tensor,
+    rows: torch.Tensor,
+    cols: torch.Tensor,
+    max_radius: int,
+) -> torch.Tensor:
+    """Estimate the bounding boxes from the nucleus extent along the row and column through the center
+
+    A pixel belongs to the nucleus as long as it is foreground and the hv map has not jumped
+    to the opposite sign (start of a touching nucleus).
+
+    Args:
+        foreground (torch.Tensor): Nucleus probability. Shape: (B, H, W)
+        h_map (torch.Tensor): Horizontal map. Shape: (B, H, W)
+        v_map (torch.Tensor): Vertical map. Shape: (B, H, W)
+        batch_idx (torch.Tensor): Image index of the centers. Shape: (N)
+        rows (torch.Tensor): Row of the centers. Shape: (N)
+        cols (torch.Tensor): Column of the centers. Shape: (N)
+        max_radius (int): Maximum nucleus radius in pixels
+
+    Returns:
+        torch.Tensor: Bounding boxes [[rmin, cmin], [rmax, cmax]] (max exclusive). Shape: (N, 2, 2)
+    """
+    _, h, w = foreground.shape
+    offsets = torch.arange(1, max_radius + 1, device=foreground.device)
+    b_idx = batch_idx[:, None]
+
+    def extent(
+        coordinates: torch.Tensor, size: int, sign: int, horizontal: bool
+    ) -> torch.Tensor:
+        positions = coordinates[:, None] + sign * offsets[None]
+        inside = (positions >= 0) & (positions < size)
+        positions = positions.clamp(0, size - 1)
+        if horizontal:
+            fg = foreground[b_idx, rows[:, None], positions]
+            direction = h_map[b_idx, rows[:, None], positions]
+        else:
+            fg = foreground[b_idx, positions, cols[:, None]]
+            direction = v_map[b_idx, positions, cols[:, None]]
+        inside = inside & (fg >= 0.5) & (sign * direction > -0.25)
+        return torch.cumprod(inside.int(), dim=1).sum(dim=1)
+
+    cmin = cols - extent(cols, w, -1, True)
+    cmax = cols + extent(cols, w, 1, True) + 1
+    rmin = rows - extent(rows, h, -1, False)
+    rmax = rows + extent(rows, h, 1, False) + 1
+    return torch.stack([torch.stack([rmin, cmin], 1), torch.stack([rmax, cmax], 1)], 1)
+
+
+def _vote_types(
+    foreground: torch.Tensor,
+    types: torch.Tensor,
+    num_types: int,
+    batch_idx: torch.Tensor,
+    rows: torch.Tensor,
+    cols: torch.Tensor,
+    vote_size: int,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Majority vote of the pixel types in a window around each center
+
+    As for the watershed path, background is just selected if no other type is present.
+
+    Args:
+        foreground (torch.Tensor): Nucleus probability. Shape: (B, H, W)
+        types (torch.Tensor): Pixel types. Shape: (B, H, W)
+        num_types (int): Number of types (including background)
+        batch_idx (torch.Tensor): Image index of the centers. Shape: (N)
+        rows (torch.Tensor): Row of the centers. Shape: (N)
+        cols (torch.Tensor): Column of the centers. Shape: (N)
+        vote_size (int): Window size
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: Type and type probability of each center. Shape: (N)
+    """
+    _, h, w = types.shape
+    offsets = torch.arange(vote_size, device=types.device) - vote_size // 2
+    window_rows = (rows[:, None, None] + offsets[None, :, None]).clamp(0, h - 1)
+    window_cols = (cols[:, None, None] + offsets[None, None, :]).clamp(0, w - 1)
+    b_idx = batch_idx[:, None, None]
+    window_types = types[b_idx, window_rows, window_cols].reshape(len(rows), -1)
+    window_fg = foreground[b_idx, window_rows, window_cols].reshape(len(rows), -1)
+
+    votes = torch.zeros((len(rows), num_types), device=types.device)
+    votes.scatter_add_(1, window_types, (window_fg >= 0.5).float())
+    cell_types = torch.argmax(votes, dim=1)
+    fallback = (cell_types == 0) & (votes[:, 1:].max(dim=1).values > 0)
+    cell_types[fallback] = torch.argmax(votes[fallback, 1:], dim=1) + 1
+    type_probs = votes.gather(1, cell_types[:, None])[:, 0] / (
+        votes.sum(dim=1) + 1.0e-6
+    )
+    return cell_types, type_probs
+
+
+def compare_detections(
+    reference: List[dict], candidate: List[dict], radius: float = 6.0
+) -> dict:
+    """Match two sets of detections by their centroids (one-to-one, closest pairs first)
+
+    Args:
+        reference (List[dict]): Reference detections with keys centroid and type (e.g., watershed)
+        candidate (List[dict]): Candidate detections with keys centroid and type (e.g., peaks)
+        radius (float, optional): Maximum centroid distance of matched detections. Defaults to 6.0.
+
+    Returns:
+        dict: Counts, keys num_reference, num_candidate, matched, distance_sum and type_matches
+    """
+    stats = {
+        "num_reference": len(reference),
+        "num_candidate": len(candidate),
+        "matched": 0,
+        "distance_sum": 0.0,
+        "type_matches": 0,
+    }
+    if len(reference) == 0 or len(candidate) == 0:
+        return stats
+    reference_centroids = np.array([c["centroid"] for c in reference], dtype=float)
+    candidate_centroids = np.array([c["centroid"] for c in candidate], dtype=float)
+    distances = cKDTree(reference_centroids).sparse_distance_matrix(
+        cKDTree(candidate_centroids), radius, output_type="ndarray"
+    )
+    distances.sort(order="v")
+    matched_reference, matched_candidate = set(), set()
+    for ref_idx, cand_idx, distance in distances.tolist():
+        if ref_idx in matched_reference or cand_idx in matched_candidate:
+            continue
+        matched_reference.add(ref_idx)
+        matched_candidate.add(cand_idx)
+        stats["matched"] += 1
+        stats["distance_sum"] += distance
+        stats["type_matches"] += int(
+            reference[ref_idx]["type"] == candidate[cand_idx]["type"]
+        )
+    return stats
+
+
+def summarize_comparison(stats: List[dict]) -> dict:
+    """Summarize matching counts (see compare_detections) to a validation report
+
+    Args:
+        stats (List[dict]): Matching counts, e.g., one per batch
+
+    Returns:
+        dict: Validation report with counts, precision, recall, f1, mean_distance and type_agreement
+            (precision/recall with respect to the reference)
+    """
+    total = {
+        key: sum(s[key] for s in stats)
+        for key in [
+            "num_reference",
+            "num_candidate",
+            "matched",
+            "distance_sum",
+            "type_matches",
+        ]
+    }
+    matched = total["matched"]
+    precision = matched / max(total["num_candidate"], 1)
+    recall = matched / max(total["num_reference"], 1)
+    return {
+        "num_reference": total["num_reference"],
+        "num_candidate": total["num_candidate"],
+        "matched": matched,
+        "precision": precision,
+        "recall": recall,
+        "f1": 2 * precision * recall / max(precision + recall, 1e-12),
+        "mean_distance": total["distance_sum"] / max(matched, 1),
+        "type_agreement": total["type_matches"] / max(matched, 1),
+    }
@@ -7,7 +7,8 @@
 # Institute for Artifical Intelligence in Medicine,
 # University Medicine Essen
 from os import environ
-from typing import List, Tuple, Union
+from copy import copy
+from typing import List, Literal, Tuple, Union
 from torch import nn
 import cv2
 import numpy as np
@@ -15,10 +16,11 @@ import ray
 import torch
 import torch.nn.functional as F
 from einops import rearrange
-from scipy.ndimage import binary_fill_holes
+from scipy.ndimage import binary_fill_holes, find_objects
 from skimage.segmentation import watershed
 
 from cellvit.data.dataclass.wsi import WSI, WSIMetadata
+from cellvit.inference.peak_detection import compare_detections, detect_peaks
 from cellvit.utils.tools import get_bounding_box, remap_label
 from cellvit.utils.tools_cp import remove_small_objects_cp
 
@@ -34,6 +36,8 @@ class DetectionCellPostProcessor:
         nr_types: int,
         classifier: nn.Module = None,
         binary: bool = False,
+        detection_only: bool = False,
+        detection_engine: Literal["watershed", "peaks"] = "watershed",
     ) -> None:
         """DetectionCellPostProcessor for postprocessing prediction maps and get detected cells, based on cupy
 
@@ -42,6 +46,11 @@ class DetectionCellPostProcessor:
             nr_types (int):  Number of cell types, including background (background = 0). Defaults to None.
             classifier (nn.Module, optional): Add a token classifier to change the cell types based on a custom cell classifier. Defaults to None.
             binary (bool): If just a binary detection/segmentation should be performed. Defaults to False.
+            detection_only (bool, optional): If just bbox, centroid and type of the cells should be extracted, without contours.
+                Defaults to False.
+            detection_engine (Literal["watershed", "peaks"], optional): Method for separating the nuclei. "watershed" uses the
+                instance separation of HoVer-Net, "peaks" detects nucleus centers directly from the hv and binary map
+                (see cellvit.inference.peak_detection, no contours, implies detection_only). Defaults to "watershed".
 
         Raises:
             NotImplementedError: Unknown
@@ -50,6 +59,8 @@ class DetectionCellPostProcessor:
         self.nr_types = nr_types
         self.classifier = classifier
         self.binary = binary
+        self.detection_engine = detection_engine
+        self.detection_only = detection_only or detection_engine == "peaks"
         self.object_size = 10
         self.k_size = 21
 
@@ -109,6 +120,9 @@ class DetectionCellPostProcessor:
         # checking
         self.check_network_output(predictions_)
 
+        if self.detection_engine == "peaks":
+            return detect_peaks(predictions_)
+
         # batch wise
         pred_maps = self._prepare_pred_maps(predictions_)
 
@@ -133,7 +147,10 @@ class DetectionCellPostProcessor:
             Tuple[np.ndarray, dict[int, dict]]: _description_
         """
         pred_inst, pred_type = self._get_pred_inst_tensor(pred_map)
-        cells = self._create_cell_dict(pred_inst, pred_type)
+        if self.detection_only:
+            cells = self._create_detection_dict(pred_inst, pred_type)
+        else:
+            cells = self._create_cell_dict(pred_inst, pred_type)
         return (pred_inst, cells)
 
     def _prepare_pred_maps(self, predictions_: dict) -> cp.ndarray:
@@ -404,6 +421,80 @@ class DetectionCellPostProcessor:
 
         return inst_info_dict
 
+    def _create_detection_dict(
+        self, pred_inst: np.ndarray, pred_type: np.ndarray
+    ) -> dict[int, dict]:
+        """Create cell dictionary without contours from instance and type predictions
+
+        Bounding boxes, centroids (image moments) and types of all instances are computed at once,
+        without cropping each instance and without contour extraction. Instances without a valid contour
+        (at least 3 points) are skipped like in the contour-based path: straight lines, i.e., instances with a
+        bounding box of one pixel width or height and diagonal lines (one pixel per row and column).
+        Instances with several fragments or holes can still differ, as the contour-based path just evaluates
+        the first contour found by OpenCV.
+
+        Keys of the dictionary:
+            * bbox: Bounding box of the cell
+            * centroid: Centroid of the cell
+            * type_prob: Probability of the cell type
+            * type: Type of the cell
+
+        Args:
+            pred_inst (np.ndarray): Instance array with shape (H, W), each instance has unique integer
+            pred_type (np.ndarray): Type array with shape (H, W), each pixel has the type of the instance
+
+        Returns:
+            dict [int, dict]: Dictionary containing the cell information
+        """
+        assert isinstance(pred_inst, np.ndarray), "pred_inst must be a numpy array"
+        assert pred_inst.ndim == 2, "pred_inst must be a 2-dimensional array"
+        assert isinstance(pred_type, np.ndarray), "pred_type must be a numpy array"
+        assert pred_type.ndim == 2, "pred_type must be a 2-dimensional array"
+        assert (
+            pred_inst.shape == pred_type.shape
+        ), "pred_inst and pred_type must have the same shape"
+
+        inst_slices = find_objects(pred_inst)
+        num_inst = len(inst_slices) + 1  # including background
+        rows, cols = np.nonzero(pred_inst)
+        labels = pred_inst[rows, cols].astype(np.int64)
+
+        # moments m00, m10 and m01 of all instances
+        area = np.bincount(labels, minlength=num_inst)
+        centroid_x = np.bincount(labels, weights=cols, minlength=num_inst)
+        centroid_y = np.bincount(labels, weights=rows, minlength=num_inst)
+        centroid_x = centroid_x / np.maximum(area, 1)
+        centroid_y = centroid_y / np.maximum(area, 1)
+
+        # dominant type, if background select the 2nd most dominant if exist
+        type_counts = np.bincount(
+            labels * self.nr_types + pred_type[rows, cols],
+            minlength=num_inst * self.nr_types,
+        ).reshape(num_inst, self.nr_types)
+        inst_types = np.argmax(type_counts, axis=1)
+        fallback = (inst_types == 0) & (np.max(type_counts[:, 1:], axis=1) > 0)
+        inst_types[fallback] = np.argmax(type_counts[fallback, 1:], axis=1) + 1
+        type_probs = type_counts[np.arange(num_inst), inst_types] / (area + 1.0e-6)
+
+        inst_info_dict = {}
+        for inst_id, inst_slice in enumerate(inst_slices, start=1):
+            if inst_slice is None:
+                continue
+            rmin, rmax = inst_slice[0].start, inst_slice[0].stop
+            cmin, cmax = inst_slice[1].start, inst_slice[1].stop
+            if rmax - rmin < 2 or cmax - cmin < 2:
+                continue
+            if area[inst_id] == rmax - rmin == cmax - cmin:  # diagonal line
+                continue
+            inst_info_dict[inst_id] = {
+                "bbox": np.array([[rmin, cmin], [rmax, cmax]]),
+                "centroid": np.array([centroid_x[inst_id], centroid_y[inst_id]]),
+                "type_prob": float(type_probs[inst_id]),
+                "type": int(inst_types[inst_id]),
+            }
+
+        return inst_info_dict
+
     def _create_single_instance_entry(
         self, inst_id: int, pred_inst: np.ndarray, pred_type: np.ndarray
     ) -> Tuple[int, dict]:
@@ -577,6 +668,7 @@ def create_batch_pooling_actor(num_cpus: int = 8):
             self,
             detection_cell_postprocessor: DetectionCellPostProcessor,
             run_conf: dict,
+            instance_map: bool = False,
         ) -> None:
             """Ray Actor for coordinating the postprocessing of **one** batch
 
@@ -587,6 +679,8 @@ def create_batch_pooling_actor(num_cpus: int = 8):
             Args:
                 detection_cell_postprocessor (DetectionCellPostProcessorCupy): Instance of the `DetectionCellPostProcessorCupy` class
                 run_conf (dict): Run configuration
+                instance_map (bool, optional): If the instance maps of the patches should be returned
+                    for the instance map export. Defaults to False.
             """
             assert "dataset_config" in run_conf, "dataset_config must be in run_conf"
             assert (
@@ -599,13 +693,19 @@ def create_batch_pooling_actor(num_cpus: int = 8):
 
             self.detection_cell_postprocessor = detection_cell_postprocessor
             self.run_conf = run_conf
+            self.instance_map = instance_map
 
         def convert_batch_to_graph_nodes(
-            self, predictions: dict, metadata: List[dict]
+            self,
+            predictions: dict,
+            metadata: List[dict],
+            wsi: Union[WSI, WSIMetadata] = None,
         ) -> Tuple[List[dict], List[dict], List[torch.Tensor], List[torch.Tensor]]:
             """Postprocess a batch of predictions and convert it to graph nodes
 
-            Returns the complete graph nodes (cell dictionary), the detection nodes (cell detection dictionary), the cell tokens and the cell positions
+            Returns the complete graph nodes (cell dictionary), the detection nodes (cell detection dictionary), the cell tokens and the cell positions.
+            If instance_map is set, the instance maps of the patches are returned additionally and each cell dictionary
+            contains its patch-local instance id (inst_id).
 
 
             Args:
@@ -618,6 +718,8 @@ def create_batch_pooling_actor(num_cpus: int = 8):
                     * row: Row index of the patch
                     * col: Column index of the patch
                     Other keys are optional
+                wsi (Union[WSI, WSIMetadata], optional): WSI of the patches, if the actor is shared by multiple slides.
+                    Defaults to None (WSI of the postprocessor).
 
             Returns:
                 Tuple[List[dict], List[dict], List[torch.Tensor], List[torch.Tensor]]:
@@ -625,10 +727,12 @@ def create_batch_pooling_actor(num_cpus: int = 8):
                     * List[dict]: Detection nodes (cell detection dictionary)
                     * List[torch.Tensor]: Cell tokens
                     * List[torch.Tensor]: Cell positions (centroid)
+                    * List[np.ndarray]: Instance maps of the patches (just if instance_map is set)
             """
-            _, cell_dict_batch = self.detection_cell_postprocessor.post_process_batch(
-                predictions
-            )
+            (
+                instance_maps,
+                cell_dict_batch,
+            ) = self.detection_cell_postprocessor.post_process_batch(predictions)
             tokens = predictions["tokens"].detach().to("cpu")
 
             batch_complete = []
@@ -645,7 +749,7 @@ def create_batch_pooling_actor(num_cpus: int = 8):
                     patch_cell_tokens,
                     patch_cell_positions,
                 ) = self.convert_patch_to_graph_nodes(
-                    patch_cell_dict, patch_metadata, tokens[idx]
+                    patch_cell_dict, patch_metadata, tokens[idx], wsi
                 )
                 batch_complete = batch_complete + patch_complete
                 batch_detection = batch_detection + patch_detection
@@ -677,6 +781,15 @@ def create_batch_pooling_actor(num_cpus: int = 8):
                     f["type"] = 1
                 pass
 
+            if self.instance_map:
+                instance_maps = instance_maps.numpy().astype(np.uint32)
+                return (
+                    batch_complete,
+                    batch_detection,
+                    batch_cell_tokens,
+                    batch_cell_positions,
+                    list(instance_maps),
+                )
             return (
                 batch_complete,
                 batch_detection,
@@ -684,11 +797,38 @@ def create_batch_pooling_actor(num_cpus: int = 8):
                 batch_cell_positions,
             )
 
+        def compare_detection_engines(self, predictions: dict) -> dict:
+            """Compare the peak-based detection of a batch with the watershed detection
+
+            Args:
+                predictions (dict): Network predictions, see convert_batch_to_graph_nodes
+
+            Returns:
+                dict: Matching counts, see cellvit.inference.peak_detection.compare_detections
+            """
+            reference_postprocessor = copy(self.detection_cell_postprocessor)
+            reference_postprocessor.detection_engine = "watershed"
+            reference_postprocessor.detection_only = True
+            _, reference = reference_postprocessor.post_process_batch(predictions)
+            _, candidate = self.detection_cell_postprocessor.post_process_batch(
+                predictions
+            )
+            stats = []
+            for reference_cells, candidate_cells in zip(reference, candidate):
+                stats.append(
+                    compare_detections(
+                        [c for c in reference_cells.values() if c["type"] != 0],
+                        [c for c in candidate_cells.values() if c["type"] != 0],
+                    )
+                )
+            return {key: sum(s[key] for s in stats) for key in stats[0]}
+
         def convert_patch_to_graph_nodes(
             self,
             patch_cell_dict: dict,
             patch_metadata: dict,
             patch_tokens: torch.Tensor,
+            wsi: Union[WSI, WSIMetadata] = None,
         ) -> Tuple[List[dict], List[dict], List[torch.Tensor], List[torch.Tensor]]:
             """Extract information from a single patch and convert it to graph nodes for a global view
 
@@ -697,7 +837,7 @@ def create_batch_pooling_actor(num_cpus: int = 8):
                     Each dictionary needs to contain the following keys:
                     * bbox: Bounding box of the cell
                     * centroid: Centroid of the cell
-                    * contour: Contour of the cell
+                    * contour: Contour of the cell (missing for detection_only)
                     * type_prob: Probability of the cell type
                     * type: Type of the cell
                 patch_metadata (dict): Metadata dictionary for the patch.
@@ -706,6 +846,7 @@ def create_batch_pooling_actor(num_cpus: int = 8):
                     * col: Column index of the patch
                     Other keys are optional but are stored in the graph nodes for later use
                 patch_tokens (torch.Tensor): Tokens of the patch. Shape: (D, H, W)
+                wsi (Union[WSI, WSIMetadata], optional): WSI of the patch. Defaults to None (WSI of the postprocessor).
 
             Returns:
                 Tuple[List[dict], List[dict], List[torch.Tensor], List[torch.Tensor]]:
@@ -714,7 +855,7 @@ def create_batch_pooling_actor(num_cpus: int = 8):
                     * List[torch.Tensor]: Cell tokens of the patch
                     * List[torch.Tensor]: Cell positions (centroid) of the patch
             """
-            wsi = self.detection_cell_postprocessor.wsi
+            wsi = self.detection_cell_postprocessor.wsi if wsi is None else wsi
             patch_cell_detection = {}
             patch_cell_detection["patch_metadata"] = patch_metadata
             patch_cell_detection["type_map"] = self.run_conf["dataset_config"][
@@ -738,7 +879,7 @@ def create_batch_pooling_actor(num_cpus: int = 8):
             cell_detections = []
 
             # extract cell information
-            for cell in patch_cell_dict.values():
+            for inst_id, cell in patch_cell_dict.items():
                 if (
                     cell["type"]
                     == self.run_conf["dataset_config"]["nuclei_types"]["Background"]
@@ -748,27 +889,34 @@ def create_batch_pooling_actor(num_cpus: int = 8):
                 centroid_global = np.rint(
                     (cell["centroid"] + np.flip(offset_global)) * wsi_scaling_factor
                 )  # TODO: check for 0.499 mpp slides
-                contour_global = (
-                    cell["contour"] + np.flip(offset_global)
-                ) * wsi_scaling_factor
                 bbox_global = (cell["bbox"] + offset_global) * wsi_scaling_factor
                 cell_dict = {
                     "bbox": bbox_global.tolist(),
                     "centroid": centroid_global.tolist(),
-                    "contour": contour_global.tolist(),
-                    "type_prob": cell["type_prob"],
-                    "type": cell["type"],
-                    "patch_coordinates": [
-                        patch_metadata["row"],
-                        patch_metadata["col"],
-                    ],
-                    "cell_status": get_cell_position_marging(
-                        bbox=cell["bbox"],
-                        patch_size=wsi.metadata["patch_size"],
-                        margin=64,
-                    ),
-                    "offset_global": offset_global.tolist(),
                 }
+                if "contour" in cell:  # no contours for detection_only
+                    contour_global = (
+                        cell["contour"] + np.flip(offset_global)
+                    ) * wsi_scaling_factor
+                    cell_dict["contour"] = contour_global.tolist()
+                cell_dict.update(
+                    {
+                        "type_prob": cell["type_prob"],
+                        "type": cell["type"],
+                        "patch_coordinates": [
+                            patch_metadata["row"],
+                            patch_metadata["col"],
+                        ],
+                        "cell_status": get_cell_position_marging(
+                            bbox=cell["bbox"],
+                            patch_size=wsi.metadata["patch_size"],
+                            margin=64,
+                        ),
+                        "offset_global": offset_global.tolist(),
+                    }
+                )
+                if self.instance_map:
+                    cell_dict["inst_id"] = int(inst_id)
                 cell_detection = {
                     "bbox": bbox_global.tolist(),
                     "centroid": centroid_global.tolist(),
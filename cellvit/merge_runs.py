@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Merge the run ledgers of the shards of a job array
+#
+# Each shard of a sharded process_dataset run (e.g., SLURM array task) writes its own run
+# ledger into the output directory. This command combines them into one ledger and stores the
+# summary statistics of each shard and of the whole run.
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import argparse
+from pathlib import Path
+from typing import Union
+
+import ujson
+
+from cellvit.utils.logger import Logger
+from cellvit.utils.run_ledger import RunLedger, ledger_summary, open_read_only
+
+
+def merge_runs(outdir: Union[Path, str], output: Union[Path, str] = None) -> dict:
+    """Merge the shard ledgers of an output directory and compute the summary statistics
+
+    The merged ledger is created anew, such that the command can be repeated while shards are still running.
+    The shard ledgers are just read (read-only connections), without taking write locks.
+
+    Args:
+        outdir (Union[Path, str]): Output directory of the sharded run
+        output (Union[Path, str], optional): Path of the merged ledger. Defaults to None (outdir/run_ledger_merged.sqlite).
+
+    Returns:
+        dict: Summary statistics with keys
+            * shards: Summary of each shard ledger (see RunLedger.summary)
+            * total: Summary of all shards
+            * failures: Slides whose last attempt failed, with the error
+    """
+    outdir = Path(outdir)
+    output = outdir / "run_ledger_merged.sqlite" if output is None else Path(output)
+    shard_ledgers = sorted(outdir.glob("run_ledger_shard_*.sqlite"))
+    assert len(shard_ledgers) > 0, f"No shard ledgers found in {outdir}"
+
+    output.unlink(missing_ok=True)
+    merged = RunLedger(output)
+    shards = {}
+    for path in shard_ledgers:
+        # read-only, shards that are still running are not blocked
+        connection = open_read_only(path)
+        try:
+            shards[path.stem] = ledger_summary(connection)
+        finally:
+            connection.close()
+        merged.merge(path)
+    summary = {
+        "shards": shards,
+        "total": merged.summary(),
+        "failures": [list(failure) for failure in merged.failures()],
+    }
+    merged.close()
+    return summary
+
+
+def main() -> None:
+    """Merge the shard ledgers of an output directory and store the summary as run_summary.json"""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Merge the run ledgers of a sharded CellViT++ run (job array)",
+    )
+    parser.add_argument("outdir", type=str, help="Output directory of the sharded run")
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Path of the merged ledger (default: outdir/run_ledger_merged.sqlite)",
+    )
+    opt = parser.parse_args()
+
+    logger = Logger(
+        level="INFO",
+        formatter="%(asctime)s - Merge-Runs - %(levelname)s - %(message)s",
+    )
+    logger = logger.create_logger()
+
+    summary = merge_runs(opt.outdir, opt.output)
+    with open(Path(opt.outdir) / "run_summary.json", "w") as outfile:
+        ujson.dump(summary, outfile, indent=2)
+
+    for shard, report in summary["shards"].items():
+        logger.info(
+            f"{shard}: {report['num_finished']} WSI finished, {report['num_failed']} failed, "
+            f"{report['num_cells']} cells, {report['processing_time']:.0f} s"
+        )
+    report = summary["total"]
+    logger.info(
+        f"Total: {report['num_finished']} WSI finished ({report['num_failed']} failed) with "
+        f"{report['slides_per_hour']:.2f} WSI/h and {report['cells_per_second']:.1f} cells/s"
+    )
+    for slide, error in summary["failures"]:
+        logger.warning(f"Failed: {slide} ({error})")
+    logger.info(f"Stored summary in {Path(opt.outdir) / 'run_summary.json'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+# Output Module
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Background writer for output artifacts
+#
+# Writing the outputs of a slide (cells, detections, geojsons, graph) is handed over to
+# a thread pool, such that the inference of the next slide can start immediately. The
+# number of slides waiting to be written is bounded to limit the memory consumption.
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Tuple
+
+from cellvit.utils.logger import NullLogger
+
+
+class BackgroundWriter:
+    def __init__(
+        self,
+        max_workers: int = 4,
+        max_pending_slides: int = 1,
+        logger: logging.Logger = None,
+    ) -> None:
+        """Write the output artifacts of slides concurrently in background threads
+
+        All artifacts of one slide are written concurrently. Once all of them are written
+        successfully, the completion callback of the slide is called (e.g., to mark the
+        slide as processed). Submitting a slide blocks as long as max_pending_slides
+        slides are still being written (bounded queue).
+
+        Write errors do not interrupt the main thread, they are logged and raised
+        as RuntimeError by the next call of flush (or close).
+
+        Args:
+            max_workers (int, optional): Number of writer threads. If 0, all artifacts are
+                written synchronously when submitting the slide. Defaults to 4.
+            max_pending_slides (int, optional): Maximum number of slides that are written in the background
+                at the same time. Defaults to 1.
+            logger (logging.Logger, optional): Logger. Defaults to None.
+        """
+        assert max_workers >= 0, "Number of writer threads must be at least 0"
+        assert max_pending_slides > 0, "Number of pending slides must be at least 1"
+        self.max_workers = max_workers
+        self.logger = logger if logger is not None else NullLogger()
+
+        self.executor: ThreadPoolExecutor = None
+        if max_workers > 0:
+            self.executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="cellvit-writer"
+            )
+        self.slots = threading.BoundedSemaphore(max_pending_slides)
+        self.pending: List[Future] = []
+        self.errors: List[Tuple[str, str, BaseException]] = []
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> "BackgroundWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def submit_slide(
+        self,
+        slide_name: str,
+        artifacts: Dict[str, Callable[[], None]],
+        on_complete: Callable[[], None] = None,
+        on_error: Callable[[str], None] = None,
+    ) -> None:
+        """Write all artifacts of a slide in the background
+
+        Args:
+            slide_name (str): Name of the slide (used for logging and errors)
+            artifacts (Dict[str, Callable[[], None]]): Artifact name and function writing the artifact
+            on_complete (Callable[[], None], optional): Called after all artifacts have been written successfully.
+                Defaults to None.
+            on_error (Callable[[str], None], optional): Called with the error message if writing any artifact
+                (or the completion callback) failed. Just used for background writing, synchronous errors are raised.
+                Defaults to None.
+        """
+        if self.executor is None:
+            for artifact_name, write_artifact in artifacts.items():
+                write_artifact()
+            if on_complete is not None:
+                on_complete()
+            return
+
+        self.slots.acquire()
+        slide_future = Future()
+        with self.lock:
+            self.pending.append(slide_future)
+        remaining = [len(artifacts)]
+        slide_errors = []
+        slide_lock = threading.Lock()
+
+        def artifact_done(artifact_name: str, future: Future) -> None:
+            with slide_lock:
+                if future.exception() is not None:
+                    slide_errors.append((artifact_name, future.exception()))
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self._finish_slide(
+                    slide_name, slide_errors, on_complete, on_error, slide_future
+                )
+
+        if len(artifacts) == 0:
+            self._finish_slide(
+                slide_name, slide_errors, on_complete, on_error, slide_future
+            )
+        for artifact_name, write_artifact in artifacts.items():
+            future = self.executor.submit(write_artifact)
+            future.add_done_callback(
+                lambda f, artifact_name=artifact_name: artifact_done(artifact_name, f)
+            )
+
+    def flush(self) -> None:
+        """Wait until all submitted slides are written
+
+        Raises:
+            RuntimeError: If writing any artifact (or a completion callback) failed
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        wait(pending)
+        with self.lock:
+            errors, self.errors = self.errors, []
+        if len(errors) > 0:
+            failed = ", ".join(f"{slide}/{artifact}" for slide, artifact, _ in errors)
+            raise RuntimeError(
+                f"Writing outputs failed for {len(errors)} artifact(s): {failed}"
+            ) from errors[0][2]
+
+    def close(self) -> None:
+        """Flush all pending slides and shutdown the writer threads
+
+        Raises:
+            RuntimeError: If writing any artifact (or a completion callback) failed
+        """
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+    def _finish_slide(
+        self,
+        slide_name: str,
+        slide_errors: List[Tuple[str, BaseException]],
+        on_complete: Callable[[], None],
+        on_error: Callable[[str], None],
+        slide_future: Future,
+    ) -> None:
+        """Run the completion callback, record errors and release the slot of the slide
+
+        Args:
+            slide_name (str): Name of the slide
+            slide_errors (List[Tuple[str, BaseException]]): Failed artifacts of this slide
+            on_complete (Callable[[], None]): Completion callback (skipped if an artifact failed)
+            on_error (Callable[[str], None]): Error callback or None
+            slide_future (Future): Future marking the slide as finished
+        """
+        try:
+            if len(slide_errors) == 0 and on_complete is not None:
+                try:
+                    on_complete()
+                except Exception as e:
+                    slide_errors.append(("on_complete", e))
+            for artifact_name, error in slide_errors:
+                self.logger.error(
+                    f"Writing {artifact_name} of {slide_name} failed: {error}"
+                )
+                with self.lock:
+                    self.errors.append((slide_name, artifact_name, error))
+            if len(slide_errors) > 0 and on_error is not None:
+                try:
+                    on_error(
+                        "; ".join(
+                            f"{artifact_name}: {error!r}"
+                            for artifact_name, error in slide_errors
+                        )
+                    )
+                except Exception as e:
+                    self.logger.error(f"Error callback of {slide_name} failed: {e}")
+        finally:
+            self.slots.release()
+            slide_future.set_result(None)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Streaming JSON writer for cell dictionaries (cells.json, cell_detection.json)
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+from typing import Callable, Iterator, List, Tuple
+
+import ujson
+
+from cellvit.output.contour_codec import (
+    contour_encoding_metadata,
+    encode_contours_base64,
+)
+
+CELLS_PLACEHOLDER = '"cells":[]'
+
+
+def iter_cell_json(
+    cell_dict: dict,
+    chunk_size: int = 10000,
+    cell_spans: List[Tuple[int, int]] = None,
+    contour_precision: float = None,
+) -> Iterator[str]:
+    """Serialize a cell dictionary to a json string, yielded in chunks
+
+    The produced document is identical to ujson.dumps(cell_dict). If contour_precision is given,
+    contours are stored as base64 strings (see contour_codec) and the encoding is added
+    to the document (key contour_encoding).
+
+    Args:
+        cell_dict (dict): Dictionary with keys wsi_metadata, type_map and cells (list with cell-dictionaries)
+        chunk_size (int, optional): Number of cells serialized at once. Defaults to 10000.
+        cell_spans (List[Tuple[int, int]], optional): If provided, the byte offset and length of each
+            serialized cell in the document are appended to this list. Defaults to None.
+        contour_precision (float, optional): If provided, contours are encoded with this
+            quantization step in pixels. Defaults to None.
+
+    Yields:
+        Iterator[str]: Parts of the json document
+    """
+    cells = cell_dict["cells"]
+    encode = contour_precision is not None and len(cells) > 0 and "contour" in cells[0]
+    if encode:
+        cell_dict = {
+            **cell_dict,
+            "contour_encoding": contour_encoding_metadata(contour_precision),
+        }
+    head, tail = ujson.dumps({**cell_dict, "cells": []}).split(CELLS_PLACEHOLDER)
+    head = head + CELLS_PLACEHOLDER[:-1]
+    # ujson escapes non-ascii characters, therefore string length equals byte length
+    position = len(head)
+    yield head
+    for start in range(0, len(cells), chunk_size):
+        separator = "," if start > 0 else ""
+        chunk = cells[start : start + chunk_size]
+        if encode:
+            encoded = encode_contours_base64(
+                [c["contour"] for c in chunk], precision=contour_precision
+            )
+            chunk = [{**c, "contour": e} for c, e in zip(chunk, encoded)]
+        if cell_spans is None:
+            yield separator + ujson.dumps(chunk)[1:-1]
+            continue
+        serialized = [ujson.dumps(c) for c in chunk]
+        position += len(separator)
+        for cell_string in serialized:
+            cell_spans.append((position, len(cell_string)))
+            position += len(cell_string) + 1
+        position -= 1
+        yield separator + ",".join(serialized)
+    yield "]" + tail
+
+
+def write_cell_json(
+    write: Callable[[str], object],
+    cell_dict: dict,
+    chunk_size: int = 10000,
+    cell_spans: List[Tuple[int, int]] = None,
+    contour_precision: float = None,
+) -> None:
+    """Stream a cell dictionary as json to a write function (e.g., outfile.write of a text file)
+
+    Args:
+        write (Callable[[str], object]): Function receiving the serialized chunks
+        cell_dict (dict): Dictionary with keys wsi_metadata, type_map and cells
+        chunk_size (int, optional): Number of cells serialized at once. Defaults to 10000.
+        cell_spans (List[Tuple[int, int]], optional): If provided, the byte offset and length of each
+            serialized cell are appended to this list. Defaults to None.
+        contour_precision (float, optional): If provided, contours are encoded with this
+            quantization step in pixels. Defaults to None.
+    """
+    for chunk in iter_cell_json(
+        cell_dict,
+        chunk_size=chunk_size,
+        cell_spans=cell_spans,
+        contour_precision=contour_precision,
+    ):
+        write(chunk)
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+# Columnar (Arrow IPC / Parquet) storage of detected cells
+#
+# Requires pyarrow (pip install cellvit[columnar]). Arrow IPC files are written uncompressed
+# and can be memory-mapped without copying or parsing.
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+from pathlib import Path
+from typing import List, Literal, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import ujson
+
+from cellvit.output.contour_codec import (
+    contour_encoding_metadata,
+    decode_contours,
+    encode_contours,
+)
+
+FILE_EXTENSIONS = {"arrow": "arrow", "parquet": "parquet"}
+
+
+def cells_to_table(
+    cell_list: List[dict],
+    wsi_metadata: dict = None,
+    type_map: dict = None,
+    detection: bool = False,
+    contour_precision: float = None,
+) -> pa.Table:
+    """Convert a list of cell dictionaries into an Arrow table
+
+    Columns:
+        * bbox: fixed_size_list<float64>[4] with (row_min, col_min, row_max, col_max)
+        * centroid: fixed_size_list<float64>[2] with (x, y)
+        * type: int32
+        * type_prob: float32 (not for detections)
+        * contour: list<int32> with flattened (x, y) points (not for detections),
+          large_binary with the encoded contour if contour_precision is given (see contour_codec)
+        * patch_coordinates: fixed_size_list<int32>[2] with (row, col) (not for detections)
+        * cell_status: int8 (not for detections)
+
+    WSI metadata, type map and the contour encoding are stored as JSON in the schema metadata.
+
+    Args:
+        cell_list (List[dict]): List with cell-dictionaries
+        wsi_metadata (dict, optional): WSI metadata. Defaults to None.
+        type_map (dict, optional): Mapping of cell types to names. Defaults to None.
+        detection (bool, optional): If just the detection columns (bbox, centroid, type) should be stored. Defaults to False.
+        contour_precision (float, optional): If provided, contours are stored compactly encoded
+            with this quantization step in pixels. Defaults to None.
+
+    Returns:
+        pa.Table: Table with one row per cell
+    """
+    num_cells = len(cell_list)
+    bbox = np.asarray([c["bbox"] for c in cell_list], dtype=np.float64).reshape(-1)
+    centroid = np.asarray([c["centroid"] for c in cell_list], dtype=np.float64)
+    columns = {
+        "bbox": pa.FixedSizeListArray.from_arrays(pa.array(bbox), 4),
+        "centroid": pa.FixedSizeListArray.from_arrays(
+            pa.array(centroid.reshape(-1)), 2
+        ),
+        "type": pa.array(
+            np.asarray([c["type"] for c in cell_list], dtype=np.int32).reshape(-1)
+        ),
+    }
+    if not detection:
+        columns["type_prob"] = pa.array(
+            np.asarray([c["type_prob"] for c in cell_list], dtype=np.float32).reshape(
+                -1
+            )
+        )
+    if not detection and contour_precision is not None:
+        data, offsets = encode_contours(
+            [c["contour"] for c in cell_list], precision=contour_precision
+        )
+        columns["contour"] = pa.LargeBinaryArray.from_buffers(
+            pa.large_binary(),
+            num_cells,
+            [None, pa.py_buffer(offsets), pa.py_buffer(data)],
+        )
+    elif not detection:
+        lengths = np.fromiter(
+            (2 * len(c["contour"]) for c in cell_list), dtype=np.int32, count=num_cells
+        )
+        offsets = np.zeros(num_cells + 1, dtype=np.int32)
+        np.cumsum(lengths, out=offsets[1:])
+        values = (
+            np.concatenate(
+                [np.rint(c["contour"]).astype(np.int32).reshape(-1) for c in cell_list]
+            )
+            if offsets[-1] > 0
+            else np.zeros(0, dtype=np.int32)
+        )
+        columns["contour"] = pa.ListArray.from_arrays(
+            pa.array(offsets), pa.array(values)
+        )
+    if not detection:
+        patch_coordinates = np.asarray(
+            [c["patch_coordinates"] for c in cell_list], dtype=np.int32
+        ).reshape(-1)
+        columns["patch_coordinates"] = pa.FixedSizeListArray.from_arrays(
+            pa.array(patch_coordinates), 2
+        )
+        columns["cell_status"] = pa.array(
+            np.asarray([c["cell_status"] for c in cell_list], dtype=np.int8).reshape(-1)
+        )
+
+    metadata = {
+        "wsi_metadata": ujson.dumps(wsi_metadata if wsi_metadata is not None else {}),
+        "type_map": ujson.dumps(type_map if type_map is not None else {}),
+    }
+    if not detection and contour_precision is not None:
+        metadata["contour_encoding"] = ujson.dumps(
+            contour_encoding_metadata(contour_precision)
+        )
+    return pa.table(columns, metadata=metadata)
+
+
+def write_cells(
+    path: Union[Path, str],
+    cell_list: List[dict],
+    wsi_metadata: dict = None,
+    type_map: dict = None,
+    detection: bool = False,
+    file_format: Literal["arrow", "parquet"] = "arrow",
+    compression: Literal["snappy", "zstd"] = None,
+    contour_precision: float = None,
+) -> Path:
+    """Store a list of cell dictionaries as Arrow IPC or Parquet file
+
+    Args:
+        path (Union[Path, str]): Output path without suffix (e.g., outdir/cells)
+        cell_list (List[dict]): List with cell-dictionaries
+        wsi_metadata (dict, optional): WSI metadata. Defaults to None.
+        type_map (dict, optional): Mapping of cell types to names. Defaults to None.
+        detection (bool, optional): If just the detection columns should be stored. Defaults to False.
+        file_format (Literal["arrow", "parquet"], optional): File format. Defaults to "arrow".
+        compression (Literal["snappy", "zstd"], optional): Compression codec, just used for Parquet
+            (Arrow IPC files stay uncompressed to be memory-mappable). Defaults to None.
+        contour_precision (float, optional): If provided, contours are stored compactly encoded
+            with this quantization step in pixels. Defaults to None.
+
+    Raises:
+        NotImplementedError: Unknown file format
+
+    Returns:
+        Path: Path to the written file
+    """
+    if file_format not in FILE_EXTENSIONS:
+        raise NotImplementedError(
+            f"Unknown file format {file_format}. Please select one of {list(FILE_EXTENSIONS)}"
+        )
+    table = cells_to_table(
+        cell_list,
+        wsi_metadata=wsi_metadata,
+        type_map=type_map,
+        detection=detection,
+        contour_precision=contour_precision,
+    )
+    path = Path(path).with_suffix(f".{FILE_EXTENSIONS[file_format]}")
+    if file_format == "arrow":
+        with pa.OSFile(str(path), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    else:
+        pq.write_table(table, str(path), compression=compression or "none")
+    return path
+
+
+def load_cells(path: Union[Path, str]) -> pa.Table:
+    """Load cells stored with write_cells, Arrow IPC files are memory-mapped (zero-copy)
+
+    Args:
+        path (Union[Path, str]): Path to the .arrow or .parquet file
+
+    Returns:
+        pa.Table: Table with one row per cell
+    """
+    path = Path(path)
+    if path.suffix == ".parquet":
+        return pq.read_table(str(path), memory_map=True)
+    with pa.memory_map(str(path), "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def load_cell_metadata(table: pa.Table) -> Tuple[dict, dict]:
+    """Return the WSI metadata and the type map stored in a cell table
+
+    Args:
+        table (pa.Table): Table loaded with load_cells
+
+    Returns:
+        Tuple[dict, dict]:
+            * dict: WSI metadata
+            * dict: Type map (keys are integers)
+    """
+    metadata = table.schema.metadata or {}
+    wsi_metadata = ujson.loads(metadata.get(b"wsi_metadata", b"{}"))
+    type_map = ujson.loads(metadata.get(b"type_map", b"{}"))
+    return wsi_metadata, {int(k): v for k, v in type_map.items()}
+
+
+def table_to_cells(table: pa.Table) -> List[dict]:
+    """Convert a cell table back into a list of cell dictionaries
+
+    Encoded contours are decoded.
+
+    Args:
+        table (pa.Table): Table loaded with load_cells
+
+    Returns:
+        List[dict]: List with cell-dictionaries
+    """
+    num_cells = table.num_rows
+    columns = {}
+    if num_cells == 0:
+        return []
+    columns["bbox"] = (
+        _flat_values(table, "bbox", np.float64).reshape(num_cells, 2, 2).tolist()
+    )
+    columns["centroid"] = (
+        _flat_values(table, "centroid", np.float64).reshape(num_cells, 2).tolist()
+    )
+    columns["type"] = table.column("type").to_numpy().tolist()
+    if "type_prob" in table.column_names:
+        columns["type_prob"] = table.column("type_prob").to_numpy().tolist()
+    if "contour" in table.column_names and pa.types.is_large_binary(
+        table.column("contour").type
+    ):
+        columns["contour"] = _decode_contour_column(table)
+    elif "contour" in table.column_names:
+        contour = table.column("contour").combine_chunks()
+        offsets = contour.offsets.to_numpy()
+        points = contour.values.to_numpy().reshape(-1, 2).tolist()
+        columns["contour"] = [
+            points[start // 2 : end // 2]
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+    if "patch_coordinates" in table.column_names:
+        columns["patch_coordinates"] = (
+            _flat_values(table, "patch_coordinates", np.int32)
+            .reshape(num_cells, 2)
+            .tolist()
+        )
+    if "cell_status" in table.column_names:
+        columns["cell_status"] = table.column("cell_status").to_numpy().tolist()
+
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+def _flat_values(table: pa.Table, column: str, dtype: np.dtype) -> np.ndarray:
+    """Flat values of a fixed size list column
+
+    Args:
+        table (pa.Table): Table
+        column (str): Column name
+        dtype (np.dtype): Dtype of the values
+
+    Returns:
+        np.ndarray: Flattened values
+    """
+    return table.column(column).combine_chunks().flatten().to_numpy().astype(dtype)
+
+
+def _decode_contour_column(table: pa.Table) -> List[list]:
+    """Decode an encoded contour column
+
+    Args:
+        table (pa.Table): Table with large_binary contour column and contour_encoding metadata
+
+    Returns:
+        List[list]: Contours as lists of (x, y) points
+    """
+    encoding = ujson.loads(table.schema.metadata[b"contour_encoding"])
+    precision = encoding["precision"]
+    contour = table.column("contour").combine_chunks()
+    _, offsets, data = contour.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int64)[
+        contour.offset : contour.offset + len(contour) + 1
+    ]
+    contours = decode_contours(
+        np.frombuffer(data, dtype=np.uint8), offsets, precision=precision
+    )
+    if float(precision).is_integer():
+        return [c.astype(np.int64).tolist() for c in contours]
+    return [c.tolist() for c in contours]
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Streaming (framed) compression of output files
+#
+# Serialized output is fed chunk by chunk to the compressor, such that neither the
+# uncompressed nor the compressed document has to be held in memory at once.
+# Supported codecs:
+#   * snappy: snappy framing format (https://github.com/google/snappy/blob/main/framing_format.txt)
+#   * zstd: zstandard frames with configurable level and worker threads (requires zstandard, pip install cellvit[zstd])
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import io
+from pathlib import Path
+from typing import IO, Literal, Union
+
+import snappy
+import ujson
+
+COMPRESSION_SUFFIXES = {"snappy": ".snappy", "zstd": ".zst"}
+
+# stream identifier chunk at the beginning of each snappy framed stream
+SNAPPY_STREAM_IDENTIFIER = b"\xff\x06\x00\x00sNaPpY"
+
+
+class SnappyFramedWriter(io.RawIOBase):
+    def __init__(self, fileobj: IO[bytes]) -> None:
+        """Binary file-like object compressing all written data in the snappy framing format
+
+        Args:
+            fileobj (IO[bytes]): Binary file object the compressed frames are written to
+        """
+        self.fileobj = fileobj
+        self.compressor = snappy.StreamCompressor()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        if len(data) > 0:
+            self.fileobj.write(self.compressor.add_chunk(bytes(data)))
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.fileobj.close()
+        super().close()
+
+
+class SnappyFramedReader(io.RawIOBase):
+    def __init__(self, fileobj: IO[bytes], read_size: int = 1 << 16) -> None:
+        """Binary file-like object decompressing a snappy framed stream on the fly
+
+        Files written as one raw snappy block (format of older versions) are
+        decompressed at once as fallback.
+
+        Args:
+            fileobj (IO[bytes]): Binary file object with compressed data
+            read_size (int, optional): Number of compressed bytes read at once. Defaults to 1 << 16.
+        """
+        self.fileobj = fileobj
+        self.read_size = read_size
+        self.buffer = b""
+        self.decompressor = snappy.StreamDecompressor()
+
+        header = self.fileobj.read(len(SNAPPY_STREAM_IDENTIFIER))
+        if header == SNAPPY_STREAM_IDENTIFIER:
+            self.framed = True
+            self.decompressor.decompress(header)
+        else:
+            self.framed = False
+            self.buffer = snappy.decompress(header + self.fileobj.read())
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: bytearray) -> int:
+        while len(self.buffer) == 0 and self.framed:
+            compressed = self.fileobj.read(self.read_size)
+            if len(compressed) == 0:
+                self.decompressor.flush()
+                break
+            self.buffer = self.decompressor.decompress(compressed)
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self) -> None:
+        if not self.closed:
+            self.fileobj.close()
+        super().close()
+
+
+def open_compressed(
+    path: Union[Path, str],
+    mode: Literal["r", "w", "rb", "wb", "rt", "wt"] = "r",
+    codec: Literal["snappy", "zstd"] = None,
+    level: int = 3,
+    threads: int = 0,
+) -> IO:
+    """Open a compressed file for streaming reading or writing
+
+    Args:
+        path (Union[Path, str]): Path to the file (including the codec suffix)
+        mode (Literal["r", "w", "rb", "wb", "rt", "wt"], optional): Mode, text mode if "b" is not given. Defaults to "r".
+        codec (Literal["snappy", "zstd"], optional): Codec. If None, the codec is derived from the file suffix. Defaults to None.
+        level (int, optional): Compression level (zstd). Defaults to 3.
+        threads (int, optional): Number of compression worker threads (zstd), 0 disables multithreading. Defaults to 0.
+
+    Raises:
+        NotImplementedError: Unknown codec
+
+    Returns:
+        IO: File object, closing it finishes the compressed stream
+    """
+    path = Path(path)
+    if codec is None:
+        codec = {v: k for k, v in COMPRESSION_SUFFIXES.items()}.get(path.suffix)
+    if codec not in COMPRESSION_SUFFIXES:
+        raise NotImplementedError(
+            f"Unknown compression codec {codec}. Please select one of {list(COMPRESSION_SUFFIXES)}"
+        )
+    writing = "w" in mode
+    fileobj = open(path, "wb" if writing else "rb")
+
+    if codec == "snappy":
+        if writing:
+            stream = io.BufferedWriter(SnappyFramedWriter(fileobj), 1 << 16)
+        else:
+            stream = io.BufferedReader(SnappyFramedReader(fileobj), 1 << 16)
+    else:
+        import zstandard
+
+        if writing:
+            stream = zstandard.ZstdCompressor(
+                level=level, threads=threads
+            ).stream_writer(fileobj, closefd=True)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=True)
+
+    if "b" not in mode:
+        stream = io.TextIOWrapper(stream, encoding="utf-8")
+    return stream
+
+
+def load_json(path: Union[Path, str]) -> Union[dict, list]:
+    """Load an (optionally compressed) json or geojson output file
+
+    Args:
+        path (Union[Path, str]): Path to the file, compression is derived from the suffix
+
+    Returns:
+        Union[dict, list]: Loaded json object
+    """
+    path = Path(path)
+    if path.suffix in COMPRESSION_SUFFIXES.values():
+        with open_compressed(path, "rt") as infile:
+            return ujson.load(infile)
+    with open(path, "r") as infile:
+        return ujson.load(infile)
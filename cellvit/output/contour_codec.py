@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# Compact encoding of cell contours
+#
+# Contours are the largest part of the cell outputs. They are encoded as follows:
+#   1. Optional Douglas-Peucker simplification with a pixel tolerance (simplify_contours)
+#   2. Quantization to integers with a given precision (step size in pixels)
+#   3. Delta coding: first point absolute, afterwards differences to the previous point
+#   4. Zigzag and varint (LEB128) coding of the (x, y) values
+# Encoding and decoding are vectorized over the ragged buffer of all contours, each contour
+# is a byte string (base64 in json). The geometric error is bounded by precision / 2 per
+# coordinate (quantization) plus the simplification tolerance.
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import base64
+from typing import List, Tuple, Union
+
+import cv2
+import numpy as np
+
+CONTOUR_CODEC = "delta-zigzag-varint"
+
+
+def contour_encoding_metadata(precision: float) -> dict:
+    """Metadata stored next to encoded contours, required for decoding
+
+    Args:
+        precision (float): Quantization step in pixels
+
+    Returns:
+        dict: Codec name and precision
+    """
+    return {"codec": CONTOUR_CODEC, "precision": precision}
+
+
+def encode_contours(
+    contours: List[Union[list, np.ndarray]], precision: float = 1.0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Encode contours into one byte buffer
+
+    Args:
+        contours (List[Union[list, np.ndarray]]): Contours with (x, y) points, shape (num_points, 2) each
+        precision (float, optional): Quantization step in pixels. Defaults to 1.0.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]:
+            * np.ndarray: Encoded bytes of all contours (uint8)
+            * np.ndarray: Byte offsets of the contours (num_contours + 1), contour i is data[offsets[i]:offsets[i+1]]
+    """
+    assert precision > 0, "Precision must be greater than 0"
+    num_contours = len(contours)
+    lengths = np.fromiter(
+        (len(c) for c in contours), dtype=np.int64, count=num_contours
+    )
+    point_offsets = np.zeros(num_contours + 1, dtype=np.int64)
+    np.cumsum(lengths, out=point_offsets[1:])
+    if point_offsets[-1] == 0:
+        return np.zeros(0, dtype=np.uint8), np.zeros(num_contours + 1, dtype=np.int64)
+
+    points = np.concatenate(
+        [np.asarray(c, dtype=np.float64).reshape(-1, 2) for c in contours]
+    )
+    quantized = np.rint(points / precision).astype(np.int64)
+    deltas = np.empty_like(quantized)
+    deltas[0] = quantized[0]
+    deltas[1:] = quantized[1:] - quantized[:-1]
+    first_points = point_offsets[:-1][lengths > 0]
+    deltas[first_points] = quantized[first_points]
+
+    values = deltas.reshape(-1)
+    zigzag = ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+    # varint: 7 bits per byte, highest bit marks a following byte
+    num_bytes = np.ones(len(zigzag), dtype=np.int64)
+    remaining = zigzag >> np.uint64(7)
+    while np.any(remaining):
+        num_bytes += remaining > 0
+        remaining >>= np.uint64(7)
+    value_offsets = np.zeros(len(zigzag) + 1, dtype=np.int64)
+    np.cumsum(num_bytes, out=value_offsets[1:])
+    value_idx = np.repeat(np.arange(len(zigzag)), num_bytes)
+    byte_position = np.arange(value_offsets[-1]) - value_offsets[value_idx]
+    payload = (
+        zigzag[value_idx] >> (np.uint64(7) * byte_position.astype(np.uint64))
+    ) & (np.uint64(0x7F))
+    continuation = byte_position < num_bytes[value_idx] - 1
+    data = (payload | (continuation.astype(np.uint64) << np.uint64(7))).astype(np.uint8)
+    return data, value_offsets[2 * point_offsets]
+
+
+def decode_contours(
+    data: np.ndarray, offsets: np.ndarray, precision: float = 1.0
+) -> List[np.ndarray]:
+    """Decode contours encoded with encode_contours
+
+    Args:
+        data (np.ndarray): Encoded bytes of all contours (uint8)
+        offsets (np.ndarray): Byte offsets of the contours (num_contours + 1)
+        precision (float, optional): Quantization step in pixels. Defaults to 1.0.
+
+    Returns:
+        List[np.ndarray]: Contours with (x, y) points, shape (num_points, 2) each
+    """
+    data = np.frombuffer(data, dtype=np.uint8) if isinstance(data, bytes) else data
+    offsets = np.asarray(offsets, dtype=np.int64)
+    data, offsets = data[offsets[0] : offsets[-1]], offsets - offsets[0]
+    num_contours = len(offsets) - 1
+    if len(data) == 0:
+        return [np.zeros((0, 2), dtype=np.float64) for _ in range(num_contours)]
+
+    value_end = (data & 0x80) == 0
+    value_start = np.flatnonzero(np.concatenate([[True], value_end[:-1]]))
+    value_idx = np.cumsum(np.concatenate([[0], value_end[:-1]]))
+    byte_position = np.arange(len(data)) - value_start[value_idx]
+    payload = (data & 0x7F).astype(np.uint64) << (
+        np.uint64(7) * byte_position.astype(np.uint64)
+    )
+    zigzag = np.add.reduceat(payload, value_start)  # bits are disjoint, sum == or
+    values = (zigzag >> np.uint64(1)).astype(np.int64) ^ -(
+        zigzag & np.uint64(1)
+    ).astype(np.int64)
+    points = values.reshape(-1, 2)
+
+    # number of points per contour from the number of varints in the byte range
+    values_before = np.concatenate([[0], np.cumsum(value_end)])
+    num_points = (values_before[offsets[1:]] - values_before[offsets[:-1]]) // 2
+    point_offsets = np.zeros(num_contours + 1, dtype=np.int64)
+    np.cumsum(num_points, out=point_offsets[1:])
+
+    # undo delta coding per contour: global cumulative sum minus the sum before the contour
+    cumulative = np.cumsum(points, axis=0)
+    before = np.zeros((num_contours, 2), dtype=np.int64)
+    nonempty = point_offsets[:-1] > 0
+    before[nonempty] = cumulative[point_offsets[:-1][nonempty] - 1]
+    coordinates = (cumulative - np.repeat(before, num_points, axis=0)) * precision
+    return np.split(coordinates, point_offsets[1:-1])
+
+
+def encode_contours_base64(
+    contours: List[Union[list, np.ndarray]], precision: float = 1.0
+) -> List[str]:
+    """Encode contours as base64 strings (e.g., for json)
+
+    Args:
+        contours (List[Union[list, np.ndarray]]): Contours with (x, y) points
+        precision (float, optional): Quantization step in pixels. Defaults to 1.0.
+
+    Returns:
+        List[str]: One base64 string per contour
+    """
+    data, offsets = encode_contours(contours, precision=precision)
+    data = data.tobytes()
+    return [
+        base64.b64encode(data[start:end]).decode("ascii")
+        for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())
+    ]
+
+
+def decode_contours_base64(
+    encoded: List[str], precision: float = 1.0
+) -> List[np.ndarray]:
+    """Decode base64 encoded contours
+
+    Args:
+        encoded (List[str]): One base64 string per contour
+        precision (float, optional): Quantization step in pixels. Defaults to 1.0.
+
+    Returns:
+        List[np.ndarray]: Contours with (x, y) points, shape (num_points, 2) each
+    """
+    chunks = [base64.b64decode(e) for e in encoded]
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    np.cumsum([len(c) for c in chunks], out=offsets[1:])
+    data = np.frombuffer(b"".join(chunks), dtype=np.uint8)
+    return decode_contours(data, offsets, precision=precision)
+
+
+def simplify_contours(
+    contours: List[Union[list, np.ndarray]], tolerance: float
+) -> List[np.ndarray]:
+    """Simplify closed contours with the Douglas-Peucker algorithm
+
+    Contours with less than 3 remaining points are kept unchanged.
+
+    Args:
+        contours (List[Union[list, np.ndarray]]): Contours with (x, y) points
+        tolerance (float): Maximum distance of the simplified contour to the original contour in pixels
+
+    Returns:
+        List[np.ndarray]: Simplified contours, shape (num_points, 2) each
+    """
+    simplified = []
+    for contour in contours:
+        contour = np.asarray(contour, dtype=np.float32).reshape(-1, 2)
+        if len(contour) <= 3:
+            simplified.append(contour)
+            continue
+        approx = cv2.approxPolyDP(contour.reshape(-1, 1, 2), tolerance, True)
+        simplified.append(approx.reshape(-1, 2) if len(approx) >= 3 else contour)
+    return simplified
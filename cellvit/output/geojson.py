@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Streaming GeoJSON writer for detected cells
+#
+# One MultiPolygon (segmentation) or MultiPoint (detection) feature per cell type is
+# serialized chunk by chunk directly to the output, the FeatureCollection list is never
+# materialized in memory.
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import uuid
+from typing import Callable, Dict, Iterator, List
+
+import numpy as np
+import ujson
+
+from cellvit.config.config import COLOR_DICT_CELLS
+from cellvit.config.templates import get_template_point, get_template_segmentation
+
+COORDINATE_PLACEHOLDER = '"coordinates":[]'
+
+
+def iter_geojson(
+    cell_list: List[dict],
+    label_map: Dict[int, str],
+    polygons: bool = False,
+    color_map: Dict[int, List[int]] = COLOR_DICT_CELLS,
+    chunk_size: int = 10000,
+) -> Iterator[str]:
+    """Serialize a list of cells to a geojson string, yielded in chunks
+
+    Cells are grouped by type with one stable argsort, such that the cell order within
+    each feature matches the order of the cell list. The produced document is identical
+    to a ujson dump of the feature list (except the random feature ids). Contours of the
+    input cells are not modified.
+
+    Args:
+        cell_list (List[dict]): Cell list with dict entry for each cell.
+            Required keys for detection:
+                * type
+                * centroid
+            Required keys for segmentation:
+                * type
+                * contour
+        label_map (Dict[int, str]): Mapping of cell types to names
+        polygons (bool, optional): If polygon segmentations (True) or detection points (False). Defaults to False.
+        color_map (Dict[int, List[int]], optional): Mapping of cell types to RGB colors. Defaults to COLOR_DICT_CELLS.
+        chunk_size (int, optional): Number of cells serialized at once. Defaults to 10000.
+
+    Yields:
+        Iterator[str]: Parts of the geojson document
+    """
+    yield "["
+    if len(cell_list) > 0:
+        types = np.fromiter((c["type"] for c in cell_list), dtype=np.int64)
+        order = np.argsort(types, kind="stable")
+        detected_types, starts = np.unique(types[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+
+        for idx, (cell_type, start, end) in enumerate(
+            zip(detected_types.tolist(), starts.tolist(), ends.tolist())
+        ):
+            if polygons:
+                feature = get_template_segmentation()
+            else:
+                feature = get_template_point()
+            feature["id"] = str(uuid.uuid4())
+            feature["geometry"]["coordinates"] = []
+            feature["properties"]["classification"]["name"] = label_map[cell_type]
+            feature["properties"]["classification"]["color"] = color_map[cell_type]
+            head, tail = ujson.dumps(feature).split(COORDINATE_PLACEHOLDER)
+
+            yield ("," if idx > 0 else "") + head + COORDINATE_PLACEHOLDER[:-1]
+            for chunk_start in range(start, end, chunk_size):
+                chunk_idx = order[chunk_start : min(chunk_start + chunk_size, end)]
+                if polygons:
+                    coordinates = [
+                        [_close_contour(cell_list[i]["contour"])] for i in chunk_idx
+                    ]
+                else:
+                    coordinates = [cell_list[i]["centroid"] for i in chunk_idx]
+                separator = "," if chunk_start > start else ""
+                yield separator + ujson.dumps(coordinates)[1:-1]
+            yield "]" + tail
+    yield "]"
+
+
+def write_geojson(
+    write: Callable[[str], object],
+    cell_list: List[dict],
+    label_map: Dict[int, str],
+    polygons: bool = False,
+    color_map: Dict[int, List[int]] = COLOR_DICT_CELLS,
+    chunk_size: int = 10000,
+) -> None:
+    """Stream a list of cells as geojson to a write function (e.g., outfile.write of a text file)
+
+    Args:
+        write (Callable[[str], object]): Function receiving the serialized chunks
+        cell_list (List[dict]): Cell list, see iter_geojson for required keys
+        label_map (Dict[int, str]): Mapping of cell types to names
+        polygons (bool, optional): If polygon segmentations (True) or detection points (False). Defaults to False.
+        color_map (Dict[int, List[int]], optional): Mapping of cell types to RGB colors. Defaults to COLOR_DICT_CELLS.
+        chunk_size (int, optional): Number of cells serialized at once. Defaults to 10000.
+    """
+    for chunk in iter_geojson(
+        cell_list,
+        label_map=label_map,
+        polygons=polygons,
+        color_map=color_map,
+        chunk_size=chunk_size,
+    ):
+        write(chunk)
+
+
+def _close_contour(contour: List[List[int]]) -> List[List[int]]:
+    """Return a closed copy of a contour (first point appended at the end)
+
+    Args:
+        contour (List[List[int]]): Contour points
+
+    Returns:
+        List[List[int]]: Closed contour
+    """
+    contour = list(contour)
+    return contour + contour[:1]
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# Memory-mapped cell graph storage
+#
+# Cell tokens are appended batch-wise to a preallocated .npy file on disk while the
+# inference is running, instead of keeping one tensor per cell in memory. The graph is
+# stored as directory with numpy arrays, which are memory-mapped when loading:
+#   * tokens.npy: Token matrix (num_cells, token_dim), float32 or float16
+#   * positions.npy: Cell positions (num_cells, 2)
+#   * nuclei_types.npy: Cell types (num_cells)
+#   * metadata.json: Graph metadata
+#   * edge_index.npy, edge_attr.npy: Spatial edges (optional)
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import os
+from pathlib import Path
+from typing import List, Literal, Union
+
+import numpy as np
+import torch
+import ujson
+
+from cellvit.data.dataclass.cell_graph import CellGraphDataWSI
+
+# fixed size of the .npy header (including magic string), allows writing it after the data
+NPY_HEADER_SIZE = 128
+
+
+class TokenStore:
+    def __init__(
+        self,
+        path: Union[Path, str],
+        dtype: Literal["float32", "float16"] = "float32",
+        initial_capacity: int = 65536,
+    ) -> None:
+        """Append-only on-disk token matrix, stored as .npy file
+
+        The file is preallocated and grows by doubling its capacity. The token dimension is
+        derived from the first batch. After close, the file is a valid .npy file that can be
+        loaded with np.load(path, mmap_mode="r").
+
+        Args:
+            path (Union[Path, str]): Path to the .npy file
+            dtype (Literal["float32", "float16"], optional): Storage dtype of the tokens. Defaults to "float32".
+            initial_capacity (int, optional): Number of preallocated rows. Defaults to 65536.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.dtype = np.dtype(dtype)
+        self.capacity = initial_capacity
+        self.num_tokens = 0
+        self.token_dim: int = None
+        self.file = open(self.path, "wb+")
+
+    def __len__(self) -> int:
+        return self.num_tokens
+
+    def append(self, tokens: Union[torch.Tensor, List[torch.Tensor]]) -> None:
+        """Append a batch of tokens
+
+        Args:
+            tokens (Union[torch.Tensor, List[torch.Tensor]]): Tokens with shape (batch, token_dim) or list of token vectors
+        """
+        if isinstance(tokens, (list, tuple)):
+            if len(tokens) == 0:
+                return
+            tokens = torch.stack(tokens)
+        tokens = tokens.detach().cpu().numpy().astype(self.dtype, copy=False)
+        tokens = tokens.reshape(len(tokens), -1)
+        if self.token_dim is None:
+            self.token_dim = tokens.shape[1]
+            self._reserve(self.capacity)
+        assert tokens.shape[1] == self.token_dim, "Token dimension changed"
+
+        if self.num_tokens + len(tokens) > self.capacity:
+            self._reserve(max(2 * self.capacity, self.num_tokens + len(tokens)))
+        self.file.seek(NPY_HEADER_SIZE + self.num_tokens * self._row_bytes())
+        self.file.write(np.ascontiguousarray(tokens).tobytes())
+        self.num_tokens += len(tokens)
+
+    def close(self) -> Path:
+        """Truncate the file to the stored tokens and write the .npy header
+
+        Returns:
+            Path: Path to the .npy file
+        """
+        if self.file.closed:
+            return self.path
+        token_dim = self.token_dim if self.token_dim is not None else 0
+        self.file.truncate(NPY_HEADER_SIZE + self.num_tokens * self._row_bytes())
+        self.file.seek(0)
+        self.file.write(_npy_header(self.dtype, (self.num_tokens, token_dim)))
+        self.file.close()
+        return self.path
+
+    def discard(self) -> None:
+        """Close and remove the file (e.g., if no graph is stored), an empty parent directory is removed as well"""
+        if not self.file.closed:
+            self.file.close()
+        self.path.unlink(missing_ok=True)
+        try:
+            self.path.parent.rmdir()
+        except OSError:  # not empty
+            pass
+
+    def _row_bytes(self) -> int:
+        return (self.token_dim or 0) * self.dtype.itemsize
+
+    def _reserve(self, capacity: int) -> None:
+        """Grow the file to the given number of rows
+
+        Args:
+            capacity (int): Number of rows
+        """
+        self.capacity = capacity
+        self.file.truncate(NPY_HEADER_SIZE + capacity * self._row_bytes())
+
+
+def write_graph_store(
+    outdir: Union[Path, str],
+    token_store: TokenStore,
+    positions: torch.Tensor,
+    nuclei_types: torch.Tensor,
+    metadata: dict,
+    order: np.ndarray = None,
+    chunk_size: int = 16384,
+    edge_index: torch.Tensor = None,
+    edge_attr: torch.Tensor = None,
+) -> Path:
+    """Finalize the token store and write positions, types and metadata next to it
+
+    Args:
+        outdir (Union[Path, str]): Output directory of the graph
+        token_store (TokenStore): Token store, tokens.npy inside outdir
+        positions (torch.Tensor): Cell positions (num_cells, 2) in final order
+        nuclei_types (torch.Tensor): Cell types (num_cells) in final order
+        metadata (dict): Graph metadata
+        order (np.ndarray, optional): If the cells have been reordered after appending the tokens, the
+            permutation (final index -> index in the token store). Tokens are reordered chunk-wise on disk. Defaults to None.
+        chunk_size (int, optional): Number of tokens copied at once when reordering. Defaults to 16384.
+        edge_index (torch.Tensor, optional): Spatial edges (2, num_edges). Defaults to None.
+        edge_attr (torch.Tensor, optional): Edge attributes (num_edges, num_edge_features). Defaults to None.
+
+    Returns:
+        Path: Path to the graph directory
+    """
+    outdir = Path(outdir)
+    outdir.mkdir(exist_ok=True, parents=True)
+    tokens_path = token_store.close()
+    if order is not None and len(order) > 0:
+        tokens = np.load(tokens_path, mmap_mode="r")
+        reordered_path = tokens_path.with_name("tokens.reordered.npy")
+        reordered = TokenStore(
+            reordered_path, dtype=tokens.dtype.name, initial_capacity=len(tokens)
+        )
+        for start in range(0, len(order), chunk_size):
+            reordered.append(
+                torch.from_numpy(tokens[order[start : start + chunk_size]])
+            )
+        reordered.close()
+        del tokens
+        os.replace(reordered_path, outdir / "tokens.npy")
+    elif tokens_path != outdir / "tokens.npy":
+        os.replace(tokens_path, outdir / "tokens.npy")
+
+    np.save(outdir / "positions.npy", positions.numpy().reshape(-1, 2))
+    np.save(outdir / "nuclei_types.npy", nuclei_types.numpy().reshape(-1))
+    if edge_index is not None:
+        np.save(outdir / "edge_index.npy", edge_index.numpy())
+    if edge_attr is not None:
+        np.save(outdir / "edge_attr.npy", edge_attr.numpy())
+    with open(outdir / "metadata.json", "w") as outfile:
+        ujson.dump(metadata, outfile)
+    return outdir
+
+
+def load_graph_store(path: Union[Path, str]) -> CellGraphDataWSI:
+    """Load a graph stored with write_graph_store, all tensors are memory-mapped
+
+    Tensors are backed by copy-on-write memory maps: they are loaded lazily from disk,
+    in-place modifications are not written back.
+
+    Args:
+        path (Union[Path, str]): Graph directory
+
+    Returns:
+        CellGraphDataWSI: Graph with memory-mapped tensors
+    """
+    path = Path(path)
+    with open(path / "metadata.json", "r") as infile:
+        metadata = ujson.load(infile)
+    return CellGraphDataWSI(
+        x=_load_tensor(path / "tokens.npy"),
+        positions=_load_tensor(path / "positions.npy"),
+        metadata=metadata,
+        nuclei_types=_load_tensor(path / "nuclei_types.npy"),
+        edge_index=_load_tensor(path / "edge_index.npy"),
+        edge_attr=_load_tensor(path / "edge_attr.npy"),
+    )
+
+
+def _load_tensor(path: Path) -> torch.Tensor:
+    """Memory-map a .npy file as tensor
+
+    Args:
+        path (Path): Path to the .npy file
+
+    Returns:
+        torch.Tensor: Memory-mapped tensor, None if the file does not exist
+    """
+    if not path.exists():
+        return None
+    array = np.load(path, mmap_mode="c")
+    if array.size == 0:
+        return torch.from_numpy(np.array(array))
+    return torch.from_numpy(array)
+
+
+def _npy_header(dtype: np.dtype, shape: tuple) -> bytes:
+    """Version 1.0 .npy header with a fixed size of NPY_HEADER_SIZE bytes
+
+    Args:
+        dtype (np.dtype): Array dtype
+        shape (tuple): Array shape
+
+    Returns:
+        bytes: Header
+    """
+    header = f"{{'descr': '{dtype.str}', 'fortran_order': False, 'shape': {shape}, }}"
+    preamble = b"\x93NUMPY\x01\x00"
+    header_len = NPY_HEADER_SIZE - len(preamble) - 2
+    header = header.ljust(header_len - 1) + "\n"
+    assert len(header) == header_len, "Shape does not fit into the npy header"
+    return preamble + header_len.to_bytes(2, "little") + header.encode("latin1")
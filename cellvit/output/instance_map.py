@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+# Chunked export of the slide-level instance label map
+#
+# The instance maps of the patches are stitched into one label map (uint32, 0 is background)
+# and written as zarr (v2) array with one chunk per patch, without assembling the full
+# resolution map in memory. Chunks are aligned to the patch grid: the chunk (row, col)
+# contains the inner region of patch (row, col) without half of the overlap on each side.
+# A chunk is written as soon as the cells of the patch and its neighbours are cleaned, such
+# that each kept cell is painted with its own pixels and removed duplicates are skipped.
+# Layout (OME-NGFF style multiscales, readable with zarr.open):
+#   * 0/, 1/, ...: Label map and downsampled levels (factor 2 per level, nearest neighbour)
+#   * cell_index/: Row of the cell in cells/cell_detection for each label (-1 for background)
+#   * .zattrs: Multiscales metadata and transformation to WSI coordinates
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import shutil
+import zlib
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+import numpy as np
+import ujson
+
+from cellvit.utils.coordinate_transform import AffineTransform
+
+Patch = Tuple[int, int]
+
+NEIGHBOUR_OFFSETS = [(dr, dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1)]
+
+
+class InstanceMapWriter:
+    def __init__(
+        self,
+        path: Union[Path, str],
+        patch_coordinates: Iterable[Patch],
+        patch_size: int,
+        overlap: int,
+        num_levels: int = 4,
+        compression_level: int = 1,
+    ) -> None:
+        """Write the stitched instance label map of a WSI chunk-wise to a zarr store
+
+        Usage: Hand over the instance maps of the processed patches with `add_patches`, the kept
+        cells with `register_cells` (in the order of the cell output) and call `write_ready` with the
+        resolved patches of the IncrementalCellStitcher. After all patches are processed, call `finalize`.
+
+        Args:
+            path (Union[Path, str]): Path to the zarr store (directory). An existing store is replaced.
+            patch_coordinates (Iterable[Patch]): (row, col) coordinates of all patches that are processed
+            patch_size (int): Patch size in pixels
+            overlap (int): Overlap of neighbouring patches in pixels
+            num_levels (int, optional): Number of resolution levels (including full resolution). Reduced if the
+                chunk size (patch_size - overlap) is not divisible by the downsampling factor. Defaults to 4.
+            compression_level (int, optional): Zlib compression level of the chunks. Defaults to 1.
+        """
+        assert num_levels > 0, "Number of levels must be greater than 0"
+        self.path = Path(path)
+        self.patch_size = patch_size
+        self.overlap = overlap
+        self.stride = patch_size - overlap
+        self.compression_level = compression_level
+        self.num_levels = num_levels
+        while self.stride % 2 ** (self.num_levels - 1) != 0:
+            self.num_levels -= 1
+
+        self.expected: Set[Patch] = {(int(r), int(c)) for r, c in patch_coordinates}
+        num_rows = max((r for r, _ in self.expected), default=-1) + 1
+        num_cols = max((c for _, c in self.expected), default=-1) + 1
+        self.shape = (num_rows * self.stride, num_cols * self.stride)
+
+        self.inst_maps: Dict[Patch, np.ndarray] = {}
+        self.labels: Dict[Patch, List[Tuple[int, int]]] = defaultdict(list)
+        self.received: Set[Patch] = set()
+        self.written: Set[Patch] = set()
+        self.num_labels: int = 0
+
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        self.path.mkdir(parents=True)
+        self._write_json(self.path / ".zgroup", {"zarr_format": 2})
+        for level in range(self.num_levels):
+            factor = 2**level
+            self._write_array_meta(
+                self.path / str(level),
+                shape=[s // factor for s in self.shape],
+                chunks=[self.stride // factor] * 2,
+                dtype="<u4",
+            )
+
+    def neighbours(self, patch: Patch) -> List[Patch]:
+        """Return the existing patches of the 3x3 neighbourhood (always including the patch itself)
+
+        Args:
+            patch (Patch): (row, col)
+
+        Returns:
+            List[Patch]: Existing patches
+        """
+        row, col = patch
+        return [
+            (row + dr, col + dc)
+            for dr, dc in NEIGHBOUR_OFFSETS
+            if (row + dr, col + dc) in self.expected or (dr, dc) == (0, 0)
+        ]
+
+    def add_patches(self, patches: List[Patch], inst_maps: List[np.ndarray]) -> None:
+        """Add the instance maps of processed patches
+
+        Args:
+            patches (List[Patch]): (row, col) coordinates of the patches
+            inst_maps (List[np.ndarray]): Instance maps (patch_size, patch_size) with patch-local instance ids
+        """
+        for patch, inst_map in zip(patches, inst_maps):
+            patch = (int(patch[0]), int(patch[1]))
+            assert inst_map.shape == (
+                self.patch_size,
+                self.patch_size,
+            ), "Instance map must have the shape (patch_size, patch_size)"
+            self.inst_maps[patch] = inst_map
+            self.received.add(patch)
+
+    def register_cells(self, cells: List[dict], first_label: int) -> None:
+        """Assign consecutive labels to kept cells
+
+        The patch-local instance id (key inst_id) is removed from the cell dictionaries.
+
+        Args:
+            cells (List[dict]): Kept cells with the keys patch_coordinates and inst_id
+            first_label (int): Label of the first cell (index of the cell in the cell output + 1)
+        """
+        for label, cell in enumerate(cells, start=first_label):
+            patch = tuple(cell["patch_coordinates"])
+            self.labels[patch].append((cell.pop("inst_id"), label))
+        self.num_labels = max(self.num_labels, first_label + len(cells) - 1)
+
+    def write_ready(self, resolved: Set[Patch]) -> None:
+        """Write all chunks whose neighbourhood is resolved, i.e., all cells that can reach the chunk are known
+
+        Args:
+            resolved (Set[Patch]): Resolved (or discarded) patches, e.g., IncrementalCellStitcher.resolved
+        """
+        for patch in sorted(self.received - self.written):
+            if all(n in resolved for n in self.neighbours(patch)):
+                self._write_chunk(patch)
+        # instance maps are dropped once all chunks they contribute to are written
+        for patch in list(self.inst_maps):
+            if all(
+                n in self.written or (n in resolved and n not in self.received)
+                for n in self.neighbours(patch)
+            ):
+                del self.inst_maps[patch]
+                self.labels.pop(patch, None)
+
+    def finalize(
+        self, coordinate_transform: AffineTransform, cell_order: np.ndarray = None
+    ) -> None:
+        """Write the remaining chunks, the label-to-cell index and the metadata
+
+        Args:
+            coordinate_transform (AffineTransform): Transformation from label map pixels (x, y) to the coordinates of the cell output
+            cell_order (np.ndarray, optional): Reordering of the cells after registering (new position -> old index),
+                e.g., Hilbert order. Defaults to None.
+        """
+        for patch in sorted(self.received - self.written):
+            self._write_chunk(patch)
+        self.inst_maps, self.labels = {}, defaultdict(list)
+
+        cell_index = np.full(self.num_labels + 1, -1, dtype=np.int64)
+        if cell_order is None:
+            cell_index[1:] = np.arange(self.num_labels)
+        else:
+            cell_index[np.asarray(cell_order, dtype=np.int64) + 1] = np.arange(
+                len(cell_order)
+            )
+        index_chunk = max(min(len(cell_index), 1 << 20), 1)
+        self._write_array_meta(
+            self.path / "cell_index",
+            shape=[len(cell_index)],
+            chunks=[index_chunk],
+            dtype="<i8",
+        )
+        for idx, start in enumerate(range(0, len(cell_index), index_chunk)):
+            self._write_chunk_file(
+                self.path / "cell_index" / str(idx),
+                cell_index[start : start + index_chunk],
+                index_chunk,
+            )
+
+        scale, translation = (
+            coordinate_transform.scale,
+            coordinate_transform.translation,
+        )
+        datasets = [
+            {
+                "path": str(level),
+                "coordinateTransformations": [
+                    {"type": "scale", "scale": [scale * 2**level] * 2},
+                    {"type": "translation", "translation": translation[::-1].tolist()},
+                ],
+            }
+            for level in range(self.num_levels)
+        ]
+        self._write_json(
+            self.path / ".zattrs",
+            {
+                "multiscales": [
+                    {
+                        "version": "0.4",
+                        "name": "instance_map",
+                        "axes": [
+                            {"name": "y", "type": "space"},
+                            {"name": "x", "type": "space"},
+                        ],
+                        "datasets": datasets,
+                    }
+                ],
+                "image-label": {"version": "0.4"},
+                "num_cells": int(self.num_labels),
+                "patch_size": self.patch_size,
+                "patch_overlap": self.overlap,
+            },
+        )
+
+    def _write_chunk(self, patch: Patch) -> None:
+        """Compose the chunk of a patch from the kept cells of the neighbourhood and write all levels
+
+        Cells of the patch itself are painted last, such that they take precedence in the chunk.
+
+        Args:
+            patch (Patch): (row, col)
+        """
+        row, col = patch
+        chunk = np.zeros((self.stride, self.stride), dtype=np.uint32)
+        neighbours = [n for n in self.neighbours(patch) if n != patch] + [patch]
+        for neighbour in neighbours:
+            if neighbour not in self.inst_maps or len(self.labels[neighbour]) == 0:
+                continue
+            inst_map = self.inst_maps[neighbour]
+            # patch origin relative to the chunk origin
+            row_offset = (neighbour[0] - row) * self.stride - self.overlap // 2
+            col_offset = (neighbour[1] - col) * self.stride - self.overlap // 2
+            row_start, row_end = max(row_offset, 0), min(
+                row_offset + self.patch_size, self.stride
+            )
+            col_start, col_end = max(col_offset, 0), min(
+                col_offset + self.patch_size, self.stride
+            )
+            if row_start >= row_end or col_start >= col_end:
+                continue
+            local_ids, labels = np.array(self.labels[neighbour]).T
+            lookup = np.zeros(
+                max(int(inst_map.max()), int(local_ids.max())) + 1, dtype=np.uint32
+            )
+            lookup[local_ids] = labels
+            painted = lookup[
+                inst_map[
+                    row_start - row_offset : row_end - row_offset,
+                    col_start - col_offset : col_end - col_offset,
+                ]
+            ]
+            np.copyto(
+                chunk[row_start:row_end, col_start:col_end],
+                painted,
+                where=painted > 0,
+            )
+        self.written.add(patch)
+        if not chunk.any():
+            # missing chunks are read as fill value (background)
+            return
+        for level in range(self.num_levels):
+            factor = 2**level
+            self._write_chunk_file(
+                self.path / str(level) / str(row) / str(col),
+                chunk[::factor, ::factor],
+            )
+
+    def _write_chunk_file(
+        self, path: Path, data: np.ndarray, chunk_length: int = None
+    ) -> None:
+        """Compress and write one chunk
+
+        Args:
+            path (Path): Chunk path
+            data (np.ndarray): Chunk data
+            chunk_length (int, optional): Length of 1D chunks, shorter chunks are padded. Defaults to None.
+        """
+        if chunk_length is not None and len(data) < chunk_length:
+            data = np.pad(data, (0, chunk_length - len(data)))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as outfile:
+            outfile.write(
+                zlib.compress(
+                    np.ascontiguousarray(data).tobytes(), self.compression_level
+                )
+            )
+
+    def _write_array_meta(
+        self, path: Path, shape: List[int], chunks: List[int], dtype: str
+    ) -> None:
+        """Write the .zarray metadata of an array
+
+        Args:
+            path (Path): Array directory
+            shape (List[int]): Array shape
+            chunks (List[int]): Chunk shape
+            dtype (str): Numpy dtype string (with byte order)
+        """
+        path.mkdir(parents=True, exist_ok=True)
+        self._write_json(
+            path / ".zarray",
+            {
+                "zarr_format": 2,
+                "shape": shape,
+                "chunks": chunks,
+                "dtype": dtype,
+                "compressor": {"id": "zlib", "level": self.compression_level},
+                "fill_value": 0 if dtype == "<u4" else -1,
+                "order": "C",
+                "filters": None,
+                "dimension_separator": "/",
+            },
+        )
+
+    @staticmethod
+    def _write_json(path: Path, content: dict) -> None:
+        with open(path, "w") as outfile:
+            ujson.dump(content, outfile, indent=2)
+
+
+def read_instance_map(path: Union[Path, str], level: int = 0) -> np.ndarray:
+    """Read one level of an instance map store into memory (without zarr dependency)
+
+    For lazy or partial reading of large slides, open the store with zarr instead.
+
+    Args:
+        path (Union[Path, str]): Path to the zarr store
+        level (int, optional): Resolution level. Defaults to 0.
+
+    Returns:
+        np.ndarray: Label map (uint32)
+    """
+    return _read_array(Path(path) / str(level))
+
+
+def read_cell_index(path: Union[Path, str]) -> np.ndarray:
+    """Read the label-to-cell index of an instance map store
+
+    Args:
+        path (Union[Path, str]): Path to the zarr store
+
+    Returns:
+        np.ndarray: Row of each label in the cell output (-1 for background)
+    """
+    return _read_array(Path(path) / "cell_index")
+
+
+def _read_array(path: Path) -> np.ndarray:
+    """Read a zarr (v2) array with zlib compressed chunks
+
+    Args:
+        path (Path): Array directory
+
+    Returns:
+        np.ndarray: Array
+    """
+    with open(path / ".zarray", "r") as infile:
+        meta = ujson.load(infile)
+    shape, chunks = meta["shape"], meta["chunks"]
+    array = np.full(shape, meta["fill_value"], dtype=np.dtype(meta["dtype"]))
+    for chunk_path in path.rglob("*"):
+        if chunk_path.is_dir() or chunk_path.name.startswith("."):
+            continue
+        chunk_idx = [int(p) for p in chunk_path.relative_to(path).parts]
+        data = np.frombuffer(
+            zlib.decompress(chunk_path.read_bytes()), dtype=array.dtype
+        ).reshape(chunks)
+        region = tuple(
+            slice(i * c, min((i + 1) * c, s))
+            for i, c, s in zip(chunk_idx, chunks, shape)
+        )
+        array[region] = data[tuple(slice(0, r.stop - r.start) for r in region)]
+    return array
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+# Spatial index sidecar (packed Hilbert R-tree) and region queries for cell outputs
+#
+# Cells are stored in Hilbert order of their centroids, such that spatially close cells
+# are close in the output file. The index stores the cell bounding boxes and a packed
+# R-tree over them. It is memory-mapped when loading, a region query only touches the
+# visited tree nodes and the byte ranges (json) or rows (arrow/parquet) of the hits.
+#
+# File layout (.sidx):
+#   * magic (8 bytes) and header length (uint64)
+#   * json header with array offsets
+#   * arrays, each aligned to 64 bytes: leaf bboxes, centroids, json byte spans (optional)
+#     and the bboxes of all tree levels (bottom-up)
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import mmap
+from itertools import chain
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import numpy as np
+import ujson
+
+from cellvit.output.contour_codec import decode_contours_base64
+
+SPATIAL_INDEX_MAGIC = b"CVSIDX01"
+ALIGNMENT = 64
+
+
+def hilbert_index(x: np.ndarray, y: np.ndarray, order: int = 16) -> np.ndarray:
+    """Position of integer points on a Hilbert curve
+
+    Args:
+        x (np.ndarray): x coordinates in [0, 2**order)
+        y (np.ndarray): y coordinates in [0, 2**order)
+        order (int, optional): Order of the Hilbert curve. Defaults to 16.
+
+    Returns:
+        np.ndarray: Hilbert index (uint64)
+    """
+    x = np.asarray(x, dtype=np.int64).copy()
+    y = np.asarray(y, dtype=np.int64).copy()
+    n = 1 << order
+    d = np.zeros(x.shape, dtype=np.uint64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += np.uint64(s * s) * ((3 * rx.astype(np.uint64)) ^ ry.astype(np.uint64))
+        # rotate quadrant
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s >>= 1
+    return d
+
+
+def hilbert_order(cell_list: List[dict], order: int = 16) -> np.ndarray:
+    """Permutation sorting cells by the Hilbert index of their centroids
+
+    Args:
+        cell_list (List[dict]): Cell list with centroid (x, y) for each cell
+        order (int, optional): Order of the Hilbert curve. Defaults to 16.
+
+    Returns:
+        np.ndarray: Permutation (cell indices in Hilbert order)
+    """
+    if len(cell_list) == 0:
+        return np.zeros(0, dtype=np.int64)
+    centroids = _stack(cell_list, "centroid", 2, np.float64)
+    minimum = centroids.min(axis=0)
+    extent = max(float((centroids.max(axis=0) - minimum).max()), 1.0)
+    grid = np.floor((centroids - minimum) / extent * ((1 << order) - 1))
+    return np.argsort(hilbert_index(grid[:, 0], grid[:, 1], order), kind="stable")
+
+
+def write_spatial_index(
+    path: Union[Path, str],
+    cell_list: List[dict],
+    source: Union[Path, str],
+    spans: List[Tuple[int, int]] = None,
+    node_size: int = 16,
+    contour_encoding: dict = None,
+) -> Path:
+    """Write a packed R-tree over the cell bounding boxes
+
+    The cells must be given in the order they are stored in the source file
+    (usually Hilbert order, see hilbert_order), such that consecutive cells are spatially close.
+
+    Args:
+        path (Union[Path, str]): Output path of the index (.sidx)
+        cell_list (List[dict]): Cells in the order of the source file, with keys bbox and centroid
+        source (Union[Path, str]): Cell file the index refers to (.json, .arrow or .parquet), stored relative to the index
+        spans (List[Tuple[int, int]], optional): Byte offset and length of each cell, required for json sources. Defaults to None.
+        node_size (int, optional): Number of children per tree node. Defaults to 16.
+        contour_encoding (dict, optional): Contour encoding of a json source (see contour_codec),
+            contours are decoded when loading cells. Defaults to None.
+
+    Returns:
+        Path: Path to the index
+    """
+    path, source = Path(path), Path(source)
+    source_format = source.suffix[1:]
+    assert source_format in ["json", "arrow", "parquet"], "Unsupported cell file"
+    assert (
+        source_format != "json" or spans is not None
+    ), "Byte spans are required for json cell files"
+    num_cells = len(cell_list)
+
+    # bbox in cells is [[row_min, col_min], [row_max, col_max]] -> (xmin, ymin, xmax, ymax)
+    bboxes = _stack(cell_list, "bbox", 4, np.float32)[:, [1, 0, 3, 2]]
+    centroids = _stack(cell_list, "centroid", 2, np.float32)
+
+    arrays = {"leaves": bboxes, "centroids": centroids}
+    if spans is not None:
+        arrays["spans"] = np.asarray(spans, dtype=np.int64).reshape(-1, 2)
+    levels = []
+    level = bboxes
+    while len(level) > 1:
+        starts = np.arange(0, len(level), node_size)
+        level = np.concatenate(
+            [
+                np.minimum.reduceat(level[:, :2], starts),
+                np.maximum.reduceat(level[:, 2:], starts),
+            ],
+            axis=1,
+        )
+        levels.append(level)
+    for level_idx, level in enumerate(levels):
+        arrays[f"level_{level_idx}"] = level
+
+    header = {
+        "version": 1,
+        "num_cells": num_cells,
+        "node_size": node_size,
+        "source": source.name,
+        "source_format": source_format,
+        "bounds": (
+            np.concatenate([bboxes[:, :2].min(0), bboxes[:, 2:].max(0)]).tolist()
+            if num_cells > 0
+            else None
+        ),
+        "num_levels": len(levels),
+        "contour_encoding": contour_encoding,
+        "arrays": {},
+    }
+    # offsets depend on the header size, reserve space with a padded header
+    header_size = len(ujson.dumps(header)) + 96 * len(arrays) + ALIGNMENT
+    offset = _align(len(SPATIAL_INDEX_MAGIC) + 8 + header_size)
+    for name, array in arrays.items():
+        header["arrays"][name] = {
+            "offset": offset,
+            "shape": list(array.shape),
+            "dtype": array.dtype.str,
+        }
+        offset = _align(offset + array.nbytes)
+    header_bytes = ujson.dumps(header).encode("utf-8")
+    assert len(header_bytes) <= header_size, "Reserved header size is too small"
+    header_bytes = header_bytes.ljust(header_size)
+
+    with open(path, "wb") as outfile:
+        outfile.write(SPATIAL_INDEX_MAGIC)
+        outfile.write(np.uint64(header_size).tobytes())
+        outfile.write(header_bytes)
+        for name, array in arrays.items():
+            outfile.seek(header["arrays"][name]["offset"])
+            outfile.write(np.ascontiguousarray(array).tobytes())
+    return path
+
+
+class SpatialIndex:
+    def __init__(self, path: Union[Path, str]) -> None:
+        """Memory-mapped spatial index of a cell output file
+
+        Args:
+            path (Union[Path, str]): Path to the index (.sidx)
+
+        Attributes:
+            path (Path): Path to the index
+            source (Path): Path to the cell file
+            source_format (str): Format of the cell file (json, arrow or parquet)
+            num_cells (int): Number of cells
+            bounds (List[float]): Bounds of all cells (xmin, ymin, xmax, ymax)
+            node_size (int): Number of children per tree node
+            contour_encoding (dict): Contour encoding of a json source or None
+        """
+        self.path = Path(path)
+        with open(self.path, "rb") as infile:
+            magic = infile.read(len(SPATIAL_INDEX_MAGIC))
+            assert magic == SPATIAL_INDEX_MAGIC, f"{self.path} is not a spatial index"
+            header_size = int(np.frombuffer(infile.read(8), dtype=np.uint64)[0])
+            header = ujson.loads(infile.read(header_size).decode("utf-8").strip())
+
+        self.source = self.path.parent / header["source"]
+        self.source_format: str = header["source_format"]
+        self.num_cells: int = header["num_cells"]
+        self.bounds: List[float] = header["bounds"]
+        self.node_size: int = header["node_size"]
+        self.contour_encoding: dict = header.get("contour_encoding")
+
+        self._arrays = {
+            name: (
+                np.memmap(
+                    self.path,
+                    dtype=np.dtype(spec["dtype"]),
+                    mode="r",
+                    offset=spec["offset"],
+                    shape=tuple(spec["shape"]),
+                )
+                if np.prod(spec["shape"]) > 0
+                else np.zeros(spec["shape"], dtype=np.dtype(spec["dtype"]))
+            )
+            for name, spec in header["arrays"].items()
+        }
+        self._levels = [
+            self._arrays[f"level_{idx}"] for idx in range(header["num_levels"])
+        ]
+        self._table = None
+
+    def query(self, xmin: float, ymin: float, xmax: float, ymax: float) -> np.ndarray:
+        """Return the cells whose bounding box intersects a rectangle
+
+        Args:
+            xmin (float): Minimum x coordinate
+            ymin (float): Minimum y coordinate
+            xmax (float): Maximum x coordinate
+            ymax (float): Maximum y coordinate
+
+        Returns:
+            np.ndarray: Sorted row indices of the cells in the cell file
+        """
+        roi = np.asarray([xmin, ymin, xmax, ymax], dtype=np.float32)
+        # number of entries per level, starting with the leaves
+        sizes = [self.num_cells] + [len(level) for level in self._levels]
+        candidates = np.arange(sizes[-1])
+        for level_idx in reversed(range(len(self._levels))):
+            level = self._levels[level_idx]
+            candidates = candidates[_intersects(level[candidates], roi)]
+            children = candidates[:, None] * self.node_size + np.arange(self.node_size)
+            candidates = children.reshape(-1)
+            candidates = candidates[candidates < sizes[level_idx]]
+        leaves = self._arrays["leaves"]
+        return candidates[_intersects(leaves[candidates], roi)]
+
+    def query_polygon(
+        self, polygon: Union[np.ndarray, List[List[float]]]
+    ) -> np.ndarray:
+        """Return the cells whose centroid is inside a polygon
+
+        Args:
+            polygon (Union[np.ndarray, List[List[float]]]): Polygon vertices (x, y)
+
+        Returns:
+            np.ndarray: Sorted row indices of the cells in the cell file
+        """
+        polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+        candidates = self.query(*polygon.min(0), *polygon.max(0))
+        centroids = np.asarray(self._arrays["centroids"][candidates], dtype=np.float64)
+        return candidates[_points_in_polygon(centroids, polygon)]
+
+    def load_cells(self, rows: np.ndarray) -> List[dict]:
+        """Load the cells with the given row indices from the cell file
+
+        Json files are memory-mapped and just the byte ranges of the requested cells are parsed.
+        Encoded contours are decoded.
+        Arrow files are memory-mapped, Parquet files are read completely once.
+
+        Args:
+            rows (np.ndarray): Row indices (e.g., result of query)
+
+        Returns:
+            List[dict]: Cell dictionaries
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return []
+        if self.source_format == "json":
+            spans = self._arrays["spans"][rows]
+            with open(self.source, "rb") as infile:
+                with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    cells = [
+                        ujson.loads(data[offset : offset + length])
+                        for offset, length in spans.tolist()
+                    ]
+            if self.contour_encoding is not None:
+                contours = decode_contours_base64(
+                    [c["contour"] for c in cells],
+                    precision=self.contour_encoding["precision"],
+                )
+                for cell, contour in zip(cells, contours):
+                    cell["contour"] = contour.tolist()
+            return cells
+
+        from cellvit.output.columnar import load_cells, table_to_cells
+
+        if self._table is None:
+            self._table = load_cells(self.source)
+        return table_to_cells(self._table.take(rows))
+
+    def query_cells(
+        self, xmin: float, ymin: float, xmax: float, ymax: float
+    ) -> List[dict]:
+        """Load all cells whose bounding box intersects a rectangle
+
+        Args:
+            xmin (float): Minimum x coordinate
+            ymin (float): Minimum y coordinate
+            xmax (float): Maximum x coordinate
+            ymax (float): Maximum y coordinate
+
+        Returns:
+            List[dict]: Cell dictionaries
+        """
+        return self.load_cells(self.query(xmin, ymin, xmax, ymax))
+
+
+def _stack(cell_list: List[dict], key: str, size: int, dtype: np.dtype) -> np.ndarray:
+    """Stack a (nested) list entry of all cells into an array without intermediate lists
+
+    Args:
+        cell_list (List[dict]): Cell list
+        key (str): Key of the entry (e.g., bbox or centroid)
+        size (int): Number of values per cell
+        dtype (np.dtype): Dtype of the array
+
+    Returns:
+        np.ndarray: Array with shape (len(cell_list), size)
+    """
+    values = (c[key] for c in cell_list)
+    if size == 4:
+        values = (chain.from_iterable(v) for v in values)
+    return np.fromiter(
+        chain.from_iterable(values), dtype=dtype, count=size * len(cell_list)
+    ).reshape(-1, size)
+
+
+def _align(offset: int) -> int:
+    """Round an offset up to the array alignment
+
+    Args:
+        offset (int): Byte offset
+
+    Returns:
+        int: Aligned byte offset
+    """
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _intersects(bboxes: np.ndarray, roi: np.ndarray) -> np.ndarray:
+    """Check which bounding boxes intersect a rectangle
+
+    Args:
+        bboxes (np.ndarray): Bounding boxes (N, 4) with (xmin, ymin, xmax, ymax)
+        roi (np.ndarray): Rectangle (xmin, ymin, xmax, ymax)
+
+    Returns:
+        np.ndarray: Boolean mask
+    """
+    return (
+        (bboxes[:, 0] <= roi[2])
+        & (bboxes[:, 2] >= roi[0])
+        & (bboxes[:, 1] <= roi[3])
+        & (bboxes[:, 3] >= roi[1])
+    )
+
+
+def _points_in_polygon(points: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    """Even-odd rule point in polygon test
+
+    Args:
+        points (np.ndarray): Points (N, 2)
+        polygon (np.ndarray): Polygon vertices (M, 2)
+
+    Returns:
+        np.ndarray: Boolean mask
+    """
+    x, y = points[:, 0], points[:, 1]
+    inside = np.zeros(len(points), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < x_cross)
+    return inside
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+# Tiled, pyramid-style output for viewers
+#
+# Cells are split into fixed-size spatial tiles by their centroid. Each tile is stored
+# as small GeoJSON (or Arrow/Parquet) file, such that viewers just load visible tiles.
+# Coarser levels double the tile size and hold decimated centroids (every 4**level-th cell),
+# a manifest lists the extent, file and cell counts per type of all tiles.
+#
+# Layout:
+#   tiles/manifest.json
+#   tiles/<level>/<col>_<row>.<ext>
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import math
+from itertools import chain
+from pathlib import Path
+from typing import Dict, List, Literal, Union
+
+import numpy as np
+import ujson
+
+from cellvit.output.compression import COMPRESSION_SUFFIXES, open_compressed
+from cellvit.output.contour_codec import contour_encoding_metadata
+from cellvit.output.geojson import write_geojson
+
+
+def write_tiles(
+    outdir: Union[Path, str],
+    cell_list: List[dict],
+    label_map: Dict[int, str],
+    tile_size: int = 4096,
+    file_format: Literal["geojson", "arrow", "parquet"] = "geojson",
+    wsi_metadata: dict = None,
+    compression: Literal["snappy", "zstd"] = None,
+    compression_level: int = 3,
+    polygons: bool = True,
+    contour_precision: float = None,
+) -> Path:
+    """Split cells into spatial tiles and write one file per tile and a manifest
+
+    Level 0 contains all cells (polygons for geojson), level k uses tiles of size
+    tile_size * 2**k with every 4**k-th cell as point. Levels are added until one tile covers all cells.
+    If the cells are stored in Hilbert order, the decimation is spatially uniform.
+
+    Args:
+        outdir (Union[Path, str]): Output directory (e.g., wsi_outdir / "tiles")
+        cell_list (List[dict]): Cells with keys bbox, centroid, type (and contour for level 0 geojson tiles)
+        label_map (Dict[int, str]): Mapping of cell types to names
+        tile_size (int, optional): Tile size of level 0 in pixels. Defaults to 4096.
+        file_format (Literal["geojson", "arrow", "parquet"], optional): File format of the tiles. Defaults to "geojson".
+        wsi_metadata (dict, optional): WSI metadata stored in the manifest. Defaults to None.
+        compression (Literal["snappy", "zstd"], optional): Compression codec of the tiles. Defaults to None.
+        compression_level (int, optional): Compression level (just zstd). Defaults to 3.
+        polygons (bool, optional): If level 0 contains polygons, otherwise points (e.g., for detections without contours).
+            Defaults to True.
+        contour_precision (float, optional): If provided, contours of Arrow/Parquet tiles are encoded
+            with this quantization step in pixels (GeoJSON tiles stay plain). Defaults to None.
+
+    Returns:
+        Path: Path to the manifest
+    """
+    assert tile_size > 0, "Tile size must be greater than 0"
+    assert file_format in ["geojson", "arrow", "parquet"], "Unknown tile format"
+    outdir = Path(outdir)
+    outdir.mkdir(exist_ok=True, parents=True)
+
+    num_cells = len(cell_list)
+    centroids = np.fromiter(
+        chain.from_iterable(c["centroid"] for c in cell_list),
+        dtype=np.float64,
+        count=2 * num_cells,
+    ).reshape(-1, 2)
+    types = np.fromiter((c["type"] for c in cell_list), dtype=np.int64, count=num_cells)
+    extent = float(centroids.max()) if num_cells > 0 else 0.0
+    num_levels = max(1, math.ceil(math.log2(max(extent, 1) / tile_size)) + 1)
+
+    manifest = {
+        "tile_size": tile_size,
+        "file_format": file_format,
+        "compression": compression,
+        "contour_encoding": (
+            contour_encoding_metadata(contour_precision)
+            if contour_precision is not None and file_format != "geojson"
+            else None
+        ),
+        "num_cells": num_cells,
+        "type_map": label_map,
+        "wsi_metadata": wsi_metadata if wsi_metadata is not None else {},
+        "levels": [],
+    }
+    for level in range(num_levels):
+        level_tile_size = tile_size * 2**level
+        decimation = 4**level
+        selected = np.arange(0, num_cells, decimation)
+        tile_cols = np.floor(centroids[selected, 0] / level_tile_size).astype(np.int64)
+        tile_rows = np.floor(centroids[selected, 1] / level_tile_size).astype(np.int64)
+
+        (outdir / str(level)).mkdir(exist_ok=True)
+        tiles = []
+        tile_keys = np.stack([tile_rows, tile_cols], axis=1)
+        unique_tiles, tile_ids = np.unique(tile_keys, axis=0, return_inverse=True)
+        tile_ids = tile_ids.reshape(-1)
+        order = np.argsort(tile_ids, kind="stable")
+        bounds = np.searchsorted(tile_ids[order], np.arange(len(unique_tiles) + 1))
+        for tile_idx, (row, col) in enumerate(unique_tiles.tolist()):
+            members = selected[order[bounds[tile_idx] : bounds[tile_idx + 1]]]
+            tile_cells = [cell_list[idx] for idx in members.tolist()]
+            file = _write_tile(
+                outdir / str(level) / f"{col}_{row}",
+                tile_cells,
+                label_map=label_map,
+                polygons=polygons and level == 0,
+                file_format=file_format,
+                compression=compression,
+                compression_level=compression_level,
+                contour_precision=contour_precision,
+            )
+            type_ids, counts = np.unique(types[members], return_counts=True)
+            tiles.append(
+                {
+                    "col": col,
+                    "row": row,
+                    "bbox": [
+                        col * level_tile_size,
+                        row * level_tile_size,
+                        (col + 1) * level_tile_size,
+                        (row + 1) * level_tile_size,
+                    ],
+                    "file": file.relative_to(outdir).as_posix(),
+                    "num_cells": len(members),
+                    "counts": {
+                        label_map[t]: c
+                        for t, c in zip(type_ids.tolist(), counts.tolist())
+                    },
+                }
+            )
+        manifest["levels"].append(
+            {
+                "level": level,
+                "tile_size": level_tile_size,
+                "decimation": decimation,
+                "geometry": "polygon" if polygons and level == 0 else "point",
+                "tiles": tiles,
+            }
+        )
+
+    manifest_path = outdir / "manifest.json"
+    with open(manifest_path, "w") as outfile:
+        ujson.dump(manifest, outfile)
+    return manifest_path
+
+
+def _write_tile(
+    path: Path,
+    cell_list: List[dict],
+    label_map: Dict[int, str],
+    polygons: bool,
+    file_format: Literal["geojson", "arrow", "parquet"],
+    compression: Literal["snappy", "zstd"],
+    compression_level: int,
+    contour_precision: float = None,
+) -> Path:
+    """Write the cells of one tile
+
+    Args:
+        path (Path): Output path without suffix
+        cell_list (List[dict]): Cells of the tile
+        label_map (Dict[int, str]): Mapping of cell types to names
+        polygons (bool): If polygons (True) or points (False) should be stored
+        file_format (Literal["geojson", "arrow", "parquet"]): File format
+        compression (Literal["snappy", "zstd"]): Compression codec or None
+        compression_level (int): Compression level (just zstd)
+        contour_precision (float, optional): Quantization step of encoded contours (just Arrow/Parquet). Defaults to None.
+
+    Returns:
+        Path: Path to the written file
+    """
+    if file_format != "geojson":
+        from cellvit.output.columnar import write_cells
+
+        return write_cells(
+            path,
+            cell_list,
+            type_map=label_map,
+            detection=not polygons,
+            file_format=file_format,
+            compression=compression,
+            contour_precision=contour_precision,
+        )
+
+    path = path.with_suffix(".geojson")
+    if compression is None:
+        outfile = open(path, "w")
+    else:
+        path = path.with_name(path.name + COMPRESSION_SUFFIXES[compression])
+        outfile = open_compressed(
+            path, "wt", codec=compression, level=compression_level
+        )
+    with outfile:
+        write_geojson(outfile.write, cell_list, label_map, polygons=polygons)
+    return path
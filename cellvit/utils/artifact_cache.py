@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# Cache of accelerated model artifacts (e.g., compiled graphs of torch.compile)
+#
+# Compiling the model takes minutes and the result just depends on the checkpoint, the
+# architecture, the device, the precision and the batch size. The artifacts are stored in
+# CACHE_DIR under a key hashed from these components, each with a json sidecar containing
+# the sha256 of the artifact and its components. Corrupt entries (checksum mismatch, missing
+# sidecar) are removed and treated as a miss. The cache is bounded by a size cap, the least
+# recently used entries (modification time, updated on each hit) are evicted first.
+# All files are written atomically, such that concurrent processes never read a partial entry.
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import ujson
+
+from cellvit.config.config import CACHE_DIR
+from cellvit.utils.logger import PrintLogger
+from cellvit.utils.run_ledger import config_hash
+
+ARTIFACT_CACHE_VERSION = 1
+
+
+class ArtifactCache:
+    def __init__(
+        self,
+        directory: Union[Path, str] = CACHE_DIR / "artifacts",
+        max_size_mb: float = 10240,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        """Size-bounded cache of binary artifacts with integrity checks and LRU eviction
+
+        Args:
+            directory (Union[Path, str], optional): Cache directory. Defaults to CACHE_DIR / "artifacts".
+            max_size_mb (float, optional): Maximum total size of the artifacts in MB. Defaults to 10240.
+            logger (Optional[logging.Logger], optional): Logger. Defaults to None.
+
+        Attributes:
+            directory (Path): Cache directory
+            max_size (int): Maximum total size of the artifacts in bytes
+            logger (logging.Logger): Logger
+        """
+        assert max_size_mb > 0, "Maximum cache size must be greater than 0"
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.logger = logger or PrintLogger()
+
+    @staticmethod
+    def key(**components) -> str:
+        """Key of an artifact, independent of the order of the components
+
+        Args:
+            **components: Json serializable components identifying the artifact
+                (e.g., checkpoint hash, architecture, device type, precision, batch size)
+
+        Returns:
+            str: Key (16 hex characters)
+        """
+        return config_hash({"version": ARTIFACT_CACHE_VERSION, **components})
+
+    def get(self, key: str) -> Union[bytes, None]:
+        """Load an artifact and verify its checksum
+
+        Corrupt entries are removed. A hit marks the entry as recently used.
+
+        Args:
+            key (str): Key of the artifact
+
+        Returns:
+            Union[bytes, None]: Artifact, None if not cached or corrupt
+        """
+        artifact_path, metadata_path = self._paths(key)
+        if not artifact_path.exists():
+            return None
+        try:
+            metadata = ujson.loads(metadata_path.read_text())
+            data = artifact_path.read_bytes()
+        except (OSError, ValueError):
+            metadata, data = {}, b""
+        if metadata.get("sha256") != hashlib.sha256(data).hexdigest():
+            self.logger.warning(f"Removing corrupt cache entry {key}")
+            self.remove(key)
+            return None
+        os.utime(artifact_path)
+        return data
+
+    def put(self, key: str, data: bytes, metadata: dict = None) -> Path:
+        """Store an artifact and evict the least recently used entries exceeding the size cap
+
+        Args:
+            key (str): Key of the artifact
+            data (bytes): Artifact
+            metadata (dict, optional): Json serializable information stored in the sidecar (e.g., the key components). Defaults to None.
+
+        Returns:
+            Path: Path of the artifact
+        """
+        artifact_path, metadata_path = self._paths(key)
+        sidecar = {
+            "version": ARTIFACT_CACHE_VERSION,
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "size": len(data),
+            "metadata": metadata or {},
+        }
+        # sidecar first, an artifact without valid sidecar is treated as corrupt
+        self._write_atomic(metadata_path, ujson.dumps(sidecar).encode("utf-8"))
+        self._write_atomic(artifact_path, data)
+        self.evict(keep=key)
+        return artifact_path
+
+    def remove(self, key: str) -> None:
+        """Remove an artifact and its sidecar
+
+        Args:
+            key (str): Key of the artifact
+        """
+        for path in self._paths(key):
+            path.unlink(missing_ok=True)
+
+    def evict(self, keep: str = None) -> int:
+        """Remove the least recently used artifacts until the total size is below the cap
+
+        Args:
+            keep (str, optional): Key that is never evicted (e.g., the artifact just stored). Defaults to None.
+
+        Returns:
+            int: Number of evicted artifacts
+        """
+        entries = []
+        for path in self.directory.glob("*.bin"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path.stem))
+        total_size = sum(entry[1] for entry in entries)
+        evicted = 0
+        for _, size, key in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total_size -= size
+            evicted += 1
+        if evicted > 0:
+            self.logger.info(f"Evicted {evicted} cached artifact(s)")
+        return evicted
+
+    def size(self) -> int:
+        """Total size of the cached artifacts in bytes"""
+        return sum(path.stat().st_size for path in self.directory.glob("*.bin"))
+
+    def _paths(self, key: str) -> Tuple[Path, Path]:
+        """Path of the artifact and its sidecar"""
+        return self.directory / f"{key}.bin", self.directory / f"{key}.json"
+
+    def _write_atomic(self, path: Path, data: bytes) -> None:
+        """Write a file atomically (temporary file and rename)"""
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        try:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Affine coordinate transformations (scaling and translation) for cell dictionaries
+#
+# All coordinates of a WSI are transformed with one array operation on a contiguous
+# buffer instead of per-point Python loops. Transformations can be composed and applied
+# once (e.g., at write time).
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+from typing import List, Tuple, Union
+
+import numpy as np
+import torch
+
+
+class AffineTransform:
+    def __init__(
+        self, scale: float = 1.0, translation: Tuple[float, float] = (0, 0)
+    ) -> None:
+        """Isotropic scaling followed by a translation: p' = p * scale + translation
+
+        Points are given in (x, y) order. Bounding boxes of cell dictionaries are stored
+        in (row, col) = (y, x) order and are handled accordingly.
+
+        Args:
+            scale (float, optional): Scaling factor. Defaults to 1.0.
+            translation (Tuple[float, float], optional): Translation in (x, y). Defaults to (0, 0).
+        """
+        self.scale = scale
+        self.translation = np.asarray(translation)
+
+    def __repr__(self) -> str:
+        return f"AffineTransform(scale={self.scale}, translation={self.translation.tolist()})"
+
+    @property
+    def is_identity(self) -> bool:
+        return self.scale == 1 and not np.any(self.translation)
+
+    def then(self, other: "AffineTransform") -> "AffineTransform":
+        """Compose two transformations, first self is applied, afterwards other
+
+        Args:
+            other (AffineTransform): Transformation applied afterwards
+
+        Returns:
+            AffineTransform: Composed transformation
+        """
+        return AffineTransform(
+            scale=self.scale * other.scale,
+            translation=self.translation * other.scale + other.translation,
+        )
+
+    def apply_points(self, points: np.ndarray, flip: bool = False) -> np.ndarray:
+        """Transform an array of points
+
+        If no scaling and an integer translation is used, integer arrays keep their dtype.
+
+        Args:
+            points (np.ndarray): Points with shape (..., 2) in (x, y) order
+            flip (bool, optional): If points are given in (y, x) order. Defaults to False.
+
+        Returns:
+            np.ndarray: Transformed points
+        """
+        points = np.asarray(points)
+        translation = self.translation[::-1] if flip else self.translation
+        if (
+            self.scale == 1
+            and np.issubdtype(points.dtype, np.integer)
+            and np.all(np.mod(translation, 1) == 0)
+        ):
+            return points + translation.astype(points.dtype)
+        return points * self.scale + translation
+
+    def apply_tensor(self, positions: torch.Tensor) -> torch.Tensor:
+        """Transform stacked cell positions
+
+        Args:
+            positions (torch.Tensor): Positions with shape (N, 2) in (x, y) order
+
+        Returns:
+            torch.Tensor: Transformed positions
+        """
+        translation = torch.as_tensor(self.translation, dtype=positions.dtype)
+        return positions * self.scale + translation
+
+    def apply_cells(self, cell_list: List[dict], contour: bool = True) -> List[dict]:
+        """Transform bbox, centroid and (optional) contour of all cells in-place
+
+        Contour points are rounded to integers after transformation.
+
+        Args:
+            cell_list (List[dict]): Cell dictionaries with keys bbox, centroid and (if contour=True) contour
+            contour (bool, optional): If contours should be transformed. Defaults to True.
+
+        Returns:
+            List[dict]: Transformed cell dictionaries (same objects)
+        """
+        if len(cell_list) == 0 or self.is_identity:
+            return cell_list
+
+        bboxes = self.apply_points([c["bbox"] for c in cell_list], flip=True).tolist()
+        centroids = self.apply_points([c["centroid"] for c in cell_list]).tolist()
+        for cell, bbox, centroid in zip(cell_list, bboxes, centroids):
+            cell["bbox"] = bbox
+            cell["centroid"] = centroid
+
+        if contour:
+            contours = [c["contour"] for c in cell_list]
+            for cell, transformed in zip(cell_list, self.apply_contours(contours)):
+                cell["contour"] = transformed
+
+        return cell_list
+
+    def apply_contours(
+        self, contours: List[Union[List[List[float]], np.ndarray]]
+    ) -> List[List[List[int]]]:
+        """Transform a list of contours with one operation on a contiguous coordinate buffer
+
+        Args:
+            contours (List[Union[List[List[float]], np.ndarray]]): Contours with (x, y) points
+
+        Returns:
+            List[List[List[int]]]: Transformed contours, rounded to integers
+        """
+        lengths = np.fromiter((len(c) for c in contours), dtype=np.int64)
+        if lengths.sum() == 0:
+            return [[] for _ in contours]
+        buffer = np.concatenate(
+            [np.asarray(c, dtype=np.float64).reshape(-1, 2) for c in contours]
+        )
+        buffer = np.rint(self.apply_points(buffer)).astype(np.int64).tolist()
+        ends = np.cumsum(lengths).tolist()
+        starts = [0] + ends[:-1]
+        return [buffer[s:e] for s, e in zip(starts, ends)]
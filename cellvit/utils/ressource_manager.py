@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
+import copy
 import os
 import psutil
 import subprocess
 import re
 import logging
-import ray
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, Optional, List, Tuple, Literal
 from cellvit.utils.logger import NullLogger
 from cellvit.utils.check_module import check_module
@@ -91,6 +93,28 @@ def is_vm() -> bool:
     return False
 
 
+def get_job_array_shard() -> Tuple[Optional[int], Optional[int]]:
+    """Get the shard index and number of shards of a SLURM job array or Kubernetes indexed job.
+
+    SLURM array task ids are mapped to 0, ..., SLURM_ARRAY_TASK_COUNT - 1 (also for arrays like 1-200 or 0-20:2).
+    Kubernetes indexed jobs just provide the index (JOB_COMPLETION_INDEX), the number of completions is not exposed.
+
+    Returns:
+        Tuple[Optional[int], Optional[int]]: Shard index and number of shards, None if not available.
+    """
+    if "SLURM_ARRAY_TASK_ID" in os.environ:
+        task_id = int(os.environ["SLURM_ARRAY_TASK_ID"])
+        task_min = int(os.environ.get("SLURM_ARRAY_TASK_MIN", 0))
+        task_step = int(os.environ.get("SLURM_ARRAY_TASK_STEP", 1))
+        task_count = os.environ.get("SLURM_ARRAY_TASK_COUNT")
+        return (task_id - task_min) // task_step, (
+            int(task_count) if task_count is not None else None
+        )
+    if "JOB_COMPLETION_INDEX" in os.environ:
+        return int(os.environ["JOB_COMPLETION_INDEX"]), None
+    return None, None
+
+
 def get_cpu_memory_slurm() -> Tuple[float, float]:
     """Get CPU and memory limits from a SLURM job.
 
@@ -507,6 +531,17 @@ def get_gpu_resources(logger: Optional[logging.Logger] = None) -> Dict[str, Any]
     return gpu_resources
 
 
+def get_cupy_available() -> bool:
+    """Check if CuPy is installed and working on the GPU
+
+    Returns:
+        bool: True if CuPy is available, False otherwise.
+    """
+    if check_module("cupy") or check_module("cupyx"):
+        return check_cupy(True, NullLogger())
+    return False
+
+
 def get_used_memory(runtime_env: str) -> float:
     """Get the current memory usage in MB for the given runtime environment.
 
@@ -638,6 +673,8 @@ def get_used_memory_slurm() -> float:
 
 
 def retrieve_actor_usage() -> List[float]:
+    import ray
+
     actor_pids = [f["Pid"] for f in ray._private.state.actors().values()]
     memory_usage = []
     for actor_pid in actor_pids:
@@ -675,6 +712,7 @@ class SystemConfiguration:
             ray_remote_cpus (int): The number of CPUs per Ray worker.
             torch_worker (int): The number of Torch workers that can be created.
             gpu_index (int): The index of the selected GPU.
+            probe_duration (float): Duration of the environment probes in seconds.
 
         Methods:
             __getitem__(key: str) -> Any: Get an attribute by key.
@@ -683,6 +721,7 @@ class SystemConfiguration:
             overwrite_ray_remote_cpus(ray_remote_cpus: int) -> None: Overwrite the number of CPUs per Ray worker.
             overwrite_available_cpus(cpu_count: int) -> None: Overwrite the number of available CPUs.
             overwrite_memory(memory: int) -> None: Overwrite the total memory available.
+            split_between_processes(num_processes: int) -> SystemConfiguration: Budget of one of multiple processes sharing the host.
             get_current_memory_usage() -> int: Get the current memory usage.
             get_current_memory_percentage() -> int: Get the current memory usage percentage.
             log_system_configuration(logger: Optional[logging.Logger] = None) -> None: Log the system configuration
@@ -701,9 +740,20 @@ class SystemConfiguration:
         self.ray_remote_cpus: int
         self.torch_worker: int
         self.gpu_index: int = gpu
-
-        (cpu_count, memory), env = get_cpu_resources()
-        gpu_resources = get_gpu_resources()
+        self.probe_duration: float
+
+        # the probes (subprocesses, CUDA and CuPy initialization) are independent and run concurrently
+        probe_start = time.time()
+        with ThreadPoolExecutor(
+            max_workers=3, thread_name_prefix="cellvit-probe"
+        ) as executor:
+            cpu_probe = executor.submit(get_cpu_resources)
+            gpu_probe = executor.submit(get_gpu_resources)
+            cupy_probe = executor.submit(get_cupy_available)
+            (cpu_count, memory), env = cpu_probe.result()
+            gpu_resources = gpu_probe.result()
+            cupy = cupy_probe.result()
+        self.probe_duration = time.time() - probe_start
 
         self.cpu_count = int(cpu_count)
         self.memory = memory
@@ -714,9 +764,7 @@ class SystemConfiguration:
             raise SystemError("Requesting non existing gpu index")
         self.gpu_memory = gpu_resources["devices"][self.gpu_index]["total_memory_gb"]
 
-        self.cupy = check_module("cupy") or check_module("cupyx")
-        if self.cupy:
-            self.cupy = check_cupy(True, NullLogger())
+        self.cupy = cupy
         self.cucim = check_module("cucim")
         self.numba = check_module("numba")
         self.ray = check_module("ray")
@@ -759,6 +807,24 @@ class SystemConfiguration:
     def overwrite_memory(self, memory: int) -> None:
         self.memory = memory
 
+    def split_between_processes(self, num_processes: int) -> "SystemConfiguration":
+        """Budget of one of multiple inference processes sharing the host (and Ray cluster)
+
+        CPU cores and Ray workers are divided evenly, each process keeps at least one of both.
+        The memory is not divided, as the memory usage is measured for the whole host.
+
+        Args:
+            num_processes (int): Number of processes
+
+        Returns:
+            SystemConfiguration: Configuration of one process
+        """
+        assert num_processes > 0, "Number of processes must be greater than 0"
+        configuration = copy.copy(self)
+        configuration.cpu_count = max(1, self.cpu_count // num_processes)
+        configuration.ray_worker = max(1, self.ray_worker // num_processes)
+        return configuration
+
     def get_current_memory_usage(self) -> int:
         return int(get_used_memory(self.runtime_environment))
 
@@ -791,6 +857,7 @@ class SystemConfiguration:
         logger.info(f"Cupy available:     {self.cupy}")
         logger.info(f"Cucim available:    {self.cucim}")
         logger.info(f"Numba available:    {self.numba}")
+        logger.info(f"Probing time:       {self.probe_duration:.2f} s")
 
         logger.info("========================================")
         logger.info("       SYSTEM LOADED SUCCESSFULLY       ")
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+# Run ledger of processed slides
+#
+# Append-only SQLite log of all processing attempts. Each slide is identified by its path,
+# a content fingerprint (size and hash of the first and last MiB) and the hash of the
+# configuration influencing the outputs. A slide is skipped if it has been finished with the
+# same key before, such that changing e.g. the taxonomy or replacing a file triggers a rerun.
+# Rows are never updated: an attempt inserts a "started" row and a "finished" or "failed"
+# row referencing its id (run_id), a crash leaves just the "started" row.
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Literal, Tuple, Union
+
+import ujson
+
+FINGERPRINT_BLOCK_SIZE = 1024 * 1024
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER,
+    slide TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    config_hash TEXT NOT NULL,
+    status TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    duration REAL,
+    num_cells INTEGER,
+    timings TEXT,
+    error TEXT,
+    host TEXT,
+    pid INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_key ON runs (slide, fingerprint, config_hash, status);
+"""
+
+LEDGER_COLUMNS = [
+    "run_id",
+    "slide",
+    "fingerprint",
+    "config_hash",
+    "status",
+    "timestamp",
+    "duration",
+    "num_cells",
+    "timings",
+    "error",
+    "host",
+    "pid",
+]
+
+
+def slide_fingerprint(path: Union[Path, str]) -> str:
+    """Content fingerprint of a slide file (independent of path and modification time)
+
+    Hashes the file size and the first and last MiB, such that fingerprinting is fast for large files.
+
+    Args:
+        path (Union[Path, str]): Path to the slide
+
+    Returns:
+        str: Hex digest
+    """
+    path = Path(path)
+    size = path.stat().st_size
+    digest = hashlib.sha256(str(size).encode("utf-8"))
+    with open(path, "rb") as infile:
+        digest.update(infile.read(FINGERPRINT_BLOCK_SIZE))
+        if size > FINGERPRINT_BLOCK_SIZE:
+            infile.seek(max(size - FINGERPRINT_BLOCK_SIZE, FINGERPRINT_BLOCK_SIZE))
+            digest.update(infile.read(FINGERPRINT_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+def config_hash(config: dict) -> str:
+    """Hash of a (json serializable) configuration, independent of the key order
+
+    Args:
+        config (dict): Configuration
+
+    Returns:
+        str: Hex digest (16 characters)
+    """
+    serialized = ujson.dumps(config, sort_keys=True, ensure_ascii=True)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:16]
+
+
+class RunLedger:
+    def __init__(self, path: Union[Path, str]) -> None:
+        """Append-only ledger of slide processing attempts stored as SQLite database
+
+        The ledger can be used from multiple threads (e.g., completion callbacks of the background writer)
+        and multiple processes, also on different nodes sharing the output directory (rollback journal with file locks).
+
+        Args:
+            path (Union[Path, str]): Path to the database (e.g., outdir/run_ledger.sqlite)
+
+        Attributes:
+            path (Path): Path to the database
+            connection (sqlite3.Connection): Database connection
+            lock (threading.Lock): Lock serializing the access of threads
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.connection = sqlite3.connect(
+            str(self.path), timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=DELETE")
+            self.connection.executescript(LEDGER_SCHEMA)
+
+    def start(self, slide: Union[Path, str], fingerprint: str, config_hash: str) -> int:
+        """Record the start of a processing attempt
+
+        Args:
+            slide (Union[Path, str]): Path to the slide
+            fingerprint (str): Content fingerprint of the slide
+            config_hash (str): Hash of the configuration
+
+        Returns:
+            int: Run id, used for recording the result
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (slide, fingerprint, config_hash, status, timestamp, host, pid) "
+                "VALUES (?, ?, ?, 'started', ?, ?, ?)",
+                (
+                    str(slide),
+                    fingerprint,
+                    config_hash,
+                    time.time(),
+                    socket.gethostname(),
+                    os.getpid(),
+                ),
+            )
+        return cursor.lastrowid
+
+    def finish(self, run_id: int, num_cells: int = None, timings: dict = None) -> None:
+        """Record the successful end of a processing attempt
+
+        Args:
+            run_id (int): Run id returned by start
+            num_cells (int, optional): Number of detected cells. Defaults to None.
+            timings (dict, optional): Durations of processing steps in seconds. Defaults to None.
+        """
+        self._record_result(
+            run_id,
+            "finished",
+            num_cells=num_cells,
+            timings=ujson.dumps(timings) if timings is not None else None,
+        )
+
+    def fail(self, run_id: int, error: str) -> None:
+        """Record a failed processing attempt
+
+        Args:
+            run_id (int): Run id returned by start
+            error (str): Error message
+        """
+        self._record_result(run_id, "failed", error=error)
+
+    def status(
+        self, slide: Union[Path, str], fingerprint: str, config_hash: str
+    ) -> Union[Literal["started", "finished", "failed"], None]:
+        """Latest status of a slide, None if it has never been processed with this configuration
+
+        A finished slide stays finished, also if later attempts failed or are still running.
+
+        Args:
+            slide (Union[Path, str]): Path to the slide
+            fingerprint (str): Content fingerprint of the slide
+            config_hash (str): Hash of the configuration
+
+        Returns:
+            Union[Literal["started", "finished", "failed"], None]: Status
+        """
+        with self.lock:
+            latest = _latest_status(
+                self.connection, (str(slide), fingerprint, config_hash)
+            )
+        return latest[0] if latest is not None else None
+
+    def failures(self, since: float = None) -> List[Tuple[str, str]]:
+        """Slides whose latest attempt failed and that have not been finished
+
+        Args:
+            since (float, optional): Just consider attempts failed after this unix timestamp. Defaults to None.
+
+        Returns:
+            List[Tuple[str, str]]: Slide path and error message
+        """
+        with self.lock:
+            return ledger_failures(self.connection, since=since)
+
+    def summary(self, config_hash: str = None, since: float = None) -> dict:
+        """Throughput report of finished attempts and failed slides
+
+        Args:
+            config_hash (str, optional): Just consider attempts with this configuration. Defaults to None.
+            since (float, optional): Just consider attempts finished after this unix timestamp. Defaults to None.
+
+        Returns:
+            dict: Report, see ledger_summary
+        """
+        with self.lock:
+            return ledger_summary(self.connection, config_hash=config_hash, since=since)
+
+    def merge(self, path: Union[Path, str]) -> int:
+        """Append all records of another ledger (e.g., of a shard of a job array)
+
+        Ids are assigned anew, results keep referencing their attempt.
+
+        Args:
+            path (Union[Path, str]): Path to the ledger to merge
+
+        Returns:
+            int: Number of merged records
+        """
+        source = open_read_only(path)
+        try:
+            rows = source.execute(
+                f"SELECT id, {', '.join(LEDGER_COLUMNS)} FROM runs ORDER BY id"
+            ).fetchall()
+        finally:
+            source.close()
+        id_map = {}
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                for row in rows:
+                    cursor = self.connection.execute(
+                        f"INSERT INTO runs ({', '.join(LEDGER_COLUMNS)}) "
+                        f"VALUES ({', '.join('?' * len(LEDGER_COLUMNS))})",
+                        (id_map.get(row[1]), *row[2:]),
+                    )
+                    id_map[row[0]] = cursor.lastrowid
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def close(self) -> None:
+        """Close the database connection"""
+        with self.lock:
+            self.connection.close()
+
+    def _record_result(self, run_id: int, status: str, **fields) -> None:
+        """Insert the result row of an attempt
+
+        Args:
+            run_id (int): Run id returned by start
+            status (str): finished or failed
+            **fields: Additional columns (num_cells, timings, error)
+        """
+        now = time.time()
+        with self.lock:
+            started = self.connection.execute(
+                "SELECT slide, fingerprint, config_hash, timestamp FROM runs WHERE id = ?",
+                (run_id,),
+            ).fetchone()
+            assert started is not None, f"Unknown run id {run_id}"
+            slide, fingerprint, config_hash, start_time = started
+            columns = {
+                "run_id": run_id,
+                "slide": slide,
+                "fingerprint": fingerprint,
+                "config_hash": config_hash,
+                "status": status,
+                "timestamp": now,
+                "duration": now - start_time,
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                **fields,
+            }
+            self.connection.execute(
+                f"INSERT INTO runs ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                tuple(columns.values()),
+            )
+
+
+def open_read_only(path: Union[Path, str]) -> sqlite3.Connection:
+    """Open a ledger read-only, without taking write locks (e.g., the ledger of a shard that is still running)
+
+    Args:
+        path (Union[Path, str]): Path to the ledger
+
+    Returns:
+        sqlite3.Connection: Read-only database connection
+    """
+    return sqlite3.connect(
+        f"{Path(path).resolve().as_uri()}?mode=ro", uri=True, timeout=60
+    )
+
+
+def ledger_failures(
+    connection: sqlite3.Connection, config_hash: str = None, since: float = None
+) -> List[Tuple[str, str]]:
+    """Slides whose latest attempt failed and that have not been finished
+
+    Args:
+        connection (sqlite3.Connection): Connection to a ledger
+        config_hash (str, optional): Just consider attempts with this configuration. Defaults to None.
+        since (float, optional): Just consider attempts failed after this unix timestamp. Defaults to None.
+
+    Returns:
+        List[Tuple[str, str]]: Slide path and error message
+    """
+    query = (
+        "SELECT slide, error FROM runs AS r WHERE status = 'failed' "
+        "AND id = (SELECT MAX(id) FROM runs WHERE slide = r.slide "
+        "AND fingerprint = r.fingerprint AND config_hash = r.config_hash) "
+        "AND NOT EXISTS (SELECT 1 FROM runs WHERE slide = r.slide "
+        "AND fingerprint = r.fingerprint AND config_hash = r.config_hash AND status = 'finished')"
+    )
+    parameters = []
+    if config_hash is not None:
+        query += " AND config_hash = ?"
+        parameters.append(config_hash)
+    if since is not None:
+        query += " AND timestamp >= ?"
+        parameters.append(since)
+    return [tuple(row) for row in connection.execute(query, parameters)]
+
+
+def ledger_summary(
+    connection: sqlite3.Connection, config_hash: str = None, since: float = None
+) -> dict:
+    """Throughput report of finished attempts and failed slides of a ledger
+
+    Args:
+        connection (sqlite3.Connection): Connection to a ledger
+        config_hash (str, optional): Just consider attempts with this configuration. Defaults to None.
+        since (float, optional): Just consider attempts finished after this unix timestamp. Defaults to None.
+
+    Returns:
+        dict: Report with keys
+            * num_finished: Number of finished attempts
+            * num_failed: Number of slides whose latest attempt failed and that have not been finished (see failures)
+            * num_cells: Number of detected cells of the finished attempts
+            * processing_time: Summed duration of the finished attempts in seconds
+            * wall_time: Time between the first start and the last result in seconds
+            * slides_per_hour: Finished slides per hour wall time
+            * cells_per_second: Detected cells per second wall time
+    """
+    conditions, parameters = ["status IN ('finished', 'failed')"], []
+    if config_hash is not None:
+        conditions.append("config_hash = ?")
+        parameters.append(config_hash)
+    if since is not None:
+        conditions.append("timestamp >= ?")
+        parameters.append(since)
+    rows = connection.execute(
+        "SELECT status, COUNT(*), COALESCE(SUM(num_cells), 0), COALESCE(SUM(duration), 0), "
+        "MIN(timestamp - COALESCE(duration, 0)), MAX(timestamp) "
+        f"FROM runs WHERE {' AND '.join(conditions)} GROUP BY status",
+        parameters,
+    ).fetchall()
+    stats = {row[0]: row[1:] for row in rows}
+    num_finished, num_cells, processing_time, _, _ = stats.get(
+        "finished", (0, 0, 0.0, None, None)
+    )
+    wall_time = 0.0
+    if len(stats) > 0:
+        wall_time = max(row[4] for row in stats.values()) - min(
+            row[3] for row in stats.values()
+        )
+    return {
+        "num_finished": num_finished,
+        "num_failed": len(
+            ledger_failures(connection, config_hash=config_hash, since=since)
+        ),
+        "num_cells": num_cells,
+        "processing_time": processing_time,
+        "wall_time": wall_time,
+        "slides_per_hour": (num_finished / wall_time * 3600 if wall_time > 0 else 0.0),
+        "cells_per_second": num_cells / wall_time if wall_time > 0 else 0.0,
+    }
+
+
+def _latest_status(
+    connection: sqlite3.Connection, key: Tuple[str, str, str]
+) -> Union[Tuple[str, float], None]:
+    """Latest status of a slide and its timestamp, a finished attempt takes precedence
+
+    Args:
+        connection (sqlite3.Connection): Connection to a ledger
+        key (Tuple[str, str, str]): Slide path, fingerprint and configuration hash
+
+    Returns:
+        Union[Tuple[str, float], None]: Status and timestamp, None if the slide has never been processed
+    """
+    finished = connection.execute(
+        "SELECT status, timestamp FROM runs WHERE slide = ? AND fingerprint = ? AND config_hash = ? "
+        "AND status = 'finished' LIMIT 1",
+        key,
+    ).fetchone()
+    if finished is not None:
+        return finished
+    return connection.execute(
+        "SELECT status, timestamp FROM runs WHERE slide = ? AND fingerprint = ? AND config_hash = ? "
+        "ORDER BY id DESC LIMIT 1",
+        key,
+    ).fetchone()
+
+
+def combined_status(
+    paths: List[Union[Path, str]],
+    slide: Union[Path, str],
+    fingerprint: str,
+    config_hash: str,
+) -> Union[Literal["started", "finished", "failed"], None]:
+    """Latest status of a slide over multiple ledgers (e.g., the ledgers of all shards of a job array)
+
+    A slide finished in any ledger is finished, otherwise the most recent attempt of all ledgers counts.
+    The ledgers are opened read-only, missing files are ignored.
+
+    Args:
+        paths (List[Union[Path, str]]): Paths to the ledgers
+        slide (Union[Path, str]): Path to the slide
+        fingerprint (str): Content fingerprint of the slide
+        config_hash (str): Hash of the configuration
+
+    Returns:
+        Union[Literal["started", "finished", "failed"], None]: Status
+    """
+    key = (str(slide), fingerprint, config_hash)
+    statuses = []
+    for path in paths:
+        if not Path(path).is_file():
+            continue
+        connection = open_read_only(path)
+        try:
+            latest = _latest_status(connection, key)
+        except sqlite3.OperationalError:
+            # database is still being created (no runs table yet)
+            latest = None
+        finally:
+            connection.close()
+        if latest is not None:
+            statuses.append(latest)
+    if len(statuses) == 0:
+        return None
+    if any(status == "finished" for status, _ in statuses):
+        return "finished"
+    return max(statuses, key=lambda latest: latest[1])[0]
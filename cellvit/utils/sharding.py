@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Static partitioning of a dataset into shards (e.g., for SLURM or Kubernetes job arrays)
+#
+# Each array task selects its shard from the same dataset without communication. The
+# partition is deterministic and balanced by file size (as estimate of the tissue area and
+# thus processing time): slides are assigned largest first to the shard with the smallest
+# load so far (longest processing time first), ties are broken by the slide path.
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import heapq
+from pathlib import Path
+from typing import Any, List, Sequence, Tuple, Union
+
+SHARD_LEDGER_NAME = "run_ledger_shard_{shard_index:04d}_of_{num_shards:04d}.sqlite"
+
+
+def partition_balanced(
+    sizes: Sequence[int], num_shards: int, keys: Sequence[str] = None
+) -> List[List[int]]:
+    """Partition items into shards with balanced total size
+
+    Args:
+        sizes (Sequence[int]): Size of each item
+        num_shards (int): Number of shards
+        keys (Sequence[str], optional): Keys for breaking ties between items of equal size. Defaults to None (item position).
+
+    Returns:
+        List[List[int]]: Item indices of each shard, in their original order
+    """
+    assert num_shards > 0, "Number of shards must be greater than 0"
+    keys = list(range(len(sizes))) if keys is None else keys
+    order = sorted(range(len(sizes)), key=lambda idx: (-sizes[idx], keys[idx]))
+    loads = [(0, shard) for shard in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    for idx in order:
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(idx)
+        heapq.heappush(loads, (load + sizes[idx], shard))
+    return [sorted(shard) for shard in shards]
+
+
+def select_shard(
+    wsi_jobs: List[Tuple[Union[Path, str], Any, Any]],
+    shard_index: int,
+    num_shards: int,
+) -> List[Tuple[Union[Path, str], Any, Any]]:
+    """Select the WSI of one shard, balanced by file size
+
+    Args:
+        wsi_jobs (List[Tuple[Union[Path, str], Any, Any]]): WSI path, mpp and magnification override of the whole dataset
+        shard_index (int): Index of the shard (0, ..., num_shards - 1)
+        num_shards (int): Number of shards
+
+    Returns:
+        List[Tuple[Union[Path, str], Any, Any]]: WSI of the shard, in the order of the dataset
+    """
+    assert 0 <= shard_index < num_shards, "Shard index must be in [0, num_shards)"
+    sizes = [Path(job[0]).stat().st_size for job in wsi_jobs]
+    keys = [str(job[0]) for job in wsi_jobs]
+    shard = partition_balanced(sizes, num_shards, keys=keys)[shard_index]
+    return [wsi_jobs[idx] for idx in shard]
+
+
+def shard_ledger_name(shard_index: int, num_shards: int) -> str:
+    """File name of the run ledger of a shard
+
+    Args:
+        shard_index (int): Index of the shard
+        num_shards (int): Number of shards
+
+    Returns:
+        str: File name (run_ledger_shard_<index>_of_<num_shards>.sqlite)
+    """
+    return SHARD_LEDGER_NAME.format(shard_index=shard_index, num_shards=num_shards)
@@ -12,7 +12,6 @@ from pathlib import Path
 from typing import List, Union
 
 import numpy as np
-import pandas as pd
 
 from scipy import ndimage
 
@@ -165,6 +164,8 @@ def load_wsi_files_from_csv(csv_path: Union[Path, str], wsi_extension: str) -> L
     Returns:
         List: List of WSI
     """
+    import pandas as pd
+
     wsi_filelist = pd.read_csv(csv_path)
     wsi_filelist = wsi_filelist["Filename"].to_list()
     wsi_filelist = [f for f in wsi_filelist if Path(f).suffix == f".{wsi_extension}"]
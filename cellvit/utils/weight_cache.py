@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Inference-only weight cache of the CellViT checkpoints
+#
+# The released checkpoints are training checkpoints (config, architecture, model weights and
+# possibly optimizer state). Loading one with torch.load reads the whole file into memory and
+# the model is initialized randomly before the weights are copied in, such that the peak memory
+# is about twice the model size. The checkpoint is converted once into an inference-only file
+# next to it (CACHE_DIR), with just the model weights (optionally in half precision). The
+# converted file is memory-mapped and the model is created on the meta device, the weights are
+# assigned without copying them (requires PyTorch >= 2.1).
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import inspect
+import logging
+import os
+from pathlib import Path
+from typing import Literal, Optional, Union
+
+import torch
+
+from cellvit.utils.logger import PrintLogger
+
+WEIGHT_CACHE_VERSION = 1
+WEIGHT_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+
+def weight_cache_supported() -> bool:
+    """Check if the installed PyTorch can memory-map files and assign weights (PyTorch >= 2.1)
+
+    Returns:
+        bool: True if torch.load supports mmap and load_state_dict supports assign
+    """
+    return (
+        "mmap" in inspect.signature(torch.load).parameters
+        and "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters
+    )
+
+
+def inference_weights_path(
+    checkpoint_path: Union[Path, str],
+    weight_dtype: Literal["float32", "float16", "bfloat16"] = "float32",
+) -> Path:
+    """Path of the inference-only weights of a checkpoint
+
+    Args:
+        checkpoint_path (Union[Path, str]): Path to the training checkpoint
+        weight_dtype (Literal["float32", "float16", "bfloat16"], optional): Dtype of the weights. Defaults to "float32".
+
+    Returns:
+        Path: Path to the converted weights (<checkpoint>-inference-<dtype>.pt)
+    """
+    checkpoint_path = Path(checkpoint_path)
+    return checkpoint_path.with_name(
+        f"{checkpoint_path.stem}-inference-{weight_dtype}.pt"
+    )
+
+
+def convert_checkpoint(
+    checkpoint_path: Union[Path, str],
+    output_path: Union[Path, str],
+    weight_dtype: Literal["float32", "float16", "bfloat16"] = "float32",
+) -> Path:
+    """Convert a training checkpoint into an inference-only weight file
+
+    Just the model weights, architecture and config are kept, floating point weights are cast to weight_dtype.
+    The file is written atomically, such that concurrent processes never load a partial file.
+
+    Args:
+        checkpoint_path (Union[Path, str]): Path to the training checkpoint
+        output_path (Union[Path, str]): Path of the converted weights
+        weight_dtype (Literal["float32", "float16", "bfloat16"], optional): Dtype of the weights. Defaults to "float32".
+
+    Returns:
+        Path: Path of the converted weights
+    """
+    assert weight_dtype in WEIGHT_DTYPES, f"Unknown weight dtype {weight_dtype}"
+    checkpoint_path, output_path = Path(checkpoint_path), Path(output_path)
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    state_dict = {
+        # clone, such that views do not store their complete storage
+        key: (
+            value.to(WEIGHT_DTYPES[weight_dtype]).clone()
+            if value.is_floating_point()
+            else value.clone()
+        )
+        for key, value in checkpoint["model_state_dict"].items()
+    }
+    converted = {
+        "version": WEIGHT_CACHE_VERSION,
+        "arch": checkpoint["arch"],
+        "config": checkpoint["config"],
+        "weight_dtype": weight_dtype,
+        "source": _source_info(checkpoint_path),
+        "model_state_dict": state_dict,
+    }
+    del checkpoint
+    tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+    try:
+        torch.save(converted, tmp_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return output_path
+
+
+def load_inference_weights(
+    checkpoint_path: Union[Path, str],
+    weight_dtype: Literal["float32", "float16", "bfloat16"] = "float32",
+    logger: Optional[logging.Logger] = None,
+) -> dict:
+    """Load the memory-mapped inference-only weights of a checkpoint, converting the checkpoint if necessary
+
+    The checkpoint is converted again if it has been replaced (different size or modification time).
+
+    Args:
+        checkpoint_path (Union[Path, str]): Path to the training checkpoint
+        weight_dtype (Literal["float32", "float16", "bfloat16"], optional): Dtype of the weights. Defaults to "float32".
+        logger (Optional[logging.Logger], optional): Logger. Defaults to None.
+
+    Returns:
+        dict: Converted checkpoint with keys
+            * arch: Model architecture
+            * config: Run configuration (flattened)
+            * weight_dtype: Dtype of the weights
+            * model_state_dict: Memory-mapped model weights
+    """
+    logger = logger or PrintLogger()
+    checkpoint_path = Path(checkpoint_path)
+    weights_path = inference_weights_path(checkpoint_path, weight_dtype)
+    if weights_path.exists():
+        weights = _load_mmap(weights_path)
+        if weights.get("version") == WEIGHT_CACHE_VERSION and weights.get(
+            "source"
+        ) == _source_info(checkpoint_path):
+            return weights
+        del weights
+        logger.info(f"Checkpoint has changed, converting {checkpoint_path.name} again")
+    else:
+        logger.info(
+            f"Converting {checkpoint_path.name} into inference weights ({weight_dtype}), just once"
+        )
+    convert_checkpoint(checkpoint_path, weights_path, weight_dtype)
+    return _load_mmap(weights_path)
+
+
+def _source_info(checkpoint_path: Path) -> dict:
+    """Identify the version of a checkpoint file by its name, size and modification time"""
+    stat = checkpoint_path.stat()
+    return {
+        "name": checkpoint_path.name,
+        "size": stat.st_size,
+        "mtime": int(stat.st_mtime),
+    }
+
+
+def _load_mmap(path: Path) -> dict:
+    """Load a file saved with torch.save memory-mapped"""
+    return torch.load(path, map_location="cpu", mmap=True)
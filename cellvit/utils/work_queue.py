@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# Work queue for processing a dataset with multiple processes
+#
+# SQLite database on a shared filesystem (e.g., outdir/work_queue.sqlite), any number of
+# processes on any number of nodes pull slides from it. A pulled slide is leased for
+# lease_timeout seconds, the lease is renewed by a heartbeat thread while the slide is
+# processed and its outputs are written. Leases of crashed processes expire and the slide is
+# handed out again. Failed slides are released and retried up to max_attempts times.
+# Slides are handed out largest first, such that the longest jobs do not end up last.
+#
+# The database uses the rollback journal instead of write-ahead logging, because WAL requires
+# shared memory and is therefore limited to processes on one host. Each lease is taken in an
+# exclusive (BEGIN IMMEDIATE) transaction, relying on the POSIX locks of the filesystem.
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import List, Tuple, Union
+
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS slides (
+    slide TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    wsi_mpp REAL,
+    wsi_magnification REAL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS slides_status ON slides (status, size);
+"""
+
+
+class WorkQueue:
+    def __init__(
+        self,
+        path: Union[Path, str],
+        lease_timeout: float = 600,
+        max_attempts: int = 3,
+    ) -> None:
+        """Queue of slides shared by multiple processes
+
+        Args:
+            path (Union[Path, str]): Path to the database (e.g., outdir/work_queue.sqlite)
+            lease_timeout (float, optional): Seconds after which the lease of a slide expires if it is not renewed. Defaults to 600.
+            max_attempts (int, optional): Number of leases per slide before it is marked as failed. Defaults to 3.
+
+        Attributes:
+            path (Path): Path to the database
+            lease_timeout (float): Seconds after which a lease expires
+            max_attempts (int): Number of leases per slide before it is marked as failed
+            owner (str): Unique id of this queue instance (host, pid and random suffix)
+            connection (sqlite3.Connection): Database connection
+            lock (threading.Lock): Lock serializing the access of threads
+        """
+        assert lease_timeout > 0, "Lease timeout must be greater than 0"
+        assert max_attempts > 0, "Max attempts must be greater than 0"
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.connection = sqlite3.connect(
+            str(self.path), timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.lock = threading.Lock()
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread = None
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=DELETE")
+            self.connection.executescript(QUEUE_SCHEMA)
+
+    def add(
+        self,
+        slides: List[Tuple[Union[Path, str], Union[float, None], Union[float, None]]],
+        logger: logging.Logger = None,
+    ) -> int:
+        """Add slides to the queue, slides already in the queue are ignored
+
+        All processes can add the same dataset, the first one fills the queue.
+        Slides that cannot be accessed (e.g., missing files) are skipped.
+
+        Args:
+            slides (List[Tuple[Union[Path, str], Union[float, None], Union[float, None]]]): Slide path, mpp and magnification override
+            logger (logging.Logger, optional): Logger for skipped slides. Defaults to None.
+
+        Returns:
+            int: Number of added slides
+        """
+        rows = []
+        for slide, wsi_mpp, wsi_magnification in slides:
+            try:
+                size = Path(slide).stat().st_size
+            except OSError as e:
+                if logger is not None:
+                    logger.error(f"Skipping {Path(slide).name}, not accessible: {e!r}")
+                continue
+            rows.append(
+                (
+                    str(Path(slide).resolve()),
+                    size,
+                    float(wsi_mpp) if wsi_mpp is not None else None,
+                    (
+                        float(wsi_magnification)
+                        if wsi_magnification is not None
+                        else None
+                    ),
+                )
+            )
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                num_before = self._count()
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO slides (slide, size, wsi_mpp, wsi_magnification) "
+                    "VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                num_added = self._count() - num_before
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return num_added
+
+    def lease(
+        self,
+    ) -> Union[Tuple[Path, Union[float, None], Union[float, None]], None]:
+        """Lease the largest pending slide (or a slide with an expired lease)
+
+        Returns:
+            Union[Tuple[Path, Union[float, None], Union[float, None]], None]: Slide path, mpp and magnification override.
+                None if no slide is left.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(
+                    "UPDATE slides SET status = 'failed', owner = NULL, error = 'Lease expired' "
+                    "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                    (now, self.max_attempts),
+                )
+                row = self.connection.execute(
+                    "SELECT slide, wsi_mpp, wsi_magnification FROM slides "
+                    "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                    "ORDER BY size DESC, slide LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is not None:
+                    self.connection.execute(
+                        "UPDATE slides SET status = 'leased', owner = ?, lease_expires = ?, "
+                        "attempts = attempts + 1 WHERE slide = ?",
+                        (self.owner, now + self.lease_timeout, row[0]),
+                    )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return Path(row[0]), row[1], row[2]
+
+    def heartbeat(self) -> int:
+        """Renew all leases of this queue instance
+
+        Returns:
+            int: Number of renewed leases
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                "UPDATE slides SET lease_expires = ? WHERE owner = ? AND status = 'leased'",
+                (time.time() + self.lease_timeout, self.owner),
+            )
+        return cursor.rowcount
+
+    def complete(self, slide: Union[Path, str]) -> None:
+        """Mark a slide as finished
+
+        Args:
+            slide (Union[Path, str]): Path to the slide
+        """
+        with self.lock:
+            self.connection.execute(
+                "UPDATE slides SET status = 'finished', owner = NULL, error = NULL WHERE slide = ?",
+                (str(Path(slide).resolve()),),
+            )
+
+    def release(
+        self, slide: Union[Path, str], error: str = None, retry: bool = True
+    ) -> None:
+        """Release the lease of a failed slide
+
+        The slide is handed out again, or marked as failed after max_attempts leases.
+        Leases taken over by another process (after expiry) are not changed.
+
+        Args:
+            slide (Union[Path, str]): Path to the slide
+            error (str, optional): Error message. Defaults to None.
+            retry (bool, optional): Hand out the slide again. Defaults to True (False marks it as failed).
+        """
+        max_attempts = self.max_attempts if retry else 0
+        with self.lock:
+            self.connection.execute(
+                "UPDATE slides SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "owner = NULL, error = ? WHERE slide = ? AND owner = ? AND status = 'leased'",
+                (max_attempts, error, str(Path(slide).resolve()), self.owner),
+            )
+
+    def progress(self) -> dict:
+        """Number of slides per status
+
+        Returns:
+            dict: Number of pending, leased, finished and failed slides
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT status, COUNT(*) FROM slides GROUP BY status"
+            ).fetchall()
+        progress = {"pending": 0, "leased": 0, "finished": 0, "failed": 0}
+        progress.update(dict(rows))
+        return progress
+
+    def start_heartbeat(self, interval: float = None) -> None:
+        """Renew the leases of this queue instance periodically in a daemon thread
+
+        Args:
+            interval (float, optional): Seconds between renewals. Defaults to None (a third of the lease timeout).
+        """
+        interval = self.lease_timeout / 3 if interval is None else interval
+        if self._heartbeat_thread is not None:
+            return
+        self._heartbeat_stop.clear()
+
+        def renew_leases() -> None:
+            while not self._heartbeat_stop.wait(interval):
+                self.heartbeat()
+
+        self._heartbeat_thread = threading.Thread(
+            target=renew_leases, name="work-queue-heartbeat", daemon=True
+        )
+        self._heartbeat_thread.start()
+
+    def stop_heartbeat(self) -> None:
+        """Stop renewing the leases"""
+        if self._heartbeat_thread is not None:
+            self._heartbeat_stop.set()
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
+    def close(self) -> None:
+        """Stop the heartbeat and close the database connection"""
+        self.stop_heartbeat()
+        with self.lock:
+            self.connection.close()
+
+    def _count(self) -> int:
+        """Number of slides in the queue (caller holds the lock)"""
+        return self.connection.execute("SELECT COUNT(*) FROM slides").fetchone()[0]
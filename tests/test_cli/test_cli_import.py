@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Test Import Time of the CLI
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+HEAVY_MODULES = [
+    "torch",
+    "torchvision",
+    "ray",
+    "pandas",
+    "shapely",
+    "pathopatch",
+    "snappy",
+    "cellvit.inference.inference",
+]
+
+# imports the CLI, parses and validates the arguments (or prints the help) in a fresh interpreter
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from cellvit.detect_cells import main
+from cellvit.inference.cli import InferenceWSIParser
+sys.argv = ["cellvit-inference"] + sys.argv[1:]
+try:
+    InferenceWSIParser().parse_arguments()
+except SystemExit:
+    pass
+print(json.dumps({"duration": time.perf_counter() - start, "modules": sorted(sys.modules)}))
+"""
+
+
+class TestCLIImport(unittest.TestCase):
+    # generous budget for slow CI machines, loading torch alone takes longer
+    IMPORT_BUDGET = 1.5
+
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.wsi_path = self.tmp_dir / "sample_wsi.svs"
+        self.wsi_path.touch()
+        self.cache_dir = self.tmp_dir / "cache"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _run_cli(self, *args: str) -> dict:
+        env = {**os.environ, "CELLVIT_CACHE": str(self.cache_dir)}
+        result = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT, *args],
+            capture_output=True,
+            text=True,
+            env=env,
+            timeout=120,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def test_help_without_heavy_imports(self):
+        """Test that the help message is shown without importing heavy dependencies."""
+        result = self._run_cli("--help")
+        self.assertEqual(
+            [module for module in HEAVY_MODULES if module in result["modules"]], []
+        )
+        self.assertLess(result["duration"], self.IMPORT_BUDGET)
+
+    def test_validation_without_heavy_imports(self):
+        """Test that a configuration is validated without heavy dependencies and side effects."""
+        result = self._run_cli(
+            "--model",
+            "HIPT",
+            "--gpu",
+            "0",
+            "--outdir",
+            str(self.tmp_dir / "output"),
+            "process_wsi",
+            "--wsi_path",
+            str(self.wsi_path),
+        )
+        self.assertEqual(
+            [module for module in HEAVY_MODULES if module in result["modules"]], []
+        )
+        self.assertLess(result["duration"], self.IMPORT_BUDGET)
+        self.assertFalse(self.cache_dir.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,9 +5,11 @@
 # Institute for Artifical Intelligence in Medicine,
 # University Medicine Essen
 
+import os
 import unittest
 
 from cellvit.inference.cli import InferenceConfiguration
+from cellvit.utils.ressource_manager import SystemConfiguration
 from pathlib import Path
 import pandas as pd
 from unittest.mock import patch
@@ -129,6 +131,42 @@ class TestInferenceConfiguration(unittest.TestCase):
             "Batch size must be between 2 and 48",
         )
 
+    @patch("torch.cuda.device_count")
+    def test_weight_cache(self, mock_device_count):
+        """Test configuration of the inference weight cache."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertTrue(config.weight_cache)
+        self.assertEqual(config.weight_dtype, "float32")
+
+        self.valid_config["inference"]["weight_cache"] = False
+        self.valid_config["inference"]["weight_dtype"] = "BFloat16"
+        config = InferenceConfiguration(self.valid_config)
+        self.assertFalse(config.weight_cache)
+        self.assertEqual(config.weight_dtype, "bfloat16")
+
+        self.valid_config["inference"]["weight_dtype"] = "int8"
+        with self.assertRaises(AssertionError):
+            InferenceConfiguration(self.valid_config)
+
+    @patch("torch.cuda.device_count")
+    def test_compile_model(self, mock_device_count):
+        """Test configuration of the model compilation and artifact cache."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertFalse(config.compile_model)
+        self.assertEqual(config.artifact_cache_size, 10240)
+
+        self.valid_config["inference"]["compile_model"] = True
+        self.valid_config["inference"]["artifact_cache_size"] = 512
+        config = InferenceConfiguration(self.valid_config)
+        self.assertTrue(config.compile_model)
+        self.assertEqual(config.artifact_cache_size, 512.0)
+
+        self.valid_config["inference"]["artifact_cache_size"] = 0
+        with self.assertRaises(AssertionError):
+            InferenceConfiguration(self.valid_config)
+
     @patch("torch.cuda.device_count")
     def test_invalid_cpu_count(self, mock_device_count):
         """Test configuration with missing output directory."""
@@ -218,41 +256,39 @@ class TestInferenceConfiguration(unittest.TestCase):
         config = InferenceConfiguration(valid_config)
         self.assertEqual(config.gpu, 3, "GPU should be 3")
 
-        # Invalid GPU ID: too high
-        invalid_config = self.valid_config.copy()
-        invalid_config["inference"]["gpu"] = 4  # Out of range (0-3)
-        with self.assertRaises(AssertionError) as context:
-            InferenceConfiguration(invalid_config)
-        self.assertIn(
-            "GPU must be between 0 and 3",
-            str(context.exception),
-            "GPU must be between 0 and 3",
-        )
+        # GPU ID too high: checked by the SystemConfiguration, CUDA is not initialized for validation
+        valid_config["inference"]["gpu"] = 4
+        config = InferenceConfiguration(valid_config)
+        self.assertEqual(config.gpu, 4, "GPU should be 4")
+        mock_device_count.assert_not_called()
 
         # Invalid GPU ID: negative
+        invalid_config = self.valid_config.copy()
         invalid_config["inference"]["gpu"] = -1
         with self.assertRaises(AssertionError) as context:
             InferenceConfiguration(invalid_config)
         self.assertIn(
-            "GPU must be between 0 and 3",
+            "GPU must be between 0 and",
             str(context.exception),
-            "GPU must be between 0 and 3",
+            "GPU must be between 0 and",
         )
 
-    @patch("torch.cuda.device_count")
-    def test_gpu_with_no_cuda(self, mock_device_count):
+    @patch("cellvit.utils.ressource_manager.get_cpu_resources")
+    @patch("cellvit.utils.ressource_manager.get_gpu_resources")
+    def test_gpu_with_no_cuda(self, mock_get_gpu_resources, mock_get_cpu_resources):
         """Test GPU setting when CUDA is not available."""
-        mock_device_count.return_value = 0  # Simulate no GPUs available
-        # Any GPU ID should fail since no GPUs are available
+        mock_get_cpu_resources.return_value = ((8, 16384), "server")
+        mock_get_gpu_resources.return_value = {
+            "has_gpu": False,
+            "gpu_count": 0,
+            "devices": {},
+        }
+        # configuration is valid, the system configuration fails since no GPUs are available
         invalid_config = self.valid_config.copy()
         invalid_config["inference"]["gpu"] = 0
-        with self.assertRaises(AssertionError) as context:
-            InferenceConfiguration(invalid_config)
-        self.assertEqual(
-            str(context.exception),
-            "GPU must be between 0 and -1",
-            "GPU must be between 0 and -1",
-        )
+        config = InferenceConfiguration(invalid_config)
+        with self.assertRaises(SystemError):
+            SystemConfiguration(gpu=config.gpu)
 
     def test_gpu_missing_config(self):
         """Test behavior when GPU config is missing."""
@@ -337,6 +373,81 @@ class TestInferenceConfiguration(unittest.TestCase):
         config = InferenceConfiguration(config_without_batch_size)
         self.assertEqual(config.batch_size, 8)  # Default value
 
+    @patch("torch.cuda.device_count")
+    def test_cell_cleaner_settings(self, mock_device_count):
+        """Test cell cleaner selection, default and invalid value."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.cell_cleaner, "polygon")  # Default value
+
+        self.valid_config["inference"]["cell_cleaner"] = "centroid"
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.cell_cleaner, "centroid")
+
+        self.valid_config["inference"]["cell_cleaner"] = "kdtree"
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception),
+            "Cell cleaner must be either 'polygon' or 'centroid'",
+        )
+
+    @patch("torch.cuda.device_count")
+    def test_cell_cleaner_strategy(self, mock_device_count):
+        """Test merge strategy and radius of the centroid cell cleaner, default and invalid values."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.cell_cleaner_strategy, "area")  # Default value
+        self.assertEqual(config.cell_cleaner_radius, 6.0)  # Default value
+
+        self.valid_config["inference"]["cell_cleaner"] = "centroid"
+        self.valid_config["inference"]["cell_cleaner_strategy"] = "Probability"
+        self.valid_config["inference"]["cell_cleaner_radius"] = 4
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config["cell_cleaner_strategy"], "probability")
+        self.assertEqual(config["cell_cleaner_radius"], 4.0)
+
+        self.valid_config["inference"]["cell_cleaner_strategy"] = "mean"
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception),
+            "Cell cleaner strategy must be either 'area' or 'probability'",
+        )
+
+        self.valid_config["inference"]["cell_cleaner_strategy"] = 1
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception), "Cell cleaner strategy must be of type string"
+        )
+
+        self.valid_config["inference"]["cell_cleaner_strategy"] = "area"
+        self.valid_config["inference"]["cell_cleaner_radius"] = 0
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception), "Cell cleaner radius must be a positive number"
+        )
+
+    @patch("torch.cuda.device_count")
+    def test_cleaning_workers(self, mock_device_count):
+        """Test number of parallel cleaning workers, default and invalid value."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.cleaning_workers, 0)  # Default value
+
+        self.valid_config["inference"]["cleaning_workers"] = 4
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config["cleaning_workers"], 4)
+
+        self.valid_config["inference"]["cleaning_workers"] = -1
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception), "Cleaning workers must be a non-negative integer"
+        )
+
     @patch("torch.cuda.device_count")
     def test_output_format_options(self, mock_device_count):
         """Test different output format options."""
@@ -365,6 +476,312 @@ class TestInferenceConfiguration(unittest.TestCase):
         config = InferenceConfiguration(config_compression_false)
         self.assertFalse(config.compression)
 
+    @patch("torch.cuda.device_count")
+    def test_compression_settings(self, mock_device_count):
+        """Test compression codec, level and threads."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.compression_codec, "snappy")  # Default value
+        self.assertEqual(config.compression_level, 3)
+        self.assertEqual(config.compression_threads, 0)
+
+        self.valid_config["output_format"]["compression_codec"] = "zstd"
+        self.valid_config["output_format"]["compression_level"] = 19
+        self.valid_config["output_format"]["compression_threads"] = 4
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.compression_codec, "zstd")
+        self.assertEqual(config.compression_level, 19)
+        self.assertEqual(config.compression_threads, 4)
+
+        with patch("cellvit.inference.cli.check_module", return_value=False):
+            with self.assertRaises(AssertionError) as context:
+                InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception),
+            "Compression codec 'zstd' requires zstandard. Install it with: pip install cellvit[zstd]",
+        )
+
+        self.valid_config["output_format"]["compression_codec"] = "gzip"
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception),
+            "Compression codec must be one of 'snappy' or 'zstd'",
+        )
+
+    @patch("torch.cuda.device_count")
+    def test_background_writer(self, mock_device_count):
+        """Test background writer flag."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertFalse(config.background_writer)  # Default value
+
+        self.valid_config["output_format"]["background_writer"] = True
+        config = InferenceConfiguration(self.valid_config)
+        self.assertTrue(config.background_writer)
+
+        self.valid_config["output_format"]["background_writer"] = "yes"
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception), "Background writer must be of type boolean"
+        )
+
+    @patch("torch.cuda.device_count")
+    def test_spatial_index(self, mock_device_count):
+        """Test spatial index flag."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertFalse(config.spatial_index)  # Default value
+
+        self.valid_config["output_format"]["spatial_index"] = True
+        config = InferenceConfiguration(self.valid_config)
+        self.assertTrue(config.spatial_index)
+
+        self.valid_config["output_format"]["spatial_index"] = 1
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception), "Spatial index must be of type boolean"
+        )
+
+    @patch("torch.cuda.device_count")
+    def test_tile_size(self, mock_device_count):
+        """Test tile size for the tiled output."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertIsNone(config.tile_size)  # Default value
+
+        self.valid_config["output_format"]["tile_size"] = 4096
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.tile_size, 4096)
+
+        self.valid_config["output_format"]["tile_size"] = 128
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(str(context.exception), "Tile size must be at least 256")
+
+    @patch("torch.cuda.device_count")
+    def test_graph_storage(self, mock_device_count):
+        """Test graph format and token dtype, default and invalid values."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.graph_format, "pt")  # Default value
+        self.assertEqual(config.graph_dtype, "float32")  # Default value
+
+        self.valid_config["output_format"]["graph_format"] = "mmap"
+        self.valid_config["output_format"]["graph_dtype"] = "float16"
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.graph_format, "mmap")
+        self.assertEqual(config.graph_dtype, "float16")
+
+        self.valid_config["output_format"]["graph_format"] = "h5"
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception), "Graph format must be one of 'pt' or 'mmap'"
+        )
+
+        self.valid_config["output_format"]["graph_format"] = "mmap"
+        self.valid_config["output_format"]["graph_dtype"] = "bfloat16"
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception),
+            "Graph dtype must be one of 'float32' or 'float16'",
+        )
+
+        self.valid_config["output_format"]["graph_dtype"] = 16
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(str(context.exception), "Graph dtype must be of type string")
+
+        self.valid_config["output_format"]["graph_dtype"] = "float16"
+        self.valid_config["output_format"]["graph_format"] = 1
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(str(context.exception), "Graph format must be of type string")
+
+    @patch("torch.cuda.device_count")
+    def test_graph_edges(self, mock_device_count):
+        """Test graph edge settings, default and invalid values."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertIsNone(config.graph_edges)  # Default value
+        self.assertEqual(config.graph_edge_k, 8)  # Default value
+
+        self.valid_config["output_format"]["graph_edges"] = "knn"
+        self.valid_config["output_format"]["graph_edge_k"] = 6
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.graph_edges, "knn")
+        self.assertEqual(config.graph_edge_k, 6)
+
+        self.valid_config["output_format"]["graph_edges"] = "radius"
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception),
+            "Graph edge radius must be provided for radius graphs",
+        )
+
+        self.valid_config["output_format"]["graph_edge_radius"] = 80
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.graph_edge_radius, 80.0)
+
+        self.valid_config["output_format"]["graph_edges"] = "voronoi"
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception),
+            "Graph edges must be one of 'knn', 'radius' or 'delaunay'",
+        )
+
+        self.valid_config["output_format"]["graph_edges"] = 5
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(str(context.exception), "Graph edges must be of type string")
+
+    @patch("torch.cuda.device_count")
+    def test_detection_only(self, mock_device_count):
+        """Test detection only flag, which implies the centroid cell cleaner."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertFalse(config.detection_only)  # Default value
+
+        self.valid_config["output_format"]["detection_only"] = True
+        config = InferenceConfiguration(self.valid_config)
+        self.assertTrue(config.detection_only)
+        self.assertEqual(config.cell_cleaner, "centroid")
+
+        self.valid_config["output_format"]["detection_only"] = "yes"
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception), "Detection only must be of type boolean"
+        )
+
+    @patch("torch.cuda.device_count")
+    def test_detection_engine(self, mock_device_count):
+        """Test detection engine and validation interval, peaks imply detection only."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.detection_engine, "watershed")  # Default value
+        self.assertEqual(config.detection_validation_interval, 0)
+
+        self.valid_config["inference"]["detection_engine"] = "Peaks"
+        self.valid_config["inference"]["detection_validation_interval"] = 10
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.detection_engine, "peaks")
+        self.assertEqual(config.detection_validation_interval, 10)
+        self.assertTrue(config.detection_only)
+        self.assertEqual(config.cell_cleaner, "centroid")
+
+        self.valid_config["inference"]["detection_validation_interval"] = -1
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception),
+            "Detection validation interval must be greater or equal to 0",
+        )
+
+        self.valid_config["inference"]["detection_engine"] = "maxima"
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception),
+            "Detection engine must be either 'watershed' or 'peaks'",
+        )
+
+    @patch("torch.cuda.device_count")
+    def test_instance_map(self, mock_device_count):
+        """Test instance map export, levels and the exclusion of the peak detection engine."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertFalse(config.instance_map)  # Default value
+        self.assertEqual(config.instance_map_levels, 4)
+
+        self.valid_config["output_format"]["instance_map"] = True
+        self.valid_config["output_format"]["instance_map_levels"] = 2
+        config = InferenceConfiguration(self.valid_config)
+        self.assertTrue(config.instance_map)
+        self.assertEqual(config.instance_map_levels, 2)
+
+        self.valid_config["output_format"]["instance_map_levels"] = 0
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception), "Instance map levels must be at least 1"
+        )
+
+        self.valid_config["output_format"]["instance_map_levels"] = 4
+        self.valid_config["inference"]["detection_engine"] = "peaks"
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception),
+            "Instance map export is not available for the peak detection engine",
+        )
+
+    @patch("torch.cuda.device_count")
+    def test_contour_encoding(self, mock_device_count):
+        """Test contour encoding, precision and tolerance."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertFalse(config.contour_encoding)  # Default value
+        self.assertEqual(config.contour_precision, 1.0)
+        self.assertEqual(config.contour_tolerance, 0.0)
+
+        self.valid_config["output_format"]["contour_encoding"] = True
+        self.valid_config["output_format"]["contour_precision"] = 0.5
+        self.valid_config["output_format"]["contour_tolerance"] = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertTrue(config.contour_encoding)
+        self.assertEqual(config.contour_precision, 0.5)
+        self.assertEqual(config.contour_tolerance, 1.0)
+
+        self.valid_config["output_format"]["contour_precision"] = 0
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception), "Contour precision must be greater than 0"
+        )
+
+        self.valid_config["output_format"]["contour_precision"] = 1.0
+        self.valid_config["output_format"]["contour_tolerance"] = -1.0
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception), "Contour tolerance must be greater or equal to 0"
+        )
+
+    @patch("torch.cuda.device_count")
+    def test_file_format(self, mock_device_count):
+        """Test file format selection, default and invalid value."""
+        mock_device_count.return_value = 1
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.file_format, "json")  # Default value
+
+        self.valid_config["output_format"]["file_format"] = "Arrow"
+        config = InferenceConfiguration(self.valid_config)
+        self.assertEqual(config.file_format, "arrow")
+
+        self.valid_config["output_format"]["file_format"] = "parquet"
+        with patch("cellvit.inference.cli.check_module", return_value=False):
+            with self.assertRaises(AssertionError) as context:
+                InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception),
+            "File format 'parquet' requires pyarrow. Install it with: pip install cellvit[columnar]",
+        )
+
+        self.valid_config["output_format"]["file_format"] = "csv"
+        with self.assertRaises(AssertionError) as context:
+            InferenceConfiguration(self.valid_config)
+        self.assertEqual(
+            str(context.exception),
+            "File format must be one of 'json', 'arrow' or 'parquet'",
+        )
+
     @patch("torch.cuda.device_count")
     def test_default_output_format_options(self, mock_device_count):
         """Test default output format options when not provided."""
@@ -411,11 +828,71 @@ class TestInferenceConfiguration(unittest.TestCase):
             config_with_dataset["process_dataset"] = {
                 "wsi_folder": str(dataset_dir),
                 "wsi_extension": "svs",
+                "skip_failed": True,
+                "work_queue": True,
+                "lease_timeout": 120,
+                "pack_slides": 8,
+                "parallel_slides": 4,
             }
 
             config = InferenceConfiguration(config_with_dataset)
             self.assertEqual(config.wsi_folder, dataset_dir)
             self.assertEqual(config.wsi_extension, "svs")
+            self.assertTrue(config.skip_failed)
+            self.assertTrue(config.work_queue)
+            self.assertEqual(config.lease_timeout, 120)
+            self.assertEqual(config.pack_slides, 8)
+            self.assertEqual(config.parallel_slides, 4)
+
+            config_with_dataset["process_dataset"]["lease_timeout"] = 0
+            with self.assertRaises(AssertionError):
+                InferenceConfiguration(config_with_dataset)
+            config_with_dataset["process_dataset"]["lease_timeout"] = 120
+            config_with_dataset["process_dataset"]["pack_slides"] = 0
+            with self.assertRaises(AssertionError):
+                InferenceConfiguration(config_with_dataset)
+            del config_with_dataset["process_dataset"]["pack_slides"]
+            config_with_dataset["process_dataset"]["parallel_slides"] = 0
+            with self.assertRaises(AssertionError):
+                InferenceConfiguration(config_with_dataset)
+            del config_with_dataset["process_dataset"]["parallel_slides"]
+
+            # sharding, explicit or from the job array environment
+            del config_with_dataset["process_dataset"]["lease_timeout"]
+            config_with_dataset["process_dataset"]["shard_index"] = 1
+            with self.assertRaises(AssertionError):
+                InferenceConfiguration(config_with_dataset)  # with work queue
+            config_with_dataset["process_dataset"]["work_queue"] = False
+            with patch.dict(os.environ, {}, clear=True):
+                with self.assertRaises(AssertionError):
+                    InferenceConfiguration(config_with_dataset)  # num_shards missing
+                config_with_dataset["process_dataset"]["num_shards"] = 4
+                config = InferenceConfiguration(config_with_dataset)
+                self.assertEqual((config.shard_index, config.num_shards), (1, 4))
+                config_with_dataset["process_dataset"]["shard_index"] = 4
+                with self.assertRaises(AssertionError):
+                    InferenceConfiguration(config_with_dataset)
+            del config_with_dataset["process_dataset"]["shard_index"]
+            del config_with_dataset["process_dataset"]["num_shards"]
+            with patch.dict(
+                os.environ,
+                {"SLURM_ARRAY_TASK_ID": "2", "SLURM_ARRAY_TASK_COUNT": "8"},
+                clear=True,
+            ):
+                config = InferenceConfiguration(config_with_dataset)
+                self.assertEqual((config.shard_index, config.num_shards), (2, 8))
+            with patch.dict(os.environ, {"JOB_COMPLETION_INDEX": "3"}, clear=True):
+                with self.assertLogs("cellvit.inference.cli", level="WARNING"):
+                    config = InferenceConfiguration(config_with_dataset)
+                self.assertIsNone(config.shard_index)
+                self.assertIsNone(config.num_shards)
+                config_with_dataset["process_dataset"]["num_shards"] = 5
+                config = InferenceConfiguration(config_with_dataset)
+                self.assertEqual((config.shard_index, config.num_shards), (3, 5))
+            del config_with_dataset["process_dataset"]["num_shards"]
+            with patch.dict(os.environ, {}, clear=True):
+                config = InferenceConfiguration(config_with_dataset)
+                self.assertIsNone(config.num_shards)
             self.assertIsNone(config.wsi_path)
         finally:
             # Aufräumen
@@ -439,6 +916,8 @@ class TestInferenceConfiguration(unittest.TestCase):
 
             config = InferenceConfiguration(config_with_filelist)
             self.assertIsNone(config.wsi_path)  # Sollte kein wsi_path haben
+            self.assertFalse(config.skip_failed)  # Default value
+            self.assertFalse(config.work_queue)
         finally:
             # Aufräumen
             if csv_path.exists():
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Test Batch Packing
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import unittest
+
+import torch
+
+from cellvit.inference.batch_packing import PackedBatch, SlideBatchPacker
+
+
+class FakeDataloader:
+    """Dataloader with the interface of LivePatchWSIDataloader, patches in discard are skipped"""
+
+    def __init__(self, slide_id: int, num_patches: int, discard: set = None):
+        self.slide_id = slide_id
+        self.dataset = list(range(num_patches))
+        self.discard = set() if discard is None else discard
+        self.batch_size = 4
+        self.element_list = list(range(num_patches))
+        self.i = 0
+
+    def __iter__(self):
+        self.i = 0
+        return self
+
+    def __next__(self):
+        if self.i >= len(self.element_list):
+            raise StopIteration
+        patches, metadata = [], []
+        while len(metadata) < self.batch_size and self.i < len(self.element_list):
+            idx = self.element_list[self.i]
+            self.i += 1
+            if idx in self.discard:
+                continue
+            patches.append(torch.full((3, 2, 2), float(self.slide_id)))
+            metadata.append({"row": idx, "col": self.slide_id})
+        if len(patches) > 0:
+            patches = torch.stack(patches)
+        return patches, metadata, []
+
+
+class TestSlideBatchPacker(unittest.TestCase):
+    def _packer(self, dataloaders, batch_size):
+        patch_coordinates = [
+            [(idx, dataloader.slide_id) for idx in dataloader.element_list]
+            for dataloader in dataloaders
+        ]
+        return SlideBatchPacker(dataloaders, patch_coordinates, batch_size)
+
+    def test_full_batches(self):
+        """Test that the patches of multiple slides fill the batches completely."""
+        dataloaders = [FakeDataloader(0, 3), FakeDataloader(1, 6), FakeDataloader(2, 2)]
+        packer = self._packer(dataloaders, batch_size=4)
+        batches = list(packer)
+
+        self.assertEqual(len(packer), 3)
+        self.assertEqual([len(b.metadata) for b in batches], [4, 4, 3])
+        self.assertEqual(batches[0].slide_indices, [0, 0, 0, 1])
+        self.assertEqual(
+            batches[0].slide_slices(), [(0, slice(0, 3)), (1, slice(3, 4))]
+        )
+        self.assertEqual(batches[0].finished, [0])
+        self.assertEqual(batches[1].finished, [])
+        self.assertEqual(batches[2].finished, [1, 2])
+        self.assertEqual(
+            batches[2].slide_slices(), [(1, slice(0, 1)), (2, slice(1, 3))]
+        )
+        for batch in batches:
+            self.assertEqual(batch.patches.shape[0], len(batch.metadata))
+            self.assertTrue(
+                torch.all(
+                    batch.patches[:, 0, 0, 0] == torch.tensor(batch.slide_indices)
+                )
+            )
+
+        # all patches in the order of the slides
+        patches = [
+            (meta["col"], meta["row"]) for batch in batches for meta in batch.metadata
+        ]
+        self.assertEqual(
+            patches, [(s, i) for s, n in enumerate([3, 6, 2]) for i in range(n)]
+        )
+
+    def test_discarded_patches(self):
+        """Test that skipped patches are reported for their slide, also for slides without patches."""
+        dataloaders = [
+            FakeDataloader(0, 4, discard={1, 3}),
+            FakeDataloader(1, 2, discard={0, 1}),
+            FakeDataloader(2, 0),
+            FakeDataloader(3, 3),
+        ]
+        batches = list(self._packer(dataloaders, batch_size=4))
+
+        discarded = {}
+        finished = []
+        for batch in batches:
+            for slide_idx, coords in batch.discarded.items():
+                discarded.setdefault(slide_idx, []).extend(coords)
+            finished.extend(batch.finished)
+        self.assertEqual(discarded, {0: [(1, 0), (3, 0)], 1: [(0, 1), (1, 1)]})
+        self.assertEqual(finished, [0, 1, 2, 3])
+        self.assertEqual(sum(len(b.metadata) for b in batches), 5)
+        self.assertTrue(all(len(b.metadata) <= 4 for b in batches))
+
+    def test_empty_batch(self):
+        """Test that a batch without patches has an empty patch list."""
+        batches = list(
+            self._packer([FakeDataloader(0, 2, discard={0, 1})], batch_size=4)
+        )
+        self.assertEqual(len(batches), 1)
+        self.assertIsInstance(batches[0], PackedBatch)
+        self.assertEqual(batches[0].patches, [])
+        self.assertEqual(batches[0].slide_slices(), [])
+        self.assertEqual(batches[0].discarded, {0: [(0, 0), (1, 0)]})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# Test Centroid Cell Cleaner
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import unittest
+
+from cellvit.inference.centroid_cell_cleaner import CentroidCellCleaner
+from cellvit.inference.inference import CellViTInference
+from cellvit.utils.logger import NullLogger
+
+
+def make_cell(
+    centroid,
+    patch_coordinates,
+    cell_status=1,
+    size=10,
+    type_prob=0.9,
+    edge_patches=None,
+    edge_position=False,
+):
+    """Cell with a square bounding box around the centroid"""
+    x, y = centroid
+    return {
+        "bbox": [[y - size / 2, x - size / 2], [y + size / 2, x + size / 2]],
+        "centroid": [x, y],
+        "type_prob": type_prob,
+        "patch_coordinates": patch_coordinates,
+        "cell_status": cell_status,
+        "edge_position": edge_position,
+        "edge_information": {"position": None, "edge_patches": edge_patches},
+    }
+
+
+class TestCentroidCellCleaner(unittest.TestCase):
+    def setUp(self):
+        self.logger = NullLogger()
+        self.cell_list = [
+            # 0: mid cell, always kept
+            make_cell((100, 100), [0, 0], cell_status=0),
+            # 1, 2: same nucleus detected in two neighbouring patches
+            make_cell((970, 500), [0, 0], size=10, type_prob=0.95),
+            make_cell((972, 501), [0, 1], size=12, type_prob=0.80),
+            # 3: margin cell without duplicate
+            make_cell((990, 300), [0, 1]),
+            # 4: close to 2, but from the same patch, is never merged
+            make_cell((972, 506), [0, 1]),
+            # 5: edge cell with an existing neighbouring patch, is removed
+            make_cell(
+                (1020, 700),
+                [0, 0],
+                edge_patches=[[0, 1]],
+                edge_position=True,
+            ),
+            # 6: edge cell without neighbouring patch, is kept
+            make_cell(
+                (40, 700),
+                [0, 0],
+                edge_patches=[[-1, 0]],
+                edge_position=True,
+            ),
+        ]
+
+    def test_area_merge_strategy(self):
+        """Test that the duplicate with the larger bounding box is kept."""
+        cleaner = CentroidCellCleaner(self.cell_list, self.logger)
+        keep_idx = cleaner.clean_detected_cells()
+        self.assertEqual(keep_idx, [0, 2, 3, 4, 6])
+
+    def test_probability_merge_strategy(self):
+        """Test that the duplicate with the higher type probability is kept."""
+        cleaner = CentroidCellCleaner(
+            self.cell_list, self.logger, merge_strategy="probability"
+        )
+        keep_idx = cleaner.clean_detected_cells()
+        self.assertEqual(keep_idx, [0, 1, 3, 4, 6])
+
+    def test_radius(self):
+        """Test that no cells are merged if the radius is too small."""
+        cleaner = CentroidCellCleaner(self.cell_list, self.logger, radius=1.0)
+        keep_idx = cleaner.clean_detected_cells()
+        self.assertEqual(keep_idx, [0, 1, 2, 3, 4, 6])
+
+    def test_pipeline_settings(self):
+        """Test that the pipeline passes the merge strategy and radius to the cleaner."""
+        celldetector = CellViTInference.__new__(CellViTInference)
+        celldetector.logger = self.logger
+        celldetector.cell_cleaner = "centroid"
+        celldetector.cell_cleaner_strategy = "probability"
+        celldetector.cell_cleaner_radius = 6.0
+        self.assertEqual(
+            celldetector._post_process_edge_cells(self.cell_list), [0, 1, 3, 4, 6]
+        )
+        celldetector.cell_cleaner_radius = 1.0
+        self.assertEqual(
+            celldetector._post_process_edge_cells(self.cell_list), [0, 1, 2, 3, 4, 6]
+        )
+
+    def test_only_mid_cells(self):
+        """Test that mid cells are returned unchanged."""
+        cell_list = [make_cell((10 * i, 10), [0, 0], cell_status=0) for i in range(5)]
+        cleaner = CentroidCellCleaner(cell_list, self.logger)
+        self.assertEqual(cleaner.clean_detected_cells(), [0, 1, 2, 3, 4])
+
+    def test_invalid_arguments(self):
+        """Test invalid radius, merge strategy and missing keys."""
+        with self.assertRaises(AssertionError):
+            CentroidCellCleaner(self.cell_list, self.logger, radius=0)
+        with self.assertRaises(AssertionError):
+            CentroidCellCleaner(self.cell_list, self.logger, merge_strategy="mean")
+        with self.assertRaises(AssertionError):
+            CentroidCellCleaner([{"bbox": [[0, 0], [1, 1]]}], self.logger)
+
+
+if __name__ == "__main__":
+    unittest.main()
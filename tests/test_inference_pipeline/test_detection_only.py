@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Test Detection-Only Postprocessing
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+from skimage.draw import ellipse
+
+from cellvit.inference.postprocessing_numpy import DetectionCellPostProcessor
+from cellvit.utils.tools import remap_label
+
+
+class TestDetectionOnly(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        pred_inst = np.zeros((512, 512), dtype=np.int32)
+        pred_type = np.zeros((512, 512), dtype=np.int32)
+        for inst_id in range(1, 151):
+            row, col = rng.integers(10, 502, size=2)
+            r_radius, c_radius = rng.integers(3, 10, size=2)
+            rr, cc = ellipse(row, col, r_radius, c_radius, shape=pred_inst.shape)
+            pred_inst[rr, cc] = inst_id
+            pred_type[rr, cc] = rng.integers(0, 6)
+            # mixed types, partially background
+            split = len(rr) // 3
+            pred_type[rr[:split], cc[:split]] = rng.integers(0, 6)
+        # thin instance without valid contour
+        pred_inst[0, 100:120] = 151
+        self.pred_inst = remap_label(pred_inst)
+        self.pred_type = pred_type
+        self.postprocessor = DetectionCellPostProcessor(
+            wsi=None, nr_types=6, detection_only=True
+        )
+
+    def test_equal_to_contour_cells(self):
+        """Test that bbox, centroid and type match the contour-based cell dictionary."""
+        cells = self.postprocessor._create_cell_dict(self.pred_inst, self.pred_type)
+        detections = self.postprocessor._create_detection_dict(
+            self.pred_inst, self.pred_type
+        )
+        self.assertEqual(set(cells.keys()), set(detections.keys()))
+        for inst_id, cell in cells.items():
+            detection = detections[inst_id]
+            self.assertNotIn("contour", detection)
+            np.testing.assert_array_equal(cell["bbox"], detection["bbox"])
+            np.testing.assert_allclose(cell["centroid"], detection["centroid"])
+            self.assertEqual(cell["type"], detection["type"])
+            self.assertAlmostEqual(cell["type_prob"], detection["type_prob"])
+
+    def test_degenerate_instances(self):
+        """Test that instances without a valid contour are skipped like in the contour-based path."""
+        pred_inst = np.zeros((32, 32), dtype=np.int32)
+        pred_inst[2, 2] = 1  # single pixel
+        pred_inst[5, 2:10] = 2  # horizontal line
+        pred_inst[[10, 11], [2, 3]] = 3  # short diagonal line
+        pred_inst[[14, 15, 16, 17], [9, 8, 7, 6]] = 4  # anti-diagonal line
+        pred_inst[[20, 20, 21], [2, 3, 2]] = 5  # corner, valid contour
+        pred_inst[25:30, 20:26] = 6
+        pred_type = (pred_inst > 0).astype(np.int32)
+
+        cells = self.postprocessor._create_cell_dict(pred_inst, pred_type)
+        detections = self.postprocessor._create_detection_dict(pred_inst, pred_type)
+        self.assertEqual(set(cells.keys()), {5, 6})
+        self.assertEqual(set(detections.keys()), set(cells.keys()))
+
+    def test_post_process_single_image(self):
+        """Test that detection_only skips contour extraction."""
+        num_cells = len(
+            self.postprocessor._create_cell_dict(self.pred_inst, self.pred_type)
+        )
+        get_pred_inst = patch.object(
+            self.postprocessor,
+            "_get_pred_inst_tensor",
+            return_value=(self.pred_inst, self.pred_type),
+        )
+        get_contour = patch.object(self.postprocessor, "_get_instance_centroid_contour")
+        with get_pred_inst, get_contour as contour_extraction:
+            _, cells = self.postprocessor.post_process_single_image(None)
+        contour_extraction.assert_not_called()
+        self.assertEqual(len(cells), num_cells)
+        self.assertTrue(all("contour" not in c for c in cells.values()))
+
+    def test_empty(self):
+        """Test instance map without cells."""
+        detections = self.postprocessor._create_detection_dict(
+            np.zeros((64, 64), dtype=np.int32), np.zeros((64, 64), dtype=np.int32)
+        )
+        self.assertEqual(detections, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
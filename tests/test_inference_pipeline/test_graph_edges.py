@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# Test Graph Edge Construction
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import unittest
+
+import numpy as np
+import torch
+from scipy.spatial import distance_matrix
+
+from cellvit.inference.graph_edges import build_edges
+
+
+class TestGraphEdges(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        self.positions = torch.from_numpy(rng.uniform(0, 1000, size=(300, 2)))
+        self.distances = distance_matrix(self.positions, self.positions)
+        np.fill_diagonal(self.distances, np.inf)
+
+    def _edge_set(self, edge_index: torch.Tensor) -> set:
+        return set(map(tuple, edge_index.T.tolist()))
+
+    def test_knn(self):
+        """Test that each cell is connected to its k nearest neighbors (chunked query)."""
+        edge_index, edge_attr = build_edges(
+            self.positions, method="knn", k=5, chunk_size=64
+        )
+        self.assertEqual(edge_index.shape, (2, 300 * 5))
+        self.assertEqual(edge_attr.shape, (300 * 5, 1))
+        expected = {
+            (int(source), target)
+            for target in range(300)
+            for source in np.argsort(self.distances[target])[:5]
+        }
+        self.assertEqual(self._edge_set(edge_index), expected)
+        self.assertTrue(
+            np.allclose(
+                edge_attr[:, 0].numpy(),
+                self.distances[edge_index[0], edge_index[1]],
+                atol=1e-3,
+            )
+        )
+
+    def test_radius(self):
+        """Test radius graph with a maximum number of neighbors."""
+        edge_index, edge_attr = build_edges(
+            self.positions, method="radius", k=300, radius=60.0, chunk_size=64
+        )
+        source, target = np.nonzero(self.distances <= 60.0)
+        self.assertEqual(self._edge_set(edge_index), set(zip(source, target)))
+
+        edge_index, edge_attr = build_edges(
+            self.positions, method="radius", k=2, radius=60.0
+        )
+        self.assertTrue(np.all(np.bincount(edge_index[1], minlength=300) <= 2))
+        self.assertTrue(torch.all(edge_attr <= 60.0))
+
+    def test_delaunay(self):
+        """Test that Delaunay edges are symmetric and contain the nearest neighbor of each cell."""
+        edge_index, edge_attr = build_edges(self.positions, method="delaunay")
+        edges = self._edge_set(edge_index)
+        self.assertEqual(edges, {(t, s) for s, t in edges})
+        nearest = np.argmin(self.distances, axis=1)
+        self.assertTrue(all((int(n), i) in edges for i, n in enumerate(nearest)))
+
+        edge_index, edge_attr = build_edges(
+            self.positions, method="delaunay", radius=50.0
+        )
+        self.assertTrue(torch.all(edge_attr <= 50.0))
+
+    def test_degenerate(self):
+        """Test graphs without cells, with a single cell and with collinear cells."""
+        for num_cells in [0, 1]:
+            edge_index, edge_attr = build_edges(torch.zeros((num_cells, 2)), "knn")
+            self.assertEqual(edge_index.shape, (2, 0))
+            self.assertEqual(edge_attr.shape, (0, 1))
+        line = torch.tensor([[0.0, 0.0], [10.0, 0.0], [20.0, 0.0], [30.0, 0.0]])
+        edge_index, _ = build_edges(line, "delaunay")
+        self.assertIn((1, 0), self._edge_set(edge_index))
+
+    def test_invalid(self):
+        """Test invalid method and missing radius."""
+        with self.assertRaises(AssertionError):
+            build_edges(self.positions, method="voronoi")
+        with self.assertRaises(AssertionError):
+            build_edges(self.positions, method="radius")
+
+
+if __name__ == "__main__":
+    unittest.main()
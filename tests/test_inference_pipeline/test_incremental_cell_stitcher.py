@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+# Test Incremental Cell Stitcher
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import itertools
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import torch
+
+from cellvit.inference.batch_packing import SlideInferenceState
+from cellvit.inference.centroid_cell_cleaner import CentroidCellCleaner
+from cellvit.inference.incremental_cell_stitcher import (
+    IncrementalCellStitcher,
+    get_overlap_components,
+)
+from cellvit.inference.inference import CellViTInference
+from cellvit.utils.logger import NullLogger
+
+PATCH_SIZE = 1024
+OVERLAP = 64
+STRIDE = PATCH_SIZE - OVERLAP
+
+
+def detect_cells(patch, centroids, rng):
+    """Simulate the detections of one patch, cells in the overlap get status 1"""
+    row, col = patch
+    x_start, y_start = col * STRIDE, row * STRIDE
+    cells = []
+    for cell_id, (x, y) in enumerate(centroids):
+        local_x, local_y = x - x_start, y - y_start
+        if not (8 <= local_x < PATCH_SIZE - 8 and 8 <= local_y < PATCH_SIZE - 8):
+            continue
+        in_mid = OVERLAP <= min(
+            local_x, local_y, PATCH_SIZE - local_x, PATCH_SIZE - local_y
+        )
+        x, y = x + rng.uniform(-1, 1), y + rng.uniform(-1, 1)
+        cells.append(
+            {
+                "bbox": [[y - 5, x - 5], [y + 5, x + 5]],
+                "centroid": [x, y],
+                "type_prob": rng.uniform(),
+                "type": 1,
+                "patch_coordinates": [row, col],
+                "cell_status": 0 if in_mid else 1,
+                "edge_position": False,
+                "edge_information": {"position": None, "edge_patches": None},
+                "cell_id": cell_id,
+            }
+        )
+    return cells
+
+
+def to_batch_results(cells):
+    """Batch results (cells, detections, tokens, positions) of the given cells"""
+    detections = [{"centroid": c["centroid"], "type": c["type"]} for c in cells]
+    tokens = [torch.zeros(4) for _ in cells]
+    positions = [torch.tensor(c["centroid"]) for c in cells]
+    return cells, detections, tokens, positions
+
+
+def clean(cell_list):
+    """Clean cells with the centroid cleaner"""
+    return CentroidCellCleaner(cell_list, NullLogger()).clean_detected_cells()
+
+
+class TestIncrementalCellStitcher(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        self.patches = [(r, c) for r in range(3) for c in range(4)]
+        # cells are placed on a grid to prevent overlapping nuclei
+        grid = np.stack(
+            np.meshgrid(np.arange(20, 3900, 25), np.arange(20, 2900, 25)), axis=-1
+        ).reshape(-1, 2)
+        centroids = grid[rng.uniform(size=len(grid)) < 0.3].astype(float)
+        self.patch_cells = {
+            patch: detect_cells(patch, centroids, rng) for patch in self.patches
+        }
+
+    def _run_stitcher(self, order, discarded=(), cell_cleaner=clean, **kwargs):
+        collected = []
+
+        def sink(cell_dicts, detections, tokens, positions):
+            self.assertEqual(len(cell_dicts), len(detections))
+            self.assertEqual(len(cell_dicts), len(tokens))
+            self.assertEqual(len(cell_dicts), len(positions))
+            collected.extend(cell_dicts)
+
+        stitcher = IncrementalCellStitcher(
+            patch_coordinates=self.patches,
+            cell_cleaner=cell_cleaner,
+            sink=sink,
+            **kwargs,
+        )
+        stitcher.mark_discarded(discarded)
+        for batch in order:
+            cells = [c for patch in batch for c in self.patch_cells[patch]]
+            stitcher.add_batch(batch, to_batch_results(cells))
+        # all patches must be resolved before finalizing
+        self.assertEqual(stitcher.resolved, set(self.patches))
+        self.assertEqual(stitcher.margin_cells, {})
+        stitcher.finalize()
+        self.assertEqual(stitcher.num_cells_emitted, len(collected))
+        return collected
+
+    def _global_reference(self, patches):
+        cell_list = [c for patch in sorted(patches) for c in self.patch_cells[patch]]
+        return [cell_list[idx] for idx in clean(cell_list)]
+
+    def test_identical_to_global_cleaning(self):
+        """Test that the stitched cells are identical to cleaning the whole WSI at once."""
+        order = [self.patches[i : i + 3] for i in range(0, len(self.patches), 3)]
+        stitched = self._run_stitcher(order)
+        reference = self._global_reference(self.patches)
+        self.assertEqual(
+            sorted(id(c) for c in stitched), sorted(id(c) for c in reference)
+        )
+        # each simulated cell is kept exactly once
+        cell_ids = [c["cell_id"] for c in stitched]
+        self.assertEqual(len(cell_ids), len(set(cell_ids)))
+
+    def test_out_of_order_batches(self):
+        """Test that the arrival order of the batches does not change the result."""
+        rng = np.random.default_rng(0)
+        shuffled = [self.patches[i] for i in rng.permutation(len(self.patches))]
+        order = [shuffled[i : i + 2] for i in range(0, len(shuffled), 2)]
+        stitched = self._run_stitcher(order)
+        reference = self._global_reference(self.patches)
+        self.assertEqual(
+            sorted(id(c) for c in stitched), sorted(id(c) for c in reference)
+        )
+
+    def test_parallel_cleaning(self):
+        """Test that cleaning components in parallel tasks is identical to cleaning the whole WSI at once."""
+        calls = []
+        lock = threading.Lock()
+
+        def recording_clean(cell_list):
+            with lock:
+                calls.append(len(cell_list))
+            return clean(cell_list)
+
+        # all patches at once: a single large cleaning step split into tasks
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            stitched = self._run_stitcher(
+                [self.patches],
+                cell_cleaner=recording_clean,
+                executor=executor,
+                min_cells_per_task=50,
+            )
+        reference = self._global_reference(self.patches)
+        self.assertGreater(len(calls), 1)
+        self.assertEqual(
+            sorted(id(c) for c in stitched), sorted(id(c) for c in reference)
+        )
+
+    def test_stitching_thread(self):
+        """Test that batch results are stitched in the stitching thread and finalizing waits for it."""
+        threads, collected = set(), []
+
+        def slow_clean(cell_list):
+            threads.add(threading.current_thread().name)
+            time.sleep(0.05)
+            return clean(cell_list)
+
+        slide = SlideInferenceState(
+            wsi_path=Path("slide.svs"),
+            run_id=0,
+            fail=MagicMock(),
+            on_complete=MagicMock(),
+            start_time=0.0,
+            exhausted=True,
+        )
+        slide.stitcher = IncrementalCellStitcher(
+            patch_coordinates=self.patches,
+            cell_cleaner=slow_clean,
+            sink=lambda cell_dicts, *args: collected.extend(cell_dicts),
+        )
+        celldetector = CellViTInference.__new__(CellViTInference)
+        celldetector._finalize_slide = MagicMock()
+
+        results, call_patches = {}, {}
+        for call_id, i in enumerate(range(0, len(self.patches), 3)):
+            batch = self.patches[i : i + 3]
+            cells = [c for patch in batch for c in self.patch_cells[patch]]
+            results[call_id] = to_batch_results(cells)
+            call_patches[call_id] = (slide, batch)
+            slide.pending_calls += 1
+
+        with patch("cellvit.inference.inference.ray") as ray:
+            ray.get.side_effect = lambda ids: [results[i] for i in ids]
+            with ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="cellvit-stitching"
+            ) as stitching:
+                pending = celldetector._stitch_batch_results(
+                    list(results), call_patches, stitching, wait=True
+                )
+                # results are handed over without waiting for the stitching
+                self.assertEqual(pending, [])
+                self.assertEqual(slide.pending_calls, 0)
+                self.assertEqual(len(slide.stitching_tasks), 1)
+                self.assertFalse(slide.stitching_tasks[0].done())
+
+                celldetector._finalize_slides([slide])
+
+        self.assertTrue(slide.submitted)
+        self.assertEqual(slide.stitching_tasks, [])
+        celldetector._finalize_slide.assert_called_once_with(slide)
+        self.assertEqual({t.split("_")[0] for t in threads}, {"cellvit-stitching"})
+        reference = self._global_reference(self.patches)
+        self.assertEqual(
+            sorted(id(c) for c in collected), sorted(id(c) for c in reference)
+        )
+
+    def test_discarded_patches(self):
+        """Test that discarded patches do not block the neighbouring patches."""
+        discarded = [(1, 1), (0, 3)]
+        kept = [p for p in self.patches if p not in discarded]
+        order = [[p] for p in kept]
+        stitched = self._run_stitcher(order, discarded=discarded)
+        reference = self._global_reference(kept)
+        self.assertEqual(
+            sorted(id(c) for c in stitched), sorted(id(c) for c in reference)
+        )
+
+    def test_waits_for_neighbours(self):
+        """Test that margin cells are only emitted after all neighbours of the involved patches are available."""
+        collected = []
+        stitcher = IncrementalCellStitcher(
+            patch_coordinates=self.patches,
+            cell_cleaner=clean,
+            sink=lambda cells, *args: collected.extend(cells),
+        )
+        stitcher.add_batch([(0, 0)], to_batch_results(self.patch_cells[(0, 0)]))
+        self.assertTrue(all(c["cell_status"] == 0 for c in collected))
+        self.assertNotIn((0, 0), stitcher.resolved)
+
+        # duplicates of (0, 0) are shared with (0, 1), (1, 0) and (1, 1), whose neighbours are still missing
+        for patch_position in [(0, 1), (1, 0), (1, 1)]:
+            stitcher.add_batch(
+                [patch_position], to_batch_results(self.patch_cells[patch_position])
+            )
+        self.assertNotIn((0, 0), stitcher.resolved)
+
+        for patch_position in [(0, 2), (1, 2), (2, 0), (2, 1), (2, 2)]:
+            stitcher.add_batch(
+                [patch_position], to_batch_results(self.patch_cells[patch_position])
+            )
+        self.assertIn((0, 0), stitcher.resolved)
+        self.assertTrue(
+            any(
+                c["cell_status"] != 0 and c["patch_coordinates"] == [0, 0]
+                for c in collected
+            )
+        )
+
+    def test_chain_across_three_patches(self):
+        """Test that a duplicate chain reaching beyond the neighbourhood of a patch is decided once."""
+        patches = [(0, 0), (0, 1), (0, 2)]
+
+        def chain_cell(patch, x):
+            return {
+                "bbox": [[0, x], [10, x + 10]],
+                "centroid": [x + 5, 5],
+                "type_prob": 0.9,
+                "type": 1,
+                "patch_coordinates": list(patch),
+                "cell_status": 1,
+                "edge_position": False,
+                "edge_information": {"position": None, "edge_patches": None},
+            }
+
+        # a overlaps b, b overlaps c, but (0, 0) and (0, 2) are no neighbours
+        patch_cells = {
+            (0, 0): [chain_cell((0, 0), 0)],
+            (0, 1): [chain_cell((0, 1), 8)],
+            (0, 2): [chain_cell((0, 2), 16)],
+        }
+
+        def greedy_clean(cell_list):
+            """Keep a cell unless it overlaps an already kept cell, the result depends on all cells"""
+            kept = []
+            for idx, cell in enumerate(cell_list):
+                (_, x_min), (_, x_max) = cell["bbox"]
+                if not any(
+                    cell_list[k]["bbox"][0][1] < x_max
+                    and x_min < cell_list[k]["bbox"][1][1]
+                    for k in kept
+                ):
+                    kept.append(idx)
+            return kept
+
+        cell_list = [c for patch in patches for c in patch_cells[patch]]
+        reference = [cell_list[idx] for idx in greedy_clean(cell_list)]
+        self.assertEqual(len(reference), 2)
+
+        for order in itertools.permutations(patches):
+            collected = []
+            stitcher = IncrementalCellStitcher(
+                patch_coordinates=patches,
+                cell_cleaner=greedy_clean,
+                sink=lambda cells, *args: collected.extend(cells),
+            )
+            for patch_position in order:
+                stitcher.add_batch(
+                    [patch_position], to_batch_results(patch_cells[patch_position])
+                )
+            self.assertEqual(stitcher.resolved, set(patches))
+            self.assertEqual(
+                sorted(id(c) for c in collected), sorted(id(c) for c in reference)
+            )
+
+    def test_overlap_components(self):
+        """Test labeling of cells with intersecting bounding boxes."""
+        bounds = np.array(
+            [
+                [0, 0, 10, 10],
+                [10, 10, 20, 20],  # touches first cell
+                [50, 50, 60, 60],
+                [5, 55, 15, 65],
+                [55, 55, 65, 65],  # same group as the third cell
+            ],
+            dtype=np.float64,
+        )
+        labels = get_overlap_components(bounds)
+        self.assertEqual(labels[0], labels[1])
+        self.assertEqual(labels[2], labels[4])
+        self.assertEqual(len(set(labels)), 3)
+
+        labels = get_overlap_components(bounds, groups=np.array([0, 1, 2, 3, 2]))
+        self.assertEqual(labels[0], labels[1])
+        self.assertEqual(len(set(labels)), 4)
+        self.assertEqual(len(get_overlap_components(np.zeros((0, 4)))), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
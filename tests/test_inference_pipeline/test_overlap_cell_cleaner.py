@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Test Overlap Cell Cleaner
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import multiprocessing
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from cellvit.detect_cells import split_cleaning_workers
+from cellvit.inference.cell_cleaning import clean_cells
+from cellvit.inference.incremental_cell_stitcher import IncrementalCellStitcher
+from cellvit.inference.inference import CellViTInference
+from cellvit.inference.overlap_cell_cleaner import OverlapCellCleaner
+from cellvit.utils.logger import NullLogger
+
+PATCH_SIZE = 1024
+OVERLAP = 64
+STRIDE = PATCH_SIZE - OVERLAP
+
+
+def make_contour(x, y, radius, num_points=8):
+    """Regular polygon approximating a circular nucleus"""
+    angles = np.linspace(0, 2 * np.pi, num_points, endpoint=False)
+    return [
+        [int(round(x + radius * np.cos(a))), int(round(y + radius * np.sin(a)))]
+        for a in angles
+    ]
+
+
+def simulate_cells(num_rows, num_cols, seed=42):
+    """Simulate the detections of all patches, cells inside the overlap are detected multiple times"""
+    rng = np.random.default_rng(seed)
+    grid = np.stack(
+        np.meshgrid(
+            np.arange(15, num_cols * STRIDE, 18), np.arange(15, num_rows * STRIDE, 18)
+        ),
+        axis=-1,
+    ).reshape(-1, 2)
+    centroids = grid[rng.uniform(size=len(grid)) < 0.5]
+    radii = rng.integers(5, 10, size=len(centroids))
+
+    cell_list = []
+    for row in range(num_rows):
+        for col in range(num_cols):
+            x_start, y_start = col * STRIDE, row * STRIDE
+            for (x, y), radius in zip(centroids, radii):
+                local_x, local_y = x - x_start, y - y_start
+                border_dist = min(
+                    local_x, local_y, PATCH_SIZE - local_x, PATCH_SIZE - local_y
+                )
+                if border_dist < radius + 1:
+                    continue
+                # jitter and identical duplicates
+                shift = rng.integers(-2, 3, size=2) if rng.uniform() < 0.5 else (0, 0)
+                contour = make_contour(x + shift[0], y + shift[1], radius)
+                cell_list.append(
+                    {
+                        "bbox": np.flip(
+                            [np.min(contour, axis=0), np.max(contour, axis=0)], axis=1
+                        ).tolist(),
+                        "contour": contour,
+                        "type": 1,
+                        "type_prob": 0.9,
+                        "patch_coordinates": [row, col],
+                        "cell_status": 0 if border_dist >= OVERLAP else 1,
+                        "edge_position": False,
+                        "edge_information": {"position": None, "edge_patches": None},
+                    }
+                )
+    return cell_list
+
+
+class TestOverlapCellCleaner(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cell_list = simulate_cells(3, 3)
+        cls.serial_idx = list(
+            OverlapCellCleaner(cls.cell_list, NullLogger())
+            .clean_detected_cells()
+            .index.values
+        )
+
+    def test_serial_cleaner_removes_duplicates(self):
+        """Test that the serial cleaner removes duplicated cells."""
+        self.assertLess(len(self.serial_idx), len(self.cell_list))
+
+    def _run_stitcher(self, order, **kwargs):
+        patches = sorted({tuple(c["patch_coordinates"]) for c in self.cell_list})
+        collected = []
+        stitcher = IncrementalCellStitcher(
+            patch_coordinates=patches,
+            sink=lambda cells, *args: collected.extend(cells),
+            **kwargs,
+        )
+        for batch in order(patches):
+            cells = [
+                c for c in self.cell_list if tuple(c["patch_coordinates"]) in batch
+            ]
+            stitcher.add_batch(batch, (cells, cells, cells, cells))
+        stitcher.finalize()
+        return collected
+
+    def test_stitched_identical_to_serial(self):
+        """Test that incremental cleaning of overlapping components is identical to the serial cleaner."""
+        collected = self._run_stitcher(
+            lambda patches: [[patch] for patch in reversed(patches)],
+            cell_cleaner=lambda cells: list(
+                OverlapCellCleaner(cells, NullLogger()).clean_detected_cells().index
+            ),
+        )
+        self.assertEqual(
+            sorted(id(c) for c in collected),
+            sorted(id(self.cell_list[idx]) for idx in self.serial_idx),
+        )
+
+    def test_parallel_identical_to_serial(self):
+        """Test that cleaning components in worker processes is identical to the serial cleaner."""
+        with ProcessPoolExecutor(
+            max_workers=2, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            collected = self._run_stitcher(
+                lambda patches: [patches],
+                cell_cleaner=partial(clean_cells, cell_cleaner="polygon"),
+                executor=executor,
+                min_cells_per_task=100,
+            )
+        self.assertEqual(
+            sorted(id(c) for c in collected),
+            sorted(id(self.cell_list[idx]) for idx in self.serial_idx),
+        )
+
+    def test_close_cleaning_pool(self):
+        """Test that the cleaning workers are shut down when the pipeline is closed."""
+        celldetector = CellViTInference.__new__(CellViTInference)
+        pool = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        )
+        celldetector.cleaning_pool = pool
+        self.assertEqual(pool.submit(sum, [1, 2]).result(timeout=120), 3)
+        celldetector.close()
+        self.assertIsNone(celldetector.cleaning_pool)
+        with self.assertRaises(RuntimeError):
+            pool.submit(sum, [1, 2])
+        celldetector.close()  # repeatable
+
+    def test_split_cleaning_workers(self):
+        """Test that parallel slide workers share the cleaning workers of the host."""
+        self.assertEqual(split_cleaning_workers(8, 4), 2)
+        self.assertEqual(split_cleaning_workers(2, 4), 1)
+        self.assertEqual(split_cleaning_workers(0, 4), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Test Peak-Based Nuclei Detection
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import unittest
+
+import numpy as np
+import torch
+from skimage.draw import ellipse
+
+from cellvit.inference.peak_detection import (
+    compare_detections,
+    detect_peaks,
+    summarize_comparison,
+)
+from cellvit.inference.postprocessing_numpy import DetectionCellPostProcessor
+from cellvit.utils.tools import remap_label
+
+
+def hv_map_from_instances(inst_map: np.ndarray) -> np.ndarray:
+    """HoVer-Net style horizontal and vertical distance maps (normalized to [-1, 1] per instance)"""
+    hv_map = np.zeros(inst_map.shape + (2,), dtype=np.float32)
+    for inst_id in np.unique(inst_map)[1:]:
+        rows, cols = np.nonzero(inst_map == inst_id)
+        for axis, coords in enumerate([cols, rows]):
+            offset = coords - coords.mean()
+            scale = np.where(
+                offset < 0, max(-offset.min(), 1e-6), max(offset.max(), 1e-6)
+            )
+            hv_map[rows, cols, axis] = offset / scale
+    return hv_map
+
+
+class TestPeakDetection(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        inst_maps, type_maps = [], []
+        for _ in range(2):
+            inst_map = np.zeros((256, 256), dtype=np.int32)
+            type_map = np.zeros((256, 256), dtype=np.int64)
+            num_cells = 0
+            for _ in range(60):
+                row, col = rng.integers(8, 248, size=2)
+                r_radius, c_radius = rng.integers(4, 9, size=2)
+                rr, cc = ellipse(row, col, r_radius, c_radius, shape=inst_map.shape)
+                if np.any(inst_map[rr, cc] > 0):
+                    continue
+                num_cells += 1
+                inst_map[rr, cc] = num_cells
+                type_map[rr, cc] = rng.integers(1, 6)
+            inst_maps.append(inst_map)
+            type_maps.append(type_map)
+        self.inst_maps = np.stack(inst_maps)
+        self.type_maps = np.stack(type_maps)
+        foreground = (self.inst_maps > 0).astype(np.float32)
+        self.predictions = {
+            "nuclei_binary_map": torch.from_numpy(
+                np.stack([1 - foreground, foreground], axis=-1)
+            ),
+            "nuclei_type_map": torch.nn.functional.one_hot(
+                torch.from_numpy(self.type_maps), 6
+            ).float(),
+            "hv_map": torch.from_numpy(
+                np.stack([hv_map_from_instances(i) for i in inst_maps])
+            ),
+        }
+        self.postprocessor = DetectionCellPostProcessor(
+            wsi=None, nr_types=6, detection_only=True
+        )
+
+    def test_detect_peaks(self):
+        """Test that each nucleus is found once, with centroid, bbox and type of the ground truth."""
+        markers, cell_dicts = detect_peaks(self.predictions)
+        self.assertEqual(markers.shape, (2, 256, 256))
+        self.assertEqual(len(cell_dicts), 2)
+        for idx, cells in enumerate(cell_dicts):
+            self.assertEqual(int(markers[idx].max()), len(cells))
+            reference = self.postprocessor._create_detection_dict(
+                remap_label(self.inst_maps[idx]),
+                self.type_maps[idx].astype(np.int32),
+            )
+            stats = compare_detections(
+                list(reference.values()), list(cells.values()), radius=2.0
+            )
+            self.assertEqual(stats["matched"], len(reference))
+            self.assertEqual(stats["matched"], len(cells))
+            self.assertEqual(stats["type_matches"], len(reference))
+            for cell in cells.values():
+                self.assertEqual(cell["bbox"].shape, (2, 2))
+                rmin, cmin = cell["bbox"][0]
+                rmax, cmax = cell["bbox"][1]
+                col, row = cell["centroid"]
+                self.assertTrue(rmin <= row <= rmax and cmin <= col <= cmax)
+
+    def test_agreement_with_watershed(self):
+        """Test that the peak engine of the postprocessor agrees with the watershed engine."""
+        postprocessor = DetectionCellPostProcessor(
+            wsi=None, nr_types=6, detection_engine="peaks"
+        )
+        self.assertTrue(postprocessor.detection_only)
+        _, peak_cells = postprocessor.post_process_batch(self.predictions)
+        _, watershed_cells = self.postprocessor.post_process_batch(self.predictions)
+        report = summarize_comparison(
+            [
+                compare_detections(list(w.values()), list(p.values()))
+                for w, p in zip(watershed_cells, peak_cells)
+            ]
+        )
+        self.assertGreater(report["f1"], 0.95)
+        self.assertGreater(report["type_agreement"], 0.95)
+
+    def test_empty(self):
+        """Test predictions without nuclei."""
+        predictions = {
+            key: torch.zeros_like(value) for key, value in self.predictions.items()
+        }
+        predictions["nuclei_binary_map"][..., 0] = 1
+        markers, cell_dicts = detect_peaks(predictions)
+        self.assertEqual(int(markers.max()), 0)
+        self.assertEqual(cell_dicts, [{}, {}])
+
+    def test_compare_detections(self):
+        """Test one-to-one matching and the summarized report."""
+        reference = [
+            {"centroid": np.array([10.0, 10.0]), "type": 1},
+            {"centroid": np.array([20.0, 10.0]), "type": 2},
+            {"centroid": np.array([50.0, 50.0]), "type": 1},
+        ]
+        candidate = [
+            {"centroid": np.array([11.0, 10.0]), "type": 1},
+            {"centroid": np.array([12.0, 10.0]), "type": 1},
+            {"centroid": np.array([20.0, 12.0]), "type": 3},
+        ]
+        stats = compare_detections(reference, candidate, radius=5.0)
+        self.assertEqual(stats["matched"], 2)
+        self.assertAlmostEqual(stats["distance_sum"], 3.0)
+        self.assertEqual(stats["type_matches"], 1)
+
+        report = summarize_comparison([stats, compare_detections(reference, [])])
+        self.assertEqual(report["num_reference"], 6)
+        self.assertEqual(report["num_candidate"], 3)
+        self.assertAlmostEqual(report["precision"], 2 / 3)
+        self.assertAlmostEqual(report["recall"], 2 / 6)
+        self.assertAlmostEqual(report["mean_distance"], 1.5)
+        self.assertAlmostEqual(report["type_agreement"], 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -67,12 +67,15 @@ class TestCellViTInference(unittest.TestCase):
         self.original_methods = {}
         for method_name in [
             "_instantiate_logger",
+            "_setup_writer",
+            "_setup_ledger",
             "_load_model",
             "_check_devices",
             "_load_classifier",
             "_load_inference_transforms",
             "_setup_amp",
             "_setup_worker",
+            "_report_startup",
         ]:
             self.original_methods[method_name] = getattr(CellViTInference, method_name)
 
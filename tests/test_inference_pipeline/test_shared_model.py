@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Test sharing the model weights between processes
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import torch
+import torch.nn as nn
+
+from cellvit.inference.inference import CellViTInference
+
+
+def _check_shared_model(shared_model: dict, queue) -> None:
+    """Worker process: report if the received weights are shared and their sum"""
+    model = shared_model["model"]
+    queue.put(
+        (
+            all(param.is_shared() for param in model.parameters()),
+            float(sum(param.detach().sum() for param in model.parameters())),
+            shared_model["model_arch"],
+        )
+    )
+
+
+class TestSharedModel(unittest.TestCase):
+    def setUp(self):
+        # pipeline without setup, just the model attributes
+        self.celldetector = CellViTInference.__new__(CellViTInference)
+        self.celldetector.model = nn.Sequential(nn.Linear(16, 32), nn.Linear(32, 4))
+        self.celldetector.run_conf = {"model": {"token_patch_size": 16}}
+        self.celldetector.model_arch = "CellViT256"
+        self.celldetector.model_path = Path("CellViT-256-x40-AMP.pth")
+        self.celldetector.model_name = "HIPT"
+        self.celldetector.device = "cpu"
+        self.celldetector.logger = MagicMock()
+
+    def test_share_model(self):
+        """Test that the weights are moved to shared memory and used by a new pipeline."""
+        shared_model = self.celldetector.share_model()
+        self.assertTrue(
+            all(param.is_shared() for param in shared_model["model"].parameters())
+        )
+
+        worker = CellViTInference.__new__(CellViTInference)
+        worker.shared_model = shared_model
+        worker.device = "cpu"
+        worker.model_name = "HIPT"
+        worker.logger = MagicMock()
+        worker._load_model()
+        self.assertIs(worker.model, self.celldetector.model)
+        self.assertEqual(worker.model_arch, "CellViT256")
+        self.assertEqual(worker.run_conf["model"]["token_patch_size"], 16)
+        self.assertFalse(worker.model.training)
+
+    def test_share_model_between_processes(self):
+        """Test that a spawned process receives the weights without copying them."""
+        shared_model = self.celldetector.share_model()
+        context = torch.multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        process = context.Process(
+            target=_check_shared_model, args=(shared_model, queue)
+        )
+        process.start()
+        is_shared, weight_sum, model_arch = queue.get(timeout=120)
+        process.join(timeout=120)
+
+        self.assertEqual(process.exitcode, 0)
+        self.assertTrue(is_shared)
+        self.assertAlmostEqual(
+            weight_sum,
+            float(sum(p.detach().sum() for p in self.celldetector.model.parameters())),
+            places=4,
+        )
+        self.assertEqual(model_arch, "CellViT256")
+
+
+if __name__ == "__main__":
+    unittest.main()
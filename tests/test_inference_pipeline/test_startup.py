@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Test concurrent startup of the inference pipeline
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from cellvit.inference.inference import CellViTInference
+from cellvit.utils.ressource_manager import SystemConfiguration
+
+STEP_DURATION = 0.3
+
+
+class TestStartup(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.system_config = MagicMock(spec=SystemConfiguration)
+        self.system_config.__getitem__.side_effect = lambda key: {
+            "gpu_index": 0,
+            "cpu_count": 8,
+        }[key]
+        self.threads = {}
+
+        def slow_step(name):
+            def step(celldetector, *args, **kwargs):
+                self.threads[name] = threading.current_thread().name
+                time.sleep(STEP_DURATION)
+                if name == "model":
+                    celldetector.model_arch = "CellViT256"
+
+            return step
+
+        def instantiate_logger(celldetector):
+            celldetector.logger = MagicMock()
+
+        methods = {
+            "_instantiate_logger": instantiate_logger,
+            "_setup_writer": lambda celldetector: None,
+            "_setup_ledger": lambda celldetector: None,
+            "_load_model": slow_step("model"),
+            "_check_devices": lambda celldetector: None,
+            "_load_classifier": slow_step("classifier"),
+            "_load_inference_transforms": lambda celldetector: None,
+            "_setup_amp": lambda celldetector, enforce_amp=False: None,
+            "_setup_worker": slow_step("ray"),
+        }
+        self.patches = [
+            patch.object(CellViTInference, name, method)
+            for name, method in methods.items()
+        ]
+        [p.start() for p in self.patches]
+
+    def tearDown(self):
+        [p.stop() for p in self.patches]
+        shutil.rmtree(self.tmp_dir)
+
+    def test_concurrent_startup(self):
+        """Test that Ray and the classifier are started while the model is loaded."""
+        celldetector = CellViTInference(
+            model_name="HIPT",
+            outdir=self.tmp_dir,
+            system_configuration=self.system_config,
+        )
+        timings = celldetector.startup_timings
+        self.assertEqual(
+            set(timings), {"model", "classifier", "ray", "compilation", "total"}
+        )
+        for step in ["model", "classifier", "ray"]:
+            self.assertGreaterEqual(timings[step], STEP_DURATION * 0.9)
+        self.assertLess(timings["total"], 2 * STEP_DURATION)
+
+        self.assertEqual(self.threads["model"], threading.main_thread().name)
+        self.assertNotEqual(self.threads["ray"], self.threads["model"])
+        self.assertNotEqual(self.threads["classifier"], self.threads["model"])
+        self.assertEqual(celldetector.num_workers, 6)
+        message = celldetector.logger.info.call_args_list[-1].args[0]
+        self.assertTrue(message.startswith("Startup finished in"))
+        for step in ["model", "classifier", "ray", "compilation"]:
+            self.assertIn(f"{step}: ", message)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Test Background Writer
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import threading
+import time
+import unittest
+
+from cellvit.output.background_writer import BackgroundWriter
+
+
+class TestBackgroundWriter(unittest.TestCase):
+    def test_artifacts_written_concurrently(self):
+        """Test that artifacts of one slide are written in parallel before completion."""
+        barrier = threading.Barrier(3, timeout=5)
+        written, completed = [], []
+
+        def write(name):
+            barrier.wait()  # only passes if all three artifacts run concurrently
+            written.append(name)
+
+        with BackgroundWriter(max_workers=3) as writer:
+            writer.submit_slide(
+                "slide_1",
+                {name: (lambda name=name: write(name)) for name in ["a", "b", "c"]},
+                on_complete=lambda: completed.append(sorted(written)),
+            )
+        self.assertEqual(completed, [["a", "b", "c"]])
+
+    def test_bounded_queue(self):
+        """Test that submitting blocks while the previous slide is still written."""
+        release = threading.Event()
+        writer = BackgroundWriter(max_workers=2, max_pending_slides=1)
+        writer.submit_slide("slide_1", {"cells": release.wait})
+
+        submitted = threading.Event()
+        thread = threading.Thread(
+            target=lambda: (writer.submit_slide("slide_2", {}), submitted.set())
+        )
+        thread.start()
+        time.sleep(0.2)
+        self.assertFalse(submitted.is_set())
+        release.set()
+        thread.join(timeout=5)
+        self.assertTrue(submitted.is_set())
+        writer.close()
+
+    def test_errors_raised_on_flush(self):
+        """Test that write errors are surfaced by flush and skip the completion callback."""
+        completed = []
+        writer = BackgroundWriter(max_workers=2)
+        writer.submit_slide(
+            "slide_1",
+            {"cells": self._raise_os_error, "graph": lambda: None},
+            on_complete=lambda: completed.append("slide_1"),
+        )
+        with self.assertRaises(RuntimeError) as context:
+            writer.flush()
+        self.assertIn("slide_1/cells", str(context.exception))
+        self.assertIsInstance(context.exception.__cause__, OSError)
+        self.assertEqual(completed, [])
+
+        # error callback receives the failed artifacts
+        errors = []
+        writer.submit_slide(
+            "slide_3",
+            {"cells": self._raise_os_error, "graph": lambda: None},
+            on_complete=lambda: completed.append("slide_3"),
+            on_error=errors.append,
+        )
+        with self.assertRaises(RuntimeError):
+            writer.flush()
+        self.assertEqual(len(errors), 1)
+        self.assertIn("cells", errors[0])
+        self.assertIn("disk full", errors[0])
+        self.assertEqual(completed, [])
+
+        # errors are only raised once
+        writer.submit_slide(
+            "slide_2", {}, on_complete=lambda: completed.append("slide_2")
+        )
+        writer.close()
+        self.assertEqual(completed, ["slide_2"])
+
+    def test_synchronous(self):
+        """Test that without worker threads, outputs are written when submitting."""
+        written = []
+        writer = BackgroundWriter(max_workers=0)
+        writer.submit_slide(
+            "slide_1",
+            {"cells": lambda: written.append("cells")},
+            on_complete=lambda: written.append("done"),
+        )
+        self.assertEqual(written, ["cells", "done"])
+        with self.assertRaises(OSError):
+            writer.submit_slide("slide_2", {"cells": self._raise_os_error})
+
+    @staticmethod
+    def _raise_os_error():
+        raise OSError("disk full")
+
+
+if __name__ == "__main__":
+    unittest.main()
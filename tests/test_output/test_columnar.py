@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Test Columnar Cell Storage
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import shutil
+import unittest
+from pathlib import Path
+
+import numpy as np
+import ujson
+
+from cellvit.output.cell_json import iter_cell_json
+from cellvit.output.columnar import (
+    load_cell_metadata,
+    load_cells,
+    table_to_cells,
+    write_cells,
+)
+
+
+class TestColumnar(unittest.TestCase):
+    def setUp(self):
+        self.outdir = Path("test_columnar_output")
+        self.outdir.mkdir(exist_ok=True)
+        rng = np.random.default_rng(42)
+        self.cells = []
+        for idx in range(20):
+            x, y = rng.integers(0, 10000, size=2).tolist()
+            contour = rng.integers(-8, 8, size=(rng.integers(3, 12), 2)) + [x, y]
+            self.cells.append(
+                {
+                    "bbox": [[y - 8.0, x - 8.0], [y + 8.0, x + 8.0]],
+                    "centroid": [float(x), float(y)],
+                    "contour": contour.tolist(),
+                    "type_prob": 0.5,
+                    "type": idx % 5,
+                    "patch_coordinates": [idx // 4, idx % 4],
+                    "cell_status": idx % 2,
+                    "offset_global": [0, 0],
+                    "edge_position": False,
+                }
+            )
+        self.wsi_metadata = {"base_mpp": 0.25, "downsampling": 1}
+        self.type_map = {0: "Background", 1: "Neoplastic"}
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir, ignore_errors=True)
+
+    def _check_roundtrip(self, file_format):
+        path = write_cells(
+            self.outdir / "cells",
+            self.cells,
+            wsi_metadata=self.wsi_metadata,
+            type_map=self.type_map,
+            file_format=file_format,
+        )
+        self.assertEqual(path.suffix, f".{file_format}")
+        table = load_cells(path)
+        self.assertEqual(table.num_rows, len(self.cells))
+        wsi_metadata, type_map = load_cell_metadata(table)
+        self.assertEqual(wsi_metadata, self.wsi_metadata)
+        self.assertEqual(type_map, self.type_map)
+
+        keys = [
+            "bbox",
+            "centroid",
+            "contour",
+            "type",
+            "type_prob",
+            "patch_coordinates",
+            "cell_status",
+        ]
+        expected = [{k: c[k] for k in keys} for c in self.cells]
+        self.assertEqual(table_to_cells(table), expected)
+
+    def test_arrow_roundtrip(self):
+        """Test writing and memory-mapped loading of Arrow IPC files."""
+        self._check_roundtrip("arrow")
+
+    def test_parquet_roundtrip(self):
+        """Test writing and loading of Parquet files."""
+        self._check_roundtrip("parquet")
+
+    def test_rescaled_contours(self):
+        """Test that non-integer contours are rounded to the nearest pixel like in the json output."""
+        cells = [
+            {**c, "contour": (np.asarray(c["contour"]) * 1.37 + 0.5).tolist()}
+            for c in self.cells
+        ]
+        cell_dict = {"wsi_metadata": {}, "type_map": {}, "cells": cells}
+        json_cells = ujson.loads("".join(iter_cell_json(cell_dict)))["cells"]
+        for file_format in ["arrow", "parquet"]:
+            path = write_cells(self.outdir / "cells", cells, file_format=file_format)
+            for cell, json_cell in zip(table_to_cells(load_cells(path)), json_cells):
+                self.assertEqual(
+                    cell["contour"], np.rint(json_cell["contour"]).astype(int).tolist()
+                )
+
+    def test_detection_columns(self):
+        """Test that detections just contain bbox, centroid and type."""
+        detections = [
+            {"bbox": c["bbox"], "centroid": c["centroid"], "type": c["type"]}
+            for c in self.cells
+        ]
+        path = write_cells(self.outdir / "cell_detection", detections, detection=True)
+        table = load_cells(path)
+        self.assertEqual(table.column_names, ["bbox", "centroid", "type"])
+        self.assertEqual(table_to_cells(table), detections)
+
+    def test_empty(self):
+        """Test that an empty cell list can be stored."""
+        path = write_cells(self.outdir / "cells", [], file_format="arrow")
+        self.assertEqual(table_to_cells(load_cells(path)), [])
+
+    def test_invalid_format(self):
+        """Test unknown file format."""
+        with self.assertRaises(NotImplementedError):
+            write_cells(self.outdir / "cells", self.cells, file_format="csv")
+
+
+if __name__ == "__main__":
+    unittest.main()
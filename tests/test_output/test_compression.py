@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Test Streaming Compression and JSON Writer
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import shutil
+import unittest
+from pathlib import Path
+
+import snappy
+import ujson
+
+from cellvit.output.cell_json import iter_cell_json, write_cell_json
+from cellvit.output.compression import (
+    SNAPPY_STREAM_IDENTIFIER,
+    load_json,
+    open_compressed,
+)
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.outdir = Path("test_compression_output")
+        self.outdir.mkdir(exist_ok=True)
+        self.cell_dict = {
+            "wsi_metadata": {"base_mpp": 0.25},
+            "type_map": {0: "Background", 1: "Neoplastic"},
+            "cells": [
+                {
+                    "centroid": [float(i), float(2 * i)],
+                    "contour": [[i, i], [i + 1, i], [i, i + 1]],
+                    "type": i % 2,
+                }
+                for i in range(5000)
+            ],
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir, ignore_errors=True)
+
+    def test_cell_json(self):
+        """Test that the streamed json equals a single ujson dump."""
+        for chunk_size in [1, 333, 10000]:
+            self.assertEqual(
+                "".join(iter_cell_json(self.cell_dict, chunk_size=chunk_size)),
+                ujson.dumps(self.cell_dict),
+            )
+        empty = {"wsi_metadata": {}, "type_map": {}, "cells": []}
+        self.assertEqual("".join(iter_cell_json(empty)), ujson.dumps(empty))
+
+    def test_snappy_framed(self):
+        """Test streaming snappy compression in the framing format."""
+        path = self.outdir / "cells.json.snappy"
+        with open_compressed(path, "wt") as outfile:
+            write_cell_json(outfile.write, self.cell_dict, chunk_size=100)
+        with open(path, "rb") as infile:
+            self.assertEqual(
+                infile.read(len(SNAPPY_STREAM_IDENTIFIER)), SNAPPY_STREAM_IDENTIFIER
+            )
+        self.assertEqual(load_json(path), ujson.loads(ujson.dumps(self.cell_dict)))
+
+    def test_snappy_legacy_block(self):
+        """Test that files compressed as one raw snappy block can still be read."""
+        path = self.outdir / "cells.json.snappy"
+        with open(path, "wb") as outfile:
+            outfile.write(snappy.compress(ujson.dumps(self.cell_dict)))
+        self.assertEqual(load_json(path), ujson.loads(ujson.dumps(self.cell_dict)))
+
+    def test_zstd(self):
+        """Test streaming zstd compression with worker threads."""
+        path = self.outdir / "cells.json.zst"
+        with open_compressed(path, "wt", level=5, threads=2) as outfile:
+            write_cell_json(outfile.write, self.cell_dict, chunk_size=100)
+        self.assertEqual(load_json(path), ujson.loads(ujson.dumps(self.cell_dict)))
+
+    def test_binary_mode(self):
+        """Test binary reading and writing with an explicit codec."""
+        data = bytes(range(256)) * 1000
+        for codec in ["snappy", "zstd"]:
+            path = self.outdir / f"data.{codec}"
+            with open_compressed(path, "wb", codec=codec) as outfile:
+                outfile.write(data[:1000])
+                outfile.write(data[1000:])
+            with open_compressed(path, "rb", codec=codec) as infile:
+                self.assertEqual(infile.read(), data)
+
+    def test_invalid_codec(self):
+        """Test unknown codec."""
+        with self.assertRaises(NotImplementedError):
+            open_compressed(self.outdir / "cells.json.gz", "wt")
+
+
+if __name__ == "__main__":
+    unittest.main()
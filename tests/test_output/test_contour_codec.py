@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# Test Compact Contour Encoding
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import ujson
+
+from cellvit.output.cell_json import write_cell_json
+from cellvit.output.columnar import load_cells, table_to_cells, write_cells
+from cellvit.output.contour_codec import (
+    decode_contours,
+    decode_contours_base64,
+    encode_contours,
+    encode_contours_base64,
+    simplify_contours,
+)
+from cellvit.output.spatial_index import SpatialIndex, write_spatial_index
+
+
+def _segment_distance(points: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    """Distance of each point to the closest edge of a closed polygon"""
+    start, end = polygon, np.roll(polygon, -1, axis=0)
+    direction = end - start
+    length = np.maximum((direction**2).sum(-1), 1e-12)
+    t = ((points[:, None] - start[None]) * direction[None]).sum(-1) / length[None]
+    closest = start[None] + np.clip(t, 0, 1)[..., None] * direction[None]
+    return np.linalg.norm(points[:, None] - closest, axis=-1).min(1)
+
+
+class TestContourCodec(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        rng = np.random.default_rng(7)
+        self.contours = []
+        for _ in range(200):
+            num_points = rng.integers(8, 40)
+            angles = np.sort(rng.uniform(0, 2 * np.pi, num_points))
+            radius = rng.uniform(4, 15)
+            center = rng.uniform(0, 100000, 2)
+            contour = center + radius * np.stack([np.cos(angles), np.sin(angles)], 1)
+            self.contours.append(np.rint(contour).astype(np.int64).tolist())
+        self.cells = [
+            {
+                "bbox": [
+                    [min(p[1] for p in c), min(p[0] for p in c)],
+                    [max(p[1] for p in c), max(p[0] for p in c)],
+                ],
+                "centroid": np.mean(c, axis=0).tolist(),
+                "contour": c,
+                "type_prob": 0.9,
+                "type": idx % 3,
+                "patch_coordinates": [0, idx],
+                "cell_status": 0,
+            }
+            for idx, c in enumerate(self.contours)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_roundtrip(self):
+        """Test lossless roundtrip of integer contours, including empty contours and large or negative values."""
+        contours = (
+            [[]] + self.contours[:10] + [[], [[-5, 2**40], [3, -(2**40)], [0, 0]]]
+        )
+        data, offsets = encode_contours(contours)
+        self.assertEqual(data.dtype, np.uint8)
+        self.assertEqual(len(offsets), len(contours) + 1)
+        decoded = decode_contours(data, offsets)
+        self.assertEqual(len(decoded), len(contours))
+        for contour, result in zip(contours, decoded):
+            np.testing.assert_array_equal(
+                result, np.asarray(contour, dtype=np.float64).reshape(-1, 2)
+            )
+
+        # subset of contours (e.g., rows taken from a table)
+        decoded = decode_contours(data, offsets[3:6])
+        for contour, result in zip(contours[3:5], decoded):
+            np.testing.assert_array_equal(result, np.asarray(contour))
+
+    def test_precision(self):
+        """Test that the quantization error is bounded by half of the precision."""
+        rng = np.random.default_rng(0)
+        contours = [
+            np.asarray(c) + rng.uniform(-1, 1, (len(c), 2)) for c in self.contours
+        ]
+        for precision in [0.25, 1.0, 2.0]:
+            decoded = decode_contours_base64(
+                encode_contours_base64(contours, precision=precision),
+                precision=precision,
+            )
+            error = max(np.abs(c - d).max() for c, d in zip(contours, decoded))
+            self.assertLessEqual(error, precision / 2 + 1e-9)
+
+    def test_compression_ratio(self):
+        """Test that encoded contours are much smaller than plain json contours."""
+        plain = len(ujson.dumps(self.contours))
+        encoded = len(ujson.dumps(encode_contours_base64(self.contours)))
+        self.assertGreater(plain / encoded, 4)
+
+    def test_simplify(self):
+        """Test that simplified contours have less points and stay within the tolerance."""
+        simplified = simplify_contours(self.contours + [[[0, 0], [1, 1]]], 1.0)
+        self.assertEqual(simplified[-1].tolist(), [[0, 0], [1, 1]])
+        num_points, num_simplified = 0, 0
+        for contour, result in zip(self.contours, simplified):
+            contour = np.asarray(contour, dtype=np.float64)
+            self.assertGreaterEqual(len(result), 3)
+            self.assertLessEqual(
+                _segment_distance(contour, result.astype(np.float64)).max(), 1.0 + 1e-6
+            )
+            num_points += len(contour)
+            num_simplified += len(result)
+        self.assertLess(num_simplified, num_points)
+
+    def test_json(self):
+        """Test encoded contours in json, also when loaded with the spatial index."""
+        cell_dict = {"wsi_metadata": {}, "type_map": {0: "Background"}}
+        cell_dict["cells"] = self.cells
+        path = self.tmp_dir / "cells.json"
+        spans = []
+        with open(path, "w") as outfile:
+            write_cell_json(
+                outfile.write,
+                cell_dict,
+                chunk_size=64,
+                cell_spans=spans,
+                contour_precision=1.0,
+            )
+        with open(path, "r") as infile:
+            loaded = ujson.load(infile)
+        self.assertEqual(loaded["contour_encoding"]["precision"], 1.0)
+        self.assertTrue(all(isinstance(c["contour"], str) for c in loaded["cells"]))
+        decoded = decode_contours_base64(
+            [c["contour"] for c in loaded["cells"]], precision=1.0
+        )
+        for cell, contour in zip(self.cells, decoded):
+            np.testing.assert_array_equal(contour, cell["contour"])
+        self.assertEqual(self.cells[0]["contour"], self.contours[0])  # not modified
+
+        write_spatial_index(
+            self.tmp_dir / "cells.sidx",
+            self.cells,
+            source=path,
+            spans=spans,
+            contour_encoding=loaded["contour_encoding"],
+        )
+        index = SpatialIndex(self.tmp_dir / "cells.sidx")
+        cells = index.load_cells(np.array([3, 17]))
+        self.assertEqual(cells[0]["contour"], self.contours[3])
+        self.assertEqual(cells[1]["contour"], self.contours[17])
+
+    def test_columnar(self):
+        """Test the binary contour column of arrow and parquet files."""
+        for file_format in ["arrow", "parquet"]:
+            path = write_cells(
+                self.tmp_dir / "cells",
+                self.cells,
+                file_format=file_format,
+                contour_precision=1.0,
+            )
+            table = load_cells(path)
+            self.assertIn(b"contour_encoding", table.schema.metadata)
+            cells = table_to_cells(table)
+            self.assertEqual([c["contour"] for c in cells], self.contours)
+            cells = table_to_cells(table.slice(5, 3))
+            self.assertEqual([c["contour"] for c in cells], self.contours[5:8])
+
+
+if __name__ == "__main__":
+    unittest.main()
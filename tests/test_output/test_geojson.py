@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Test Streaming GeoJSON Writer
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import copy
+import io
+import unittest
+
+import numpy as np
+import ujson
+
+from cellvit.config.config import COLOR_DICT_CELLS
+from cellvit.output.geojson import iter_geojson, write_geojson
+
+
+class TestStreamingGeojson(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.label_map = {0: "Background", 1: "Neoplastic", 2: "Inflammatory"}
+        self.cells = []
+        for idx in range(50):
+            x, y = rng.integers(0, 5000, size=2).tolist()
+            contour = rng.integers(-5, 5, size=(rng.integers(3, 8), 2)) + [x, y]
+            self.cells.append(
+                {
+                    "type": int(rng.choice([1, 2])),
+                    "centroid": [float(x), float(y)],
+                    "contour": contour.tolist(),
+                }
+            )
+
+    def _expected(self, polygons):
+        features = []
+        for cell_type in sorted({c["type"] for c in self.cells}):
+            cells = [c for c in self.cells if c["type"] == cell_type]
+            if polygons:
+                coordinates = [[c["contour"] + [c["contour"][0]]] for c in cells]
+            else:
+                coordinates = [c["centroid"] for c in cells]
+            features.append(
+                (
+                    "MultiPolygon" if polygons else "MultiPoint",
+                    self.label_map[cell_type],
+                    COLOR_DICT_CELLS[cell_type],
+                    coordinates,
+                )
+            )
+        return features
+
+    def _parse(self, geojson_string):
+        features = ujson.loads(geojson_string)
+        return [
+            (
+                f["geometry"]["type"],
+                f["properties"]["classification"]["name"],
+                f["properties"]["classification"]["color"],
+                f["geometry"]["coordinates"],
+            )
+            for f in features
+        ]
+
+    def test_polygons(self):
+        """Test segmentation export with small chunks, input contours are not modified."""
+        original = copy.deepcopy(self.cells)
+        output = io.StringIO()
+        write_geojson(
+            output.write, self.cells, self.label_map, polygons=True, chunk_size=7
+        )
+        self.assertEqual(self._parse(output.getvalue()), self._expected(True))
+        self.assertEqual(self.cells, original)
+
+    def test_points(self):
+        """Test detection export, chunk size does not change the result."""
+        for chunk_size in [1, 13, 1000]:
+            geojson_string = "".join(
+                iter_geojson(self.cells, self.label_map, chunk_size=chunk_size)
+            )
+            self.assertEqual(self._parse(geojson_string), self._expected(False))
+
+    def test_empty(self):
+        """Test that an empty cell list results in an empty feature list."""
+        self.assertEqual("".join(iter_geojson([], self.label_map)), "[]")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Test Memory-Mapped Graph Storage
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import shutil
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import numpy as np
+import torch
+
+from cellvit.data.dataclass.cell_graph import CellGraphDataWSI
+from cellvit.inference.batch_packing import SlideInferenceState
+from cellvit.inference.inference import CellViTInference
+from cellvit.output.graph_store import TokenStore, load_graph_store, write_graph_store
+
+
+class TestGraphStore(unittest.TestCase):
+    def setUp(self):
+        self.outdir = Path("test_graph_store_output")
+        self.tokens = torch.randn(1000, 32)
+        self.positions = torch.rand(1000, 2) * 10000
+        self.nuclei_types = torch.randint(0, 6, (1000,))
+        self.metadata = {"wsi_metadata": {"mpp": 0.25}, "nuclei_types": {"0": "a"}}
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir, ignore_errors=True)
+
+    def _fill_store(self, dtype: str = "float32") -> TokenStore:
+        # small capacity to test growing the file, batches as list and as tensor
+        store = TokenStore(
+            self.outdir / "tokens.npy", dtype=dtype, initial_capacity=100
+        )
+        store.append(list(self.tokens[:10]))
+        store.append([])
+        for start in range(10, 1000, 64):
+            store.append(self.tokens[start : start + 64])
+        return store
+
+    def test_store_and_load(self):
+        """Test that tokens appended in batches are loaded as memory-mapped tensors."""
+        store = self._fill_store()
+        self.assertEqual(len(store), 1000)
+        edge_index = torch.randint(0, 1000, (2, 5000))
+        edge_attr = torch.rand(5000, 1)
+        write_graph_store(
+            self.outdir,
+            store,
+            self.positions,
+            self.nuclei_types,
+            self.metadata,
+            edge_index=edge_index,
+            edge_attr=edge_attr,
+        )
+
+        graph = load_graph_store(self.outdir)
+        self.assertIsInstance(graph, CellGraphDataWSI)
+        self.assertEqual(graph.x.dtype, torch.float32)
+        self.assertTrue(torch.equal(graph.x, self.tokens))
+        self.assertTrue(torch.equal(graph.positions, self.positions))
+        self.assertTrue(torch.equal(graph.nuclei_types, self.nuclei_types))
+        self.assertEqual(graph.metadata, self.metadata)
+        self.assertTrue(torch.equal(graph.edge_index, edge_index))
+        self.assertTrue(torch.equal(graph.edge_attr, edge_attr))
+        self.assertIsInstance(
+            np.load(self.outdir / "tokens.npy", mmap_mode="r"), np.memmap
+        )
+
+    def test_float16_and_order(self):
+        """Test float16 storage and reordering the tokens on disk."""
+        store = self._fill_store(dtype="float16")
+        order = np.random.default_rng(0).permutation(1000)
+        write_graph_store(
+            self.outdir,
+            store,
+            self.positions[order],
+            self.nuclei_types[order],
+            self.metadata,
+            order=order,
+            chunk_size=100,
+        )
+
+        graph = load_graph_store(self.outdir)
+        self.assertEqual(graph.x.dtype, torch.float16)
+        self.assertTrue(torch.equal(graph.x, self.tokens[order].half()))
+        self.assertFalse((self.outdir / "tokens.reordered.npy").exists())
+
+    def test_empty(self):
+        """Test graph without cells."""
+        store = TokenStore(self.outdir / "tokens.npy")
+        write_graph_store(
+            self.outdir,
+            store,
+            torch.zeros((0, 2)),
+            torch.zeros((0,), dtype=torch.int64),
+            self.metadata,
+        )
+        graph = load_graph_store(self.outdir)
+        self.assertEqual(len(graph.x), 0)
+        self.assertEqual(len(graph.positions), 0)
+        self.assertIsNone(graph.edge_index)
+
+    def test_discard(self):
+        """Test that a discarded store releases the file and removes it with its empty directory."""
+        store = self._fill_store()
+        store.discard()
+        self.assertTrue(store.file.closed)
+        self.assertFalse(self.outdir.exists())
+
+    def test_slide_without_cells(self):
+        """Test that a slide without cells leaves no token file behind."""
+        wsi_outdir = self.outdir / "slide"
+        celldetector = CellViTInference.__new__(CellViTInference)
+        celldetector.logger = MagicMock()
+        celldetector.ledger = MagicMock()
+        on_complete = MagicMock()
+        slide = SlideInferenceState(
+            wsi_path=Path("slide.svs"),
+            run_id=1,
+            fail=MagicMock(),
+            on_complete=on_complete,
+            start_time=0.0,
+            wsi_outdir=wsi_outdir,
+            stitcher=MagicMock(num_cells_received=0),
+            graph_data={
+                "cell_tokens": TokenStore(wsi_outdir / "cells_graph" / "tokens.npy")
+            },
+        )
+        token_store = slide.graph_data["cell_tokens"]
+        celldetector._finalize_slide(slide)
+
+        self.assertTrue(token_store.file.closed)
+        self.assertFalse((wsi_outdir / "cells_graph").exists())
+        celldetector.ledger.finish.assert_called_once()
+        on_complete.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Test Chunked Instance Map Export
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import ujson
+from skimage.draw import disk
+
+from cellvit.output.instance_map import (
+    InstanceMapWriter,
+    read_cell_index,
+    read_instance_map,
+)
+from cellvit.utils.coordinate_transform import AffineTransform
+from cellvit.utils.tools import remap_label
+
+
+class TestInstanceMap(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.patch_size, self.overlap = 64, 16
+        self.stride = self.patch_size - self.overlap
+        self.num_rows, self.num_cols = 3, 4
+
+        # global label map, shifted by half of the overlap (first patch starts at -overlap/2)
+        rng = np.random.default_rng(3)
+        margin = self.overlap // 2
+        canvas = np.zeros(
+            (
+                self.num_rows * self.stride + self.overlap,
+                self.num_cols * self.stride + self.overlap,
+            ),
+            dtype=np.int32,
+        )
+        centers = []
+        for _ in range(80):
+            center = rng.integers(margin + 5, np.array(canvas.shape) - margin - 5)
+            rr, cc = disk(center, 4, shape=canvas.shape)
+            if np.any(canvas[rr, cc] > 0):
+                continue
+            centers.append(center - margin)
+            canvas[rr, cc] = len(centers)
+        self.canvas = canvas
+        self.centers = np.array(centers)
+
+        # patch-local instance maps and the patch owning each cell (center in the inner region)
+        self.patches = [
+            (row, col) for row in range(self.num_rows) for col in range(self.num_cols)
+        ]
+        self.inst_maps, self.local_ids = {}, {}
+        for row, col in self.patches:
+            crop = canvas[
+                row * self.stride : row * self.stride + self.patch_size,
+                col * self.stride : col * self.stride + self.patch_size,
+            ]
+            local_map = remap_label(crop)
+            self.inst_maps[(row, col)] = local_map
+            for global_id, local_id in zip(crop[crop > 0], local_map[crop > 0]):
+                self.local_ids[(row, col, int(global_id))] = int(local_id)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _cells_of_patch(self, patch):
+        owner = self.centers // self.stride
+        return [
+            {"patch_coordinates": list(patch), "inst_id": self.local_ids[(*patch, idx)]}
+            for idx in range(1, len(self.centers) + 1)
+            if tuple(owner[idx - 1]) == patch
+        ]
+
+    def test_stitched_map(self):
+        """Test that chunks are written once the neighbourhood is resolved and the stitched map equals the ground truth."""
+        writer = InstanceMapWriter(
+            self.tmp_dir / "instance_map.zarr",
+            patch_coordinates=self.patches,
+            patch_size=self.patch_size,
+            overlap=self.overlap,
+            num_levels=3,
+        )
+        writer.add_patches(self.patches, [self.inst_maps[p] for p in self.patches])
+
+        expected = np.zeros(
+            (self.num_rows * self.stride, self.num_cols * self.stride), dtype=np.uint32
+        )
+        margin = self.overlap // 2
+        resolved = set()
+        num_cells = 0
+        for patch in self.patches:
+            cells = self._cells_of_patch(patch)
+            for label, cell in enumerate(cells, start=num_cells + 1):
+                global_id = next(
+                    k[2]
+                    for k, v in self.local_ids.items()
+                    if k[:2] == patch and v == cell["inst_id"]
+                )
+                expected[
+                    self.canvas[margin:-margin, margin:-margin] == global_id
+                ] = label
+            writer.register_cells(cells, first_label=num_cells + 1)
+            self.assertTrue(all("inst_id" not in c for c in cells))
+            num_cells += len(cells)
+            resolved.add(patch)
+            writer.write_ready(resolved)
+            if patch == (0, 1):
+                # (0, 0) needs the resolved row below
+                self.assertEqual(writer.written, set())
+        self.assertEqual(writer.written, set(self.patches))
+        self.assertEqual(writer.inst_maps, {})
+
+        order = np.random.default_rng(0).permutation(num_cells)
+        writer.finalize(AffineTransform(scale=2.0), cell_order=order)
+
+        label_map = read_instance_map(self.tmp_dir / "instance_map.zarr")
+        np.testing.assert_array_equal(label_map, expected)
+        for level in [1, 2]:
+            np.testing.assert_array_equal(
+                read_instance_map(self.tmp_dir / "instance_map.zarr", level),
+                expected[:: 2**level, :: 2**level],
+            )
+        cell_index = read_cell_index(self.tmp_dir / "instance_map.zarr")
+        self.assertEqual(cell_index[0], -1)
+        np.testing.assert_array_equal(cell_index[order + 1], np.arange(num_cells))
+
+        with open(self.tmp_dir / "instance_map.zarr" / ".zattrs", "r") as infile:
+            attrs = ujson.load(infile)
+        self.assertEqual(attrs["num_cells"], num_cells)
+        datasets = attrs["multiscales"][0]["datasets"]
+        self.assertEqual(len(datasets), 3)
+        self.assertEqual(
+            datasets[1]["coordinateTransformations"][0]["scale"], [4.0, 4.0]
+        )
+
+    def test_unregistered_cells_and_levels(self):
+        """Test that cells which are not kept (e.g., removed duplicates) are not painted and levels are reduced to the chunk size."""
+        writer = InstanceMapWriter(
+            self.tmp_dir / "instance_map.zarr",
+            patch_coordinates=self.patches,
+            patch_size=self.patch_size,
+            overlap=self.overlap,
+            num_levels=8,
+        )
+        self.assertEqual(writer.num_levels, 5)  # 48 = 3 * 2^4
+        writer.add_patches(self.patches, [self.inst_maps[p] for p in self.patches])
+        writer.finalize(AffineTransform())
+        label_map = read_instance_map(self.tmp_dir / "instance_map.zarr")
+        self.assertFalse(label_map.any())
+        self.assertEqual(len(read_cell_index(self.tmp_dir / "instance_map.zarr")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Test Spatial Index
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import shutil
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from cellvit.output.cell_json import write_cell_json
+from cellvit.output.columnar import write_cells
+from cellvit.output.spatial_index import (
+    SpatialIndex,
+    hilbert_order,
+    write_spatial_index,
+)
+
+
+class TestSpatialIndex(unittest.TestCase):
+    def setUp(self):
+        self.outdir = Path("test_spatial_index_output")
+        self.outdir.mkdir(exist_ok=True)
+        rng = np.random.default_rng(7)
+        cells = []
+        for idx, (x, y) in enumerate(rng.uniform(0, 20000, size=(3000, 2)).tolist()):
+            size = rng.uniform(4, 20)
+            cells.append(
+                {
+                    "bbox": [[y - size, x - size], [y + size, x + size]],
+                    "centroid": [x, y],
+                    "contour": [[int(x), int(y)], [int(x) + 1, int(y)]],
+                    "type_prob": 0.5,
+                    "type": idx % 3,
+                    "patch_coordinates": [0, 0],
+                    "cell_status": 0,
+                }
+            )
+        self.cells = [cells[idx] for idx in hilbert_order(cells)]
+        self.bboxes = np.asarray([c["bbox"] for c in self.cells]).reshape(-1, 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir, ignore_errors=True)
+
+    def _brute_force(self, xmin, ymin, xmax, ymax):
+        b = self.bboxes
+        mask = (
+            (b[:, 1] <= xmax)
+            & (b[:, 3] >= xmin)
+            & (b[:, 0] <= ymax)
+            & (b[:, 2] >= ymin)
+        )
+        return np.nonzero(mask)[0]
+
+    def test_hilbert_order(self):
+        """Test that consecutive cells in Hilbert order are spatially close."""
+        centroids = np.asarray([c["centroid"] for c in self.cells])
+        hilbert_distance = np.linalg.norm(np.diff(centroids, axis=0), axis=1).mean()
+        random_distance = np.linalg.norm(
+            np.diff(
+                centroids[np.random.default_rng(0).permutation(len(centroids))], axis=0
+            ),
+            axis=1,
+        ).mean()
+        self.assertLess(hilbert_distance, random_distance / 5)
+
+    def test_json_query(self):
+        """Test rectangle queries on a json cell file."""
+        cell_dict = {"wsi_metadata": {}, "type_map": {}, "cells": self.cells}
+        spans = []
+        with open(self.outdir / "cells.json", "w") as outfile:
+            write_cell_json(outfile.write, cell_dict, chunk_size=100, cell_spans=spans)
+        write_spatial_index(
+            self.outdir / "cells.sidx", self.cells, self.outdir / "cells.json", spans
+        )
+
+        index = SpatialIndex(self.outdir / "cells.sidx")
+        self.assertEqual(index.num_cells, len(self.cells))
+        for roi in [
+            (1000, 2000, 3000, 2500),
+            (0, 0, 20000, 20000),
+            (-50, -50, -10, -10),
+        ]:
+            rows = index.query(*roi)
+            np.testing.assert_array_equal(rows, self._brute_force(*roi))
+            self.assertEqual(index.load_cells(rows), [self.cells[r] for r in rows])
+
+    def test_arrow_query(self):
+        """Test rectangle and polygon queries on an arrow cell file."""
+        path = write_cells(self.outdir / "cells", self.cells, file_format="arrow")
+        write_spatial_index(self.outdir / "cells.sidx", self.cells, path)
+
+        index = SpatialIndex(self.outdir / "cells.sidx")
+        roi = (5000, 5000, 9000, 7000)
+        rows = index.query(*roi)
+        np.testing.assert_array_equal(rows, self._brute_force(*roi))
+        loaded = index.query_cells(*roi)
+        self.assertEqual(
+            [c["centroid"] for c in loaded], [self.cells[r]["centroid"] for r in rows]
+        )
+
+        # triangle with vertices (0, 0), (10000, 0), (0, 10000)
+        rows = index.query_polygon([[0, 0], [10000, 0], [0, 10000]])
+        centroids = np.asarray([c["centroid"] for c in self.cells])
+        expected = np.nonzero(centroids.sum(axis=1) < 10000)[0]
+        np.testing.assert_array_equal(rows, expected)
+
+    def test_empty(self):
+        """Test index without cells."""
+        path = write_cells(self.outdir / "cells", [], file_format="arrow")
+        write_spatial_index(self.outdir / "cells.sidx", [], path)
+        index = SpatialIndex(self.outdir / "cells.sidx")
+        self.assertEqual(len(index.query(0, 0, 100, 100)), 0)
+        self.assertEqual(index.query_cells(0, 0, 100, 100), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Test Tiled Output
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import shutil
+import unittest
+from pathlib import Path
+
+import numpy as np
+import ujson
+
+from cellvit.output.compression import load_json
+from cellvit.output.tiles import write_tiles
+
+
+class TestTiles(unittest.TestCase):
+    def setUp(self):
+        self.outdir = Path("test_tiles_output")
+        self.label_map = {0: "Background", 1: "Neoplastic", 2: "Inflammatory"}
+        rng = np.random.default_rng(3)
+        self.cells = []
+        for idx, (x, y) in enumerate(rng.uniform(0, 10000, size=(500, 2)).tolist()):
+            self.cells.append(
+                {
+                    "bbox": [[y - 3, x - 3], [y + 3, x + 3]],
+                    "centroid": [x, y],
+                    "contour": [
+                        [int(x), int(y)],
+                        [int(x) + 2, int(y)],
+                        [int(x), int(y) + 2],
+                    ],
+                    "type_prob": 0.5,
+                    "type": 1 + idx % 2,
+                    "patch_coordinates": [0, 0],
+                    "cell_status": 0,
+                }
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir, ignore_errors=True)
+
+    def test_geojson_tiles(self):
+        """Test tile assignment, levels, counts and decimation of the manifest."""
+        manifest_path = write_tiles(
+            self.outdir, self.cells, self.label_map, tile_size=4096
+        )
+        with open(manifest_path, "r") as infile:
+            manifest = ujson.load(infile)
+
+        # 10000 px extent: 4096 (3x3 tiles), 8192 (2x2 tiles), 16384 (1 tile)
+        self.assertEqual(
+            [lvl["tile_size"] for lvl in manifest["levels"]], [4096, 8192, 16384]
+        )
+        level_0 = manifest["levels"][0]
+        self.assertEqual(len(level_0["tiles"]), 9)
+        self.assertEqual(sum(t["num_cells"] for t in level_0["tiles"]), len(self.cells))
+        self.assertEqual(
+            sum(t["counts"]["Neoplastic"] for t in level_0["tiles"]),
+            sum(c["type"] == 1 for c in self.cells),
+        )
+        for tile in level_0["tiles"]:
+            features = load_json(self.outdir / tile["file"])
+            self.assertTrue(
+                all(f["geometry"]["type"] == "MultiPolygon" for f in features)
+            )
+            num_cells = sum(len(f["geometry"]["coordinates"]) for f in features)
+            self.assertEqual(num_cells, tile["num_cells"])
+            xmin, ymin, xmax, ymax = tile["bbox"]
+            for feature in features:
+                for polygon in feature["geometry"]["coordinates"]:
+                    x, y = polygon[0][0]
+                    self.assertTrue(xmin <= x < xmax + 1 and ymin <= y < ymax + 1)
+
+        coarse = manifest["levels"][2]
+        self.assertEqual(coarse["decimation"], 16)
+        self.assertEqual(coarse["tiles"][0]["num_cells"], len(range(0, 500, 16)))
+        features = load_json(self.outdir / coarse["tiles"][0]["file"])
+        self.assertTrue(all(f["geometry"]["type"] == "MultiPoint" for f in features))
+
+    def test_compressed_tiles(self):
+        """Test that compressed tiles can be loaded."""
+        manifest_path = write_tiles(
+            self.outdir, self.cells, self.label_map, tile_size=20000, compression="zstd"
+        )
+        with open(manifest_path, "r") as infile:
+            manifest = ujson.load(infile)
+        self.assertEqual(len(manifest["levels"]), 1)
+        tile = manifest["levels"][0]["tiles"][0]
+        self.assertTrue(tile["file"].endswith(".geojson.zst"))
+        features = load_json(self.outdir / tile["file"])
+        self.assertEqual(sum(len(f["geometry"]["coordinates"]) for f in features), 500)
+
+    def test_point_tiles(self):
+        """Test tiles of detections without contours."""
+        detections = [
+            {"bbox": c["bbox"], "centroid": c["centroid"], "type": c["type"]}
+            for c in self.cells
+        ]
+        manifest_path = write_tiles(
+            self.outdir, detections, self.label_map, tile_size=20000, polygons=False
+        )
+        with open(manifest_path, "r") as infile:
+            manifest = ujson.load(infile)
+        self.assertEqual(manifest["levels"][0]["geometry"], "point")
+        features = load_json(self.outdir / manifest["levels"][0]["tiles"][0]["file"])
+        self.assertTrue(all(f["geometry"]["type"] == "MultiPoint" for f in features))
+        self.assertEqual(sum(len(f["geometry"]["coordinates"]) for f in features), 500)
+
+    def test_empty(self):
+        """Test tiled output without cells."""
+        manifest_path = write_tiles(self.outdir, [], self.label_map)
+        with open(manifest_path, "r") as infile:
+            manifest = ujson.load(infile)
+        self.assertEqual(manifest["levels"][0]["tiles"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
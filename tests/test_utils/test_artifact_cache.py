@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Test Artifact Cache
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import os
+import shutil
+import tempfile
+import unittest
+from functools import partial
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import torch
+
+from cellvit.inference.inference import CellViTInference
+from cellvit.utils.artifact_cache import ArtifactCache
+
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.cache = ArtifactCache(
+            self.tmp_dir / "artifacts", max_size_mb=1, logger=MagicMock()
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_key(self):
+        """Test that the key is independent of the order and changes with each component."""
+        key = ArtifactCache.key(checkpoint="abc", batch_size=8, device="cuda")
+        self.assertEqual(
+            key, ArtifactCache.key(device="cuda", batch_size=8, checkpoint="abc")
+        )
+        self.assertNotEqual(
+            key, ArtifactCache.key(checkpoint="abc", batch_size=16, device="cuda")
+        )
+        self.assertEqual(len(key), 16)
+
+    def test_put_get(self):
+        """Test that a stored artifact is returned unchanged and a missing one is a miss."""
+        self.assertIsNone(self.cache.get("missing"))
+        self.cache.put("key", b"compiled graph", metadata={"batch_size": 8})
+        self.assertEqual(self.cache.get("key"), b"compiled graph")
+        self.assertEqual(self.cache.size(), len(b"compiled graph"))
+        self.assertEqual(list(self.cache.directory.glob("*.tmp")), [])
+
+    def test_corrupt_entry(self):
+        """Test that corrupt artifacts and artifacts without sidecar are removed."""
+        path = self.cache.put("key", b"compiled graph")
+        path.write_bytes(b"compiled grapf")
+        self.assertIsNone(self.cache.get("key"))
+        self.assertFalse(path.exists())
+
+        path = self.cache.put("key", b"compiled graph")
+        path.with_suffix(".json").unlink()
+        self.assertIsNone(self.cache.get("key"))
+        self.assertFalse(path.exists())
+
+    def test_lru_eviction(self):
+        """Test that the least recently used artifacts are evicted above the size cap."""
+        data = b"0" * 400 * 1024
+        for idx, key in enumerate(["first", "second"]):
+            path = self.cache.put(key, data)
+            os.utime(path, (idx, idx))
+        # hit makes the first artifact the most recently used one
+        self.assertEqual(self.cache.get("first"), data)
+        self.cache.put("third", data)
+
+        self.assertIsNone(self.cache.get("second"))
+        self.assertEqual(self.cache.get("first"), data)
+        self.assertEqual(self.cache.get("third"), data)
+        self.assertLessEqual(self.cache.size(), self.cache.max_size)
+
+    def test_setup_compilation(self):
+        """Test that the pipeline loads cached artifacts before compiling the model."""
+        checkpoint_path = self.tmp_dir / "CellViT-256-x40-AMP.pth"
+        checkpoint_path.write_bytes(b"checkpoint")
+        celldetector = CellViTInference.__new__(CellViTInference)
+        celldetector.compile_model = True
+        celldetector.artifact_cache_size = 1
+        celldetector.model = MagicMock()
+        celldetector.model_path = checkpoint_path
+        celldetector.model_arch = "CellViT256"
+        celldetector.device = "cpu"
+        celldetector.mixed_precision = False
+        celldetector.batch_size = 8
+        celldetector.logger = MagicMock()
+
+        save_artifacts = MagicMock(return_value=(b"compiled graph", None))
+        with patch.object(
+            torch.compiler, "save_cache_artifacts", save_artifacts, create=True
+        ):
+            with patch(
+                "torch.compiler.load_cache_artifacts", create=True
+            ) as load_artifacts:
+                with patch(
+                    "cellvit.inference.inference.ArtifactCache",
+                    partial(ArtifactCache, self.cache.directory),
+                ):
+                    celldetector._setup_compilation()
+                    load_artifacts.assert_not_called()
+                    celldetector._save_compiled_artifacts()
+                    celldetector._setup_compilation()
+                    load_artifacts.assert_called_once_with(b"compiled graph")
+
+                    # other batch size, other compiled graph
+                    celldetector.batch_size = 16
+                    celldetector._setup_compilation()
+                    load_artifacts.assert_called_once()
+        self.assertEqual(celldetector.model.compile.call_count, 3)
+        self.assertEqual(len(list(self.cache.directory.glob("*.bin"))), 1)
+
+    def test_compilation_without_cache_api(self):
+        """Test that the model is compiled without the cache if PyTorch lacks the cache artifacts API."""
+        celldetector = CellViTInference.__new__(CellViTInference)
+        celldetector.compile_model = True
+        celldetector.model = MagicMock()
+        celldetector.logger = MagicMock()
+        with patch("torch.compiler", MagicMock(spec=[])):
+            with patch("cellvit.inference.inference.ArtifactCache") as artifact_cache:
+                celldetector._setup_compilation()
+                celldetector._save_compiled_artifacts()
+                artifact_cache.assert_not_called()
+        celldetector.model.compile.assert_called_once()
+        celldetector.logger.warning.assert_called_once()
+        self.assertIsNone(celldetector.artifact_key)
+
+        # failing to store the artifacts does not abort the inference
+        celldetector.artifact_cache = MagicMock()
+        celldetector.artifact_key = "key"
+        save_artifacts = MagicMock(side_effect=RuntimeError("unsupported"))
+        with patch.object(
+            torch.compiler, "save_cache_artifacts", save_artifacts, create=True
+        ):
+            celldetector._save_compiled_artifacts()
+        celldetector.artifact_cache.put.assert_not_called()
+        self.assertIsNone(celldetector.artifact_key)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Test Affine Coordinate Transformations
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import copy
+import unittest
+
+import numpy as np
+import torch
+
+from cellvit.utils.coordinate_transform import AffineTransform
+
+
+def reference_transform(cell, scale, correction_width, correction_height):
+    """Per-point reference implementation (rescaling followed by padding removal)"""
+    cell = copy.deepcopy(cell)
+    cell["bbox"] = [
+        [b[0] * scale - correction_height, b[1] * scale - correction_width]
+        for b in cell["bbox"]
+    ]
+    cell["centroid"] = [
+        cell["centroid"][0] * scale - correction_width,
+        cell["centroid"][1] * scale - correction_height,
+    ]
+    if "contour" in cell:
+        cell["contour"] = [
+            [
+                round(c[0] * scale - correction_width),
+                round(c[1] * scale - correction_height),
+            ]
+            for c in cell["contour"]
+        ]
+    return cell
+
+
+class TestAffineTransform(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        self.cells = []
+        for _ in range(50):
+            x, y = rng.uniform(0, 5000, size=2)
+            contour = rng.uniform(-10, 10, size=(rng.integers(3, 20), 2)) + [x, y]
+            self.cells.append(
+                {
+                    "bbox": [[y - 10.0, x - 10.0], [y + 10.0, x + 10.0]],
+                    "centroid": [x, y],
+                    "contour": contour.tolist(),
+                    "type": 1,
+                }
+            )
+
+    def test_identity(self):
+        """Test that the identity transformation does not change the cells."""
+        transform = AffineTransform()
+        self.assertTrue(transform.is_identity)
+        cells = copy.deepcopy(self.cells)
+        self.assertEqual(transform.apply_cells(cells), self.cells)
+
+    def test_scaling_and_translation(self):
+        """Test composition of rescaling and padding removal against the per-point reference."""
+        scale, correction_width, correction_height = 1.0784, 320, 17
+        transform = AffineTransform(scale=scale).then(
+            AffineTransform(translation=(-correction_width, -correction_height))
+        )
+        transformed = transform.apply_cells(copy.deepcopy(self.cells))
+        for cell, result in zip(self.cells, transformed):
+            self.assertEqual(
+                result,
+                reference_transform(cell, scale, correction_width, correction_height),
+            )
+
+    def test_detection_without_contour(self):
+        """Test that cells without contour can be transformed."""
+        cells = [{"bbox": c["bbox"], "centroid": c["centroid"]} for c in self.cells]
+        transformed = AffineTransform(scale=2.0).apply_cells(cells, contour=False)
+        self.assertEqual(
+            transformed[0]["centroid"], [v * 2 for v in self.cells[0]["centroid"]]
+        )
+        self.assertNotIn("contour", transformed[0])
+
+    def test_integer_translation_keeps_integers(self):
+        """Test that integer coordinates stay integers for a pure integer translation."""
+        transform = AffineTransform(translation=(-5, 3))
+        points = transform.apply_points(np.array([[10, 20]]))
+        self.assertTrue(np.issubdtype(points.dtype, np.integer))
+        self.assertEqual(points.tolist(), [[5, 23]])
+        bbox = transform.apply_points(np.array([[20, 10]]), flip=True)
+        self.assertEqual(bbox.tolist(), [[23, 5]])
+
+    def test_tensor(self):
+        """Test transformation of stacked positions."""
+        positions = torch.tensor([[10.0, 20.0], [0.0, 5.0]])
+        transform = AffineTransform(scale=0.5, translation=(1, -1))
+        result = transform.apply_tensor(positions)
+        self.assertTrue(torch.allclose(result, torch.tensor([[6.0, 9.0], [1.0, 1.5]])))
+        self.assertEqual(result.dtype, positions.dtype)
+
+    def test_empty_contours(self):
+        """Test contours without points."""
+        self.assertEqual(AffineTransform(scale=2.0).apply_contours([[], []]), [[], []])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,6 +6,7 @@
 # University Medicine Essen
 
 import os
+import time
 import unittest
 from unittest import TestCase
 from unittest.mock import MagicMock, mock_open, patch
@@ -18,6 +19,7 @@ from cellvit.utils.ressource_manager import (
     get_cpu_memory_vm_or_server,
     get_cpu_resources,
     get_gpu_resources,
+    get_job_array_shard,
     get_used_memory,
     get_used_memory_kubernetes,
     get_used_memory_process,
@@ -40,6 +42,30 @@ class TestRessourceManager(unittest.TestCase):
         """Test is_slurm when SLURM_JOB_ID is not set."""
         self.assertFalse(is_slurm())
 
+    @patch.dict(
+        os.environ,
+        {
+            "SLURM_ARRAY_TASK_ID": "7",
+            "SLURM_ARRAY_TASK_MIN": "1",
+            "SLURM_ARRAY_TASK_STEP": "2",
+            "SLURM_ARRAY_TASK_COUNT": "10",
+        },
+        clear=True,
+    )
+    def test_get_job_array_shard_slurm(self):
+        """Test the shard of a SLURM job array with offset and step (1-19:2)."""
+        self.assertEqual(get_job_array_shard(), (3, 10))
+
+    @patch.dict(os.environ, {"JOB_COMPLETION_INDEX": "4"}, clear=True)
+    def test_get_job_array_shard_kubernetes(self):
+        """Test the shard of a Kubernetes indexed job."""
+        self.assertEqual(get_job_array_shard(), (4, None))
+
+    @patch.dict(os.environ, {}, clear=True)
+    def test_get_job_array_shard_none(self):
+        """Test that no shard is returned outside of job arrays."""
+        self.assertEqual(get_job_array_shard(), (None, None))
+
     @patch("os.path.exists", return_value=True)
     @patch.dict(os.environ, {"KUBERNETES_SERVICE_HOST": "localhost"})
     def test_is_kubernetes_true(self, mock_exists):
@@ -511,6 +537,30 @@ class TestSystemConfiguration(unittest.TestCase):
         self.assertFalse(config.cucim)
         self.assertFalse(config.numba)
 
+    @patch("cellvit.utils.ressource_manager.get_cpu_resources")
+    @patch("cellvit.utils.ressource_manager.get_gpu_resources")
+    def test_split_between_processes(
+        self, mock_get_gpu_resources, mock_get_cpu_resources
+    ):
+        mock_get_cpu_resources.return_value = ((66, 262144), "server")
+        mock_get_gpu_resources.return_value = {
+            "has_gpu": False,
+            "gpu_count": 1,
+            "devices": {0: {"total_memory_gb": 0}},
+        }
+        config = SystemConfiguration()
+        self.assertEqual(config.ray_worker, 8)
+
+        worker_config = config.split_between_processes(4)
+        self.assertEqual(worker_config.cpu_count, 16)
+        self.assertEqual(worker_config.ray_worker, 2)
+        self.assertEqual(worker_config.ray_remote_cpus, config.ray_remote_cpus)
+        self.assertEqual(worker_config.memory, 262144)
+        self.assertEqual(config.cpu_count, 66)  # unchanged
+
+        worker_config = config.split_between_processes(16)
+        self.assertEqual((worker_config.cpu_count, worker_config.ray_worker), (4, 1))
+
     @patch("cellvit.utils.ressource_manager.get_cpu_resources")
     @patch("cellvit.utils.ressource_manager.get_gpu_resources")
     def test_invalid_gpu_index(self, mock_get_gpu_resources, mock_get_cpu_resources):
@@ -528,6 +578,34 @@ class TestSystemConfiguration(unittest.TestCase):
         with self.assertRaises(SystemError):
             SystemConfiguration(gpu=2)
 
+    @patch("cellvit.utils.ressource_manager.get_cupy_available")
+    @patch("cellvit.utils.ressource_manager.get_cpu_resources")
+    @patch("cellvit.utils.ressource_manager.get_gpu_resources")
+    def test_concurrent_probes(
+        self, mock_get_gpu_resources, mock_get_cpu_resources, mock_get_cupy_available
+    ):
+        """Test that the environment probes run concurrently."""
+
+        def slow_probe(result):
+            def probe():
+                time.sleep(0.3)
+                return result
+
+            return probe
+
+        mock_get_cpu_resources.side_effect = slow_probe(((8, 16384), "server"))
+        mock_get_gpu_resources.side_effect = slow_probe(
+            {"has_gpu": True, "gpu_count": 1, "devices": {0: {"total_memory_gb": 8.0}}}
+        )
+        mock_get_cupy_available.side_effect = slow_probe(True)
+
+        config = SystemConfiguration()
+        self.assertEqual(config.cpu_count, 8)
+        self.assertEqual(config.gpu_memory, 8.0)
+        self.assertTrue(config.cupy)
+        self.assertGreaterEqual(config.probe_duration, 0.3)
+        self.assertLess(config.probe_duration, 0.6)
+
     @patch("cellvit.utils.ressource_manager.logging.getLogger")
     @patch("cellvit.utils.ressource_manager.get_cpu_resources")
     @patch("cellvit.utils.ressource_manager.get_gpu_resources")
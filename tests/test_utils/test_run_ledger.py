@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+# Test Run Ledger
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import ujson
+
+from cellvit.detect_cells import process_dataset_group, process_dataset_wsi
+from cellvit.inference.inference import CellViTInference
+from cellvit.merge_runs import merge_runs
+from cellvit.utils.run_ledger import RunLedger, config_hash, slide_fingerprint
+
+
+class TestRunLedger(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.ledger = RunLedger(self.tmp_dir / "run_ledger.sqlite")
+
+    def tearDown(self):
+        self.ledger.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fingerprint(self):
+        """Test that the fingerprint depends on the content, not on the path."""
+        content = bytes(range(256)) * 10000
+        (self.tmp_dir / "a.svs").write_bytes(content)
+        (self.tmp_dir / "b.svs").write_bytes(content)
+        (self.tmp_dir / "c.svs").write_bytes(content[:-1] + b"\x00")
+        self.assertEqual(
+            slide_fingerprint(self.tmp_dir / "a.svs"),
+            slide_fingerprint(self.tmp_dir / "b.svs"),
+        )
+        self.assertNotEqual(
+            slide_fingerprint(self.tmp_dir / "a.svs"),
+            slide_fingerprint(self.tmp_dir / "c.svs"),
+        )
+
+    def test_config_hash(self):
+        """Test that the configuration hash is independent of the key order."""
+        self.assertEqual(
+            config_hash({"model": "SAM", "taxonomy": "pannuke"}),
+            config_hash({"taxonomy": "pannuke", "model": "SAM"}),
+        )
+        self.assertNotEqual(
+            config_hash({"model": "SAM", "taxonomy": "pannuke"}),
+            config_hash({"model": "SAM", "taxonomy": "binary"}),
+        )
+
+    def test_status(self):
+        """Test the status of attempts, keyed by slide, fingerprint and configuration."""
+        key = ("slide.svs", "abc", "config_1")
+        self.assertIsNone(self.ledger.status(*key))
+        run_id = self.ledger.start(*key)
+        self.assertEqual(self.ledger.status(*key), "started")
+        self.ledger.fail(run_id, "OSError('disk full')")
+        self.assertEqual(self.ledger.status(*key), "failed")
+        self.assertEqual(
+            self.ledger.failures(), [("slide.svs", "OSError('disk full')")]
+        )
+
+        run_id = self.ledger.start(*key)
+        self.ledger.finish(run_id, num_cells=100, timings={"inference": 1.0})
+        self.assertEqual(self.ledger.status(*key), "finished")
+        self.assertEqual(self.ledger.failures(), [])
+        # a later attempt does not change the finished status
+        self.ledger.start(*key)
+        self.assertEqual(self.ledger.status(*key), "finished")
+
+        # other configuration or content
+        self.assertIsNone(self.ledger.status("slide.svs", "abc", "config_2"))
+        self.assertIsNone(self.ledger.status("slide.svs", "def", "config_1"))
+
+        # append-only: every event is a row, results reference their attempt
+        connection = sqlite3.connect(str(self.tmp_dir / "run_ledger.sqlite"))
+        rows = connection.execute(
+            "SELECT id, run_id, status, num_cells, timings FROM runs ORDER BY id"
+        ).fetchall()
+        connection.close()
+        self.assertEqual(
+            [row[2] for row in rows],
+            ["started", "failed", "started", "finished", "started"],
+        )
+        self.assertEqual(rows[3][1], rows[2][0])
+        self.assertEqual(rows[3][3], 100)
+        self.assertEqual(ujson.loads(rows[3][4]), {"inference": 1.0})
+
+    def test_unreadable_slide(self):
+        """Test that a missing slide fails in the dataset loop instead of aborting it."""
+        celldetector = CellViTInference.__new__(CellViTInference)
+        celldetector.logger = MagicMock()
+        celldetector.ledger = self.ledger
+        celldetector.ledger_path = self.ledger.path
+        celldetector._resolve_ledger_paths()
+        celldetector.config_hash = "abc"
+        missing = self.tmp_dir / "missing.svs"
+        self.assertIsNone(celldetector.run_status(missing))
+        key = celldetector._ledger_key(missing)
+        self.ledger.fail(self.ledger.start(*key), "FileNotFoundError()")
+        self.assertEqual(celldetector.run_status(missing), "failed")
+
+        on_error = MagicMock()
+        celldetector.process_wsi = MagicMock()
+        celldetector.run_status = MagicMock(side_effect=sqlite3.OperationalError())
+        self.assertIsNone(process_dataset_wsi(celldetector, missing, on_error=on_error))
+        on_error.assert_called_once()
+        celldetector.process_wsi.assert_not_called()
+
+        on_error.reset_mock()
+        celldetector.process_wsi_group = MagicMock()
+        statuses = process_dataset_group(
+            celldetector, [{"wsi_path": missing, "on_error": on_error}]
+        )
+        self.assertEqual(statuses, [None])
+        on_error.assert_called_once()
+        celldetector.process_wsi_group.assert_not_called()
+
+    def test_status_of_other_ledgers(self):
+        """Test that the run status considers the ledgers of other shards and the merged ledger."""
+        (self.tmp_dir / "a.svs").write_bytes(b"a" * 100)
+        celldetector = CellViTInference.__new__(CellViTInference)
+        celldetector.ledger_path = self.tmp_dir / "run_ledger_shard_0000_of_0002.sqlite"
+        celldetector.ledger = RunLedger(celldetector.ledger_path)
+        celldetector._resolve_ledger_paths()
+        celldetector.config_hash = "abc"
+        key = celldetector._ledger_key(self.tmp_dir / "a.svs")
+        self.assertIsNone(celldetector.run_status(self.tmp_dir / "a.svs"))
+
+        # failed in an earlier unsharded run, retried by a shard of the current run
+        self.ledger.fail(self.ledger.start(*key), "OSError()")
+        self.assertEqual(celldetector.run_status(self.tmp_dir / "a.svs"), "failed")
+        celldetector.ledger.start(*key)
+        self.assertEqual(celldetector.run_status(self.tmp_dir / "a.svs"), "started")
+
+        # finished by a run with a different number of shards
+        other = RunLedger(self.tmp_dir / "run_ledger_shard_0002_of_0003.sqlite")
+        other.finish(other.start(*key), num_cells=10)
+        other.close()
+        celldetector._resolve_ledger_paths()
+        self.assertEqual(celldetector.run_status(self.tmp_dir / "a.svs"), "finished")
+        celldetector.ledger.close()
+
+    def test_effective_config_hash(self):
+        """Test that options without effect on the outputs do not change the configuration hash."""
+
+        def setup_hash(**options):
+            celldetector = CellViTInference.__new__(CellViTInference)
+            celldetector.logger = MagicMock()
+            celldetector.outdir = self.tmp_dir
+            celldetector.ledger_path = self.ledger.path
+            settings = {
+                "model_name": "SAM",
+                "nuclei_taxonomy": "pannuke",
+                "patch_size": 1024,
+                "overlap": 64,
+                "geojson": False,
+                "graph": False,
+                "compression": False,
+                "compression_codec": "snappy",
+                "cell_cleaner": "overlap",
+                "file_format": "json",
+                "spatial_index": False,
+                "tile_size": None,
+                "graph_format": "pt",
+                "graph_dtype": "float32",
+                "graph_edges": None,
+                "graph_edge_k": 8,
+                "graph_edge_radius": 50.0,
+                "detection_only": False,
+                "detection_engine": "watershed",
+                "instance_map": False,
+                "instance_map_levels": 1,
+                "contour_encoding": False,
+                "contour_precision": 1.0,
+                "contour_tolerance": 0.0,
+                "weight_dtype": "float32",
+            }
+            settings.update(options)
+            for key, value in settings.items():
+                setattr(celldetector, key, value)
+            celldetector._setup_ledger()
+            celldetector.ledger.close()
+            return celldetector.config_hash
+
+        reference = setup_hash()
+        self.assertEqual(reference, setup_hash(compression_codec="zstd"))
+        self.assertEqual(
+            reference, setup_hash(contour_precision=0.5, contour_tolerance=1.0)
+        )
+        self.assertNotEqual(
+            setup_hash(compression=True),
+            setup_hash(compression=True, compression_codec="zstd"),
+        )
+        self.assertNotEqual(
+            setup_hash(contour_encoding=True),
+            setup_hash(contour_encoding=True, contour_tolerance=1.0),
+        )
+
+    def test_summary(self):
+        """Test the throughput report and the usage from multiple threads."""
+
+        def process(idx):
+            run_id = self.ledger.start(f"slide_{idx}.svs", str(idx), "config")
+            if idx % 4 == 0:
+                self.ledger.fail(run_id, "error")
+            else:
+                self.ledger.finish(run_id, num_cells=10)
+
+        threads = [threading.Thread(target=process, args=(idx,)) for idx in range(16)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+
+        report = self.ledger.summary()
+        self.assertEqual(report["num_finished"], 12)
+        self.assertEqual(report["num_failed"], 4)
+        self.assertEqual(report["num_cells"], 120)
+        self.assertGreaterEqual(report["wall_time"], 0)
+        self.assertEqual(len(self.ledger.failures()), 4)
+        self.assertEqual(self.ledger.summary(config_hash="other")["num_finished"], 0)
+
+        # a slide finished after a failed attempt is not reported as failed
+        self.ledger.fail(self.ledger.start("slide_0.svs", "0", "config"), "error")
+        self.ledger.finish(self.ledger.start("slide_0.svs", "0", "config"))
+        report = self.ledger.summary()
+        self.assertEqual(report["num_finished"], 13)
+        self.assertEqual(report["num_failed"], 3)
+        self.assertEqual(len(self.ledger.failures()), 3)
+
+        # reopening the ledger keeps all records
+        ledger = RunLedger(self.tmp_dir / "run_ledger.sqlite")
+        self.assertEqual(ledger.summary()["num_finished"], 13)
+        ledger.close()
+
+    def test_merge_runs(self):
+        """Test merging the ledgers of the shards of a job array."""
+        for shard in range(2):
+            ledger = RunLedger(
+                self.tmp_dir / f"run_ledger_shard_{shard:04d}_of_0002.sqlite"
+            )
+            for idx in range(3):
+                run_id = ledger.start(f"slide_{shard}_{idx}.svs", "fp", "config")
+                if shard == 1 and idx == 0:
+                    ledger.fail(run_id, "error")
+                else:
+                    ledger.finish(run_id, num_cells=10 * (shard + 1))
+            ledger.close()
+
+        for _ in range(2):  # repeatable
+            summary = merge_runs(self.tmp_dir)
+        self.assertEqual(len(summary["shards"]), 2)
+        self.assertEqual(
+            summary["shards"]["run_ledger_shard_0001_of_0002"]["num_failed"], 1
+        )
+        self.assertEqual(summary["total"]["num_finished"], 5)
+        self.assertEqual(summary["total"]["num_cells"], 70)
+        self.assertEqual(summary["failures"], [["slide_1_0.svs", "error"]])
+
+        merged = RunLedger(self.tmp_dir / "run_ledger_merged.sqlite")
+        self.assertEqual(merged.status("slide_1_2.svs", "fp", "config"), "finished")
+        rows = merged.connection.execute(
+            "SELECT r.slide, s.slide FROM runs AS r JOIN runs AS s ON r.run_id = s.id"
+        ).fetchall()
+        merged.close()
+        self.assertEqual(len(rows), 6)
+        self.assertTrue(all(row[0] == row[1] for row in rows))
+
+
+if __name__ == "__main__":
+    unittest.main()
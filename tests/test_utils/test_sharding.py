@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Test Dataset Sharding
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from cellvit.utils.sharding import partition_balanced, select_shard, shard_ledger_name
+
+
+class TestSharding(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_partition_balanced(self):
+        """Test that the partition is complete, disjoint and balanced by size."""
+        sizes = np.random.default_rng(0).integers(1, 1000, 500).tolist()
+        shards = partition_balanced(sizes, 16)
+        self.assertEqual(sorted(sum(shards, [])), list(range(500)))
+        self.assertTrue(all(shard == sorted(shard) for shard in shards))
+        loads = [sum(sizes[idx] for idx in shard) for shard in shards]
+        # longest processing time first: imbalance bounded by the largest item
+        self.assertLessEqual(max(loads) - min(loads), max(sizes))
+        self.assertEqual(partition_balanced(sizes, 16), shards)
+
+        # more shards than items
+        shards = partition_balanced([5, 3], 4)
+        self.assertEqual(shards, [[0], [1], [], []])
+
+    def test_select_shard(self):
+        """Test that all shards together contain each WSI once, independent of the list order."""
+        wsi_jobs = []
+        for idx in range(20):
+            path = self.tmp_dir / f"slide_{idx:02d}.svs"
+            path.write_bytes(b"0" * (idx % 5 + 1) * 100)
+            wsi_jobs.append((path, None, None))
+        shards = [select_shard(wsi_jobs, idx, 3) for idx in range(3)]
+        self.assertEqual(sorted(sum(shards, [])), sorted(wsi_jobs))
+        self.assertEqual(
+            [sorted(shard) for shard in shards],
+            [sorted(select_shard(wsi_jobs[::-1], idx, 3)) for idx in range(3)],
+        )
+        with self.assertRaises(AssertionError):
+            select_shard(wsi_jobs, 3, 3)
+
+    def test_shard_ledger_name(self):
+        """Test the ledger name of a shard."""
+        self.assertEqual(
+            shard_ledger_name(3, 200), "run_ledger_shard_0003_of_0200.sqlite"
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# Test Inference Weight Cache
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import torch
+import torch.nn as nn
+
+from cellvit.inference.inference import CellViTInference
+from cellvit.utils.weight_cache import (
+    convert_checkpoint,
+    inference_weights_path,
+    load_inference_weights,
+    weight_cache_supported,
+)
+
+
+class TinyModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.encoder = nn.Linear(8, 16)
+        self.norm = nn.BatchNorm1d(16)
+        self.patch_size = 16
+
+
+class TestWeightCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.model = TinyModel()
+        self.checkpoint_path = self.tmp_dir / "CellViT-256-x40-AMP.pth"
+        torch.save(
+            {
+                "arch": "CellViT256",
+                "config": {"data.num_nuclei_classes": 6, "model.backbone": "ViT256"},
+                "model_state_dict": self.model.state_dict(),
+                "optimizer_state_dict": {"state": torch.randn(1000)},
+            },
+            self.checkpoint_path,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_convert_checkpoint(self):
+        """Test that just the weights are kept and cast to the weight dtype."""
+        output_path = inference_weights_path(self.checkpoint_path, "float16")
+        self.assertEqual(output_path.name, "CellViT-256-x40-AMP-inference-float16.pt")
+        convert_checkpoint(self.checkpoint_path, output_path, "float16")
+
+        converted = torch.load(output_path, map_location="cpu")
+        self.assertNotIn("optimizer_state_dict", converted)
+        self.assertEqual(converted["arch"], "CellViT256")
+        self.assertEqual(converted["weight_dtype"], "float16")
+        state_dict = converted["model_state_dict"]
+        self.assertEqual(state_dict["encoder.weight"].dtype, torch.float16)
+        self.assertEqual(state_dict["norm.num_batches_tracked"].dtype, torch.int64)
+        self.assertTrue(
+            torch.allclose(
+                state_dict["encoder.weight"].float(),
+                self.model.encoder.weight,
+                atol=1e-3,
+            )
+        )
+        self.assertEqual(list(self.tmp_dir.glob(".*.tmp")), [])
+
+    def test_load_inference_weights(self):
+        """Test that the checkpoint is converted once and again after it has been replaced."""
+        weights = load_inference_weights(self.checkpoint_path, logger=MagicMock())
+        weights_path = inference_weights_path(self.checkpoint_path)
+        self.assertTrue(weights_path.exists())
+        self.assertTrue(
+            torch.equal(
+                weights["model_state_dict"]["encoder.weight"], self.model.encoder.weight
+            )
+        )
+
+        converted_mtime = weights_path.stat().st_mtime_ns
+        load_inference_weights(self.checkpoint_path, logger=MagicMock())
+        self.assertEqual(weights_path.stat().st_mtime_ns, converted_mtime)
+
+        # replaced checkpoint
+        new_model = TinyModel()
+        torch.save(
+            {
+                "arch": "CellViT256",
+                "config": {},
+                "model_state_dict": new_model.state_dict(),
+            },
+            self.checkpoint_path,
+        )
+        os.utime(self.checkpoint_path, (0, 0))
+        weights = load_inference_weights(self.checkpoint_path, logger=MagicMock())
+        self.assertTrue(
+            torch.equal(
+                weights["model_state_dict"]["encoder.weight"], new_model.encoder.weight
+            )
+        )
+
+    def test_load_model_on_meta_device(self):
+        """Test that the pipeline assigns the cached weights to a model created on the meta device."""
+        celldetector = CellViTInference.__new__(CellViTInference)
+        celldetector.model_name = "HIPT"
+        celldetector.shared_model = None
+        celldetector.weight_cache = True
+        celldetector.weight_dtype = "bfloat16"
+        celldetector.device = "cpu"
+        celldetector.logger = MagicMock()
+
+        devices = []
+
+        def get_model(model_type):
+            devices.append(torch.empty(1).device.type)
+            return TinyModel()
+
+        celldetector._get_model = get_model
+        with patch(
+            "cellvit.inference.inference.cache_cellvit_256",
+            return_value=self.checkpoint_path,
+        ):
+            celldetector._load_model()
+
+        self.assertEqual(devices, ["meta"])
+        self.assertEqual(celldetector.model_arch, "CellViT256")
+        self.assertEqual(celldetector.run_conf["data"]["num_nuclei_classes"], 6)
+        weight = celldetector.model.encoder.weight
+        self.assertEqual(weight.device.type, "cpu")
+        self.assertEqual(weight.dtype, torch.float32)
+        self.assertTrue(torch.allclose(weight, self.model.encoder.weight, atol=1e-2))
+        self.assertFalse(celldetector.model.training)
+
+    def _pipeline(self, weight_dtype):
+        """Pipeline without setup, loading the tiny model from the checkpoint"""
+        celldetector = CellViTInference.__new__(CellViTInference)
+        celldetector.model_name = "HIPT"
+        celldetector.shared_model = None
+        celldetector.weight_cache = True
+        celldetector.weight_dtype = weight_dtype
+        celldetector.device = "cpu"
+        celldetector.logger = MagicMock()
+        return celldetector
+
+    def test_cast_on_device(self):
+        """Test that half precision weights are moved to the device before they are cast to float32."""
+        calls = []
+
+        class RecordingModel(TinyModel):
+            def to(self, *args, **kwargs):
+                calls.append(("to", self.encoder.weight.dtype))
+                return super().to(*args, **kwargs)
+
+            def float(self):
+                calls.append(("float", self.encoder.weight.dtype))
+                return super().float()
+
+        celldetector = self._pipeline("float16")
+        celldetector._get_model = lambda model_type: RecordingModel()
+        with patch(
+            "cellvit.inference.inference.cache_cellvit_256",
+            return_value=self.checkpoint_path,
+        ):
+            celldetector._load_model()
+        self.assertEqual(calls, [("to", torch.float16), ("float", torch.float16)])
+        self.assertEqual(celldetector.model.encoder.weight.dtype, torch.float32)
+
+    def test_read_only_checkpoint_directory(self):
+        """Test that the checkpoint is loaded without weight cache if the converted weights cannot be written."""
+        celldetector = self._pipeline("bfloat16")
+        celldetector._get_model = lambda model_type: TinyModel()
+        with patch(
+            "cellvit.inference.inference.cache_cellvit_256",
+            return_value=self.checkpoint_path,
+        ), patch(
+            "cellvit.utils.weight_cache.torch.save",
+            side_effect=PermissionError("Read-only file system"),
+        ):
+            celldetector._load_model()
+
+        celldetector.logger.warning.assert_called_once()
+        self.assertFalse(inference_weights_path(self.checkpoint_path).exists())
+        self.assertEqual(list(self.tmp_dir.glob(".*.tmp")), [])
+        weight = celldetector.model.encoder.weight
+        self.assertEqual(weight.dtype, torch.float32)
+        # rounded like the cached weights
+        self.assertTrue(
+            torch.equal(weight, self.model.encoder.weight.to(torch.bfloat16).float())
+        )
+
+    def test_unsupported_torch(self):
+        """Test that the pipeline loads the full checkpoint if torch.load cannot memory-map (PyTorch < 2.1)."""
+        self.assertTrue(weight_cache_supported())
+
+        def load_without_mmap(f, map_location=None, pickle_module=None, **kwargs):
+            return original_load(f, map_location=map_location)
+
+        original_load = torch.load
+        with patch("torch.load", load_without_mmap):
+            self.assertFalse(weight_cache_supported())
+
+            celldetector = CellViTInference.__new__(CellViTInference)
+            celldetector.model_name = "HIPT"
+            celldetector.shared_model = None
+            celldetector.weight_cache = weight_cache_supported()
+            celldetector.device = "cpu"
+            celldetector.logger = MagicMock()
+            celldetector._get_model = lambda model_type: TinyModel()
+            with patch(
+                "cellvit.inference.inference.cache_cellvit_256",
+                return_value=self.checkpoint_path,
+            ):
+                celldetector._load_model()
+
+        self.assertFalse(inference_weights_path(self.checkpoint_path).exists())
+        self.assertTrue(
+            torch.equal(celldetector.model.encoder.weight, self.model.encoder.weight)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Test Work Queue
+#
+# @ Fabian Hörst, fabian.hoerst@uk-essen.de
+# Institute for Artifical Intelligence in Medicine,
+# University Medicine Essen
+
+import multiprocessing
+import shutil
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from cellvit.utils.work_queue import WorkQueue
+
+
+def _pull_slides(queue_path: Path, result_path: Path) -> None:
+    """Worker process: pull slides until the queue is empty and record them"""
+    queue = WorkQueue(queue_path, lease_timeout=60)
+    queue.start_heartbeat(interval=0.01)
+    processed = []
+    while (job := queue.lease()) is not None:
+        time.sleep(0.01)
+        processed.append(job[0].name)
+        queue.complete(job[0])
+    queue.close()
+    result_path.write_text("\n".join(processed))
+
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.slides = []
+        for idx in range(12):
+            slide = self.tmp_dir / f"slide_{idx:02d}.svs"
+            slide.write_bytes(b"0" * (idx * 100 + 1))
+            self.slides.append(slide)
+        self.queue_path = self.tmp_dir / "work_queue.sqlite"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_largest_first(self):
+        """Test that slides are leased largest first and added only once."""
+        queue = WorkQueue(self.queue_path)
+        self.assertEqual(queue.add([(s, 0.25, None) for s in self.slides]), 12)
+        self.assertEqual(queue.add([(s, 0.25, None) for s in self.slides]), 0)
+        leased = []
+        while (job := queue.lease()) is not None:
+            leased.append(job)
+            queue.complete(job[0])
+        self.assertEqual(
+            [job[0].name for job in leased], [s.name for s in self.slides[::-1]]
+        )
+        self.assertEqual(leased[0][1:], (0.25, None))
+        self.assertEqual(queue.progress()["finished"], 12)
+        queue.close()
+
+    def test_unreadable_slides(self):
+        """Test that missing slides are skipped without failing the whole add."""
+        queue = WorkQueue(self.queue_path)
+        logger = MagicMock()
+        jobs = [(s, None, None) for s in self.slides[:3]]
+        jobs.insert(1, (self.tmp_dir / "missing.svs", None, None))
+        self.assertEqual(queue.add(jobs, logger=logger), 3)
+        self.assertEqual(logger.error.call_count, 1)
+        self.assertEqual(queue.progress()["pending"], 3)
+        queue.close()
+
+    def test_release_and_expiry(self):
+        """Test that failed and expired leases are handed out again until max_attempts."""
+        queue = WorkQueue(self.queue_path, lease_timeout=0.2, max_attempts=2)
+        other = WorkQueue(self.queue_path, lease_timeout=0.2, max_attempts=2)
+        queue.add([(self.slides[0], None, None), (self.slides[1], None, None)])
+
+        slide = queue.lease()[0]
+        self.assertEqual(slide.name, self.slides[1].name)
+        queue.release(slide, "OSError('disk full')")
+        self.assertEqual(other.lease()[0], slide)
+        queue.release(slide, "not the owner")  # no effect
+        self.assertEqual(other.progress()["leased"], 1)
+
+        # lease of the second process expires, slide has reached max_attempts
+        time.sleep(0.3)
+        self.assertEqual(queue.lease()[0].name, self.slides[0].name)
+        self.assertEqual(queue.progress()["failed"], 1)
+
+        # heartbeat keeps the lease alive
+        queue.start_heartbeat(interval=0.05)
+        time.sleep(0.3)
+        self.assertIsNone(other.lease())
+        queue.release(self.slides[0], "skipped", retry=False)
+        self.assertEqual(
+            queue.progress(), {"pending": 0, "leased": 0, "finished": 0, "failed": 2}
+        )
+        queue.close()
+        other.close()
+
+    def test_multiple_processes(self):
+        """Test that each slide is processed exactly once by multiple processes."""
+        queue = WorkQueue(self.queue_path)
+        queue.add([(s, None, None) for s in self.slides])
+        queue.close()
+
+        context = multiprocessing.get_context("spawn")
+        result_paths = [self.tmp_dir / f"worker_{idx}.txt" for idx in range(3)]
+        workers = [
+            context.Process(target=_pull_slides, args=(self.queue_path, path))
+            for path in result_paths
+        ]
+        [worker.start() for worker in workers]
+        [worker.join(timeout=120) for worker in workers]
+        self.assertTrue(all(worker.exitcode == 0 for worker in workers))
+
+        processed = []
+        for path in result_paths:
+            processed.extend(filter(None, path.read_text().split("\n")))
+        self.assertEqual(sorted(processed), sorted(s.name for s in self.slides))
+        queue = WorkQueue(self.queue_path)
+        self.assertEqual(queue.progress()["finished"], 12)
+        queue.close()
+
+
+if __name__ == "__main__":
+    unittest.main()